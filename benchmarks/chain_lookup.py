@@ -0,0 +1,107 @@
+"""
+Benchmark of the block chain lookups of `PersistentBackend`.
+
+Grows a chain to 1M blocks and measures the latency of `get_by_public_key_and_sequence_number`, `get_by_hash` and
+`get_range` at every size, to show that the lookups stay flat as the chain grows.
+
+Usage: python -m benchmarks.chain_lookup [--blocks 1000000] [--lookups 1000]
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+from hashlib import sha256
+
+from market.database.backends import PersistentBackend
+
+# Amount of public keys taking part in the chain.
+KEYS = 1000
+# Blocks inserted per transaction while growing the chain.
+INSERT_BATCH = 10000
+
+
+def key(index):
+    return sha256('key%d' % index).hexdigest()
+
+
+def block_hash(index):
+    return sha256('block%d' % index).hexdigest()
+
+
+def grow_chain(backend, sequence_numbers, start, end):
+    """
+    Insert blocks `start` to `end` directly, `add_block` commits every block which makes growing a large chain slow.
+    :return: The (public key, sequence number, hash) of the inserted blocks.
+    """
+    inserted = []
+    for batch_start in xrange(start, end, INSERT_BATCH):
+        rows = []
+        for index in xrange(batch_start, min(end, batch_start + INSERT_BATCH)):
+            benefactor, beneficiary = random.sample(xrange(KEYS), 2)
+            sequence_numbers[benefactor] += 1
+            sequence_numbers[beneficiary] += 1
+            rows.append((buffer(key(benefactor)), buffer(key(beneficiary)), buffer('agreement'), buffer('agreement'),
+                         sequence_numbers[benefactor], sequence_numbers[beneficiary], buffer(''), buffer(''),
+                         buffer('signature'), buffer('signature'), index, buffer(block_hash(index)),
+                         buffer(block_hash(index - 1)), index))
+            inserted.append((key(beneficiary), sequence_numbers[beneficiary], block_hash(index)))
+
+        backend.executemany(
+            u"INSERT INTO block_chain (benefactor, beneficiary, "
+            u"agreement_benefactor, agreement_beneficiary, sequence_number_benefactor, sequence_number_beneficiary, "
+            u"previous_hash_benefactor, previous_hash_beneficiary, signature_benefactor, signature_beneficiary, "
+            u"insert_time, hash_block, previous_hash, sequence_number) "
+            u"VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+            rows)
+        backend.commit()
+    return inserted
+
+
+def measure(function, arguments):
+    """
+    :return: The mean latency of `function` over all `arguments` in microseconds.
+    """
+    start = time.time()
+    for argument in arguments:
+        function(*argument)
+    return (time.time() - start) / len(arguments) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark block chain lookups")
+    parser.add_argument('--blocks', type=int, default=1000000, help='Size of the chain at the end of the benchmark')
+    parser.add_argument('--lookups', type=int, default=1000, help='Lookups measured at every chain size')
+    args = parser.parse_args()
+
+    working_directory = tempfile.mkdtemp()
+    backend = PersistentBackend(working_directory)
+    try:
+        sequence_numbers = [0] * KEYS
+        blocks = []
+        size = 0
+        target = 1000
+
+        print "%10s %14s %14s %14s" % ("blocks", "by seq (us)", "by hash (us)", "range (us)")
+        while size < args.blocks:
+            target = min(target, args.blocks)
+            blocks.extend(grow_chain(backend, sequence_numbers, size, target))
+            size = target
+
+            sample = random.sample(blocks, min(args.lookups, len(blocks)))
+            by_sequence_number = measure(backend.get_by_public_key_and_sequence_number,
+                                         [(public_key, sequence_number) for public_key, sequence_number, _ in sample])
+            by_hash = measure(backend.get_by_hash, [(hash,) for _, _, hash in sample])
+            by_range = measure(backend.get_range, [(public_key, sequence_number, sequence_number + 10)
+                                                   for public_key, sequence_number, _ in sample])
+
+            print "%10d %14.1f %14.1f %14.1f" % (size, by_sequence_number, by_hash, by_range)
+            target *= 10
+    finally:
+        backend.close()
+        shutil.rmtree(working_directory)
+
+
+if __name__ == '__main__':
+    main()
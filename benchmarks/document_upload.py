@@ -0,0 +1,92 @@
+"""
+Benchmark of the document uploads of a loan request to several banks.
+
+Every simulated bank runs a local `tftp_server.Server` on a port of its own. The same documents are uploaded to all
+banks with `TransferQueue.upload_list`, one file after the other, and with `TransferQueue.upload_all_concurrent`. The
+benchmark reports the seconds every mode takes.
+
+Usage: python -m benchmarks.document_upload [--banks 4] [--documents 3] [--document-size 262144]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import tftpy
+
+from tftp_client import TransferQueue, MAX_TRANSFERS, MAX_TRANSFERS_PER_HOST
+from tftp_server import Server
+
+FIRST_PORT = 50100
+
+
+def upload_sequential(jobs):
+    queue = TransferQueue()
+    for job in jobs:
+        queue.add(*job)
+    queue.upload_all()
+    return queue.failed
+
+
+def upload_concurrent(jobs, max_transfers, max_transfers_per_host):
+    """
+    Run the concurrent uploads without a reactor, firing the Deferreds on the transfer threads.
+    """
+    queue = TransferQueue(max_transfers, max_transfers_per_host, call_in_reactor=lambda f, *args: f(*args))
+    for job in jobs:
+        queue.add(*job)
+
+    done = threading.Event()
+    queue.upload_all_concurrent().addCallback(lambda _: done.set())
+    done.wait()
+    return queue.failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark sequential and concurrent document uploads")
+    parser.add_argument('--banks', type=int, default=4, help='Amount of simulated banks')
+    parser.add_argument('--documents', type=int, default=3, help='Amount of documents per loan request')
+    parser.add_argument('--document-size', type=int, default=256 * 1024, help='Size of a document in bytes')
+    parser.add_argument('--max-transfers', type=int, default=MAX_TRANSFERS)
+    parser.add_argument('--max-transfers-per-host', type=int, default=MAX_TRANSFERS_PER_HOST)
+    args = parser.parse_args()
+
+    tftpy.setLogLevel('ERROR')
+    working_directory = tempfile.mkdtemp()
+    servers = []
+    try:
+        documents_directory = os.path.join(working_directory, 'documents')
+        os.makedirs(documents_directory)
+        for document in xrange(args.documents):
+            with open(os.path.join(documents_directory, 'document%d.pdf' % document), 'wb') as document_file:
+                document_file.write(os.urandom(args.document_size))
+
+        for bank in xrange(args.banks):
+            root = os.path.join(working_directory, 'bank%d' % bank)
+            os.makedirs(root)
+            server = Server(root, FIRST_PORT + bank)
+            server.start()
+            servers.append(server)
+        time.sleep(1)
+
+        runs = [
+            ('sequential', upload_sequential, ()),
+            ('concurrent', upload_concurrent, (args.max_transfers, args.max_transfers_per_host)),
+        ]
+
+        print "%12s %10s %10s" % ("mode", "seconds", "failed")
+        for name, upload, extra_args in runs:
+            jobs = [('127.0.0.1', FIRST_PORT + bank, documents_directory, '%s-' % name) for bank in xrange(args.banks)]
+            start = time.time()
+            failed = upload(jobs, *extra_args)
+            print "%12s %10.2f %10d" % (name, time.time() - start, len(failed))
+    finally:
+        for server in servers:
+            server.stop(now=True)
+        shutil.rmtree(working_directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+"""
+Benchmark of a mixed workload on `PersistentBackend` and `ShardedBackend`.
+
+Every writer thread has its own connection(s) and repeatedly runs one kind of write: large document blobs, updates of
+users and new campaigns. The benchmark reports the operations per second of every kind, and in total, for both
+backends. In a single file the writers contend for the one write lock, while the shards can be written in parallel.
+
+Usage: python -m benchmarks.sharded_backend [--seconds 10] [--document-size 262144]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from market.database.backends import PersistentBackend
+from market.database.sharded import ShardedBackend
+
+# The kinds of writes, each run by its own thread.
+WORKLOADS = ['document', 'user', 'campaign']
+
+
+def run_workload(create_backend, kind, document_size, seconds, results):
+    """
+    Write values of one kind for `seconds`, retrying when the database is locked. The backend is created on the thread
+    itself, as an SQLite connection can only be used by the thread that opened it.
+    """
+    backend = create_backend()
+    count = 0
+    payload = 'x' * (document_size if kind == 'document' else 256)
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        try:
+            if kind == 'user':
+                # Users are updated over and over again
+                value_id = 'user%d' % (count % 100)
+                if backend.exists(kind, value_id):
+                    backend.put(kind, value_id, payload + str(count))
+                else:
+                    backend.post(kind, value_id, payload)
+            else:
+                backend.post(kind, '%s%d' % (kind, count), payload)
+            count += 1
+        except Exception as exception:
+            if 'locked' not in str(exception):
+                raise
+    backend.close()
+    results[kind] = count
+
+
+def measure(create_backend, document_size, seconds):
+    """
+    :return: Dictionary of the operations per second of every kind of write
+    """
+    results = {}
+    threads = [threading.Thread(target=run_workload, args=(create_backend, kind, document_size, seconds, results))
+               for kind in WORKLOADS]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return dict((kind, count / float(seconds)) for kind, count in results.iteritems())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark a mixed workload on a single and a sharded database")
+    parser.add_argument('--seconds', type=int, default=10, help='Duration of every run')
+    parser.add_argument('--document-size', type=int, default=256 * 1024, help='Size of a document in bytes')
+    args = parser.parse_args()
+
+    working_directory = tempfile.mkdtemp()
+    try:
+        single_directory = os.path.join(working_directory, 'single')
+        os.makedirs(single_directory)
+        # Create the schema and the shards up front, so the writer threads don't race to create them
+        PersistentBackend(single_directory).close()
+        sharded = ShardedBackend(os.path.join(working_directory, 'sharded'))
+        for kind in WORKLOADS:
+            sharded.post(kind, 'schema-' + kind, '')
+        sharded.close()
+
+        runs = [
+            ('single', lambda: PersistentBackend(single_directory)),
+            ('sharded', lambda: ShardedBackend(os.path.join(working_directory, 'sharded'))),
+        ]
+
+        print "%10s %12s %12s %12s %12s" % ("backend", "document/s", "user/s", "campaign/s", "total/s")
+        for name, create_backend in runs:
+            result = measure(create_backend, args.document_size, args.seconds)
+            print "%10s %12.1f %12.1f %12.1f %12.1f" % (name, result['document'], result['user'], result['campaign'],
+                                                        sum(result.values()))
+    finally:
+        shutil.rmtree(working_directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""
+Loopback throughput of a document upload for several TFTP block sizes.
+
+A single local `tftp_server.Server` receives the same document once per block size, uploaded by a `tftp_client.Client`
+negotiating that block size. Every block is acknowledged before the next one is sent, so the amount of round trips,
+and thereby the upload time over a real network, drops with the block size.
+
+Usage: python -m benchmarks.tftp_blksize [--document-size 5242880] [--blksize 512 1428 8192]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import tftpy
+
+from tftp_client import Client
+from tftp_server import Server
+
+PORT = 50200
+BLOCK_SIZES = [512, 1428, 4096, 8192, 16384, 65464]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark TFTP uploads over loopback for several block sizes")
+    parser.add_argument('--document-size', type=int, default=5 * 1024 * 1024, help='Size of the document in bytes')
+    parser.add_argument('--blksize', type=int, nargs='+', default=BLOCK_SIZES, help='Block sizes to measure')
+    args = parser.parse_args()
+
+    tftpy.setLogLevel('ERROR')
+    working_directory = tempfile.mkdtemp()
+    server = None
+    try:
+        document_path = os.path.join(working_directory, 'document.pdf')
+        with open(document_path, 'wb') as document_file:
+            document_file.write(os.urandom(args.document_size))
+
+        root = os.path.join(working_directory, 'bank')
+        os.makedirs(root)
+        server = Server(root, PORT)
+        server.start()
+        time.sleep(1)
+
+        print "%8s %8s %10s %10s" % ("blksize", "blocks", "seconds", "MB/s")
+        for blksize in args.blksize:
+            client = Client('127.0.0.1', PORT, blksize)
+            start = time.time()
+            client.upload(document_path, 'document-%d.pdf' % blksize)
+            duration = time.time() - start
+            print "%8d %8d %10.2f %10.2f" % (blksize, args.document_size / blksize + 1, duration,
+                                             args.document_size / duration / 1024 / 1024)
+    finally:
+        if server:
+            server.stop(now=True)
+        shutil.rmtree(working_directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+import argparse
+import os
+
+from market.database.backends import PersistentBackend
+from market.database.blocklog import BlockLog
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the block_chain table of a market database to a block log.")
+
+    parser.add_argument("--working-directory", help="Directory holding the database", type=str, default=os.getcwd())
+    parser.add_argument("--database", help="Name of the database file", type=str, default=PersistentBackend.DATABASE_PATH)
+    parser.add_argument("--output", help="Directory of the block log", type=str, default="blocklog")
+
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.working_directory, args.database)):
+        raise SystemExit("No database found at %s" % os.path.join(args.working_directory, args.database))
+
+    backend = PersistentBackend(args.working_directory, unicode(args.database))
+    block_log = BlockLog(os.path.join(args.working_directory, args.output))
+    try:
+        if block_log.get_latest_hash():
+            raise SystemExit("The block log at %s is not empty" % args.output)
+
+        converted = 0
+        for _, row in backend.iter_blocks():
+            block_log.append_row(row)
+            converted += 1
+    finally:
+        block_log.close()
+        backend.close()
+
+    print "Converted %d blocks." % converted
@@ -3,6 +3,8 @@ import os
 import sys
 
 import tftp_server
+from market.api.api import TFTP_TRANSPORT, DISPERSY_TRANSPORT
+from market.database.backends import DURABILITY_PROFILES, DEFAULT_DURABILITY
 from market.market_app import MarketApplication, MarketApplicationING, MarketApplicationRABO, MarketApplicationMONEYOU, \
     MarketApplicationABN
 from scenarios.apps import MarketAppSceneBank, MarketAppSceneBankING, MarketAppSceneBankRABO, MarketAppSceneBankMONEYOU, \
@@ -14,6 +16,12 @@ if __name__ == "__main__":
     parser.add_argument("--headless", help="Run the market in headless mode", action="store_true")
     parser.add_argument("--bank", help="Run the market as a bank.", type=str, choices=['abn', 'ing', 'rabo', 'moneyou'],)
     parser.add_argument("--scenario", help="Select a scenario to enable", type=str, choices=['bank', 'borrower', 'investor'],)
+    parser.add_argument("--durability", help="Durability profile of the database", type=str,
+                        choices=sorted(DURABILITY_PROFILES), default=DEFAULT_DURABILITY)
+    parser.add_argument("--document-transport", help="Transport to send and receive the documents with", type=str,
+                        choices=[TFTP_TRANSPORT, DISPERSY_TRANSPORT], default=TFTP_TRANSPORT)
+    parser.add_argument("--chain-store", help="Keep the block chain in a block log in this directory instead of the "
+                                              "database", type=str)
 
     args = parser.parse_args()
     start_tftp_server = True
@@ -50,11 +58,15 @@ if __name__ == "__main__":
     else:
         raise SystemExit("Unknown bank")
 
+    app.durability = args.durability
+    app.document_transport = args.document_transport
+    app.chain_store = args.chain_store
 
-    if start_tftp_server:
+    if start_tftp_server and args.document_transport == TFTP_TRANSPORT:
         tftp_server = tftp_server.Server()
         tftp_server.set_logging(os.getcwd()+'/logging/', 'INFO')
         tftp_server.start()
+        app.tftp_server = tftp_server
         
     from twisted.application import reactors
     reactors.installReactor('qt5')
@@ -1,16 +1,22 @@
 """
 Implementation of the Mortgage Market API
 """
+import copy
 import os
 import time
 from datetime import timedelta, datetime
 from enum import Enum
+from functools import wraps
 
 import tftp_client
+from tftp_manifest import Manifest
+from twisted.internet.defer import DeferredList, gatherResults, maybeDeferred, succeed
 from dispersy.crypto import ECCrypto
 from market.api import APIMessage
 from market.api.crypto import get_public_key
 from market.community.queue import OutgoingMessageQueue, IncomingMessageQueue
+from market.database.backends import BlockChain
+from market.database.blobstore import BlobStore
 from market.database.database import Database
 from market.models.document import Document
 from market.models.house import House
@@ -32,6 +38,40 @@ class STATUS(Enum):
 
 
 CAMPAIGN_LENGTH_DAYS = 30
+# Directory of the blob store holding the document data, if none is given to the API.
+BLOB_DIRECTORY = os.path.join('sqlite', 'blobs')
+# Transports the documents of a loan request can be sent to the banks with: TFTP uploads to the TFTP server of the
+# bank, or chunked transfers over the community.
+TFTP_TRANSPORT = 'tftp'
+DISPERSY_TRANSPORT = 'dispersy'
+# Names of the tasks creating a loan request runs in the background.
+SEND_DOCUMENTS_TASK = 'send_loan_request_documents'
+SIGN_LOAN_REQUEST_TASK = 'sign_loan_request'
+FAN_OUT_LOAN_REQUEST_TASK = 'fan_out_loan_request'
+
+
+def read_transaction(loader):
+    """
+    Run an API loader within a read transaction, so all of its queries see the same snapshot of the database.
+    """
+    @wraps(loader)
+    def wrapper(self, *args, **kwargs):
+        with self.db.read_transaction():
+            return loader(self, *args, **kwargs)
+
+    return wrapper
+
+
+def write_transaction(action):
+    """
+    Run an API action within a transaction, so its writes are either all stored or, if it raises, none of them.
+    """
+    @wraps(action)
+    def wrapper(self, *args, **kwargs):
+        with self.db.transaction():
+            return action(self, *args, **kwargs)
+
+    return wrapper
 
 
 class MarketAPI(object):
@@ -41,9 +81,14 @@ class MarketAPI(object):
     The constructor requires one variable, the `Database` used for storage.
     """
 
-    def __init__(self, database):
+    def __init__(self, database, blob_store=None, block_chain=None):
         assert isinstance(database, Database)
+        assert blob_store is None or isinstance(blob_store, BlobStore)
+        assert block_chain is None or isinstance(block_chain, BlockChain)
         self._database = database
+        if blob_store is not None:
+            database.blob_store = blob_store
+        self._block_chain = block_chain
         self._user_key = None
         self.crypto = ECCrypto()
         self.community = None
@@ -51,6 +96,26 @@ class MarketAPI(object):
         self.outgoing_queue = OutgoingMessageQueue(self)
         self.incoming_queue = IncomingMessageQueue(self)
         self.failed_documents = []
+        # Deferred of the uploads of the documents of the last loan request, firing with the failed uploads
+        self.document_uploads = None
+        # Transport to send the documents with, `TFTP_TRANSPORT` or `DISPERSY_TRANSPORT`
+        self.document_transport = TFTP_TRANSPORT
+        # Bank id -> `TransferMetrics` of the documents uploaded to the bank over TFTP, with the compression ratio and
+        # transfer time
+        self.document_metrics = {}
+        # `AsyncMarketDatabase` to run the heavy reads on, or None to run them on the calling thread
+        self.async_db = None
+        # `DocumentIngestion` to store the documents of a profile with, or None to store them on the calling thread
+        self.ingestion = None
+        # Document id -> Deferred of a pending document, firing with the stored document, or None if it failed
+        self.pending_documents = {}
+        # Callables called with a pending document, the bytes stored and its size while it is stored, with None as the
+        # bytes stored if it couldn't be stored
+        self.document_listeners = []
+        # `TaskRunner` to run the side effects of actions with, or None to run them right away
+        self.task_runner = None
+        # The `Task` sending the documents of the last loan request, if run by the `task_runner`
+        self.document_task = None
 
     @property
     def db(self):
@@ -59,6 +124,45 @@ class MarketAPI(object):
         """
         return self._database
 
+    @property
+    def blob_store(self):
+        """
+        Returns the blob store holding the document data, opening the one in `BLOB_DIRECTORY` if none was given
+        """
+        if self._database.blob_store is None:
+            self._database.blob_store = BlobStore(BLOB_DIRECTORY)
+        return self._database.blob_store
+
+    @property
+    def block_chain(self):
+        """
+        Returns the `BlockChain` holding the blocks of this node, the backend of the database if none was given
+        """
+        return self._database.backend if self._block_chain is None else self._block_chain
+
+    def run_read(self, func, *args):
+        """
+        Run a read only function on a reader thread of `async_db`, or directly if there is no `async_db`.
+
+        :param func: Function called with a :any:`MarketDatabase` and `args`
+        :return: Deferred firing with the result of the function
+        """
+        if self.async_db is None:
+            return maybeDeferred(func, self.db, *args)
+        return self.async_db.run_read(func, *args)
+
+    def _run_loader(self, loader, *args):
+        """
+        Run an API loader through `run_read`, against the database of the reader thread.
+        """
+        def read(database):
+            database.blob_store = self._database.blob_store
+            api = copy.copy(self)
+            api._database = database
+            return loader(api, *args)
+
+        return self.run_read(read)
+
     def user_key(self):
         """
         Returns the user key the API communicates as.
@@ -161,32 +265,168 @@ class MarketAPI(object):
         try:
             role = Role(payload['role'])
             user.role_id = role.value
+            previous_profile_id = user.profile_id
 
             profile = None
             if role.name == 'INVESTOR':
                 profile = Profile(payload['first_name'], payload['last_name'], payload['email'], payload['iban'], payload['phonenumber'])
                 user.profile_id = self.db.post(Profile.type, profile)
             elif role.name == 'BORROWER':
-                documents = []
-                if payload['documents_list']:
-                    for document_name, document_path in payload['documents_list'].iteritems():
-                        document = Document.encode_document(document_name, document_path)
-                        self.db.post(Document.type, document)
-                        documents.append(document.id)
+                documents, pending = self._create_documents(payload['documents_list'] or {})
                 profile = BorrowersProfile(payload['first_name'], payload['last_name'], payload['email'], payload['iban'],
                                            payload['phonenumber'], payload['current_postalcode'],
                                            payload['current_housenumber'], payload['current_address'],
                                            documents)
                 user.profile_id = self.db.post(BorrowersProfile.type, profile)
+                for document, document_path in pending:
+                    self._ingest_document(document, document_path, user.profile_id)
             elif role.name == 'FINANCIAL_INSTITUTION':
                 self.db.put(User.type, user.id, user)
                 return True
 
             self.db.put(User.type, user.id, user)
+            self._remove_documents(previous_profile_id, user.profile_id)
             return profile
         except KeyError:
             return False
 
+    def _create_documents(self, documents_list):
+        """
+        Create the documents of a borrower's profile. Without an ingestion the files are stored right away, otherwise
+        the documents stay pending until their files are stored in the background.
+
+        :param documents_list: Dictionary from the names of the documents to the paths of their files
+        :return: Tuple of the ids of the documents and the (document, path) tuples of the pending ones
+        """
+        documents = []
+        pending = []
+        for document_name, document_path in documents_list.iteritems():
+            if self.ingestion is None:
+                document = Document.store_document(document_name, document_path, self.blob_store)
+            else:
+                # Stored in the background, the profile only refers to it for now
+                document = Document.pending_document(document_name, document_path)
+                pending.append((document, document_path))
+            self.db.post(Document.type, document)
+            documents.append(document.id)
+        return documents, pending
+
+    def _remove_documents(self, profile_id, new_profile_id):
+        """
+        Remove the documents of a replaced borrower's profile, releasing their data in the blob store.
+
+        :param profile_id: The id of the replaced profile, if any
+        :param new_profile_id: The id of the profile replacing it, the documents are kept if it is the same profile
+        """
+        if not profile_id or profile_id == new_profile_id:
+            return
+        profile = self.db.get(BorrowersProfile.type, profile_id)
+        if profile is None or not profile.document_list:
+            return
+
+        # The database releases the data of the documents it deletes
+        for document_id in profile.document_list:
+            document = self.db.get(Document.type, document_id)
+            if document:
+                self.db.delete(document)
+        del profile.document_list[:]
+        self.db.put(BorrowersProfile.type, profile.id, profile)
+
+    def _ingest_document(self, document, path, profile_id):
+        """
+        Store the file of a pending document in the background. Once stored, the document refers to its data. If it
+        can't be stored, the document is removed from the profile.
+
+        :param document: The pending :any:`Document`
+        :param path: The path of the file
+        :param profile_id: The id of the :any:`BorrowersProfile` the document belongs to
+        :return: Deferred firing with the stored document, or None if it couldn't be stored
+        """
+        def progress(stored, size):
+            for listener in self.document_listeners:
+                listener(document, stored, size)
+
+        def on_stored(result):
+            blob_hash, size = result
+            self.pending_documents.pop(document.id, None)
+            stored_document = self.db.get(Document.type, document.id)
+            if stored_document is None:
+                # Removed in the meantime
+                self.blob_store.release(blob_hash)
+                return None
+            stored_document.stored(blob_hash, size)
+            self.db.put(Document.type, stored_document.id, stored_document)
+            return stored_document
+
+        def on_failed(_):
+            self.pending_documents.pop(document.id, None)
+            self._drop_document(document, profile_id)
+            progress(None, document.size)
+            return None
+
+        deferred = self.pending_documents[document.id] = self.ingestion.ingest(path, progress)
+        return deferred.addCallbacks(on_stored, on_failed)
+
+    def _drop_document(self, document, profile_id):
+        """
+        Remove a document that couldn't be stored from the database and from its profile.
+        """
+        profile = self.db.get(BorrowersProfile.type, profile_id) if profile_id else None
+        if profile and document.id in profile.document_list:
+            profile.document_list.remove(document.id)
+            self.db.put(BorrowersProfile.type, profile.id, profile)
+        self.db.delete(document)
+
+    def upgrade_documents(self):
+        """
+        Move the data of the documents an older version stored inline in the database to the blob store.
+
+        :return: The amount of documents upgraded
+        """
+        upgraded = 0
+        for document in self.db.get_all(Document.type) or []:
+            if document.inline_data is not None:
+                document.store_inline_data(self.blob_store)
+                self.db.put(Document.type, document.id, document)
+                upgraded += 1
+        return upgraded
+
+    def resume_documents(self):
+        """
+        Store the documents a previous run left pending again, from the files they were created from. A pending
+        document without a file, or that no profile refers to, is removed instead.
+
+        :return: The Deferreds of the documents being stored
+        """
+        deferreds = []
+        profile_of = {}
+        for profile in self.db.get_all(BorrowersProfile.type) or []:
+            for document_id in profile.document_list:
+                profile_of[document_id] = profile.id
+
+        for document in self.db.get_all(Document.type) or []:
+            if not document.pending or document.id in self.pending_documents:
+                continue
+            profile_id = profile_of.get(document.id)
+            if document.source and profile_id:
+                deferreds.append(self._ingest_document(document, document.source, profile_id))
+            else:
+                self._drop_document(document, profile_id)
+        return deferreds
+
+    def _load_documents(self, document_ids):
+        """
+        Load documents, waiting for the pending ones to be stored.
+
+        :param document_ids: The ids of the documents
+        :return: Deferred firing with the :any:`Document` objects that are stored
+        """
+        deferreds = [self.pending_documents[document_id] if document_id in self.pending_documents
+                     else succeed(self.db.get(Document.type, document_id)) for document_id in document_ids]
+        return gatherResults(deferreds).addCallback(
+            lambda documents: [document for document in documents if document and not document.pending])
+
+    @read_transaction
     def load_profile(self, user):
         """
         Load the given users profile.
@@ -212,6 +452,13 @@ class MarketAPI(object):
 
         return profile
 
+    def load_profile_async(self, user):
+        """
+        Deferred returning version of :any:`load_profile`, run off the reactor thread.
+        """
+        return self._run_loader(MarketAPI.load_profile, user)
+
+    @write_transaction
     def place_loan_offer(self, investor, payload):
         """
         Create a loan offer by an investor and save it to the database. This offer will always be created with status as 'PENDING' as the borrower involved is the only one
@@ -298,6 +545,7 @@ class MarketAPI(object):
         else:
             return False
 
+    @read_transaction
     def load_investments(self, user):
         """
         Get the pending and current investments list from the investor.
@@ -311,10 +559,7 @@ class MarketAPI(object):
 
         investments = []
 
-        for investment_id in user.investment_ids:
-            investment = self.db.get(Investment.type, investment_id)
-            assert isinstance(investment, Investment)
-
+        for investment in self.db.investments_for_investor(user.id):
             mortgage = self.db.get(Mortgage.type, investment.mortgage_id)
             house = self.db.get(House.type, mortgage.house_id)
             campaign = self.db.get(Campaign.type, mortgage.campaign_id)
@@ -328,6 +573,13 @@ class MarketAPI(object):
                 investments.append([investment, house, campaign, None])
         return investments
 
+    def load_investments_async(self, user):
+        """
+        Deferred returning version of :any:`load_investments`, run off the reactor thread.
+        """
+        return self._run_loader(MarketAPI.load_investments, user)
+
+    @read_transaction
     def load_open_market(self):
         """
         Returns a list of all mortgages that have an active campaign going on.
@@ -349,6 +601,12 @@ class MarketAPI(object):
 
         return mortgages
 
+    def load_open_market_async(self):
+        """
+        Deferred returning version of :any:`load_open_market`, run off the reactor thread.
+        """
+        return self._run_loader(MarketAPI.load_open_market)
+
     def get_role(self, user):
         """
         Get the role of the user from the database.
@@ -420,52 +678,20 @@ class MarketAPI(object):
                 user.loan_request_ids.append(self.db.post(LoanRequest.type, loan_request))
                 user.post_or_put(self.db)
 
-                # Send the documents to the banks
-                bank_ip_addresses = []
-                for bank_id in payload['banks']:
-                    if bank_id in self.user_candidate:
-                        # TODO bank_ip_addresses.append(self.user_candidate[bank_id].wan_address[0])
-                        bank_ip_addresses.append(self.user_candidate[bank_id].wan_address[0])
-                        # else:
-                        #     # TODO tell the user that the chosen bank is not online
-                        #     raise
-
-                profile = self.load_profile(user)
-                if profile:
-                    # if profile.document_list:
-                    for document_id in profile.document_list:
-                        document = self.db.get(Document.type, document_id)
-                        document.decode_document(os.getcwd() + '/resources/documents/' + document.name + '.pdf')
-                    tq = tftp_client.TransferQueue()
-                    for ip_address in bank_ip_addresses:
-                        # Add to queue
-                        tq.add(ip_address, 50000, os.getcwd()+'/resources/documents', str(loan_request.id)+'/')
-                    tq.upload_all()
-                    self.failed_documents = tq.failed
-
-                # The loan request won't be changed anymore. Sign it.
-                loan_request.sign(self)
-
-                # Add the loan request to the banks' pending loan request list
-                banks = []
-                for bank_id in payload['banks']:
-                    bank = self.db.get(User.type, bank_id)
-                    assert isinstance(bank, User)
-                    bank.loan_request_ids.append(loan_request.id)
-                    self.db.put(User.type, bank.id, bank)
-                    banks.append(bank)
-
-                # Add message to queue
-                profile = self.load_profile(user)
-                loan_request.sign(self)
-                house.sign(self)
-                profile.sign(self)
-                user.sign(self)
-
-                self.outgoing_queue.push((APIMessage.LOAN_REQUEST, [LoanRequest.type, House.type, BorrowersProfile.type, User.type],
-                                          {LoanRequest.type: loan_request, House.type: house, BorrowersProfile.type: profile,
-                                           User.type: user}, banks))
-                # TODO send a 'document' message
+                # Send the documents, sign the models and send them to the banks
+                arguments = [user.id, loan_request.id, payload['banks']]
+                if self.task_runner is None:
+                    self.document_uploads = self._send_loan_request_documents(*arguments)
+                    self._sign_loan_request(*arguments)
+                    self._fan_out_loan_request(*arguments)
+                    # Pick up the signatures
+                    loan_request.update(self.db)
+                    user.update(self.db)
+                else:
+                    self.document_uploads = None
+                    self.document_task = self.task_runner.submit(SEND_DOCUMENTS_TASK, arguments)
+                    signed = self.task_runner.submit(SIGN_LOAN_REQUEST_TASK, arguments)
+                    self.task_runner.submit(FAN_OUT_LOAN_REQUEST_TASK, arguments, after=signed)
 
                 return loan_request
 
@@ -474,6 +700,147 @@ class MarketAPI(object):
         else:
             return False
 
+    def use_task_runner(self, task_runner):
+        """
+        Run the side effects of actions as tasks of a task runner from now on.
+
+        :param task_runner: The :any:`TaskRunner`
+        """
+        task_runner.register(SEND_DOCUMENTS_TASK,
+                             lambda *arguments: self._send_loan_request_documents(*arguments).addCallback(
+                                 self._require_documents_sent))
+        task_runner.register(SIGN_LOAN_REQUEST_TASK, self._sign_loan_request)
+        task_runner.register(FAN_OUT_LOAN_REQUEST_TASK, self._fan_out_loan_request)
+        self.task_runner = task_runner
+
+    def _send_loan_request_documents(self, user_id, loan_request_id, bank_ids):
+        """
+        Send the documents of the borrower of a loan request to the banks, once they are stored.
+
+        :return: Deferred firing with the failed uploads
+        """
+        profile = self.load_profile(self.db.get(User.type, user_id))
+        if not profile:
+            return succeed([])
+
+        loan_request = self.db.get(LoanRequest.type, loan_request_id)
+        self.failed_documents = []
+        uploads = self._load_documents(profile.document_list)
+        uploads.addCallback(lambda documents: self._send_documents(loan_request, documents, bank_ids))
+        return uploads.addCallback(self._on_documents_uploaded)
+
+    @staticmethod
+    def _require_documents_sent(failed_documents):
+        """
+        Fail a task sending documents if some of them couldn't be sent, so it is run again.
+        """
+        if failed_documents:
+            raise RuntimeError("%d documents could not be sent" % len(failed_documents))
+
+    def _sign_loan_request(self, user_id, loan_request_id, bank_ids):
+        """
+        Sign a new loan request and the models sent along with it. The loan request won't be changed anymore.
+        """
+        user = self.db.get(User.type, user_id)
+        loan_request = self.db.get(LoanRequest.type, loan_request_id)
+        loan_request.sign(self)
+        self.db.get(House.type, loan_request.house_id).sign(self)
+        self.load_profile(user).sign(self)
+        user.sign(self)
+
+    def _fan_out_loan_request(self, user_id, loan_request_id, bank_ids):
+        """
+        Add a signed loan request to the inboxes of the banks, and send it to them.
+        """
+        user = self.db.get(User.type, user_id)
+        loan_request = self.db.get(LoanRequest.type, loan_request_id)
+        house = self.db.get(House.type, loan_request.house_id)
+        profile = self.load_profile(user)
+
+        banks = []
+        for bank_id in bank_ids:
+            bank = self.db.get(User.type, bank_id)
+            assert isinstance(bank, User)
+            self.update_inbox(bank.id, loan_request)
+            banks.append(bank)
+
+        self.outgoing_queue.push((APIMessage.LOAN_REQUEST, [LoanRequest.type, House.type, BorrowersProfile.type, User.type],
+                                  {LoanRequest.type: loan_request, House.type: house, BorrowersProfile.type: profile,
+                                   User.type: user}, banks))
+        # TODO send a 'document' message
+
+    def _send_documents(self, loan_request, documents, bank_ids):
+        """
+        Send the documents of a loan request to the banks that are online, in the background, with the
+        `document_transport` of this node. The documents of the banks that are offline count as failed uploads.
+
+        :param loan_request: The loan request the documents belong to
+        :param documents: The :any:`Document` objects to send
+        :param bank_ids: The ids of the banks to send the documents to
+        :return: Deferred firing with the failed uploads
+        """
+        # The (bank id, document name) of the documents of the banks that can't be reached
+        unreachable = [(bank_id, document.name) for bank_id in bank_ids if bank_id not in self.user_candidate
+                       for document in documents]
+
+        reachable = [bank_id for bank_id in bank_ids if bank_id in self.user_candidate]
+        if self.document_transport == DISPERSY_TRANSPORT and self.community:
+            sent = self._send_documents_dispersy(loan_request, documents, reachable)
+        else:
+            sent = self._send_documents_tftp(loan_request, documents, reachable)
+        return sent.addCallback(lambda failed: unreachable + failed)
+
+    def _send_documents_dispersy(self, loan_request, documents, bank_ids):
+        """
+        Send the documents of a loan request to the banks in chunked transfers over the community.
+
+        :return: Deferred firing with the failed uploads
+        """
+        deferreds = []
+        uploads = []
+        for bank_id in bank_ids:
+            for document in documents:
+                deferreds.append(self.community.document_transfers.send(bank_id, self.user_candidate[bank_id],
+                                                                        str(loan_request.id), document))
+                uploads.append((bank_id, document.name))
+        return DeferredList(deferreds).addCallback(
+            lambda results: [upload for upload, (success, sent) in zip(uploads, results) if not (success and sent)])
+
+    def _send_documents_tftp(self, loan_request, documents, bank_ids):
+        """
+        Upload the documents of a loan request to the TFTP servers of the banks, straight from the blob files,
+        skipping the documents a bank already has.
+
+        :return: Deferred firing with the failed uploads
+        """
+        manifest = Manifest()
+        for document in documents:
+            manifest.add(document.name + '.pdf', document.path(self.blob_store), document.blob_hash, document.size)
+        tq = tftp_client.TransferQueue()
+        hosts = {}
+        for bank_id in bank_ids:
+            host = (self.user_candidate[bank_id].wan_address[0], 50000)
+            hosts[host] = bank_id
+            tq.add(host[0], host[1], manifest, str(loan_request.id) + '/')
+
+        def uploaded(_):
+            for host, metrics in tq.metrics.items():
+                if host in hosts:
+                    self.document_metrics.setdefault(hosts[host], tftp_client.TransferMetrics()).merge(metrics)
+            return tq.failed
+        return tq.upload_all_concurrent().addCallback(uploaded)
+
+    def _on_documents_uploaded(self, failed_documents):
+        """
+        Callback of the document uploads of a loan request, storing the uploads that failed.
+
+        :param failed_documents: The failed uploads
+        :return: The failed uploads
+        """
+        self.failed_documents = failed_documents
+        return self.failed_documents
+
+    @read_transaction
     def load_borrowers_loans(self, user):
         """
         Get the borrower's current accepted loans
@@ -490,17 +857,22 @@ class MarketAPI(object):
                 loans.append([mortgage, None])
                 campaign = self.db.get(Campaign.type, user.campaign_ids[0])
 
-                for investment_id in user.investment_ids:
-                    investment = self.db.get(Investment.type, investment_id)
-                    if investment.status == STATUS.ACCEPTED and investment.mortgage_id == mortgage_id:
-                        investor = self.db.get(User.type, investment.investor_key)
-                        investors_profile = self.db.get(Profile.type, investor.profile_id)
-                        loans.append([investment, investors_profile])
+                for investment in self.db.investments_for_mortgage(mortgage_id, STATUS.ACCEPTED):
+                    investor = self.db.get(User.type, investment.investor_key)
+                    investors_profile = self.db.get(Profile.type, investor.profile_id)
+                    loans.append([investment, investors_profile])
 
                 return loans
 
         return loans
 
+    def load_borrowers_loans_async(self, user):
+        """
+        Deferred returning version of :any:`load_borrowers_loans`, run off the reactor thread.
+        """
+        return self._run_loader(MarketAPI.load_borrowers_loans, user)
+
+    @read_transaction
     def load_borrowers_offers(self, user):
         """
         Get all the borrower's offers(mortgage offers or loan offers) from the database.
@@ -518,10 +890,7 @@ class MarketAPI(object):
 
             # If the mortgage is already accepted, we get the loan offers from the investors
             if mortgage.status == STATUS.ACCEPTED and not campaign.completed:
-                for investment_id in user.investment_ids:
-                    investment = self.db.get(Investment.type, investment_id)
-                    if investment.status == STATUS.PENDING:
-                        offers.append(investment)
+                offers.extend(self.db.investments_for_mortgage(mortgage_id, STATUS.PENDING))
 
                 return offers
             # If the mortgage has not yet been accepted, get the mortgage offers from the banks
@@ -530,6 +899,13 @@ class MarketAPI(object):
 
         return offers
 
+    def load_borrowers_offers_async(self, user):
+        """
+        Deferred returning version of :any:`load_borrowers_offers`, run off the reactor thread.
+        """
+        return self._run_loader(MarketAPI.load_borrowers_offers, user)
+
+    @write_transaction
     def create_campaign(self, user, mortgage, loan_request):
         """
         Create a funding campaign with crowdfunding goal the difference between the price of the house and the amount requested from the bank.
@@ -579,6 +955,7 @@ class MarketAPI(object):
             return self.db.put(User.type, user.id, user)
         return False
 
+    @write_transaction
     def accept_mortgage_offer(self, user, payload):
         """
         Accept a mortgage offer for the given user.
@@ -623,6 +1000,7 @@ class MarketAPI(object):
         # Create the campaign
         return self.create_campaign(user, mortgage, loan_request)
 
+    @write_transaction
     def accept_investment_offer(self, user, payload):
         """
         Accept an investment offer for the given user.
@@ -704,11 +1082,10 @@ class MarketAPI(object):
         :param campaign: The campaign that needs to be checked
         """
         if campaign.completed:
-            for investment_id in user.investment_ids:
-                investment = self.db.get(Investment.type, investment_id)
-                if investment.status == STATUS.PENDING:
-                    self.reject_investment_offer(user, {'investment_id': investment_id})
+            for investment in self.db.investments_for_mortgage(campaign.mortgage_id, STATUS.PENDING):
+                self.reject_investment_offer(user, {'investment_id': investment.id})
 
+    @write_transaction
     def reject_mortgage_offer(self, user, payload):
         """
         Decline a mortgage offer for the given user.
@@ -749,6 +1126,7 @@ class MarketAPI(object):
 
         return self.db.put(LoanRequest.type, loan_request.id, loan_request) and self.db.put(User.type, user.id, user)
 
+    @write_transaction
     def reject_investment_offer(self, user, payload):
         """
         Decline an investment offer for the given user.
@@ -801,30 +1179,64 @@ class MarketAPI(object):
 
         return investment
 
-    def load_all_loan_requests(self, user):
+    def update_inbox(self, bank_id, loan_request):
+        """
+        Store the status of a loan request for a bank in the inbox of the bank, adding the loan request to the inbox if
+        it isn't there yet.
+
+        :param bank_id: The id of the bank
+        :param loan_request: The :any:`LoanRequest` sent to the bank
+        :type loan_request: :any:`LoanRequest`
         """
-        Display all pending loan requests for the specific bank
+        status = loan_request.status.get(bank_id, STATUS.PENDING)
+        self.db.backend.put_inbox_entry(bank_id, loan_request.id, status.value)
+
+    @read_transaction
+    def load_all_loan_requests(self, user, status=STATUS.PENDING, limit=None, offset=0):
+        """
+        Display a page of the pending loan requests for the specific bank, from its inbox
 
         :param user: The bank :any:`User`
         :type user: :any:`User`
-        :return: A list of lists containing the :any: 'LoanRequest's and the :any: 'House's
+        :param status: The status of the loan requests to display
+        :type status: :any:`STATUS`
+        :param limit: The maximum amount of loan requests to display, all loan requests if None
+        :param offset: The amount of loan requests to skip
+        :return: A list of lists containing the :any: 'LoanRequest's and the :any: 'House's, in the order they were
+        received
         :rtype: list
         """
         assert isinstance(user, User)
 
-        user = self._get_user(user)
+        loan_requests = []
+        for loan_request_id, _, _ in self.db.backend.get_inbox(user.id, status.value, limit, offset):
+            loan_request = self.db.get(LoanRequest.type, loan_request_id)
+            house = self.db.get(House.type, loan_request.house_id)
+            loan_requests.append([loan_request, house])
 
-        pending_loan_requests = []
+        return loan_requests
 
-        # Only show loan requests that are still pending
-        for pending_loan_request_id in user.loan_request_ids:
-            if self.db.get(LoanRequest.type, pending_loan_request_id).status[user.id] == STATUS.PENDING:
-                pending_loan_request = self.db.get(LoanRequest.type, pending_loan_request_id)
-                house = self.db.get(House.type, pending_loan_request.house_id)
-                pending_loan_requests.append([pending_loan_request, house])
+    def load_all_loan_requests_async(self, user, status=STATUS.PENDING, limit=None, offset=0):
+        """
+        Deferred returning version of :any:`load_all_loan_requests`, run off the reactor thread.
+        """
+        return self._run_loader(MarketAPI.load_all_loan_requests, user, status, limit, offset)
 
-        return pending_loan_requests
+    def count_loan_requests(self, user, status=STATUS.PENDING):
+        """
+        Count the loan requests in the inbox of the bank, to page through them with :any:`load_all_loan_requests`.
 
+        :param user: The bank :any:`User`
+        :type user: :any:`User`
+        :param status: The status of the loan requests to count
+        :type status: :any:`STATUS`
+        :rtype: int
+        """
+        assert isinstance(user, User)
+
+        return self.db.backend.count_inbox(user.id, status.value)
+
+    @read_transaction
     def load_single_loan_request(self, payload):
         """
         Display the selected pending loan request
@@ -842,6 +1254,13 @@ class MarketAPI(object):
 
         return [loan_request, borrower_profile, house]
 
+    def load_single_loan_request_async(self, payload):
+        """
+        Deferred returning version of :any:`load_single_loan_request`, run off the reactor thread.
+        """
+        return self._run_loader(MarketAPI.load_single_loan_request, payload)
+
+    @write_transaction
     def accept_loan_request(self, bank, payload):
         """
         Have the loan request passed by the payload be accepted by the bank calling the function.
@@ -880,6 +1299,7 @@ class MarketAPI(object):
         loan_request = self.db.get(LoanRequest.type, payload['request_id'])
         assert isinstance(loan_request, LoanRequest)
         loan_request.status[bank.id] = STATUS.ACCEPTED
+        self.update_inbox(bank.id, loan_request)
 
         # Create a mortgage
         mortgage = Mortgage(loan_request.id, loan_request.house_id, bank.id, payload['amount'],
@@ -916,6 +1336,7 @@ class MarketAPI(object):
         else:
             return None
 
+    @write_transaction
     def reject_loan_request(self, user, payload):
         """
         Decline an investment offer for the given user.
@@ -948,8 +1369,8 @@ class MarketAPI(object):
         assert isinstance(borrower, User)
         loan_request_id = borrower.loan_request_ids[0]
 
-        # Remove the loan request from the bank's list
-        user.loan_request_ids.remove(loan_request_id)
+        # Keep the loan request in the bank's inbox as rejected
+        self.update_inbox(user.id, rejected_loan_request)
 
         # Check if the loan request has been rejected by all selected banks
         rejected = True
@@ -977,6 +1398,7 @@ class MarketAPI(object):
         else:
             return None
 
+    @read_transaction
     def load_bids(self, payload):
         """ Returns a list of all bids on the selected campaign.
 
@@ -999,17 +1421,14 @@ class MarketAPI(object):
         loan_request = self.db.get(LoanRequest.type, mortgage.request_id)
         borrower = self.db.get(User.type, loan_request.user_key)
 
-        bids = []
-        for investment_id in borrower.investment_ids:
-            investment = self.db.get(Investment.type, investment_id)
-            if investment:
-                bids.append(investment)
+        bids = self.db.investments_for_mortgage(mortgage.id)
 
         house = self.db.get(House.type, loan_request.house_id)
         campaign = self.db.get(Campaign.type, borrower.campaign_ids[0])
 
         return bids, house, campaign
 
+    @read_transaction
     def load_mortgages(self, user):
         """
             Display all pending and running mortgages for the bank
@@ -1042,6 +1461,7 @@ class MarketAPI(object):
 
         return mortgages
 
+    @read_transaction
     def load_borrowers_loan_status(self, user):
         """
         Get the borrower's campaign if it exists or loan request if it exists
@@ -0,0 +1,219 @@
+"""
+Running the side effects of user actions as tracked background tasks.
+
+An action of the user only stores its core models and submits the rest of its work, like signing models or sending
+documents, as tasks to a `TaskRunner`. Every task is kept in the task table of the backend, so its status can be shown
+and an unfinished task is run again after a restart. A task that fails is retried with an increasing delay, up to
+`MAX_ATTEMPTS` times. A task can wait for another task, and fails along with it. The finished tasks are deleted from
+the task table once a runner starts again.
+
+Tasks run on the reactor thread, as they use the database of the API. A task returning a Deferred is done once the
+Deferred fires, so the slow work of a task, like uploads, runs on the threads of the components doing it.
+"""
+import logging
+import pickle
+import uuid
+
+from twisted.internet.defer import maybeDeferred
+
+logger = logging.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# Amount of times a task is run before it is given up on.
+MAX_ATTEMPTS = 5
+# Delay in seconds before the first retry of a failed task, doubled after every further attempt.
+RETRY_DELAY = 10.0
+
+
+class Task(object):
+    """
+    A unit of background work, run by calling the function registered under its name with its arguments.
+    """
+
+    def __init__(self, task_id, name, arguments, status=PENDING, attempts=0, error=None, after=None):
+        self.id = task_id
+        self.name = name
+        self.arguments = arguments
+        self.status = status
+        self.attempts = attempts
+        self.error = error
+        self.after = after
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def __repr__(self):
+        return "<Task %s %s %s>" % (self.name, self.id, self.status)
+
+
+class TaskRunner(object):
+    """
+    Runs tasks in the background, keeping them in the task table of a backend.
+    """
+
+    def __init__(self, backend, max_attempts=MAX_ATTEMPTS, retry_delay=RETRY_DELAY, call_later=None):
+        """
+        :param backend: The backend holding the task table
+        :param max_attempts: The amount of times a task is run before it is given up on
+        :param retry_delay: The delay in seconds before the first retry of a failed task
+        :param call_later: Callable used to run a task after a delay, defaults to `reactor.callLater`
+        """
+        if call_later is None:
+            from twisted.internet import reactor
+            call_later = reactor.callLater
+
+        self.backend = backend
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.call_later = call_later
+        self.functions = {}
+        # Callables called with a task every time its status changes
+        self.listeners = []
+        self.running = False
+        # The unfinished tasks, and the tasks that finished since the runner started
+        self._tasks = {}
+
+    def register(self, name, function):
+        """
+        Register the function running the tasks with a name.
+        :param function: Callable called with the arguments of a task, returning a value or a Deferred. The task fails
+        if it raises or the Deferred fails.
+        """
+        self.functions[name] = function
+
+    def start(self):
+        """
+        Start running tasks, including the unfinished tasks stored before. A task that was running when the node
+        stopped is run again, a task waiting for a task that failed before fails. The finished tasks stored before
+        are deleted.
+        """
+        self.running = True
+        # The statuses of the tasks that finished before
+        finished = {}
+        for row in self.backend.get_tasks():
+            task_id, name, arguments, status, attempts, error, after = row
+            if status in (DONE, FAILED):
+                finished[str(task_id)] = status
+                continue
+            task = Task(str(task_id), str(name), pickle.loads(str(arguments).decode('base64')), PENDING, attempts,
+                        error, str(after) if after else None)
+            self._tasks[task.id] = task
+            self._save(task)
+
+        for task in self._tasks.values():
+            if task.after and task.after not in self._tasks and finished.get(task.after) != DONE:
+                self._fail(task, "Task %s failed" % task.after)
+        self._prune(finished)
+        for task in self._tasks.values():
+            self._schedule(task)
+
+    def _prune(self, finished):
+        """
+        Delete the finished tasks from the backend, except for the done tasks an unfinished task still waits for.
+        :param finished: The statuses of the finished tasks by their id
+        """
+        waited_for = set(task.after for task in self._tasks.values() if not task.finished)
+        for task_id in finished:
+            if task_id not in waited_for:
+                self.backend.delete_task(task_id)
+
+    def stop(self):
+        """
+        Stop starting tasks. The tasks that were not done are run again once a runner is started.
+        """
+        self.running = False
+
+    def submit(self, name, arguments, after=None):
+        """
+        Store a task and run it in the background.
+        :param name: The name the function running the task was registered with
+        :param arguments: A list of picklable arguments of the function
+        :param after: The task to wait for, if any
+        :return: The `Task`
+        """
+        assert name in self.functions, "No function registered for task %s" % name
+        task = Task(str(uuid.uuid1()), name, list(arguments), after=after.id if after else None)
+        self._tasks[task.id] = task
+        self._save(task)
+        self._schedule(task)
+        return task
+
+    def get(self, task_id):
+        """
+        :return: The `Task` with the id, or None if it finished before the runner started or doesn't exist
+        """
+        return self._tasks.get(task_id)
+
+    def tasks(self, statuses=None):
+        """
+        :param statuses: The statuses of the tasks to return, all tasks if None
+        :return: The tasks known to the runner
+        """
+        return [task for task in self._tasks.values() if statuses is None or task.status in statuses]
+
+    def _save(self, task):
+        self.backend.save_task(task.id, task.name, pickle.dumps(task.arguments).encode('base64'), task.status,
+                               task.attempts, task.error, task.after)
+        for listener in self.listeners:
+            listener(task)
+
+    def _schedule(self, task, delay=0):
+        """
+        Run a pending task after a delay, once the task it waits for is done.
+        """
+        if not self.running or task.status != PENDING:
+            return
+
+        previous = self._tasks.get(task.after) if task.after else None
+        if previous is not None and previous.status != DONE:
+            if previous.status == FAILED:
+                self._fail(task, "Task %s failed" % previous.id)
+            # Otherwise scheduled once the previous task is done
+            return
+        self.call_later(delay, self._run, task)
+
+    def _run(self, task):
+        if not self.running or task.status != PENDING:
+            return
+        if task.name not in self.functions:
+            self._fail(task, "No function registered for task %s" % task.name)
+            return
+
+        task.status = RUNNING
+        task.attempts += 1
+        self._save(task)
+        deferred = maybeDeferred(self.functions[task.name], *task.arguments)
+        deferred.addCallbacks(lambda _: self._done(task), lambda failure: self._failed(task, failure))
+
+    def _done(self, task):
+        task.status = DONE
+        task.error = None
+        self._save(task)
+        self._schedule_next(task)
+
+    def _failed(self, task, failure):
+        logger.warning("Attempt %d of %s failed: %s", task.attempts, task, failure.getErrorMessage())
+        if task.attempts >= self.max_attempts:
+            self._fail(task, failure.getErrorMessage())
+            return
+
+        task.status = PENDING
+        task.error = failure.getErrorMessage()
+        self._save(task)
+        self._schedule(task, self.retry_delay * 2 ** (task.attempts - 1))
+
+    def _fail(self, task, error):
+        task.status = FAILED
+        task.error = error
+        self._save(task)
+        self._schedule_next(task)
+
+    def _schedule_next(self, task):
+        for next_task in self._tasks.values():
+            if next_task.after == task.id:
+                self._schedule(next_task)
@@ -1,13 +1,19 @@
 import base64
 import logging
+import math
+import random
 import time
+from hashlib import sha1
+from threading import RLock
 
+from dispersy.bloomfilter import BloomFilter
 from dispersy.community import Community
 from dispersy.conversion import DefaultConversion
 from dispersy.destination import CommunityDestination, CandidateDestination
 from dispersy.distribution import DirectDistribution, FullSyncDistribution
 from dispersy.message import Message, DelayMessageByProof
 from dispersy.resolution import PublicResolution
+from twisted.internet.defer import maybeDeferred
 
 from conversion import MortgageMarketConversion
 from dispersy.authentication import MemberAuthentication, DoubleMemberAuthentication
@@ -19,11 +25,67 @@ from market.models.loans import LoanRequest, Mortgage, Campaign, Investment
 from market.models.profiles import BorrowersProfile, Profile
 from market.models.user import User
 from market.database.backends import DatabaseBlock, BlockChain
-from payload import DatabaseModelPayload, APIMessagePayload, SignedConfirmPayload
+from market.community.encoding import encode
+from market.community.signing import SigningPipeline
+from market.community.transfer import DocumentTransfers
+from payload import DatabaseModelPayload, APIMessagePayload, SignedConfirmPayload, ModelSyncRequestPayload, \
+    ModelBatchPayload, BlockRangeRequestPayload, BlockBatchPayload, DocumentOfferPayload, DocumentChunkPayload, \
+    DocumentAckPayload
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# Model types that are broadcast to the whole community, and thus kept in sync between nodes.
+PUBLIC_MODEL_TYPES = [Campaign.type, Mortgage.type, House.type, LoanRequest.type, Investment.type]
+
+# Seconds between two model sync requests.
+MODEL_SYNC_INTERVAL = 30.0
+# Size of the bloom filter in a model sync request, in bytes.
+MODEL_SYNC_BLOOM_SIZE = 1024
+# Error rate the bloom filter is sized for.
+MODEL_SYNC_ERROR_RATE = 0.01
+# Maximum amount of encoded model bytes sent in response to a single model sync request.
+MODEL_SYNC_MAX_BYTES = 64 * 1024
+# Maximum amount of encoded model bytes in a single model sync response message.
+MODEL_SYNC_BATCH_BYTES = 8 * 1024
+
+# Seconds between two rounds of requesting the missing halves of incomplete blocks.
+BLOCK_SYNC_INTERVAL = 60.0
+# Maximum amount of incomplete blocks requested per round.
+BLOCK_SYNC_MAX_INCOMPLETE = 100
+# Maximum amount of sequence numbers served for a single block range request.
+BLOCK_SYNC_MAX_RANGE = 100
+# Maximum amount of encoded block bytes in a single block range response message.
+BLOCK_SYNC_BATCH_BYTES = 8 * 1024
+
+
+def model_sync_key(model):
+    """
+    The key identifying a specific version of a model during model synchronization.
+
+    The version of a model is the time it was signed.
+    """
+    return "%s:%s:%d" % (model.type, model.id, model.time_signed)
+
+
+def model_sync_slice(model, slice_count):
+    """
+    Return the slice a model falls in when the models are split into `slice_count` slices.
+
+    The slice only depends on the type and id of the model, so all versions of a model fall in the same slice.
+    """
+    return int(sha1("%s:%s" % (model.type, model.id)).hexdigest()[:8], 16) % slice_count
+
+
+def get_public_models(database, types=PUBLIC_MODEL_TYPES):
+    """
+    Return all public models of the given types in a `MarketDatabase`.
+    """
+    models = []
+    for type_name in types:
+        models.extend(database.get_all(type_name) or [])
+    return models
+
 
 class MortgageMarketCommunity(Community):
     @classmethod
@@ -36,6 +98,23 @@ class MortgageMarketCommunity(Community):
         self._api = None
         self._user = None
 
+        # Bandwidth bounds of the model synchronization.
+        self.model_sync_bloom_size = MODEL_SYNC_BLOOM_SIZE
+        self.model_sync_error_rate = MODEL_SYNC_ERROR_RATE
+        self.model_sync_max_bytes = MODEL_SYNC_MAX_BYTES
+        self.model_sync_batch_bytes = MODEL_SYNC_BATCH_BYTES
+        self._model_sync_round = 0
+        # Bounds of the block range synchronization.
+        self.block_sync_max_range = BLOCK_SYNC_MAX_RANGE
+        self.block_sync_batch_bytes = BLOCK_SYNC_BATCH_BYTES
+        # Held while building a signed confirm on the chain head and persisting it, so two concurrent requests can't
+        # claim the same sequence number.
+        self._chain_lock = RLock()
+        # Signature requests for the agreements this node signs as benefactor.
+        self.signing_pipeline = SigningPipeline(self)
+        # Documents sent to and received from other nodes in chunks, when they don't use TFTP.
+        self.document_transfers = DocumentTransfers(self)
+
     def initialize(self):
         super(MortgageMarketCommunity, self).initialize()
         logger.info("Example community initialized")
@@ -81,6 +160,62 @@ class MortgageMarketCommunity(Community):
                     SignedConfirmPayload(),
                     self._generic_timeline_check,
                     self.received_signed_confirm_response),
+            Message(self, u"model_sync_request",
+                    MemberAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    ModelSyncRequestPayload(),
+                    self.check_message,
+                    self.on_model_sync_request),
+            Message(self, u"model_sync_response",
+                    MemberAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    ModelBatchPayload(),
+                    self.check_message,
+                    self.on_model_sync_response),
+            Message(self, u"block_range_request",
+                    MemberAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    BlockRangeRequestPayload(),
+                    self.check_message,
+                    self.on_block_range_request),
+            Message(self, u"block_range_response",
+                    MemberAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    BlockBatchPayload(),
+                    self.check_message,
+                    self.on_block_range_response),
+            Message(self, u"document_offer",
+                    MemberAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    DocumentOfferPayload(),
+                    self.check_message,
+                    self.on_document_offer),
+            Message(self, u"document_chunk",
+                    MemberAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    DocumentChunkPayload(),
+                    self.check_message,
+                    self.on_document_chunk),
+            Message(self, u"document_ack",
+                    MemberAuthentication(),
+                    PublicResolution(),
+                    DirectDistribution(),
+                    CandidateDestination(),
+                    DocumentAckPayload(),
+                    self.check_message,
+                    self.on_document_ack),
         ]
 
     def initiate_conversions(self):
@@ -173,11 +308,9 @@ class MortgageMarketCommunity(Community):
         house.post_or_put(self.api.db, check_time=True)
         profile.post_or_put(self.api.db, check_time=True)
 
-        # Save the loan request to the bank
+        # Save the loan request to the inbox of the bank
         if self.user.id in loan_request.banks:
-            self.user.update(self.api.db)
-            self.user.loan_request_ids.append(loan_request.id)
-            self.user.post_or_put(self.api.db)
+            self.api.update_inbox(self.user.id, loan_request)
 
         return True
 
@@ -395,20 +528,329 @@ class MortgageMarketCommunity(Community):
                     # before the model is saved.
                     self.api.user_candidate[obj.id] = message.candidate
 
+    ##############
+    ##### MODEL SYNC MESSAGES
+    ###############
+
+    def send_model_sync_request(self, candidate=None):
+        """
+        Ask a candidate for the public models this node is missing, or has an older version of.
+
+        The request covers one slice of the known models per round, so the bloom filter stays within
+        `model_sync_bloom_size` bytes regardless of the amount of models known.
+
+        :param candidate: The candidate to sync with. A random verified candidate if None.
+        :return: True if a request was sent, False if there was no candidate to send it to.
+        """
+        if candidate is None:
+            candidates = list(self.dispersy_yield_verified_candidates())
+            if not candidates:
+                return False
+            candidate = random.choice(candidates)
+
+        # The known models are read off the reactor thread
+        deferred = self.api.run_read(get_public_models, PUBLIC_MODEL_TYPES)
+        deferred.addCallback(self._send_model_sync_filter, candidate)
+        deferred.addErrback(lambda failure: logger.error("Model sync request failed: %s", failure.getErrorMessage()))
+        return True
+
+    def _send_model_sync_filter(self, models, candidate):
+        bits = self.model_sync_bloom_size * 8
+        capacity = int(bits * math.log(2) ** 2 / -math.log(self.model_sync_error_rate))
+        slice_count = max(1, int(math.ceil(len(models) / float(capacity))))
+        slice_index = self._model_sync_round % slice_count
+        self._model_sync_round += 1
+
+        # A new prefix every round ensures false positives differ between rounds.
+        bloom_filter = BloomFilter(bits, self.model_sync_error_rate, prefix=chr(random.randint(0, 255)))
+        for model in models:
+            if model_sync_slice(model, slice_count) == slice_index:
+                bloom_filter.add(model_sync_key(model))
+
+        meta = self.get_meta_message(u"model_sync_request")
+        message = meta.impl(authentication=(self.my_member,),
+                            distribution=(self.claim_global_time(),),
+                            destination=(candidate,),
+                            payload=(PUBLIC_MODEL_TYPES, slice_index, slice_count, bloom_filter))
+        self.dispersy.store_update_forward([message], False, False, True)
+
+    def send_model_sync_response(self, models, candidate):
+        meta = self.get_meta_message(u"model_sync_response")
+        message = meta.impl(authentication=(self.my_member,),
+                            distribution=(self.claim_global_time(),),
+                            destination=(candidate,),
+                            payload=(models,))
+        self.dispersy.store_update_forward([message], False, False, True)
+
+    def on_model_sync_request(self, messages):
+        """
+        Send the models in the requested slice that are not in the bloom filter of the requester.
+
+        At most `model_sync_max_bytes` of models are sent per request, in batches of `model_sync_batch_bytes`. A model
+        larger than `model_sync_max_bytes` is sent on its own, once it is the first model missing. The models are read
+        off the reactor thread.
+        """
+        for message in messages:
+            types = [type_name for type_name in message.payload.types if type_name in PUBLIC_MODEL_TYPES]
+            deferred = self.api.run_read(get_public_models, types)
+            deferred.addCallback(self._send_model_sync_batches, message)
+            deferred.addErrback(lambda failure: logger.error("Model sync request failed: %s",
+                                                             failure.getErrorMessage()))
+
+    def _send_model_sync_batches(self, models, message):
+        payload = message.payload
+
+        batch = []
+        batch_size = 0
+        total_size = 0
+        for model in models:
+            if model_sync_slice(model, payload.slice_count) != payload.slice_index:
+                continue
+            if model_sync_key(model) in payload.bloom_filter:
+                continue
+
+            size = len(model.encode())
+            if total_size + size > self.model_sync_max_bytes:
+                # Otherwise a model larger than the limit would never be synced
+                if not total_size:
+                    self.send_model_sync_response([model], message.candidate)
+                break
+
+            if batch and batch_size + size > self.model_sync_batch_bytes:
+                self.send_model_sync_response(batch, message.candidate)
+                batch = []
+                batch_size = 0
+
+            batch.append(model)
+            batch_size += size
+            total_size += size
+
+        if batch:
+            self.send_model_sync_response(batch, message.candidate)
+
+    def on_model_sync_response(self, messages):
+        for message in messages:
+            for model in message.payload.models:
+                if self._model_sync_allowed(model):
+                    model.post_or_put(self.api.db, check_time=True)
+                else:
+                    logger.warning("Dropping synced %s %s without a valid signature", model.type, model.id)
+
+    def _model_sync_allowed(self, model):
+        """
+        Whether a model received through model sync may be stored: a public model with a valid signature of a user
+        known to this node.
+        """
+        if model.type not in PUBLIC_MODEL_TYPES or not model._has_signature():
+            return False
+        if not isinstance(self.api.db.get(User.type, model.signer), User):
+            return False
+        return DatabaseModel.signature_valid(model)
+
+    ##############
+    ##### BLOCK RANGE MESSAGES
+    ###############
+
+    def send_block_range_request(self, public_key, from_sequence_number, to_sequence_number, candidate):
+        meta = self.get_meta_message(u"block_range_request")
+        message = meta.impl(authentication=(self.my_member,),
+                            distribution=(self.claim_global_time(),),
+                            destination=(candidate,),
+                            payload=(public_key, from_sequence_number, to_sequence_number))
+        self.dispersy.store_update_forward([message], False, False, True)
+
+    def send_block_range_response(self, blocks, candidate):
+        meta = self.get_meta_message(u"block_range_response")
+        message = meta.impl(authentication=(self.my_member,),
+                            distribution=(self.claim_global_time(),),
+                            destination=(candidate,),
+                            payload=(blocks,))
+        self.dispersy.store_update_forward([message], False, False, True)
+
+    def request_incomplete_blocks(self):
+        """
+        Request the completed versions of the blocks this node persisted as benefactor, but never received the
+        beneficiary's signature for, for example because the signature response timed out.
+
+        The blocks are requested from the beneficiary of their agreement, in ranges of consecutive sequence numbers.
+        :return: The amount of block range requests sent
+        """
+        if not isinstance(self.api.block_chain, BlockChain):
+            return 0
+
+        # Public key of the beneficiary -> sorted sequence numbers of the incomplete blocks
+        missing = {}
+        for block in self.api.block_chain.get_incomplete_blocks(self.user.id, BLOCK_SYNC_MAX_INCOMPLETE):
+            agreement = DatabaseModel.decode(block.agreement_benefactor)
+            beneficiary_key = self._get_beneficiary_key(agreement) if isinstance(agreement, DatabaseModel) else None
+            if beneficiary_key in self.api.user_candidate:
+                missing.setdefault(beneficiary_key, []).append(block.sequence_number_benefactor)
+
+        requests = 0
+        for beneficiary_key, sequence_numbers in missing.iteritems():
+            candidate = self.api.user_candidate[beneficiary_key]
+            start = end = sequence_numbers[0]
+            for sequence_number in sequence_numbers[1:] + [None]:
+                if sequence_number is not None and sequence_number == end + 1 and \
+                        sequence_number - start < self.block_sync_max_range:
+                    end = sequence_number
+                    continue
+                self.send_block_range_request(self.user.id, start, end, candidate)
+                requests += 1
+                start = end = sequence_number
+        return requests
+
+    def on_block_range_request(self, messages):
+        """
+        Send the requested blocks, at most `block_sync_max_range` sequence numbers per request, in batches of
+        `block_sync_batch_bytes`.
+        """
+        if not isinstance(self.api.block_chain, BlockChain):
+            return
+
+        for message in messages:
+            payload = message.payload
+            to_sequence_number = min(payload.to_sequence_number,
+                                     payload.from_sequence_number + self.block_sync_max_range - 1)
+            if self.api.block_chain is self.api.db.backend:
+                deferred = self.api.run_read(lambda database, *args: database.backend.get_range(*args),
+                                             payload.public_key, payload.from_sequence_number, to_sequence_number)
+            else:
+                deferred = maybeDeferred(self.api.block_chain.get_range, payload.public_key,
+                                         payload.from_sequence_number, to_sequence_number)
+            deferred.addCallback(self._send_block_range_batches, message)
+            deferred.addErrback(lambda failure: logger.error("Block range request failed: %s",
+                                                             failure.getErrorMessage()))
+
+    def _send_block_range_batches(self, blocks, message):
+        batch = []
+        batch_size = 0
+        for block in blocks:
+            row = block.to_row()
+            size = len(encode(row))
+            if batch and batch_size + size > self.block_sync_batch_bytes:
+                self.send_block_range_response(batch, message.candidate)
+                batch = []
+                batch_size = 0
+            batch.append(row)
+            batch_size += size
+
+        if batch:
+            self.send_block_range_response(batch, message.candidate)
+
+    def on_block_range_response(self, messages):
+        """
+        Complete the incomplete blocks of this node with the received blocks, see `_get_completing_block`.
+        """
+        if not isinstance(self.api.block_chain, BlockChain):
+            return
+
+        for message in messages:
+            sender = message.authentication.member.public_key.encode("HEX")
+            for row in message.payload.blocks:
+                with self._chain_lock:
+                    block = self._get_completing_block(sender, DatabaseBlock.from_row(row))
+                    if block:
+                        logger.info("Completing block: %s", base64.encodestring(block.hash_block).strip())
+                        self.api.block_chain.update_block_with_beneficiary(block)
+
+    def _get_completing_block(self, sender, block):
+        """
+        Return the block that completes an incomplete block of this node with the half of the beneficiary of a received
+        block, or None if the received block can't be used.
+
+        The block must come from its beneficiary, whose signature on the response covers its half, and the beneficiary
+        must have agreed to the agreement of this node. The half of this node is never taken from the network: the
+        received half of the benefactor must equal the stored one byte for byte.
+        :param sender: The public key of the sender of the block
+        :param block: The received `DatabaseBlock`
+        """
+        if block.benefactor != self.user.id or sender != block.beneficiary or not block.signature_beneficiary or \
+                not block.verify():
+            return None
+
+        local = self.api.block_chain.get_by_public_key_and_sequence_number(self.user.id,
+                                                                           block.sequence_number_benefactor)
+        if not self._completes_block(local, block):
+            return None
+
+        return DatabaseBlock((local.benefactor, block.beneficiary, local.agreement_benefactor,
+                              block.agreement_beneficiary, local.sequence_number_benefactor,
+                              block.sequence_number_beneficiary, local.previous_hash_benefactor,
+                              block.previous_hash_beneficiary, local.signature_benefactor, block.signature_beneficiary,
+                              local.insert_time))
+
+    @staticmethod
+    def _completes_block(local, block):
+        """
+        Check that a received block has the half of the benefactor of an incomplete local block, and that its
+        beneficiary agreed to the same agreement.
+        """
+        if not local or local.signature_beneficiary:
+            return False
+        half = lambda b: (b.benefactor, b.agreement_benefactor, b.sequence_number_benefactor,
+                          b.previous_hash_benefactor, b.signature_benefactor, b.insert_time)
+        if half(local) != half(block):
+            return False
+
+        agreement = DatabaseModel.decode(local.agreement_benefactor)
+        agreement_beneficiary = DatabaseModel.decode(block.agreement_beneficiary)
+        return agreement is not None and agreement_beneficiary is not None and \
+            agreement.id == agreement_beneficiary.id
+
+    ##############
+    ##### DOCUMENT TRANSFER MESSAGES
+    ###############
+
+    def send_document_offer(self, candidate, transfer_id, folder, name, mime, blob_hash, size, chunk_size):
+        meta = self.get_meta_message(u"document_offer")
+        message = meta.impl(authentication=(self.my_member,),
+                            distribution=(self.claim_global_time(),),
+                            destination=(candidate,),
+                            payload=(transfer_id, folder, name, mime, blob_hash, size, chunk_size))
+        self.dispersy.store_update_forward([message], False, False, True)
+
+    def send_document_chunk(self, candidate, transfer_id, index, chunk_hash, data):
+        meta = self.get_meta_message(u"document_chunk")
+        message = meta.impl(authentication=(self.my_member,),
+                            distribution=(self.claim_global_time(),),
+                            destination=(candidate,),
+                            payload=(transfer_id, index, chunk_hash, data))
+        self.dispersy.store_update_forward([message], False, False, True)
+
+    def send_document_ack(self, candidate, transfer_id, next_index, received):
+        meta = self.get_meta_message(u"document_ack")
+        message = meta.impl(authentication=(self.my_member,),
+                            distribution=(self.claim_global_time(),),
+                            destination=(candidate,),
+                            payload=(transfer_id, next_index, received))
+        self.dispersy.store_update_forward([message], False, False, True)
+
+    def on_document_offer(self, messages):
+        for message in messages:
+            self.document_transfers.on_offer(message.authentication.member.public_key.encode("HEX"),
+                                             message.candidate, message.payload)
+
+    def on_document_chunk(self, messages):
+        for message in messages:
+            self.document_transfers.on_chunk(message.authentication.member.public_key.encode("HEX"),
+                                             message.candidate, message.payload)
+
+    def on_document_ack(self, messages):
+        for message in messages:
+            self.document_transfers.on_ack(message.authentication.member.public_key.encode("HEX"), message.payload)
+
     ##############
     ##### SIGNED MESSAGES
     ###############
 
     def publish_signed_confirm_request_message(self, user_key, agreement_benefactor):
         """
-        Creates and sends out a signed signature_request message
+        Queues a signed signature_request message in the signing pipeline, which sends it out once its window allows.
         Returns true upon success
         """
-        if user_key in self.api.user_candidate and isinstance(agreement_benefactor, DatabaseModel):
-            candidate = self.api.user_candidate[user_key]
-            message = self.create_signed_confirm_request_message(candidate, agreement_benefactor)
-            self.create_signature_request(candidate, message, self.allow_signed_confirm_response)
-            return True
+        if isinstance(agreement_benefactor, DatabaseModel):
+            return self.signing_pipeline.push(user_key, agreement_benefactor)
         else:
             return False
 
@@ -427,34 +869,35 @@ class MortgageMarketCommunity(Community):
         # insert_time 10
         benefactor = self.user.id
 
-        payload_list = []
-        for k in range(1, 12):
-            payload_list.append(None)
-
-        payload_list[0] = benefactor  # benefactor, 0
-        payload_list[1] = ''  # beneficiary, 1
-        payload_list[2] = agreement_benefactor
-        payload_list[3] = None  # agreement beneficiary
-        payload_list[4] = self._get_next_sequence_number()
-        payload_list[5] = 0  # sequence number beneficiary
-        payload_list[6] = self._get_latest_hash()
-        payload_list[7] = ''  # previous hash beneficiary
-        payload_list[8] = ''  # Signature benefactor
-        payload_list[9] = ''  # Signature beneficiary
-        payload_list[10] = int(time.time())
-
-        meta = self.get_meta_message(u"signed_confirm")
-
-        message = meta.impl(authentication=([self.my_member, candidate.get_member()],),
-                            distribution=(self.claim_global_time(),),
-                            payload=tuple(payload_list))
+        with self._chain_lock:
+            payload_list = []
+            for k in range(1, 12):
+                payload_list.append(None)
+
+            payload_list[0] = benefactor  # benefactor, 0
+            payload_list[1] = ''  # beneficiary, 1
+            payload_list[2] = agreement_benefactor
+            payload_list[3] = None  # agreement beneficiary
+            payload_list[4] = self._get_next_sequence_number()
+            payload_list[5] = 0  # sequence number beneficiary
+            payload_list[6] = self._get_latest_link_hash()
+            payload_list[7] = ''  # previous hash beneficiary
+            payload_list[8] = ''  # Signature benefactor
+            payload_list[9] = ''  # Signature beneficiary
+            payload_list[10] = int(time.time())
 
-        for signature in message.authentication.signed_members:
-            encoded_sig = signature[1].public_key.encode("HEX")
-            if encoded_sig == benefactor:
-                message.payload._benefactor_signature = signature[0].encode("HEX")
+            meta = self.get_meta_message(u"signed_confirm")
+
+            message = meta.impl(authentication=([self.my_member, candidate.get_member()],),
+                                distribution=(self.claim_global_time(),),
+                                payload=tuple(payload_list))
+
+            for signature in message.authentication.signed_members:
+                encoded_sig = signature[1].public_key.encode("HEX")
+                if encoded_sig == benefactor:
+                    message.payload.signature_benefactor = signature[0].encode("HEX")
 
-        self.persist_signature(message)
+            self.persist_signature(message)
 
         return message
 
@@ -471,41 +914,67 @@ class MortgageMarketCommunity(Community):
         agreement_local = self.api.db.get(agreement.type, agreement.id)
 
         if agreement == agreement_local:
-            sequence_number_beneficiary = self._get_next_sequence_number()
-            previous_hash_beneficiary = self._get_latest_hash()
-
-            new_payload = (
-                payload.benefactor,
-                self.user.id,
-                agreement,
-                agreement_local,
-                payload.sequence_number_benefactor,
-                sequence_number_beneficiary,
-                payload.previous_hash_benefactor,
-                previous_hash_beneficiary,
-                '',
-                '',
-                payload.insert_time,
-            )
-
-            meta = self.get_meta_message(u"signed_confirm")
-            message = meta.impl(authentication=(message.authentication.members, message.authentication.signatures),
-                                distribution=(message.distribution.global_time,),
-                                payload=new_payload)
-
-            for signature in message.authentication.signed_members:
-                encoded_sig = signature[1].public_key.encode("HEX")
-                if encoded_sig == payload.benefactor:
-                    message.payload.signature_benefactor = signature[0].encode("HEX")
-                elif encoded_sig == self.user.id:
-                    message.payload.signature_beneficiary = signature[0].encode("HEX")
-
-            self.persist_signature(message)
+            with self._chain_lock:
+                # A repeated request, for example a retry after a lost response, is answered with the persisted block
+                block = self._get_beneficiary_block(payload)
+                if block:
+                    sequence_number_beneficiary = block.sequence_number_beneficiary
+                    previous_hash_beneficiary = block.previous_hash_beneficiary
+                else:
+                    sequence_number_beneficiary = self._get_next_sequence_number()
+                    previous_hash_beneficiary = self._get_latest_link_hash()
+
+                new_payload = (
+                    payload.benefactor,
+                    self.user.id,
+                    agreement,
+                    agreement_local,
+                    payload.sequence_number_benefactor,
+                    sequence_number_beneficiary,
+                    payload.previous_hash_benefactor,
+                    previous_hash_beneficiary,
+                    '',
+                    '',
+                    payload.insert_time,
+                )
+
+                meta = self.get_meta_message(u"signed_confirm")
+                message = meta.impl(authentication=(message.authentication.members, message.authentication.signatures),
+                                    distribution=(message.distribution.global_time,),
+                                    payload=new_payload)
+
+                for signature in message.authentication.signed_members:
+                    encoded_sig = signature[1].public_key.encode("HEX")
+                    if encoded_sig == payload.benefactor:
+                        message.payload.signature_benefactor = signature[0].encode("HEX")
+                    elif encoded_sig == self.user.id:
+                        message.payload.signature_beneficiary = signature[0].encode("HEX")
+
+                if block:
+                    logger.info("Answering a repeated sr with: %s", base64.encodestring(block.hash_block).strip())
+                else:
+                    self.persist_signature(message)
 
             return message
         else:
             return None
 
+    def _get_beneficiary_block(self, payload):
+        """
+        Return the block this node already persisted as beneficiary for a signature request, or None.
+        :param payload: The payload of the signature request
+        """
+        if not isinstance(self.api.block_chain, BlockChain):
+            return None
+
+        block = self.api.block_chain.get_by_public_key_and_sequence_number(payload.benefactor,
+                                                                           payload.sequence_number_benefactor)
+        if block and block.benefactor == payload.benefactor and block.beneficiary == self.user.id and \
+                block.sequence_number_benefactor == payload.sequence_number_benefactor and \
+                block.insert_time == payload.insert_time:
+            return block
+        return None
+
     def allow_signed_confirm_response(self, request, response, modified):
         """
         We've received a signature response message after sending a request, we must return either:
@@ -521,21 +990,30 @@ class MortgageMarketCommunity(Community):
             agreement_local = request.payload.agreement_benefactor
 
             if agreement_local == agreement:
-                if isinstance(agreement, Investment):
-                    mortgage = self.api.db.get(Mortgage.type, agreement.mortgage_id)
-                elif isinstance(agreement, Mortgage):
-                    mortgage = agreement
-                else:
+                beneficiary_key = self._get_beneficiary_key(agreement)
+                if beneficiary_key is None:
                     return False
 
-                loan_request = self.api.db.get(LoanRequest.type, mortgage.request_id)
-                beneficiary = self.api.db.get(User.type, loan_request.user_key)
-
-                return (response.payload.beneficiary == beneficiary.id and response.payload.benefactor == self.user.id
+                return (response.payload.beneficiary == beneficiary_key and response.payload.benefactor == self.user.id
                         and modified)
             else:
                 return False
 
+    def _get_beneficiary_key(self, agreement):
+        """
+        Return the public key of the beneficiary of an agreement, or None if it can't be determined.
+        """
+        if isinstance(agreement, Investment):
+            mortgage = self.api.db.get(Mortgage.type, agreement.mortgage_id)
+        elif isinstance(agreement, Mortgage):
+            mortgage = agreement
+        else:
+            return None
+
+        loan_request = mortgage and self.api.db.get(LoanRequest.type, mortgage.request_id)
+        beneficiary = loan_request and self.api.db.get(User.type, loan_request.user_key)
+        return beneficiary.id if beneficiary else None
+
     def received_signed_confirm_response(self, messages):
         """
         We've received a valid signature response and must process this message.
@@ -557,13 +1035,13 @@ class MortgageMarketCommunity(Community):
         A hash will be created from the message.
         :param message:
         """
-        assert isinstance(self.api.db.backend, BlockChain), "Not using a BlockChain enabled backend"
+        assert isinstance(self.api.block_chain, BlockChain), "Not using a BlockChain enabled backend"
 
-        self.api.db.backend.check_add_genesis_block()
+        self.api.block_chain.check_add_genesis_block()
 
         block = DatabaseBlock.from_signed_confirm_message(message)
         logger.info("Persisting sr: %s", base64.encodestring(block.hash_block).strip())
-        self.api.db.backend.add_block(block)
+        self.api.block_chain.add_block(block)
 
     def update_signature(self, message):
         """
@@ -571,20 +1049,19 @@ class MortgageMarketCommunity(Community):
         A hash will be created from the message.
         :param message:
         """
-        assert isinstance(self.api.db.backend, BlockChain), "Not using a BlockChain enabled backend"
+        assert isinstance(self.api.block_chain, BlockChain), "Not using a BlockChain enabled backend"
 
         block = DatabaseBlock.from_signed_confirm_message(message)
-        block.sequence_number = self.api.db.backend.get_latest_sequence_number()
+        block.sequence_number = self.api.block_chain.get_latest_sequence_number()
 
         logger.info("Persisting sr: %s", base64.encodestring(block.hash_block).strip())
-        self.api.db.backend.update_block_with_beneficiary(block)
+        self.api.block_chain.update_block_with_beneficiary(block)
 
     def _get_next_sequence_number(self):
-        assert isinstance(self.api.db.backend, BlockChain), "Not using a BlockChain enabled backend"
-        return self.api.db.backend.get_latest_sequence_number() + 1
+        assert isinstance(self.api.block_chain, BlockChain), "Not using a BlockChain enabled backend"
+        return self.api.block_chain.get_latest_sequence_number() + 1
 
-    def _get_latest_hash(self):
-        assert isinstance(self.api.db.backend, BlockChain), "Not using a BlockChain enabled backend"
+    def _get_latest_link_hash(self):
+        assert isinstance(self.api.block_chain, BlockChain), "Not using a BlockChain enabled backend"
 
-        previous_hash = self.api.db.backend.get_latest_hash()
-        return previous_hash
\ No newline at end of file
+        return self.api.block_chain.get_latest_link_hash()
\ No newline at end of file
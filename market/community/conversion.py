@@ -1,3 +1,4 @@
+from dispersy.bloomfilter import BloomFilter
 from dispersy.conversion import BinaryConversion
 from dispersy.conversion import DropPacket
 from market.community.encoding import encode, decode
@@ -11,6 +12,13 @@ class MortgageMarketConversion(BinaryConversion):
         self.define_meta_message(chr(14), community.get_meta_message(u"api_message_community"), self._encode_api_message, self._decode_api_message)
         self.define_meta_message(chr(15), community.get_meta_message(u"api_message_candidate"), self._encode_api_message, self._decode_api_message)
         self.define_meta_message(chr(16), community.get_meta_message(u"signed_confirm"), self._encode_signed_confirm, self._decode_signed_confirm)
+        self.define_meta_message(chr(17), community.get_meta_message(u"model_sync_request"), self._encode_model_sync_request, self._decode_model_sync_request)
+        self.define_meta_message(chr(18), community.get_meta_message(u"model_sync_response"), self._encode_model_batch, self._decode_model_batch)
+        self.define_meta_message(chr(19), community.get_meta_message(u"block_range_request"), self._encode_block_range_request, self._decode_block_range_request)
+        self.define_meta_message(chr(20), community.get_meta_message(u"block_range_response"), self._encode_block_batch, self._decode_block_batch)
+        self.define_meta_message(chr(21), community.get_meta_message(u"document_offer"), self._encode_document_offer, self._decode_document_offer)
+        self.define_meta_message(chr(22), community.get_meta_message(u"document_chunk"), self._encode_document_chunk, self._decode_document_chunk)
+        self.define_meta_message(chr(23), community.get_meta_message(u"document_ack"), self._encode_document_ack, self._decode_document_ack)
 
     def _encode_api_message(self, message):
         encoded_models = dict()
@@ -139,4 +147,176 @@ class MortgageMarketConversion(BinaryConversion):
 
         return offset, placeholder.meta.payload.implement(fields, decoded_models)
 
+    def _encode_model_sync_request(self, message):
+        bloom_filter = message.payload.bloom_filter
+        packet = encode((message.payload.types, message.payload.slice_index, message.payload.slice_count,
+                         bloom_filter.functions, bloom_filter.prefix, bloom_filter.bytes))
+        return packet,
+
+    def _decode_model_sync_request(self, placeholder, offset, data):
+        try:
+            offset, payload = decode(data, offset)
+        except ValueError:
+            raise DropPacket("Unable to decode the model sync request payload")
+
+        if not isinstance(payload, tuple) or len(payload) != 6:
+            raise DropPacket("Invalid payload type")
+
+        types, slice_index, slice_count, functions, prefix, bloom_bytes = payload
+        if not isinstance(types, list):
+            raise DropPacket("Invalid 'types' type")
+        self._check_slice(slice_index, slice_count)
+        bloom_filter = self._decode_bloom_filter(functions, prefix, bloom_bytes)
+
+        return offset, placeholder.meta.payload.implement(types, slice_index, slice_count, bloom_filter)
+
+    @staticmethod
+    def _check_slice(slice_index, slice_count):
+        if not isinstance(slice_count, int) or slice_count < 1:
+            raise DropPacket("Invalid 'slice_count' value")
+        if not isinstance(slice_index, int) or not 0 <= slice_index < slice_count:
+            raise DropPacket("Invalid 'slice_index' value")
+
+    @staticmethod
+    def _decode_bloom_filter(functions, prefix, bloom_bytes):
+        if not isinstance(functions, int) or functions < 1:
+            raise DropPacket("Invalid bloom filter 'functions' value")
+        if not isinstance(prefix, str) or not isinstance(bloom_bytes, str) or not bloom_bytes:
+            raise DropPacket("Invalid bloom filter")
+        return BloomFilter(bloom_bytes, functions, prefix=prefix)
+
+    def _encode_model_batch(self, message):
+        packet = encode([model.encode() for model in message.payload.models])
+        return packet,
+
+    def _decode_model_batch(self, placeholder, offset, data):
+        try:
+            offset, payload = decode(data, offset)
+        except ValueError:
+            raise DropPacket("Unable to decode the model batch payload")
+
+        if not isinstance(payload, list):
+            raise DropPacket("Invalid payload type")
+
+        models = []
+        for encoded_model in payload:
+            model = DatabaseModel.decode(encoded_model)
+            if not isinstance(model, DatabaseModel):
+                raise DropPacket("Invalid model in batch")
+            models.append(model)
+
+        return offset, placeholder.meta.payload.implement(models)
+
+    def _encode_block_range_request(self, message):
+        packet = encode((message.payload.public_key, message.payload.from_sequence_number,
+                         message.payload.to_sequence_number))
+        return packet,
+
+    def _decode_block_range_request(self, placeholder, offset, data):
+        try:
+            offset, payload = decode(data, offset)
+        except ValueError:
+            raise DropPacket("Unable to decode the block range request payload")
+
+        if not isinstance(payload, tuple) or len(payload) != 3:
+            raise DropPacket("Invalid payload type")
+
+        public_key, from_sequence_number, to_sequence_number = payload
+        if not isinstance(public_key, str):
+            raise DropPacket("Invalid 'public_key' type")
+        if not isinstance(from_sequence_number, int) or not isinstance(to_sequence_number, int) or \
+                not 0 <= from_sequence_number <= to_sequence_number:
+            raise DropPacket("Invalid sequence number range")
+
+        return offset, placeholder.meta.payload.implement(public_key, from_sequence_number, to_sequence_number)
+
+    def _encode_block_batch(self, message):
+        packet = encode([tuple(row) for row in message.payload.blocks])
+        return packet,
+
+    def _decode_block_batch(self, placeholder, offset, data):
+        try:
+            offset, payload = decode(data, offset)
+        except ValueError:
+            raise DropPacket("Unable to decode the block batch payload")
+
+        if not isinstance(payload, list):
+            raise DropPacket("Invalid payload type")
+
+        # Columns 4, 5, 10 and 13 are integers, the others strings, see `PersistentBackend.BLOCK_QUERY`.
+        for row in payload:
+            if not isinstance(row, tuple) or len(row) != 14:
+                raise DropPacket("Invalid block in batch")
+            for column, value in enumerate(row):
+                if not isinstance(value, (int, long) if column in (4, 5, 10, 13) else str):
+                    raise DropPacket("Invalid block in batch")
+
+        return offset, placeholder.meta.payload.implement(payload)
+
+    def _encode_document_offer(self, message):
+        payload = message.payload
+        packet = encode((payload.transfer_id, payload.folder, payload.name, payload.mime, payload.blob_hash,
+                         payload.size, payload.chunk_size))
+        return packet,
+
+    def _decode_document_offer(self, placeholder, offset, data):
+        try:
+            offset, payload = decode(data, offset)
+        except ValueError:
+            raise DropPacket("Unable to decode the document offer payload")
+
+        if not isinstance(payload, tuple) or len(payload) != 7:
+            raise DropPacket("Invalid payload type")
+
+        transfer_id, folder, name, mime, blob_hash, size, chunk_size = payload
+        if not all(isinstance(value, str) for value in (transfer_id, folder, name, mime, blob_hash)):
+            raise DropPacket("Invalid document offer")
+        if not isinstance(size, (int, long)) or size < 0 or not isinstance(chunk_size, int) or chunk_size <= 0:
+            raise DropPacket("Invalid document size")
+
+        return offset, placeholder.meta.payload.implement(transfer_id, folder, name, mime, blob_hash, size,
+                                                          chunk_size)
+
+    def _encode_document_chunk(self, message):
+        payload = message.payload
+        packet = encode((payload.transfer_id, payload.index, payload.chunk_hash, payload.data))
+        return packet,
+
+    def _decode_document_chunk(self, placeholder, offset, data):
+        try:
+            offset, payload = decode(data, offset)
+        except ValueError:
+            raise DropPacket("Unable to decode the document chunk payload")
+
+        if not isinstance(payload, tuple) or len(payload) != 4:
+            raise DropPacket("Invalid payload type")
+
+        transfer_id, index, chunk_hash, chunk_data = payload
+        if not isinstance(transfer_id, str) or not isinstance(chunk_hash, str) or not isinstance(chunk_data, str):
+            raise DropPacket("Invalid document chunk")
+        if not isinstance(index, int) or index < 0:
+            raise DropPacket("Invalid chunk index")
+
+        return offset, placeholder.meta.payload.implement(transfer_id, index, chunk_hash, chunk_data)
+
+    def _encode_document_ack(self, message):
+        payload = message.payload
+        packet = encode((payload.transfer_id, payload.next_index, payload.received))
+        return packet,
+
+    def _decode_document_ack(self, placeholder, offset, data):
+        try:
+            offset, payload = decode(data, offset)
+        except ValueError:
+            raise DropPacket("Unable to decode the document ack payload")
+
+        if not isinstance(payload, tuple) or len(payload) != 3:
+            raise DropPacket("Invalid payload type")
+
+        transfer_id, next_index, received = payload
+        if not isinstance(transfer_id, str) or not isinstance(next_index, int) or next_index < -1:
+            raise DropPacket("Invalid document ack")
+        if not isinstance(received, list) or not all(isinstance(index, int) for index in received):
+            raise DropPacket("Invalid received chunks")
 
+        return offset, placeholder.meta.payload.implement(transfer_id, next_index, received)
@@ -326,9 +326,10 @@ def decode(stream, offset=0):
     Returns the new OFFSET of the stream and the decoded data.
 
     Only version 'a' decoding is supported.  This version is
-    indicated by the first byte in the binary STREAM.
+    indicated by the first byte in the binary STREAM. STREAM may be a
+    buffer, to decode straight from a memory map.
     """
-    assert isinstance(stream, bytes), "STREAM has invalid type: %s" % type(stream)
+    assert isinstance(stream, (bytes, buffer)), "STREAM has invalid type: %s" % type(stream)
     assert isinstance(offset, int), "OFFSET has invalid type: %s" % type(offset)
     if stream[offset] == "a":
         index = offset + 1
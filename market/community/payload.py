@@ -1,3 +1,4 @@
+from dispersy.bloomfilter import BloomFilter
 from dispersy.payload import Payload
 from market.models import DatabaseModel
 
@@ -162,3 +163,236 @@ class SignedConfirmPayload(Payload):
         def insert_time(self):
             return self._insert_time
 
+
+
+class ModelSyncRequestPayload(Payload):
+    """
+    Request for the public models a node is missing. The requesting node sends a bloom filter containing the
+    (type, id, version) keys of the models it already has, for a single slice of its models.
+
+    The models are split into `slice_count` slices to keep the bloom filter within a fixed size. Only models in slice
+    `slice_index` are covered by the bloom filter.
+    """
+
+    class Implementation(Payload.Implementation):
+        def __init__(self, meta, types, slice_index, slice_count, bloom_filter):
+            assert isinstance(types, list)
+            assert isinstance(slice_index, int)
+            assert isinstance(slice_count, int)
+            assert 0 <= slice_index < slice_count
+            assert isinstance(bloom_filter, BloomFilter)
+
+            super(ModelSyncRequestPayload.Implementation, self).__init__(meta)
+
+            self._types = types
+            self._slice_index = slice_index
+            self._slice_count = slice_count
+            self._bloom_filter = bloom_filter
+
+        @property
+        def types(self):
+            return self._types
+
+        @property
+        def slice_index(self):
+            return self._slice_index
+
+        @property
+        def slice_count(self):
+            return self._slice_count
+
+        @property
+        def bloom_filter(self):
+            return self._bloom_filter
+
+
+class ModelBatchPayload(Payload):
+    """
+    A batch of models sent in response to a `ModelSyncRequestPayload`.
+    """
+
+    class Implementation(Payload.Implementation):
+        def __init__(self, meta, models):
+            assert isinstance(models, list)
+            for model in models:
+                assert isinstance(model, DatabaseModel), "%s is not a DatabaseModel" % model
+
+            super(ModelBatchPayload.Implementation, self).__init__(meta)
+
+            self._models = models
+
+        @property
+        def models(self):
+            return self._models
+
+
+class BlockRangeRequestPayload(Payload):
+    """
+    Request for the blocks of a public key within a range of its sequence numbers.
+    """
+
+    class Implementation(Payload.Implementation):
+        def __init__(self, meta, public_key, from_sequence_number, to_sequence_number):
+            assert isinstance(public_key, str)
+            assert isinstance(from_sequence_number, int)
+            assert isinstance(to_sequence_number, int)
+            assert 0 <= from_sequence_number <= to_sequence_number
+
+            super(BlockRangeRequestPayload.Implementation, self).__init__(meta)
+
+            self._public_key = public_key
+            self._from_sequence_number = from_sequence_number
+            self._to_sequence_number = to_sequence_number
+
+        @property
+        def public_key(self):
+            return self._public_key
+
+        @property
+        def from_sequence_number(self):
+            return self._from_sequence_number
+
+        @property
+        def to_sequence_number(self):
+            return self._to_sequence_number
+
+
+class BlockBatchPayload(Payload):
+    """
+    A batch of blocks sent in response to a `BlockRangeRequestPayload`, as rows in the order of
+    `PersistentBackend.BLOCK_QUERY`.
+    """
+
+    class Implementation(Payload.Implementation):
+        def __init__(self, meta, blocks):
+            assert isinstance(blocks, list)
+
+            super(BlockBatchPayload.Implementation, self).__init__(meta)
+
+            self._blocks = blocks
+
+        @property
+        def blocks(self):
+            return self._blocks
+
+
+class DocumentOfferPayload(Payload):
+    """
+    Announces a document transfer: the document sent in chunks of `chunk_size` bytes, to be stored as
+    `folder`/`name` by the receiver.
+    """
+
+    class Implementation(Payload.Implementation):
+        def __init__(self, meta, transfer_id, folder, name, mime, blob_hash, size, chunk_size):
+            assert isinstance(transfer_id, str)
+            assert isinstance(folder, str)
+            assert isinstance(name, str)
+            assert isinstance(mime, str)
+            assert isinstance(blob_hash, str)
+            assert isinstance(size, (int, long)) and size >= 0
+            assert isinstance(chunk_size, int) and chunk_size > 0
+
+            super(DocumentOfferPayload.Implementation, self).__init__(meta)
+
+            self._transfer_id = transfer_id
+            self._folder = folder
+            self._name = name
+            self._mime = mime
+            self._blob_hash = blob_hash
+            self._size = size
+            self._chunk_size = chunk_size
+
+        @property
+        def transfer_id(self):
+            return self._transfer_id
+
+        @property
+        def folder(self):
+            return self._folder
+
+        @property
+        def name(self):
+            return self._name
+
+        @property
+        def mime(self):
+            return self._mime
+
+        @property
+        def blob_hash(self):
+            return self._blob_hash
+
+        @property
+        def size(self):
+            return self._size
+
+        @property
+        def chunk_size(self):
+            return self._chunk_size
+
+
+class DocumentChunkPayload(Payload):
+    """
+    A single chunk of a document transfer, with the SHA-256 digest of its data.
+    """
+
+    class Implementation(Payload.Implementation):
+        def __init__(self, meta, transfer_id, index, chunk_hash, data):
+            assert isinstance(transfer_id, str)
+            assert isinstance(index, int) and index >= 0
+            assert isinstance(chunk_hash, str)
+            assert isinstance(data, str)
+
+            super(DocumentChunkPayload.Implementation, self).__init__(meta)
+
+            self._transfer_id = transfer_id
+            self._index = index
+            self._chunk_hash = chunk_hash
+            self._data = data
+
+        @property
+        def transfer_id(self):
+            return self._transfer_id
+
+        @property
+        def index(self):
+            return self._index
+
+        @property
+        def chunk_hash(self):
+            return self._chunk_hash
+
+        @property
+        def data(self):
+            return self._data
+
+
+class DocumentAckPayload(Payload):
+    """
+    Acknowledges the chunks of a document transfer: all chunks before `next_index`, and the later chunks in
+    `received`. A `next_index` of -1 rejects the transfer.
+    """
+
+    class Implementation(Payload.Implementation):
+        def __init__(self, meta, transfer_id, next_index, received):
+            assert isinstance(transfer_id, str)
+            assert isinstance(next_index, int) and next_index >= -1
+            assert isinstance(received, list)
+
+            super(DocumentAckPayload.Implementation, self).__init__(meta)
+
+            self._transfer_id = transfer_id
+            self._next_index = next_index
+            self._received = received
+
+        @property
+        def transfer_id(self):
+            return self._transfer_id
+
+        @property
+        def next_index(self):
+            return self._next_index
+
+        @property
+        def received(self):
+            return self._received
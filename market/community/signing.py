@@ -0,0 +1,215 @@
+"""
+Pipelined `signed_confirm` requests.
+
+Every agreement this node signs as benefactor becomes a signature request to the beneficiary. Instead of firing them off
+inline, the requests go through a `SigningPipeline` that keeps at most `window` of them in flight, queues the rest,
+retries the ones that time out and keeps track of throughput and latency.
+
+The sequence number and previous hash of a request are reserved when its half of the block is persisted, which
+`MortgageMarketCommunity.create_signed_confirm_request_message` does under the chain lock. Requests in flight at the same
+time thus always claim consecutive sequence numbers, and a retry resends the original message so it keeps its number.
+"""
+import logging
+import time
+from collections import deque
+from threading import RLock
+
+logger = logging.getLogger(__name__)
+
+# Maximum amount of signature requests waiting for a response at the same time.
+SIGNING_WINDOW = 8
+# Seconds before an unanswered signature request times out.
+SIGNING_TIMEOUT = 10.0
+# Amount of times a timed out signature request is sent again before giving up on it.
+SIGNING_RETRIES = 2
+# Seconds between two log lines with the `SigningStats` of a pipeline.
+SIGNING_STATS_INTERVAL = 60.0
+
+
+def agreement_key(agreement):
+    return agreement.type, agreement.id
+
+
+class SigningRequest(object):
+    """
+    A signature request for a single agreement.
+    """
+
+    def __init__(self, user_key, agreement, candidate):
+        self.user_key = user_key
+        self.agreement = agreement
+        self.candidate = candidate
+        self.message = None
+        self.attempts = 0
+        self.queued_at = time.time()
+        self.started_at = None
+
+
+class SigningStats(object):
+    """
+    Counters of a `SigningPipeline`.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.requested = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.retries = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    @property
+    def throughput(self):
+        """
+        Completed requests per second since the pipeline was created.
+        """
+        elapsed = time.time() - self.started_at
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def average_latency(self):
+        """
+        Average seconds between queueing a request and receiving its accepted response.
+        """
+        return self.total_latency / self.completed if self.completed else 0.0
+
+    def add_latency(self, latency):
+        self.completed += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def __str__(self):
+        return "%d requested, %d completed (%.2f/s), %d rejected, %d timeouts, %d retries, %d failed, " \
+               "latency %.2fs average, %.2fs max" % (self.requested, self.completed, self.throughput, self.rejected,
+                                                    self.timeouts, self.retries, self.failed, self.average_latency,
+                                                    self.max_latency)
+
+
+class SigningPipeline(object):
+    """
+    Sends the `signed_confirm` requests of a community with a bounded in-flight window.
+    """
+
+    def __init__(self, community, window=SIGNING_WINDOW, timeout=SIGNING_TIMEOUT, retries=SIGNING_RETRIES):
+        """
+        :param community: The `MortgageMarketCommunity` sending the requests
+        :param window: Maximum amount of requests in flight
+        :param timeout: Seconds before a request times out
+        :param retries: Amount of times a timed out request is sent again
+        """
+        self._community = community
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self.stats = SigningStats()
+
+        self._lock = RLock()
+        self._queue = deque()
+        # (agreement type, agreement id) -> SigningRequest, for both the queued and the in flight requests
+        self._pending = {}
+        self._in_flight = {}
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    @property
+    def in_flight(self):
+        return len(self._in_flight)
+
+    def log_stats(self):
+        """
+        Log the `stats` of the pipeline, with the amount of queued and in flight requests.
+        """
+        logger.info("Signing: %s, %d queued, %d in flight", self.stats, self.queued, self.in_flight)
+
+    def is_pending(self, agreement):
+        return agreement_key(agreement) in self._pending
+
+    def push(self, user_key, agreement):
+        """
+        Queue a signature request for an agreement and start it if the window allows.
+        :param user_key: The public key of the beneficiary
+        :param agreement: The agreement to sign
+        :return: True if the request is queued or already pending, False if the beneficiary is unknown
+        """
+        candidate = self._community.api.user_candidate.get(user_key)
+        if candidate is None:
+            return False
+
+        with self._lock:
+            key = agreement_key(agreement)
+            if key not in self._pending:
+                self._pending[key] = SigningRequest(user_key, agreement, candidate)
+                self._queue.append(key)
+                self.stats.requested += 1
+
+        self.process()
+        return True
+
+    def process(self):
+        """
+        Start queued requests until the window is full.
+        """
+        while True:
+            with self._lock:
+                if not self._queue or len(self._in_flight) >= self.window:
+                    return
+                key = self._queue.popleft()
+                request = self._pending[key]
+                self._in_flight[key] = request
+
+            self._send(request)
+
+    def _send(self, request):
+        if request.message is None:
+            candidate = self._community.api.user_candidate.get(request.user_key, request.candidate)
+            request.candidate = candidate
+            request.started_at = time.time()
+            request.message = self._community.create_signed_confirm_request_message(candidate, request.agreement)
+
+        request.attempts += 1
+        self._community.create_signature_request(request.candidate, request.message, self.on_response,
+                                                 timeout=self.timeout)
+
+    def on_response(self, request_message, response, modified):
+        """
+        Signature response callback, `response` being None when the request timed out.
+        :return: Whether the response is accepted, see `MortgageMarketCommunity.allow_signed_confirm_response`
+        """
+        accepted = self._community.allow_signed_confirm_response(request_message, response, modified)
+        key = agreement_key(request_message.payload.agreement_benefactor)
+
+        with self._lock:
+            request = self._in_flight.get(key)
+            if request is None:
+                return accepted
+
+            retry = False
+            if response is None:
+                self.stats.timeouts += 1
+                if request.attempts <= self.retries:
+                    self.stats.retries += 1
+                    retry = True
+                else:
+                    # The half signed block stays in the chain, to be completed by the block range sync.
+                    logger.warning("Giving up on the signature request for %s %s", *key)
+                    self.stats.failed += 1
+            elif accepted:
+                self.stats.add_latency(time.time() - request.queued_at)
+            else:
+                self.stats.rejected += 1
+
+            if not retry:
+                del self._in_flight[key]
+                del self._pending[key]
+
+        if retry:
+            self._send(request)
+        else:
+            self.process()
+
+        return accepted
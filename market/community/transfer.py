@@ -0,0 +1,402 @@
+"""
+Chunked document transfers over the community, as an alternative to the TFTP uploads.
+
+The sender offers a document from its `BlobStore` in a `document_offer` message and sends it in `document_chunk`
+messages of `chunk_size` bytes, each carrying the SHA-256 digest of its data. The receiver acknowledges every chunk in a
+`document_ack` message, with the index up to which all chunks arrived and the later chunks that arrived out of order. At
+most `window` chunks beyond the acknowledged index are in flight. When no acknowledgement makes progress for `timeout`
+seconds the unacknowledged chunks are sent again, and after `retries` rounds without progress the transfer fails.
+
+All messages are signed by their member. The receiver only accepts an offer from the borrower of a loan request with this
+node, the folder of the offer being the id of that loan request. It only accepts the chunks of a transfer from the member
+that offered it and the sender only accepts acknowledgements from the member it offered the document to. The receiver
+writes the chunks in order straight into a `BlobWriter`, and only stores the document once the hash of the whole matches
+the offer.
+"""
+import logging
+import ntpath
+import os
+import shutil
+import time
+from collections import OrderedDict
+from hashlib import sha256
+from threading import RLock
+from uuid import UUID
+
+from twisted.internet.defer import Deferred
+
+from market.database.blobstore import BLOB_HASH
+from market.models.document import Document
+from market.models.loans import LoanRequest
+
+logger = logging.getLogger(__name__)
+
+# Size of the data in a single chunk message, small enough for the signed message to fit in a single UDP packet.
+DOCUMENT_CHUNK_SIZE = 1024
+# Maximum amount of chunks in flight beyond the acknowledged index.
+DOCUMENT_WINDOW = 16
+# Seconds without progress before the unacknowledged chunks are sent again.
+DOCUMENT_TIMEOUT = 2.0
+# Amount of rounds without progress before a transfer fails.
+DOCUMENT_RETRIES = 5
+# Largest chunk size and document size accepted from a sender.
+MAX_CHUNK_SIZE = 8 * 1024
+MAX_DOCUMENT_SIZE = 64 * 1024 * 1024
+# Folder and document names that would not stay inside the received directory.
+INVALID_NAMES = ('', '.', '..')
+# The `next_index` of an acknowledgement rejecting a transfer.
+REJECTED = -1
+# Amount of finished incoming transfers remembered, to acknowledge their retransmitted chunks.
+FINISHED_HISTORY = 100
+# Directory the received documents are linked into, one folder per loan request, for the bank's views.
+RECEIVED_DIRECTORY = os.path.join(os.getcwd(), 'resources', 'received')
+
+
+def get_chunk_count(size, chunk_size):
+    """
+    The amount of chunks of a document, an empty document being sent as a single empty chunk.
+    """
+    return max(1, (size + chunk_size - 1) // chunk_size)
+
+
+class OutgoingTransfer(object):
+    """
+    A document sent to a single receiver.
+    """
+
+    def __init__(self, transfer_id, user_key, candidate, folder, document, data, chunk_size):
+        self.transfer_id = transfer_id
+        self.user_key = user_key
+        self.candidate = candidate
+        self.folder = folder
+        self.document = document
+        self.data = data
+        self.chunk_size = chunk_size
+        self.chunk_count = get_chunk_count(document.size, chunk_size)
+
+        self.offered = False
+        # All chunks before `next_index` are acknowledged, as are the ones in `received`
+        self.next_index = 0
+        self.received = set()
+        # One past the highest chunk sent so far
+        self.next_to_send = 0
+        self.attempts = 0
+        self.last_progress = time.time()
+        self.deferred = Deferred()
+
+    def chunk(self, index):
+        return self.data[index * self.chunk_size:(index + 1) * self.chunk_size]
+
+
+class IncomingTransfer(object):
+    """
+    A document received from a single sender.
+    """
+
+    def __init__(self, sender_key, payload, writer):
+        self.sender_key = sender_key
+        self.transfer_id = payload.transfer_id
+        self.folder = ntpath.basename(payload.folder)
+        self.name = ntpath.basename(payload.name)
+        self.mime = payload.mime
+        self.blob_hash = payload.blob_hash
+        self.size = payload.size
+        self.chunk_size = payload.chunk_size
+        self.chunk_count = get_chunk_count(payload.size, payload.chunk_size)
+        self.writer = writer
+
+        self.next_index = 0
+        # Index -> data of the chunks that arrived ahead of `next_index`
+        self.buffered = {}
+        self.last_activity = time.time()
+
+    def chunk_length(self, index):
+        return min(self.chunk_size, self.size - index * self.chunk_size)
+
+
+class DocumentTransfers(object):
+    """
+    The outgoing and incoming document transfers of a `MortgageMarketCommunity`.
+    """
+
+    def __init__(self, community, window=DOCUMENT_WINDOW, chunk_size=DOCUMENT_CHUNK_SIZE, timeout=DOCUMENT_TIMEOUT,
+                 retries=DOCUMENT_RETRIES, received_directory=RECEIVED_DIRECTORY):
+        """
+        :param community: The `MortgageMarketCommunity` sending the messages
+        :param window: Maximum amount of chunks in flight beyond the acknowledged index
+        :param chunk_size: The size of the chunks sent
+        :param timeout: Seconds without progress before chunks are sent again
+        :param retries: Amount of rounds without progress before a transfer fails
+        :param received_directory: Directory to link the received documents into, None to only store them
+        """
+        self._community = community
+        self.window = window
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.retries = retries
+        self.received_directory = received_directory
+
+        self._lock = RLock()
+        # transfer id -> OutgoingTransfer
+        self._outgoing = {}
+        # (sender key, transfer id) -> IncomingTransfer
+        self._incoming = {}
+        # (sender key, transfer id) -> final acknowledged index
+        self._finished = OrderedDict()
+
+    @property
+    def outgoing(self):
+        return len(self._outgoing)
+
+    @property
+    def incoming(self):
+        return len(self._incoming)
+
+    def send(self, user_key, candidate, folder, document):
+        """
+        Send a document to a user.
+        :param user_key: The public key of the receiving user
+        :param candidate: The candidate of the receiving user
+        :param folder: The folder to store the document in at the receiver, the id of its loan request
+        :param document: The `Document` to send, stored in the blob store of the API
+        :return: Deferred firing with True once the receiver stored the document, or False if the transfer failed
+        """
+        data = document.map(self._community.api.blob_store)
+        transfer = OutgoingTransfer(os.urandom(8), user_key, candidate, folder, document, data, self.chunk_size)
+        with self._lock:
+            self._outgoing[transfer.transfer_id] = transfer
+
+        self._send_offer(transfer)
+        return transfer.deferred
+
+    def _send_offer(self, transfer):
+        document = transfer.document
+        self._community.send_document_offer(transfer.candidate, transfer.transfer_id, transfer.folder,
+                                            document.name + '.pdf', document.mime, document.blob_hash,
+                                            document.size, transfer.chunk_size)
+
+    def _send_chunk(self, transfer, index):
+        data = transfer.chunk(index)
+        self._community.send_document_chunk(transfer.candidate, transfer.transfer_id, index, sha256(data).digest(),
+                                            data)
+
+    def _fill_window(self, transfer):
+        end = min(transfer.chunk_count, transfer.next_index + self.window)
+        while transfer.next_to_send < end:
+            if transfer.next_to_send not in transfer.received:
+                self._send_chunk(transfer, transfer.next_to_send)
+            transfer.next_to_send += 1
+
+    def _finish_outgoing(self, transfer, success):
+        with self._lock:
+            if self._outgoing.pop(transfer.transfer_id, None) is None:
+                return
+        if hasattr(transfer.data, 'close'):
+            transfer.data.close()
+        transfer.deferred.callback(success)
+
+    def on_ack(self, member_key, payload):
+        """
+        Process the acknowledgement of an outgoing transfer.
+        :param member_key: The public key of the member that signed the acknowledgement
+        """
+        with self._lock:
+            transfer = self._outgoing.get(payload.transfer_id)
+            if transfer is None or transfer.user_key != member_key:
+                return
+
+            if payload.next_index == REJECTED:
+                logger.warning("Transfer of %s rejected by the receiver", transfer.document.name)
+                finished = False
+            else:
+                self._acknowledge(transfer, payload.next_index, payload.received)
+                finished = True if transfer.next_index >= transfer.chunk_count else None
+                if finished is None:
+                    self._fill_window(transfer)
+
+        if finished is not None:
+            self._finish_outgoing(transfer, finished)
+
+    @staticmethod
+    def _acknowledge(transfer, next_index, received):
+        """
+        Record the chunks acknowledged by the receiver, a new acknowledgement resetting the retries.
+        """
+        received = set(index for index in received if next_index < index < transfer.chunk_count)
+        if not transfer.offered or next_index > transfer.next_index or not received <= transfer.received:
+            transfer.attempts = 0
+            transfer.last_progress = time.time()
+        transfer.offered = True
+        if next_index > transfer.next_index:
+            transfer.next_index = min(next_index, transfer.chunk_count)
+            transfer.received = set(index for index in transfer.received if index >= transfer.next_index)
+            transfer.next_to_send = max(transfer.next_to_send, transfer.next_index)
+        transfer.received |= received
+
+    def on_offer(self, sender_key, candidate, payload):
+        """
+        Accept a document offer, or acknowledge it again if it is already known.
+        :param sender_key: The public key of the member that signed the offer
+        """
+        key = (sender_key, payload.transfer_id)
+        with self._lock:
+            if key in self._finished:
+                self._community.send_document_ack(candidate, payload.transfer_id, self._finished[key], [])
+                return
+
+            incoming = self._incoming.get(key)
+            if incoming is None:
+                if not self._accepts(sender_key, payload):
+                    self._community.send_document_ack(candidate, payload.transfer_id, REJECTED, [])
+                    return
+
+                blob_store = self._community.api.blob_store
+                incoming = IncomingTransfer(sender_key, payload, None)
+                if blob_store.contains(payload.blob_hash):
+                    # Already stored, for instance for another loan request
+                    blob_store.add_reference(payload.blob_hash)
+                    self._store_document(incoming)
+                    self._finish_incoming(key, incoming.chunk_count)
+                    self._community.send_document_ack(candidate, payload.transfer_id, incoming.chunk_count, [])
+                    return
+
+                incoming.writer = blob_store.writer()
+                self._incoming[key] = incoming
+
+            self._community.send_document_ack(candidate, payload.transfer_id, incoming.next_index,
+                                              sorted(incoming.buffered))
+
+    def _accepts(self, sender_key, payload):
+        """
+        Whether an offer is valid, and comes from the borrower of a loan request with this node.
+        """
+        folder = ntpath.basename(payload.folder)
+        if payload.chunk_size > MAX_CHUNK_SIZE or payload.size > MAX_DOCUMENT_SIZE or \
+                not BLOB_HASH.match(payload.blob_hash) or folder in INVALID_NAMES or \
+                ntpath.basename(payload.name) in INVALID_NAMES:
+            return False
+
+        try:
+            loan_request = self._community.api.db.get(LoanRequest.type, UUID(folder))
+        except ValueError:
+            return False
+        return isinstance(loan_request, LoanRequest) and loan_request.user_key == sender_key and \
+            self._community.user.id in loan_request.banks
+
+    def on_chunk(self, sender_key, candidate, payload):
+        """
+        Write a chunk of an incoming transfer, and acknowledge it.
+        :param sender_key: The public key of the member that signed the chunk
+        """
+        key = (sender_key, payload.transfer_id)
+        with self._lock:
+            incoming = self._incoming.get(key)
+            if incoming is None:
+                if key in self._finished:
+                    self._community.send_document_ack(candidate, payload.transfer_id, self._finished[key], [])
+                return
+
+            if not self._valid_chunk(incoming, payload):
+                logger.warning("Dropping invalid chunk %d of %s", payload.index, incoming.name)
+                return
+
+            self._write_chunk(incoming, payload.index, payload.data)
+            next_index = incoming.next_index
+            if next_index == incoming.chunk_count:
+                del self._incoming[key]
+                next_index = self._commit_incoming(incoming)
+                self._finish_incoming(key, next_index)
+
+            self._community.send_document_ack(candidate, payload.transfer_id, next_index,
+                                              sorted(incoming.buffered) if next_index >= 0 else [])
+
+    @staticmethod
+    def _valid_chunk(incoming, payload):
+        """
+        Whether a chunk belongs to an incoming transfer, with the length and hash it should have.
+        """
+        return payload.index < incoming.chunk_count and len(payload.data) == incoming.chunk_length(payload.index) and \
+            sha256(payload.data).digest() == payload.chunk_hash
+
+    def _write_chunk(self, incoming, index, data):
+        """
+        Buffer a chunk within the window, and write the buffered chunks that are next in order.
+        """
+        incoming.last_activity = time.time()
+        if incoming.next_index <= index < incoming.next_index + self.window:
+            incoming.buffered[index] = data
+            while incoming.next_index in incoming.buffered:
+                incoming.writer.write(incoming.buffered.pop(incoming.next_index))
+                incoming.next_index += 1
+
+    def _commit_incoming(self, incoming):
+        """
+        Store a completely received document if it matches its hash.
+        :return: The index to acknowledge, `REJECTED` if the document doesn't match
+        """
+        try:
+            incoming.writer.commit(incoming.blob_hash)
+        except ValueError:
+            logger.warning("Document %s doesn't match its hash", incoming.name)
+            return REJECTED
+        self._store_document(incoming)
+        return incoming.chunk_count
+
+    def _finish_incoming(self, key, next_index):
+        self._finished[key] = next_index
+        while len(self._finished) > FINISHED_HISTORY:
+            self._finished.popitem(last=False)
+
+    def _store_document(self, incoming):
+        """
+        Save a completely received document, and link it into the received directory.
+        """
+        document = Document(incoming.mime, incoming.blob_hash, incoming.size, incoming.name)
+        self._community.api.db.post(Document.type, document)
+
+        if self.received_directory and incoming.folder:
+            folder = os.path.join(self.received_directory, incoming.folder)
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+            target = os.path.join(folder, incoming.name)
+            if os.path.exists(target):
+                os.remove(target)
+            try:
+                os.link(document.path(self._community.api.blob_store), target)
+            except OSError:
+                # The blob store is on another file system
+                shutil.copyfile(document.path(self._community.api.blob_store), target)
+        logger.info("Received document %s from %s", incoming.name, incoming.sender_key[-16:])
+        return document
+
+    def process(self):
+        """
+        Send the unacknowledged chunks of the outgoing transfers without progress again, fail the ones that ran out of
+        retries, and drop the incoming transfers whose sender went silent.
+        """
+        now = time.time()
+        failed = []
+        with self._lock:
+            for transfer in self._outgoing.values():
+                if now - transfer.last_progress < self.timeout:
+                    continue
+                transfer.attempts += 1
+                transfer.last_progress = now
+                if transfer.attempts > self.retries:
+                    logger.warning("Giving up on the transfer of %s", transfer.document.name)
+                    failed.append(transfer)
+                elif not transfer.offered:
+                    self._send_offer(transfer)
+                else:
+                    for index in xrange(transfer.next_index, transfer.next_to_send):
+                        if index not in transfer.received:
+                            self._send_chunk(transfer, index)
+
+            for key, incoming in self._incoming.items():
+                if now - incoming.last_activity > self.timeout * (self.retries + 1):
+                    logger.warning("Dropping the incomplete transfer of %s", incoming.name)
+                    incoming.writer.abort()
+                    del self._incoming[key]
+
+        for transfer in failed:
+            self._finish_outgoing(transfer, False)
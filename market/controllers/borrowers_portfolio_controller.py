@@ -1,3 +1,5 @@
+from twisted.internet.defer import gatherResults
+
 from market import Global
 from market.api.api import STATUS
 from market.models.loans import Mortgage, Investment, Campaign, LoanRequest
@@ -21,13 +23,21 @@ class BorrowersPortfolioController:
         """
         Setup the portfolio screen with up-to-date data.
         """
+        # Retrieve the loans
+        deferred = gatherResults([self.mainwindow.api.load_borrowers_loans_async(self.mainwindow.app.user),
+                                  self.mainwindow.api.load_borrowers_offers_async(self.mainwindow.app.user)],
+                                 consumeErrors=True)
+        deferred.addCallbacks(self.show_loans, self.mainwindow.show_load_error)
+
+    def show_loans(self, loans):
+        """
+        Fill the tables with the loaded accepted and pending loans.
+        """
         # Clear the table
         self.accepted_table.setRowCount(0)
         self.pending_table.setRowCount(0)
 
-        # Retrieve the loans
-        self.accepted_loans = self.mainwindow.api.load_borrowers_loans(self.mainwindow.app.user)
-        self.pending_loans = self.mainwindow.api.load_borrowers_offers(self.mainwindow.app.user)
+        self.accepted_loans, self.pending_loans = loans
 
         # Fill the table with loans
         self.add_accepted_loans()
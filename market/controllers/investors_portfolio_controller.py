@@ -23,21 +23,17 @@ class InvestorsPortfolioController:
         """
         Sets up the view.
         """
-        # Clear table
-        self.table.setRowCount(0)
-
         # Getting the investments from the investor
-        investments = self.mainwindow.api.load_investments(self.mainwindow.app.user)
-
-        # If the list is empty, do nothing. Otherwise fill table
-        if investments:
-            # Fill the investments table
-            self.fill_table(investments)
+        deferred = self.mainwindow.api.load_investments_async(self.mainwindow.app.user)
+        deferred.addCallbacks(self.fill_table, self.mainwindow.show_load_error)
 
     def fill_table(self, investments):
         """
         Fills the table with investments.
         """
+        # Clear table
+        self.table.setRowCount(0)
+
         for investment, house, campaign, profile in investments:
             # Property Address, Campaign Status, Investment Status, Amount Invested, Interest, Duration
             address = house.address + ' ' + house.house_number + ', ' + house.postal_code
@@ -136,6 +136,16 @@ class MainWindowController(QMainWindow):
         for i in range(0, len(row)):
             table.setItem(rowcount, i, QTableWidgetItem(str(row[i])))
 
+    def show_load_error(self, failure):
+        """
+
+            Shows a "Loading failed" alert when the data of a screen could not be loaded.
+
+            :param failure: The Failure of the Deferred loading the data
+
+        """
+        self.show_dialog("Loading failed", 'The data could not be loaded: %s' % failure.getErrorMessage())
+
     def show_dialog(self, title, message):
         """
 
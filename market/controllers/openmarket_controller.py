@@ -28,8 +28,15 @@ class OpenMarketController:
         """
         Setup the open market table with up-to-date data.
         """
+        deferred = self.mainwindow.api.load_open_market_async()
+        deferred.addCallbacks(self.show_open_market, self.mainwindow.show_load_error)
+
+    def show_open_market(self, content):
+        """
+        Fill the open market table with the loaded campaigns.
+        """
         self.table.setRowCount(0)
-        self.content = self.mainwindow.api.load_open_market()
+        self.content = content
         for tpl in self.content:
             mortgage = tpl[0]
             campaign = tpl[1]
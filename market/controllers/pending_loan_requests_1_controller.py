@@ -19,11 +19,17 @@ class PendingLoanRequests1Controller:
         """
         Setup the view with up-to-date data. Clears and reloads the table on re-entry of the page.
         """
+        # Getting the loan requests for the bank
+        deferred = self.mainwindow.api.load_all_loan_requests_async(self.mainwindow.app.user)
+        deferred.addCallbacks(self.show_loan_requests, self.mainwindow.show_load_error)
+
+    def show_loan_requests(self, loan_requests):
+        """
+        Fill the table with the loaded loan requests.
+        """
         # Clear table
         self.loan_request_table.setRowCount(0)
-
-        # Getting the loan requests for the bank
-        self.loan_requests = self.mainwindow.api.load_all_loan_requests(self.mainwindow.app.user)
+        self.loan_requests = loan_requests
 
         # If the list is empty, do nothing. Otherwise fill table
         if self.loan_requests:
@@ -18,6 +18,11 @@ class PendingLoanRequests2Controller:
         self.table = self.mainwindow.fiplr2_documents_table
         self.loan_request_id = None
         self.search = glob
+        # Loan request id -> {document name: path}, kept up to date by the TFTP server once a loan request is shown
+        self.documents = {}
+        self.tftp_server = self.mainwindow.app.tftp_server
+        if self.tftp_server:
+            self.tftp_server.subscribe(self.document_received)
 
         # Add listener to the 'accept' and 'reject' buttons
         self.mainwindow.fiplr2_accept_pushbutton.clicked.connect(self.accept_request)
@@ -29,8 +34,14 @@ class PendingLoanRequests2Controller:
         :param loan_request_id: The UUID of the loan request
         """
         self.loan_request_id = loan_request_id
-        [loan_request, borrower_profile, house] = self.mainwindow.api.load_single_loan_request(
-            {'loan_request_id': loan_request_id})
+        deferred = self.mainwindow.api.load_single_loan_request_async({'loan_request_id': loan_request_id})
+        deferred.addCallbacks(self.show_loan_request, self.mainwindow.show_load_error)
+
+    def show_loan_request(self, result):
+        """
+        Fill the view with the loaded loan request, the profile of its borrower and the house.
+        """
+        [loan_request, borrower_profile, house] = result
 
         # Insert personal information
         self.mainwindow.fiplr2_firstname_lineedit.setText(str(borrower_profile.first_name))
@@ -56,7 +67,47 @@ class PendingLoanRequests2Controller:
         self.mainwindow.fiplr2_property_value_lineedit.setText(str(house.price))
         self.mainwindow.fiplr2_description_textedit.setText(str(loan_request.description))
 
-        documents = self.search(os.getcwd() + '/resources/received/'+str(loan_request_id)+'/*.pdf')
+        self.show_documents()
+
+    def load_documents(self, loan_request_id):
+        """
+        Returns the paths of the documents received for a loan request. With a TFTP server the folder is only searched
+        the first time, after that the server reports the documents it receives.
+        :param loan_request_id: The UUID of the loan request
+        """
+        folder = str(loan_request_id)
+        if not self.tftp_server or folder not in self.documents:
+            documents = self.search(os.getcwd() + '/resources/received/' + folder + '/*.pdf')
+            if not self.tftp_server:
+                return documents
+            self.documents[folder] = dict((ntpath.basename(path), path) for path in documents)
+        return [path for _, path in sorted(self.documents[folder].items())]
+
+    def document_received(self, received):
+        """
+        Called by the TFTP server, on its own thread, for every file it received.
+        :param received: The `ReceivedFile`
+        """
+        from twisted.internet import reactor
+        reactor.callFromThread(self.add_document, received)
+
+    def add_document(self, received):
+        """
+        Add a received document to the documents of its loan request, and show it if the loan request is shown.
+        :param received: The `ReceivedFile`
+        """
+        if not received.name.endswith('.pdf') or received.folder not in self.documents:
+            # Not shown yet, the folder is searched once it is
+            return
+        self.documents[received.folder][received.name] = received.path
+        if received.folder == str(self.loan_request_id):
+            self.show_documents()
+
+    def show_documents(self):
+        """
+        Fill the table with the documents of the shown loan request.
+        """
+        documents = self.load_documents(self.loan_request_id)
         self.table.setRowCount(0)
         for i in range(0, len(documents)):
             self.table.insertRow(i)
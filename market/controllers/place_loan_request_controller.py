@@ -1,4 +1,5 @@
 from market import Global
+from market.api.tasks import FAILED
 
 
 class PlaceLoanRequestController:
@@ -15,6 +16,10 @@ class PlaceLoanRequestController:
             Global.BANKS['RABO'],
             Global.BANKS['MONEYOU'],
         ]
+        # Id of the task sending the documents of the loan request, if any
+        self.document_task_id = None
+        if self.mainwindow.api.task_runner:
+            self.mainwindow.api.task_runner.listeners.append(self.task_changed)
 
     def setup_view(self):
         pass
@@ -32,15 +37,32 @@ class PlaceLoanRequestController:
                                         'Your request is being processed and '
                                         'your documents are being uploaded.')
             if self.mainwindow.api.create_loan_request(self.mainwindow.app.user, payload):
-                if self.mainwindow.api.failed_documents:
-                    self.mainwindow.show_dialog("Documents error", 'Some of the documents could not be sent.')
-                else:
-                    self.mainwindow.show_dialog("Loan request created", 'Your loan request has been sent.')
+                self.mainwindow.show_dialog("Loan request created", 'Your loan request has been sent.')
+                # The documents are uploaded in the background
+                if self.mainwindow.api.document_task:
+                    self.document_task_id = self.mainwindow.api.document_task.id
+                elif self.mainwindow.api.document_uploads:
+                    self.mainwindow.api.document_uploads.addCallback(self.documents_uploaded)
             else:
                 self.mainwindow.show_dialog("Loan request error", 'You can only have a single loan request.')
         except ValueError:
             self.mainwindow.show_dialog("Loan request error", 'You didn\'t enter the required information.')
 
+    def documents_uploaded(self, failed_documents):
+        """
+        Shows a "Documents error" if some of the documents of the loan request could not be sent.
+        """
+        if failed_documents:
+            self.mainwindow.show_dialog("Documents error", 'Some of the documents could not be sent.')
+        return failed_documents
+
+    def task_changed(self, task):
+        """
+        Shows a "Documents error" once the task sending the documents of the loan request has given up.
+        """
+        if task.id == self.document_task_id and task.status == FAILED:
+            self.mainwindow.show_dialog("Documents error", 'Some of the documents could not be sent.')
+
     def get_data(self):
         """
         Retrieves data from the forms, and returns the data as a dict.
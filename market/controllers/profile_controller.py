@@ -25,6 +25,8 @@ class ProfileController:
         self.mainwindow.profile_save_pushbutton.clicked.connect(self.save_form)
         self.table = self.mainwindow.profile_documents_table
         self.prepare_table()
+        # Show the progress of the documents stored in the background
+        self.mainwindow.api.document_listeners.append(self.document_progress)
 
     def prepare_table(self):
         rows = len(DOCUMENT_NAMES)
@@ -47,15 +49,40 @@ class ProfileController:
             self.documents[document_name] = path
             self.table.setItem(index, 1, QTableWidgetItem(str(ntpath.basename(path))))
 
+    def document_progress(self, document, stored, size):
+        """
+        Show how much of a document saved with the profile has been stored.
+        :param document: The pending `Document`
+        :param stored: The amount of bytes stored, None if the document couldn't be stored
+        :param size: The size of the document
+        """
+        if document.name not in DOCUMENT_NAMES or not self.documents[document.name]:
+            return
+        file_name = ntpath.basename(self.documents[document.name])
+        if stored is None:
+            text = '%s (failed)' % file_name
+        elif stored < size:
+            text = '%s (%d%%)' % (file_name, 100 * stored // size)
+        else:
+            text = file_name
+        self.table.setItem(DOCUMENT_NAMES.index(document.name), 1, QTableWidgetItem(text))
+
     def setup_view(self):
         """
         Setup the profile screen with up-to-date data.
         """
         # Check if user already has a role, if so load the right data. Otherwise show an empty profile
         if self.mainwindow.app.user.role_id:
-            self.current_profile = self.mainwindow.api.load_profile(self.mainwindow.app.user)
-            if self.current_profile:
-                self.update_form(self.current_profile)
+            deferred = self.mainwindow.api.load_profile_async(self.mainwindow.app.user)
+            deferred.addCallbacks(self.show_profile, self.mainwindow.show_load_error)
+
+    def show_profile(self, profile):
+        """
+        Fill the form with the loaded profile.
+        """
+        self.current_profile = profile
+        if self.current_profile:
+            self.update_form(self.current_profile)
 
     def save_form(self):
         """
@@ -0,0 +1,87 @@
+"""
+Compressed archive files for blocks moved out of the `block_chain` table.
+
+An archive file holds the blocks between two checkpoints as zlib compressed, length prefixed
+`market.community.encoding` rows, in the order of `PersistentBackend.BLOCK_QUERY`.
+"""
+import os
+import struct
+import zlib
+
+from market.community.encoding import encode, decode
+
+ROW_HEADER = struct.Struct('>I')
+
+# Indexes of the columns of a block row.
+BENEFACTOR, BENEFICIARY, SEQUENCE_NUMBER_BENEFACTOR, SEQUENCE_NUMBER_BENEFICIARY, HASH_BLOCK = 0, 1, 4, 5, 11
+
+
+def write_archive(file_path, rows):
+    """
+    Write the rows to an archive file. The file is written under a temporary name first, so it is either complete or
+    missing.
+    :param file_path: The path of the archive
+    :param rows: The block rows
+    """
+    compressor = zlib.compressobj(9)
+    temporary_path = file_path + '.tmp'
+    with open(temporary_path, 'wb') as archive_file:
+        for row in rows:
+            data = encode(tuple(row))
+            archive_file.write(compressor.compress(ROW_HEADER.pack(len(data)) + data))
+        archive_file.write(compressor.flush())
+        archive_file.flush()
+        os.fsync(archive_file.fileno())
+    os.rename(temporary_path, file_path)
+
+
+def read_archive(file_path):
+    """
+    Read all rows of an archive file.
+    :return: List of block rows
+    """
+    with open(file_path, 'rb') as archive_file:
+        data = zlib.decompress(archive_file.read())
+
+    rows = []
+    offset = 0
+    while offset < len(data):
+        length, = ROW_HEADER.unpack_from(data, offset)
+        offset += ROW_HEADER.size
+        rows.append(decode(data[offset:offset + length])[1])
+        offset += length
+    return rows
+
+
+class ArchivedBlocks(object):
+    """
+    The rows of an archive file, indexed for the `BlockChain` lookups.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.by_hash = {}
+        self.by_benefactor = {}
+        self.by_beneficiary = {}
+        for row in rows:
+            self.by_hash.setdefault(row[HASH_BLOCK], row)
+            self.by_benefactor.setdefault((row[BENEFACTOR], row[SEQUENCE_NUMBER_BENEFACTOR]), row)
+            self.by_beneficiary.setdefault((row[BENEFICIARY], row[SEQUENCE_NUMBER_BENEFICIARY]), row)
+
+    def get_by_public_key_and_sequence_number(self, public_key, sequence_number):
+        return self.by_benefactor.get((public_key, sequence_number)) or \
+            self.by_beneficiary.get((public_key, sequence_number))
+
+    def get_range(self, public_key, from_sequence_number, to_sequence_number):
+        """
+        :return: List of (sequence number of the public key, row) tuples
+        """
+        result = []
+        for row in self.rows:
+            if row[BENEFACTOR] == public_key and from_sequence_number <= row[SEQUENCE_NUMBER_BENEFACTOR] <= \
+                    to_sequence_number:
+                result.append((row[SEQUENCE_NUMBER_BENEFACTOR], row))
+            elif row[BENEFICIARY] == public_key and from_sequence_number <= row[SEQUENCE_NUMBER_BENEFICIARY] <= \
+                    to_sequence_number:
+                result.append((row[SEQUENCE_NUMBER_BENEFICIARY], row))
+        return result
@@ -0,0 +1,145 @@
+"""
+Running database calls off the reactor thread.
+
+`AsyncMarketDatabase` mirrors the `MarketDatabase` methods, but returns Deferreds. Writes are done by a single writer
+thread, in the order they were issued, while reads, such as the loaders of the GUI screens, are spread over a small pool
+of reader threads. Every thread opens its own `MarketDatabase` through a factory, as an SQLite connection can only be
+used by the thread that opened it. The readers only need a `ReadOnlyBackend`.
+
+The results are handed back on the reactor thread. Reads are not ordered with respect to the writes of the writer
+thread, so a read that must see such a write should be chained to the Deferred of that write.
+"""
+import logging
+from Queue import Queue
+from threading import Thread
+
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+logger = logging.getLogger(__name__)
+
+# Amount of reader threads.
+READER_THREADS = 2
+
+
+class DatabaseThread(Thread):
+    """
+    A thread with its own database, running the calls it takes from a queue.
+    """
+
+    def __init__(self, name, queue, database_factory, call_in_reactor):
+        super(DatabaseThread, self).__init__(name=name)
+        self.daemon = True
+        self.queue = queue
+        self.database_factory = database_factory
+        self.call_in_reactor = call_in_reactor
+
+    def run(self):
+        try:
+            database = self.database_factory()
+        except Exception:
+            logger.exception("Unable to open the database of %s", self.name)
+            database = None
+            failure = Failure()
+
+        try:
+            while True:
+                call = self.queue.get()
+                if call is None:
+                    break
+
+                func, args, deferred = call
+                if database is None:
+                    self.call_in_reactor(deferred.errback, failure)
+                    continue
+
+                try:
+                    result = func(database, *args)
+                except Exception:
+                    self.call_in_reactor(deferred.errback, Failure())
+                else:
+                    self.call_in_reactor(deferred.callback, result)
+        finally:
+            if database is not None and hasattr(database.backend, 'close'):
+                database.backend.close()
+
+
+class AsyncMarketDatabase(object):
+    """
+    A `MarketDatabase` whose methods return Deferreds and run on dedicated threads.
+    """
+
+    def __init__(self, database_factory, readers=READER_THREADS, call_in_reactor=None, reader_factory=None):
+        """
+        :param database_factory: Callable returning a new `MarketDatabase`, called once on the writer thread
+        :param readers: The amount of reader threads
+        :param call_in_reactor: Callable used to run the result callbacks on the reactor thread, defaults to
+        `reactor.callFromThread`
+        :param reader_factory: Callable returning a new read only `MarketDatabase`, called once on every reader thread,
+        defaults to `database_factory`
+        """
+        if call_in_reactor is None:
+            from twisted.internet import reactor
+            call_in_reactor = reactor.callFromThread
+
+        self._write_queue = Queue()
+        self._read_queue = Queue()
+        self._threads = [DatabaseThread("database-writer", self._write_queue, database_factory, call_in_reactor)]
+        self._threads.extend(DatabaseThread("database-reader-%d" % i, self._read_queue,
+                                            reader_factory or database_factory, call_in_reactor)
+                             for i in xrange(readers))
+        self.running = False
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+        self.running = True
+
+    def stop(self, timeout=None):
+        """
+        Stop the threads once the calls issued before have been run.
+        """
+        if not self.running:
+            return
+        self.running = False
+
+        self._write_queue.put(None)
+        for _ in self._threads[1:]:
+            self._read_queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def run_read(self, func, *args):
+        """
+        Run a read only function on a reader thread.
+        :param func: Function called with the `MarketDatabase` of the thread and `args`
+        :return: Deferred firing with the result of the function
+        """
+        deferred = Deferred()
+        self._read_queue.put((func, args, deferred))
+        return deferred
+
+    def run_write(self, func, *args):
+        """
+        Run a function on the writer thread, after all writes issued before it.
+        :param func: Function called with the `MarketDatabase` of the thread and `args`
+        :return: Deferred firing with the result of the function
+        """
+        deferred = Deferred()
+        self._write_queue.put((func, args, deferred))
+        return deferred
+
+    def get(self, _type, _id):
+        return self.run_read(lambda database: database.get(_type, _id))
+
+    def get_all(self, _type):
+        return self.run_read(lambda database: database.get_all(_type))
+
+    def post(self, _type, obj):
+        return self.run_write(lambda database: database.post(_type, obj))
+
+    def put(self, _type, _id, obj):
+        return self.run_write(lambda database: database.put(_type, _id, obj))
+
+    def delete(self, obj):
+        return self.run_write(lambda database: database.delete(obj))
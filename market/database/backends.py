@@ -1,9 +1,38 @@
+from Queue import Queue
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
 from hashlib import sha256
 from os import path
+from threading import RLock, local
+import os
+import sqlite3
 import time
 
+from dispersy.crypto import ECCrypto
 from dispersy.database import Database
 from market.community.encoding import encode
+from market.database.archive import ArchivedBlocks, read_archive, write_archive
+from market.database.digest import DIGEST_BUCKETS, EMPTY_DIGEST, DigestTree, model_bucket, model_digest, xor_digest
+
+
+# A signed summary of the block chain up to and including the block at `height`, see `PersistentBackend`.
+Checkpoint = namedtuple('Checkpoint', ['height', 'position', 'hash_block', 'digest', 'signer', 'signature', 'archive'])
+
+# The PRAGMA statements run when a `PersistentBackend` is opened, per durability profile.
+DURABILITY_PROFILES = {
+    # A rollback journal that is synced on every commit, readers block the writer.
+    'strict': (u"PRAGMA journal_mode = DELETE", u"PRAGMA synchronous = FULL"),
+    # A write-ahead log that is only synced at checkpoints, readers don't block the writer. A crash can lose the last
+    # commits, but doesn't corrupt the database.
+    'balanced': (u"PRAGMA journal_mode = WAL", u"PRAGMA synchronous = NORMAL"),
+    # For loading large amounts of data, a crash can corrupt the database.
+    'bulk-load': (u"PRAGMA journal_mode = MEMORY", u"PRAGMA synchronous = OFF"),
+}
+DEFAULT_DURABILITY = 'balanced'
+# Seconds between two runs of `PersistentBackend.maintenance`.
+MAINTENANCE_INTERVAL = 900.0
+# Amount of read only connections a `PersistentBackend` opens next to its writer connection, in WAL mode only.
+READER_CONNECTIONS = 2
 
 
 class Backend(object):
@@ -98,6 +127,142 @@ class Backend(object):
         """
         raise NotImplementedError
 
+    def save_task(self, task_id, name, arguments, status, attempts, error, after):
+        """
+        Store a task of the task runner, replacing the task with the same id.
+        :param task_id: The id of the task
+        :param name: The name of the task
+        :param arguments: The encoded arguments of the task
+        :param status: The status of the task
+        :param attempts: The amount of times the task was run
+        :param error: The error of the last attempt, if any
+        :param after: The id of the task this task waits for, if any
+        """
+        raise NotImplementedError
+
+    def get_tasks(self, statuses=None):
+        """
+        Return the stored tasks, in the order they were first stored.
+        :param statuses: The statuses of the tasks to return, all tasks if None
+        :return: A list of (id, name, arguments, status, attempts, error, after) tuples
+        """
+        raise NotImplementedError
+
+    def delete_task(self, task_id):
+        """
+        Delete a stored task.
+        :param task_id: The id of the task
+        """
+        raise NotImplementedError
+
+    def put_inbox_entry(self, bank_id, loan_request_id, status, received_at=None):
+        """
+        Store a loan request in the inbox of a bank, or update its status if it is there already.
+        :param bank_id: The id of the bank
+        :param loan_request_id: The id of the loan request
+        :param status: The status of the loan request for the bank
+        :param received_at: The time the loan request was received, defaults to now. Kept when updating an entry.
+        """
+        raise NotImplementedError
+
+    def get_inbox(self, bank_id, status=None, limit=None, offset=0):
+        """
+        Return a page of the inbox of a bank, in the order the loan requests were received.
+        :param bank_id: The id of the bank
+        :param status: The status of the loan requests to return, all loan requests if None
+        :param limit: The maximum amount of entries to return, all entries if None
+        :param offset: The amount of entries to skip
+        :return: A list of (loan_request_id, status, received_at) tuples
+        """
+        raise NotImplementedError
+
+    def count_inbox(self, bank_id, status=None):
+        """
+        Count the loan requests in the inbox of a bank.
+        :param bank_id: The id of the bank
+        :param status: The status of the loan requests to count, all loan requests if None
+        """
+        raise NotImplementedError
+
+    def delete_inbox_entry(self, bank_id, loan_request_id):
+        """
+        Remove a loan request from the inbox of a bank.
+        :param bank_id: The id of the bank
+        :param loan_request_id: The id of the loan request
+        """
+        raise NotImplementedError
+
+    def put_investment_index(self, investment_id, mortgage_id, investor_key, status):
+        """
+        Index a stored investment by its mortgage and by its investor, replacing the entry of the investment if any.
+        :param investment_id: The id of the investment
+        :param mortgage_id: The id of the mortgage the investment is made in
+        :param investor_key: The id of the investor
+        :param status: The status of the investment
+        """
+        raise NotImplementedError
+
+    def delete_investment_index(self, investment_id):
+        """
+        Remove an investment from the index.
+        :param investment_id: The id of the investment
+        """
+        raise NotImplementedError
+
+    def get_investments(self, mortgage_id=None, investor_key=None, status=None):
+        """
+        Return the stored investments matching the index, in the order they were first indexed.
+        :param mortgage_id: The id of the mortgage of the investments, any mortgage if None
+        :param investor_key: The id of the investor of the investments, any investor if None
+        :param status: The status of the investments, any status if None
+        :return: A list of the stored values of the investments
+        """
+        raise NotImplementedError
+
+    def get_bucket_digests(self):
+        """
+        Return the digests of all buckets, see `market.database.digest`.
+        :return: A list of `DIGEST_BUCKETS` digests
+        """
+        raise NotImplementedError
+
+    def get_bucket_entries(self, bucket):
+        """
+        Return the stored values that fall in a bucket.
+        :param bucket: The bucket index
+        :return: A sorted list of (type name, id, digest) tuples
+        """
+        raise NotImplementedError
+
+    def get_digest_tree(self):
+        """
+        Return the merkle tree over the bucket digests.
+        :return: `DigestTree`
+        """
+        return DigestTree(self.get_bucket_digests())
+
+    def get_digest_root(self):
+        """
+        Return the root digest over all stored values. Two backends with the same root hold the same values.
+        :return: The root digest
+        """
+        return self.get_digest_tree().root
+
+    @contextmanager
+    def read_transaction(self):
+        """
+        Run the reads within the block on a consistent snapshot of the backend, if the backend supports it.
+        """
+        yield
+
+    @contextmanager
+    def transaction(self):
+        """
+        Apply the writes within the block as a single unit of work, if the backend supports it. When the block raises,
+        its writes are undone.
+        """
+        yield
+
 
 class BlockChain(object):
     def add_block(self, block):
@@ -121,6 +286,14 @@ class BlockChain(object):
         """
         raise NotImplementedError
 
+    def get_latest_link_hash(self):
+        """
+        Get the link hash of the latest block in the chain, see `DatabaseBlock.link_hash`. This is what a new block,
+        of this chain or of the chain of the other party of an agreement, refers to as its previous hash.
+        :return: the link hash, or '' if the chain is empty
+        """
+        raise NotImplementedError
+
     def get_by_hash(self, hash):
         """
         Returns a block saved in the persistence.
@@ -137,6 +310,33 @@ class BlockChain(object):
         :return: The block that was requested or None"""
         raise NotImplementedError
 
+    def get_range(self, public_key, from_sequence_number, to_sequence_number):
+        """
+        Returns the blocks of a public key within a range of its sequence numbers.
+        :param public_key: The public key, either as benefactor or as beneficiary
+        :param from_sequence_number: The first sequence number (inclusive)
+        :param to_sequence_number: The last sequence number (inclusive)
+        :return: A list of blocks ordered by the sequence number of the public key
+        """
+        raise NotImplementedError
+
+    def get_incomplete_blocks(self, public_key, limit):
+        """
+        Returns the blocks of a benefactor that lack the signature of the beneficiary.
+        :param public_key: The public key of the benefactor
+        :param limit: The maximum amount of blocks returned
+        :return: A list of blocks ordered by the sequence number of the benefactor
+        """
+        raise NotImplementedError
+
+    def iter_blocks(self, after_position=0):
+        """
+        Iterate over the blocks in the order they were added to the chain.
+        :param after_position: Only return the blocks after this position
+        :return: Generator of (position, row) tuples, the row holding the columns of `PersistentBackend.BLOCK_QUERY`
+        """
+        raise NotImplementedError
+
     def _create_database_block(self, db_result):
         """
         Create a Database block or return None.
@@ -166,7 +366,25 @@ class BlockChain(object):
         Generates the genesis block.
         :return: DatabaseBlock, the genesis block
         """
-        raise NotImplementedError
+        packet = encode(
+            (
+                str(''),  # benefactor,
+                str(''),  # beneficiary,
+                str(None),  # agreement_benefactor,
+                str(None),  # agreement_beneficiary,
+                0,  # sequence_number_benefactor,
+                0,  # sequence_number_beneficiary,
+                str(''),  # previous_hash_benefactor,
+                str(''),  # previous_hash_beneficiary,
+                str(''),  # signature_benefactor,
+                str(''),  # signature_beneficiary,
+                0  # insert_time
+            )
+        )
+        hash = sha256(packet).hexdigest()
+
+        return DatabaseBlock((str(''), str(''), str(None), str(None), 0, 0,
+                              str(''), str(''), str(''), str(''), 0, str(hash)))
 
     def check_add_genesis_block(self):
         """
@@ -179,8 +397,11 @@ class MemoryBackend(Backend):
     """
     An in memory implementation of the backend.
     """
-    _data = {'__option': {}}
-    _id = {}
+
+    def __init__(self):
+        self._data = {'__option': {}}
+        self._id = {}
+        self._digests = [EMPTY_DIGEST] * DIGEST_BUCKETS
 
     def get(self, type_name, value_id):
         try:
@@ -197,9 +418,11 @@ class MemoryBackend(Backend):
 
         self._data[type_name][value_id] = obj
         self._id[value_id] = True
+        self._update_digest(type_name, value_id, None, obj)
 
     def put(self, type_name, value_id, obj):
         if self.exists(type_name, value_id):
+            self._update_digest(type_name, value_id, self._data[type_name][value_id], obj)
             self._data[type_name][value_id] = obj
             return True
         return False
@@ -207,10 +430,19 @@ class MemoryBackend(Backend):
     def delete(self, obj):
         if obj:
             if self.exists(obj.type, obj.id):
+                self._update_digest(obj.type, obj.id, self._data[obj.type][obj.id], None)
                 del self._data[obj.type][obj.id]
+                self._id.pop(obj.id, None)
                 return True
         return False
 
+    def _update_digest(self, type_name, value_id, old, new):
+        bucket = model_bucket(type_name, value_id)
+        if old is not None:
+            self._digests[bucket] = xor_digest(self._digests[bucket], model_digest(type_name, value_id, old))
+        if new is not None:
+            self._digests[bucket] = xor_digest(self._digests[bucket], model_digest(type_name, value_id, new))
+
     def id_available(self, value_id):
         return value_id not in self._id
 
@@ -222,6 +454,7 @@ class MemoryBackend(Backend):
     def clear(self):
         self._data = {'__option': {}}
         self._id = {}
+        self._digests = [EMPTY_DIGEST] * DIGEST_BUCKETS
 
     def get_all(self, type_name):
         try:
@@ -238,6 +471,67 @@ class MemoryBackend(Backend):
         except:
             raise KeyError
 
+    def save_task(self, task_id, name, arguments, status, attempts, error, after):
+        self._data.setdefault('__task', OrderedDict())[task_id] = (task_id, name, arguments, status, attempts, error,
+                                                                    after)
+
+    def get_tasks(self, statuses=None):
+        return [task for task in self._data.get('__task', {}).values() if statuses is None or task[3] in statuses]
+
+    def delete_task(self, task_id):
+        self._data.get('__task', {}).pop(task_id, None)
+
+    def put_inbox_entry(self, bank_id, loan_request_id, status, received_at=None):
+        inbox = self._data.setdefault('__inbox', {}).setdefault(bank_id, OrderedDict())
+        if loan_request_id in inbox:
+            received_at = inbox[loan_request_id][2]
+        elif received_at is None:
+            received_at = time.time()
+        inbox[loan_request_id] = (loan_request_id, status, received_at)
+
+    def _inbox_entries(self, bank_id, status):
+        entries = self._data.get('__inbox', {}).get(bank_id, {}).values()
+        return sorted([entry for entry in entries if status is None or entry[1] == status], key=lambda entry: entry[2])
+
+    def get_inbox(self, bank_id, status=None, limit=None, offset=0):
+        entries = self._inbox_entries(bank_id, status)[offset:]
+        return entries if limit is None else entries[:limit]
+
+    def count_inbox(self, bank_id, status=None):
+        return len(self._inbox_entries(bank_id, status))
+
+    def delete_inbox_entry(self, bank_id, loan_request_id):
+        self._data.get('__inbox', {}).get(bank_id, {}).pop(loan_request_id, None)
+
+    def put_investment_index(self, investment_id, mortgage_id, investor_key, status):
+        self._data.setdefault('__investment', OrderedDict())[investment_id] = (mortgage_id, investor_key, status)
+
+    def delete_investment_index(self, investment_id):
+        self._data.get('__investment', {}).pop(investment_id, None)
+
+    def get_investments(self, mortgage_id=None, investor_key=None, status=None):
+        investments = []
+        for investment_id, (entry_mortgage_id, entry_investor_key, entry_status) in \
+                self._data.get('__investment', {}).iteritems():
+            if (mortgage_id is None or entry_mortgage_id == mortgage_id) and \
+                    (investor_key is None or entry_investor_key == investor_key) and \
+                    (status is None or entry_status == status):
+                investments.append(self._data['investment'][investment_id])
+        return investments
+
+    def get_bucket_digests(self):
+        return list(self._digests)
+
+    def get_bucket_entries(self, bucket):
+        entries = []
+        for type_name, values in self._data.iteritems():
+            if type_name.startswith('__'):
+                continue
+            for value_id, value in values.iteritems():
+                if model_bucket(type_name, value_id) == bucket:
+                    entries.append((type_name, value_id, model_digest(type_name, value_id, value)))
+        return sorted(entries)
+
 
 class PersistentBackend(Database, Backend, BlockChain):
     """
@@ -247,8 +541,20 @@ class PersistentBackend(Database, Backend, BlockChain):
 
     # Path to the database location + dispersy._workingdirectory
     DATABASE_PATH = u"market.db"
+    # Selects the columns of a block in the order `DatabaseBlock` expects them.
+    BLOCK_QUERY = u"SELECT benefactor, beneficiary, " \
+                  u"agreement_benefactor, agreement_beneficiary, sequence_number_benefactor, " \
+                  u"sequence_number_beneficiary, previous_hash_benefactor, " \
+                  u"previous_hash_beneficiary, signature_benefactor, signature_beneficiary, " \
+                  u"insert_time, hash_block, previous_hash, sequence_number " \
+                  u"FROM `block_chain` "
     # Version to keep track if the db schema needs to be updated.
-    LATEST_DB_VERSION = 1
+    LATEST_DB_VERSION = 10
+    # Amount of archive files kept in memory for lookups that fall through the `block_chain` table.
+    ARCHIVE_CACHE_SIZE = 2
+    # Seconds after which an incomplete block no longer holds back archiving, it is archived without the signature of
+    # the beneficiary.
+    INCOMPLETE_BLOCK_TIMEOUT = 7 * 24 * 60 * 60
     # Schema for the DB.
     schema = u"""
     CREATE TABLE IF NOT EXISTS market(
@@ -256,7 +562,15 @@ class PersistentBackend(Database, Backend, BlockChain):
      type_name		            TEXT NOT NULL,
      value                      TEXT NOT NULL,
 
-     insert_time                TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL
+     insert_time                TIMESTAMP DEFAULT CURRENT_TIMESTAMP NOT NULL,
+     digest_bucket              INTEGER,
+     digest                     BLOB
+     );
+
+
+    CREATE TABLE IF NOT EXISTS market_digest(
+     bucket                     INTEGER PRIMARY KEY,
+     digest                     BLOB NOT NULL
      );
 
 
@@ -279,19 +593,254 @@ class PersistentBackend(Database, Backend, BlockChain):
      sequence_number              INTEGER NOT NULL
      );
 
+    CREATE INDEX IF NOT EXISTS block_chain_benefactor_idx ON block_chain(benefactor, sequence_number_benefactor);
+    CREATE INDEX IF NOT EXISTS block_chain_beneficiary_idx ON block_chain(beneficiary, sequence_number_beneficiary);
+    CREATE INDEX IF NOT EXISTS block_chain_hash_idx ON block_chain(hash_block);
+    CREATE INDEX IF NOT EXISTS block_chain_incomplete_idx ON block_chain(benefactor, sequence_number_benefactor)
+     WHERE length(signature_beneficiary) = 0;
+
+
+    CREATE TABLE IF NOT EXISTS block_checkpoint(
+     height                       INTEGER PRIMARY KEY,
+     position                     INTEGER NOT NULL,
+     hash_block                   TEXT NOT NULL,
+     digest                       TEXT NOT NULL,
+     signer                       TEXT NOT NULL,
+     signature                    TEXT NOT NULL,
+     archive                      TEXT
+     );
+
+
+    CREATE TABLE IF NOT EXISTS archived_block(
+     hash_block                   TEXT NOT NULL,
+     benefactor                   TEXT NOT NULL,
+     sequence_number_benefactor   INTEGER NOT NULL,
+     beneficiary                  TEXT NOT NULL,
+     sequence_number_beneficiary  INTEGER NOT NULL,
+     archive                      TEXT NOT NULL
+     );
+
+    CREATE INDEX IF NOT EXISTS archived_block_benefactor_idx ON archived_block(benefactor, sequence_number_benefactor);
+    CREATE INDEX IF NOT EXISTS archived_block_beneficiary_idx ON archived_block(beneficiary, sequence_number_beneficiary);
+    CREATE INDEX IF NOT EXISTS archived_block_hash_idx ON archived_block(hash_block);
+
+
+    CREATE TABLE IF NOT EXISTS task(
+     id                           TEXT PRIMARY KEY,
+     name                         TEXT NOT NULL,
+     arguments                    TEXT NOT NULL,
+     status                       TEXT NOT NULL,
+     attempts                     INTEGER NOT NULL,
+     error                        TEXT,
+     after                        TEXT
+     );
+
+
+    CREATE TABLE IF NOT EXISTS loan_request_inbox(
+     bank_id                      TEXT NOT NULL,
+     loan_request_id              TEXT NOT NULL,
+     status                       INTEGER NOT NULL,
+     received_at                  REAL NOT NULL,
+     PRIMARY KEY (bank_id, loan_request_id)
+     );
+
+    CREATE INDEX IF NOT EXISTS loan_request_inbox_status_idx ON loan_request_inbox(bank_id, status, received_at);
+
+
+    CREATE TABLE IF NOT EXISTS investment_index(
+     id                           TEXT PRIMARY KEY,
+     mortgage_id                  TEXT NOT NULL,
+     investor_key                 TEXT NOT NULL,
+     status                       INTEGER NOT NULL
+     );
+
+    CREATE INDEX IF NOT EXISTS investment_index_mortgage_idx ON investment_index(mortgage_id, status);
+    CREATE INDEX IF NOT EXISTS investment_index_investor_idx ON investment_index(investor_key, status);
+
 
     CREATE TABLE IF NOT EXISTS option(key TEXT PRIMARY KEY, value BLOB);
     INSERT INTO option(key, value) VALUES('database_version', '""" + str(LATEST_DB_VERSION) + u"""');
     """
 
-    def __init__(self, working_directory, database_name=DATABASE_PATH):
+    def __init__(self, working_directory, database_name=DATABASE_PATH, durability=DEFAULT_DURABILITY,
+                 readers=READER_CONNECTIONS):
+        """
+        :param working_directory: The directory of the database
+        :param database_name: The file name of the database
+        :param durability: The durability profile, one of `DURABILITY_PROFILES`
+        :param readers: The amount of read only connections used by `read_transaction`
+        """
+        if durability not in DURABILITY_PROFILES:
+            raise ValueError("Unknown durability profile %s" % durability)
+
         super(PersistentBackend, self).__init__(path.join(working_directory, database_name))
+        self.durability = durability
+        self.journal_mode = None
+        self.readers = readers
+        self._reader_connections = None
+        # The cursor of the read transaction of the current thread, if any.
+        self._read_state = local()
+        # Depth of the open write transactions, commits are held back while it is above 0.
+        self._transaction_depth = 0
+        # Serializes appends, so the chain head can't change between reading it and writing the next block.
+        self.chain_lock = RLock()
+        # Archived blocks are stored next to the database.
+        self.archive_directory = path.join(working_directory, database_name) + u".archive"
+        self._archive_cache = []
         self.open()
 
     def open(self, initial_statements=True, prepare_visioning=True):
-        return super(PersistentBackend, self).open(initial_statements, prepare_visioning)
+        result = super(PersistentBackend, self).open(initial_statements, prepare_visioning)
+        self._apply_durability()
+        self._open_readers()
+        self._load_chain_head()
+        return result
+
+    def _open_readers(self):
+        """
+        Open the read only connections. Only a write-ahead log lets readers run alongside the writer.
+        """
+        if self.journal_mode != 'wal' or not self.readers:
+            return
+
+        self._reader_connections = Queue()
+        for _ in xrange(self.readers):
+            # Autocommit mode, so the read transactions are started and ended explicitly.
+            connection = sqlite3.connect(self.file_path, check_same_thread=False, isolation_level=None)
+            connection.text_factory = self._connection.text_factory
+            connection.execute(u"PRAGMA query_only = ON")
+            self._reader_connections.put(connection)
+
+    def _close_readers(self):
+        if self._reader_connections is None:
+            return
+        for _ in xrange(self.readers):
+            self._reader_connections.get().close()
+        self._reader_connections = None
+
+    @contextmanager
+    def read_transaction(self):
+        """
+        Run the reads within the block on a read only connection, all seeing the same snapshot of the database.
+
+        The writer connection is not blocked by the transaction, nor does the transaction see the writes made during
+        it. Nested read transactions join the outer one. Without read only connections the reads run on the writer
+        connection as usual.
+        """
+        # Within a write transaction the reads have to see its uncommitted writes.
+        if self._reader_connections is None or getattr(self._read_state, 'cursor', None) is not None or \
+                self._transaction_depth:
+            yield
+            return
+
+        connection = self._reader_connections.get()
+        cursor = connection.cursor()
+        cursor.execute(u"BEGIN")
+        self._read_state.cursor = cursor
+        try:
+            yield
+        finally:
+            self._read_state.cursor = None
+            cursor.execute(u"COMMIT")
+            cursor.close()
+            self._reader_connections.put(connection)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold back the commits of the writes within the block and commit them at once at the end, or roll them back if
+        the block raises. Nested transactions join the outer one.
+        """
+        self._transaction_depth += 1
+        try:
+            yield
+        except:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.rollback()
+            raise
+        else:
+            self._transaction_depth -= 1
+            if not self._transaction_depth:
+                self.commit()
+
+    def commit(self, exiting=False):
+        if self._transaction_depth:
+            return
+        return super(PersistentBackend, self).commit(exiting)
+
+    def rollback(self):
+        """
+        Undo the uncommitted writes.
+        """
+        self._connection.rollback()
+        # The chain head cache may refer to a block that was rolled back.
+        self._load_chain_head()
+
+    def _read(self, statement, bindings=()):
+        """
+        Execute a read only statement, within the read transaction of the current thread if there is one.
+        """
+        cursor = getattr(self._read_state, 'cursor', None)
+        if cursor is not None:
+            return cursor.execute(statement, bindings)
+        return self.execute(statement, bindings)
+
+    def _apply_durability(self):
+        # The journal mode can't be changed within a transaction.
+        self.commit()
+        for statement in DURABILITY_PROFILES[self.durability]:
+            db_result = self.execute(statement).fetchone()
+            if statement.startswith(u"PRAGMA journal_mode"):
+                self.journal_mode = str(db_result[0]).lower()
+
+    def maintenance(self):
+        """
+        Checkpoint the write-ahead log and refresh the statistics of the query planner.
+
+        The statistics are gathered with ANALYZE the first time, afterwards `PRAGMA optimize` only analyzes the tables
+        whose statistics are out of date.
+        """
+        self.commit()
+        if self.journal_mode == 'wal':
+            self.execute(u"PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+
+        db_query = u"SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'sqlite_stat1'"
+        if self.execute(db_query).fetchone():
+            self.execute(u"PRAGMA optimize").fetchall()
+        else:
+            self.execute(u"ANALYZE")
+        self.commit()
+
+    def _load_chain_head(self):
+        """
+        Load the chain head cache from the database.
+
+        The cache holds the hash, link hash, sequence number and identifying key of the latest block and the length of
+        the chain, so appending a block does not have to query the chain. It assumes this backend is the only writer of
+        the chain.
+        """
+        db_result = self.execute(self.BLOCK_QUERY + u"ORDER BY ROWID DESC LIMIT 1").fetchone()
+
+        if db_result:
+            block = DatabaseBlock.from_row(db_result)
+            self._latest_hash = block.hash_block
+            self._latest_link_hash = block.link_hash()
+            self._latest_sequence_number = block.sequence_number
+            self._latest_key = (block.insert_time, block.sequence_number_benefactor, block.benefactor)
+            self._chain_length = self.execute(u"SELECT COUNT(*) FROM block_chain").fetchone()[0]
+        else:
+            self._reset_chain_head()
+
+    def _reset_chain_head(self):
+        self._latest_hash = ''
+        self._latest_link_hash = ''
+        self._latest_sequence_number = 0
+        self._latest_key = None
+        self._chain_length = 0
 
     def close(self, commit=True):
+        self._close_readers()
         return super(PersistentBackend, self).close(commit)
 
     def check_database(self, database_version):
@@ -300,17 +849,195 @@ class PersistentBackend(Database, Backend, BlockChain):
         assert int(database_version) >= 0
         database_version = int(database_version)
 
-        if database_version < self.LATEST_DB_VERSION:
-            # Remove all previous data, since we have only been testing so far, and previous blocks might not be
-            # reliable. In the future, we should implement an actual upgrade procedure
+        if database_version < 1:
+            # A new database, create the latest schema.
             self.executescript(self.schema)
             self.commit()
+        elif database_version < self.LATEST_DB_VERSION:
+            self._upgrade_database(database_version)
 
         return self.LATEST_DB_VERSION
 
+    def _upgrade_database(self, database_version):
+        """
+        Upgrade an existing database one version at a time, using the `_upgrade_to_<version>` methods.
+        The upgrade steps are idempotent, so an interrupted upgrade can simply be run again.
+        :param database_version: The current version of the database
+        """
+        for version in xrange(database_version + 1, self.LATEST_DB_VERSION + 1):
+            getattr(self, '_upgrade_to_%d' % version)()
+            self.execute(u"INSERT OR REPLACE INTO `option` (key, value) VALUES ('database_version', ?)",
+                         (unicode(version),))
+            self.commit()
+
+    def _get_columns(self, table):
+        return [row[1] for row in self.execute(u"PRAGMA table_info(`%s`)" % table).fetchall()]
+
+    def _upgrade_to_2(self):
+        """
+        Add the bucketed digests over the stored values.
+        """
+        columns = self._get_columns(u"market")
+        if u"digest_bucket" not in columns:
+            self.execute(u"ALTER TABLE `market` ADD COLUMN digest_bucket INTEGER")
+        if u"digest" not in columns:
+            self.execute(u"ALTER TABLE `market` ADD COLUMN digest BLOB")
+        self.execute(u"CREATE TABLE IF NOT EXISTS market_digest(bucket INTEGER PRIMARY KEY, digest BLOB NOT NULL)")
+        self.rebuild_digests()
+
+    def _upgrade_to_3(self):
+        """
+        Index the block chain by public key and sequence number, and by hash.
+        """
+        self.execute(u"CREATE INDEX IF NOT EXISTS block_chain_benefactor_idx "
+                     u"ON block_chain(benefactor, sequence_number_benefactor)")
+        self.execute(u"CREATE INDEX IF NOT EXISTS block_chain_beneficiary_idx "
+                     u"ON block_chain(beneficiary, sequence_number_beneficiary)")
+        self.execute(u"CREATE INDEX IF NOT EXISTS block_chain_hash_idx ON block_chain(hash_block)")
+
+    def _upgrade_to_4(self):
+        """
+        Add the checkpoints of the block chain.
+        """
+        self.execute(u"CREATE TABLE IF NOT EXISTS block_checkpoint(height INTEGER PRIMARY KEY, "
+                     u"position INTEGER NOT NULL, hash_block TEXT NOT NULL, digest TEXT NOT NULL, "
+                     u"signer TEXT NOT NULL, signature TEXT NOT NULL, archive TEXT)")
+
+    def _upgrade_to_5(self):
+        """
+        Add the tasks of the task runner.
+        """
+        self.execute(u"CREATE TABLE IF NOT EXISTS task(id TEXT PRIMARY KEY, name TEXT NOT NULL, "
+                     u"arguments TEXT NOT NULL, status TEXT NOT NULL, attempts INTEGER NOT NULL, error TEXT, "
+                     u"after TEXT)")
+
+    def _upgrade_to_6(self):
+        """
+        Add the inboxes of the banks, filled with the loan requests the stored banks have received.
+        """
+        self.execute(u"CREATE TABLE IF NOT EXISTS loan_request_inbox(bank_id TEXT NOT NULL, "
+                     u"loan_request_id TEXT NOT NULL, status INTEGER NOT NULL, received_at REAL NOT NULL, "
+                     u"PRIMARY KEY (bank_id, loan_request_id))")
+        self.execute(u"CREATE INDEX IF NOT EXISTS loan_request_inbox_status_idx "
+                     u"ON loan_request_inbox(bank_id, status, received_at)")
+
+        from market.models import DatabaseModel
+        users = self.execute(u"SELECT value FROM `market` WHERE type_name = 'users'").fetchall()
+        for user in (DatabaseModel.decode(value) for value, in users):
+            for loan_request_id in user.loan_request_ids:
+                rows = self.execute(u"SELECT value, CAST(strftime('%s', insert_time) AS REAL) FROM `market` "
+                                    u"WHERE type_name = 'loan_request' AND id = ?",
+                                    (unicode(loan_request_id),)).fetchall()
+                if not rows:
+                    continue
+                loan_request = DatabaseModel.decode(rows[0][0])
+                # The borrowers keep their own loan requests in the same list
+                if user.id not in loan_request.status:
+                    continue
+                status = loan_request.status[user.id]
+                self.execute(u"INSERT OR IGNORE INTO `loan_request_inbox` (bank_id, loan_request_id, status, "
+                             u"received_at) VALUES (?, ?, ?, ?)",
+                             (unicode(user.id), unicode(loan_request_id), getattr(status, 'value', status),
+                              rows[0][1] or time.time()))
+
+    def _upgrade_to_7(self):
+        """
+        Index the stored investments by mortgage and by investor.
+        """
+        self.execute(u"CREATE TABLE IF NOT EXISTS investment_index(id TEXT PRIMARY KEY, mortgage_id TEXT NOT NULL, "
+                     u"investor_key TEXT NOT NULL, status INTEGER NOT NULL)")
+        self.execute(u"CREATE INDEX IF NOT EXISTS investment_index_mortgage_idx "
+                     u"ON investment_index(mortgage_id, status)")
+        self.execute(u"CREATE INDEX IF NOT EXISTS investment_index_investor_idx "
+                     u"ON investment_index(investor_key, status)")
+
+        from market.models import DatabaseModel
+        rows = self.execute(u"SELECT value FROM `market` WHERE type_name = 'investment' ORDER BY ROWID").fetchall()
+        for investment in (DatabaseModel.decode(value) for value, in rows):
+            self.put_investment_index(investment.id, investment.mortgage_id, investment.investor_key,
+                                      investment.status.value)
+
+    def _upgrade_to_8(self):
+        """
+        Link the blocks of the chain by the half of the benefactor of the preceding block, see
+        `DatabaseBlock.link_hash`, the archived blocks first. Only `previous_hash` changes, which neither the hash of a
+        block nor the digest of a checkpoint covers. The first block of the chain keeps its link.
+        """
+        link_hash = None
+        for checkpoint in self.get_checkpoints():
+            if checkpoint.archive:
+                archive_path = path.join(self.archive_directory, checkpoint.archive)
+                rows = [DatabaseBlock.from_row(row) for row in read_archive(archive_path)]
+                link_hash = self._relink(rows, link_hash)
+                write_archive(archive_path, [block.to_row() for block in rows])
+
+        rows = self.execute(u"SELECT ROWID, " + self.BLOCK_QUERY[len(u"SELECT "):] + u"ORDER BY ROWID").fetchall()
+        blocks = [DatabaseBlock.from_row(row[1:]) for row in rows]
+        self._relink(blocks, link_hash)
+        self.executemany(u"UPDATE block_chain SET previous_hash = ? WHERE ROWID = ?",
+                         [(buffer(block.previous_hash), row[0]) for row, block in zip(rows, blocks)])
+
+    @staticmethod
+    def _relink(blocks, link_hash):
+        """
+        Link consecutive blocks by their link hashes.
+        :param link_hash: The link hash of the block preceding the first block, None to keep the link of the first block
+        :return: The link hash of the last block
+        """
+        for block in blocks:
+            if link_hash is not None:
+                block.previous_hash = link_hash
+            link_hash = block.link_hash()
+        return link_hash
+
+    def _upgrade_to_9(self):
+        """
+        Index the archived blocks by public key and sequence number, and by hash.
+        """
+        self.execute(u"CREATE TABLE IF NOT EXISTS archived_block(hash_block TEXT NOT NULL, benefactor TEXT NOT NULL, "
+                     u"sequence_number_benefactor INTEGER NOT NULL, beneficiary TEXT NOT NULL, "
+                     u"sequence_number_beneficiary INTEGER NOT NULL, archive TEXT NOT NULL)")
+        self.execute(u"CREATE INDEX IF NOT EXISTS archived_block_benefactor_idx "
+                     u"ON archived_block(benefactor, sequence_number_benefactor)")
+        self.execute(u"CREATE INDEX IF NOT EXISTS archived_block_beneficiary_idx "
+                     u"ON archived_block(beneficiary, sequence_number_beneficiary)")
+        self.execute(u"CREATE INDEX IF NOT EXISTS archived_block_hash_idx ON archived_block(hash_block)")
+
+        self.execute(u"DELETE FROM archived_block")
+        for checkpoint in self.get_checkpoints():
+            if checkpoint.archive:
+                self._index_archive(checkpoint.archive,
+                                    read_archive(path.join(self.archive_directory, checkpoint.archive)))
+
+    def _upgrade_to_10(self):
+        """
+        Index the blocks that lack the signature of the beneficiary.
+        """
+        self.execute(u"CREATE INDEX IF NOT EXISTS block_chain_incomplete_idx "
+                     u"ON block_chain(benefactor, sequence_number_benefactor) WHERE length(signature_beneficiary) = 0")
+
+    def rebuild_digests(self):
+        """
+        Recompute the digests of all stored values and buckets.
+        """
+        digests = [EMPTY_DIGEST] * DIGEST_BUCKETS
+        rows = self.execute(u"SELECT ROWID, type_name, id, value FROM `market`").fetchall()
+        for rowid, type_name, value_id, value in rows:
+            bucket = model_bucket(type_name, value_id)
+            digest = model_digest(type_name, value_id, value)
+            digests[bucket] = xor_digest(digests[bucket], digest)
+            self.execute(u"UPDATE `market` SET digest_bucket = ?, digest = ? WHERE ROWID = ?",
+                         (bucket, buffer(digest), rowid))
+
+        self.execute(u"DELETE FROM `market_digest`")
+        self.executemany(u"INSERT INTO `market_digest` (bucket, digest) VALUES (?, ?)",
+                         [(bucket, buffer(digest)) for bucket, digest in enumerate(digests)
+                          if digest != EMPTY_DIGEST])
+        self.commit()
+
     def get(self, type_name, value_id):
         db_query = u"SELECT value FROM `market` WHERE type_name = ? AND id = ?"
-        db_result = self.execute(db_query, (unicode(type_name), unicode(value_id))).fetchall()
+        db_result = self._read(db_query, (unicode(type_name), unicode(value_id))).fetchall()
 
         if len(db_result) != 1:
             raise IndexError
@@ -319,7 +1046,7 @@ class PersistentBackend(Database, Backend, BlockChain):
 
     def get_all(self, type_name):
         db_query = u"SELECT value FROM `market` WHERE type_name = ?"
-        db_result = self.execute(db_query, (unicode(type_name),)).fetchall()
+        db_result = self._read(db_query, (unicode(type_name),)).fetchall()
 
         return [t[0] for t in db_result]
 
@@ -327,25 +1054,61 @@ class PersistentBackend(Database, Backend, BlockChain):
         if not self.id_available(value_id):
             raise IndexError("Index already in use")
 
-        db_query = u"INSERT INTO `market` (id, type_name, value) VALUES (?, ?, ?)"
-        self.execute(db_query, (unicode(value_id), unicode(type_name), unicode(obj)))
+        bucket = model_bucket(type_name, value_id)
+        digest = model_digest(type_name, value_id, unicode(obj))
+
+        db_query = u"INSERT INTO `market` (id, type_name, value, digest_bucket, digest) VALUES (?, ?, ?, ?, ?)"
+        self.execute(db_query, (unicode(value_id), unicode(type_name), unicode(obj), bucket, buffer(digest)))
+        self._update_bucket_digest(bucket, digest)
         self.commit()
 
     def put(self, type_name, value_id, obj):
-        if self.exists(type_name, value_id):
-            db_query = u"UPDATE `market` SET value = ? WHERE id = ? AND type_name = ?"
-            self.execute(db_query, (unicode(obj), unicode(value_id), unicode(type_name)))
+        db_query = u"SELECT digest_bucket, digest FROM `market` WHERE id = ? AND type_name = ?"
+        db_result = self.execute(db_query, (unicode(value_id), unicode(type_name))).fetchall()
+
+        if len(db_result) == 1:
+            bucket, old_digest = db_result[0]
+            digest = model_digest(type_name, value_id, unicode(obj))
+
+            db_query = u"UPDATE `market` SET value = ?, digest = ? WHERE id = ? AND type_name = ?"
+            self.execute(db_query, (unicode(obj), buffer(digest), unicode(value_id), unicode(type_name)))
+            self._update_bucket_digest(bucket, xor_digest(str(old_digest), digest))
             self.commit()
             return True
         else:
             return False
 
     def delete(self, obj):
+        db_query = u"SELECT digest_bucket, digest FROM `market` WHERE id = ?"
+        for bucket, digest in self.execute(db_query, (unicode(obj.id),)).fetchall():
+            self._update_bucket_digest(bucket, str(digest))
+
         db_query = u"DELETE FROM `market` WHERE id = ?"
         cur = self.execute(db_query, (unicode(obj.id),))
         self.commit()
         return cur.rowcount > 0
 
+    def _update_bucket_digest(self, bucket, change):
+        """
+        Combine a change into the digest of a bucket. Does not commit.
+        :param bucket: The bucket index
+        :param change: The digest to combine with the current bucket digest
+        """
+        db_result = self.execute(u"SELECT digest FROM `market_digest` WHERE bucket = ?", (bucket,)).fetchone()
+        digest = xor_digest(str(db_result[0]) if db_result else EMPTY_DIGEST, change)
+        self.execute(u"INSERT OR REPLACE INTO `market_digest` (bucket, digest) VALUES (?, ?)", (bucket, buffer(digest)))
+
+    def get_bucket_digests(self):
+        digests = [EMPTY_DIGEST] * DIGEST_BUCKETS
+        for bucket, digest in self.execute(u"SELECT bucket, digest FROM `market_digest`").fetchall():
+            digests[bucket] = str(digest)
+        return digests
+
+    def get_bucket_entries(self, bucket):
+        db_query = u"SELECT type_name, id, digest FROM `market` WHERE digest_bucket = ?"
+        db_result = self.execute(db_query, (bucket,)).fetchall()
+        return sorted((type_name, value_id, str(digest)) for type_name, value_id, digest in db_result)
+
     def id_available(self, value_id):
         db_query = u"SELECT COUNT(*) FROM `market` WHERE id = ?"
         db_result = self.execute(db_query, (unicode(value_id),)).fetchall()
@@ -353,13 +1116,21 @@ class PersistentBackend(Database, Backend, BlockChain):
 
     def exists(self, type_name, value_id):
         db_query = u"SELECT COUNT(*) FROM `market` WHERE id = ? AND type_name = ?"
-        db_result = self.execute(db_query, (unicode(value_id), unicode(type_name))).fetchall()
+        db_result = self._read(db_query, (unicode(value_id), unicode(type_name))).fetchall()
         return db_result[0][0] == 1
 
     def clear(self):
         self.execute(u"DELETE FROM market")
+        self.execute(u"DELETE FROM market_digest")
         self.execute(u"DELETE FROM block_chain")
+        self.execute(u"DELETE FROM block_checkpoint")
+        self.execute(u"DELETE FROM archived_block")
         self.execute(u"DELETE FROM option")
+        self.execute(u"DELETE FROM task")
+        self.execute(u"DELETE FROM loan_request_inbox")
+        self.execute(u"DELETE FROM investment_index")
+        self._archive_cache = []
+        self._reset_chain_head()
 
     def set_option(self, option_name, value):
         db_query = u"INSERT INTO `option` (key, value) VALUES (?, ?)"
@@ -375,27 +1146,123 @@ class PersistentBackend(Database, Backend, BlockChain):
 
         return db_result[0][0]
 
+    def save_task(self, task_id, name, arguments, status, attempts, error, after):
+        # Update in place, so the tasks keep the order they were first stored in
+        bindings = (unicode(name), unicode(arguments), unicode(status), attempts,
+                    unicode(error) if error is not None else None, unicode(after) if after is not None else None,
+                    unicode(task_id))
+        cur = self.execute(u"UPDATE `task` SET name = ?, arguments = ?, status = ?, attempts = ?, error = ?, after = ? "
+                           u"WHERE id = ?", bindings)
+        if not cur.rowcount:
+            self.execute(u"INSERT INTO `task` (name, arguments, status, attempts, error, after, id) "
+                         u"VALUES (?, ?, ?, ?, ?, ?, ?)", bindings)
+        self.commit()
+
+    def get_tasks(self, statuses=None):
+        db_query = u"SELECT id, name, arguments, status, attempts, error, after FROM `task`"
+        bindings = ()
+        if statuses is not None:
+            db_query += u" WHERE status IN (%s)" % u", ".join(u"?" * len(statuses))
+            bindings = tuple(unicode(status) for status in statuses)
+        return self._read(db_query + u" ORDER BY ROWID", bindings).fetchall()
+
+    def delete_task(self, task_id):
+        self.execute(u"DELETE FROM `task` WHERE id = ?", (unicode(task_id),))
+        self.commit()
+
+    def put_inbox_entry(self, bank_id, loan_request_id, status, received_at=None):
+        bindings = (int(status), unicode(bank_id), unicode(loan_request_id))
+        cur = self.execute(u"UPDATE `loan_request_inbox` SET status = ? WHERE bank_id = ? AND loan_request_id = ?",
+                           bindings)
+        if not cur.rowcount:
+            self.execute(u"INSERT INTO `loan_request_inbox` (status, bank_id, loan_request_id, received_at) "
+                         u"VALUES (?, ?, ?, ?)", bindings + (received_at if received_at is not None else time.time(),))
+        self.commit()
+
+    @staticmethod
+    def _inbox_filter(bank_id, status):
+        if status is None:
+            return u" WHERE bank_id = ?", (unicode(bank_id),)
+        return u" WHERE bank_id = ? AND status = ?", (unicode(bank_id), int(status))
+
+    def get_inbox(self, bank_id, status=None, limit=None, offset=0):
+        where, bindings = self._inbox_filter(bank_id, status)
+        db_query = u"SELECT loan_request_id, status, received_at FROM `loan_request_inbox`" + where + \
+                   u" ORDER BY received_at, ROWID LIMIT ? OFFSET ?"
+        return self._read(db_query, bindings + (limit if limit is not None else -1, offset)).fetchall()
+
+    def count_inbox(self, bank_id, status=None):
+        where, bindings = self._inbox_filter(bank_id, status)
+        return self._read(u"SELECT COUNT(*) FROM `loan_request_inbox`" + where, bindings).fetchall()[0][0]
+
+    def delete_inbox_entry(self, bank_id, loan_request_id):
+        self.execute(u"DELETE FROM `loan_request_inbox` WHERE bank_id = ? AND loan_request_id = ?",
+                     (unicode(bank_id), unicode(loan_request_id)))
+        self.commit()
+
+    def put_investment_index(self, investment_id, mortgage_id, investor_key, status):
+        # Update in place, so the investments keep the order they were first indexed in
+        bindings = (unicode(mortgage_id), unicode(investor_key), int(status), unicode(investment_id))
+        cur = self.execute(u"UPDATE `investment_index` SET mortgage_id = ?, investor_key = ?, status = ? WHERE id = ?",
+                           bindings)
+        if not cur.rowcount:
+            self.execute(u"INSERT INTO `investment_index` (mortgage_id, investor_key, status, id) VALUES (?, ?, ?, ?)",
+                         bindings)
+        self.commit()
+
+    def delete_investment_index(self, investment_id):
+        self.execute(u"DELETE FROM `investment_index` WHERE id = ?", (unicode(investment_id),))
+        self.commit()
+
+    def get_investments(self, mortgage_id=None, investor_key=None, status=None):
+        conditions = []
+        bindings = []
+        for column, value in ((u"mortgage_id", mortgage_id), (u"investor_key", investor_key)):
+            if value is not None:
+                conditions.append(u"investment_index.%s = ?" % column)
+                bindings.append(unicode(value))
+        if status is not None:
+            conditions.append(u"investment_index.status = ?")
+            bindings.append(int(status))
+
+        db_query = u"SELECT market.value FROM `investment_index` JOIN `market` " \
+                   u"ON market.type_name = 'investment' AND market.id = investment_index.id"
+        if conditions:
+            db_query += u" WHERE " + u" AND ".join(conditions)
+        return [row[0] for row in self._read(db_query + u" ORDER BY investment_index.ROWID", tuple(bindings))]
+
     def add_block(self, block):
         """
-        Persist a block
+        Persist a block on top of the current chain head.
+        Sets the `previous_hash` and `sequence_number` of the block.
         :param block: The data that will be saved.
         """
-        data = (buffer(block.benefactor), buffer(block.beneficiary),
-                buffer(block.agreement_benefactor), buffer(block.agreement_beneficiary),
-                block.sequence_number_benefactor, block.sequence_number_beneficiary,
-                buffer(block.previous_hash_benefactor), buffer(block.previous_hash_beneficiary),
-                buffer(block.signature_benefactor), buffer(block.signature_beneficiary),
-                block.insert_time, buffer(block.hash_block), buffer(self.get_latest_hash()),
-                self.get_next_sequence_number())
-
-        self.execute(
-            u"INSERT INTO block_chain (benefactor, beneficiary, "
-            u"agreement_benefactor, agreement_beneficiary, sequence_number_benefactor, sequence_number_beneficiary, "
-            u"previous_hash_benefactor, previous_hash_beneficiary, signature_benefactor, signature_beneficiary, "
-            u"insert_time, hash_block, previous_hash, sequence_number) "
-            u"VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
-            data)
-        self.commit()
+        with self.chain_lock:
+            block.previous_hash = self._latest_link_hash
+            block.sequence_number = self.get_next_sequence_number()
+
+            data = (buffer(block.benefactor), buffer(block.beneficiary),
+                    buffer(block.agreement_benefactor), buffer(block.agreement_beneficiary),
+                    block.sequence_number_benefactor, block.sequence_number_beneficiary,
+                    buffer(block.previous_hash_benefactor), buffer(block.previous_hash_beneficiary),
+                    buffer(block.signature_benefactor), buffer(block.signature_beneficiary),
+                    block.insert_time, buffer(block.hash_block), buffer(block.previous_hash),
+                    block.sequence_number)
+
+            self.execute(
+                u"INSERT INTO block_chain (benefactor, beneficiary, "
+                u"agreement_benefactor, agreement_beneficiary, sequence_number_benefactor, sequence_number_beneficiary, "
+                u"previous_hash_benefactor, previous_hash_beneficiary, signature_benefactor, signature_beneficiary, "
+                u"insert_time, hash_block, previous_hash, sequence_number) "
+                u"VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)",
+                data)
+            self.commit()
+
+            self._latest_hash = block.hash_block
+            self._latest_link_hash = block.link_hash()
+            self._latest_sequence_number = block.sequence_number
+            self._latest_key = (block.insert_time, block.sequence_number_benefactor, block.benefactor)
+            self._chain_length += 1
 
     def update_block_with_beneficiary(self, block):
         """
@@ -409,25 +1276,29 @@ class PersistentBackend(Database, Backend, BlockChain):
 
         where = (block.insert_time, block.sequence_number_benefactor, buffer(block.benefactor))
 
-        self.execute(
-            u"UPDATE block_chain "
-            u"SET beneficiary = ?, agreement_beneficiary = ?, "
-            u"sequence_number_beneficiary = ?, previous_hash_beneficiary = ?, signature_benefactor = ?,"
-            u"signature_beneficiary = ?, hash_block = ? "
-            u"WHERE insert_time = ? AND sequence_number_benefactor = ? AND benefactor = ?",
-            data + where)
-        self.commit()
+        with self.chain_lock:
+            self.execute(
+                u"UPDATE block_chain "
+                u"SET beneficiary = ?, agreement_beneficiary = ?, "
+                u"sequence_number_beneficiary = ?, previous_hash_beneficiary = ?, signature_benefactor = ?,"
+                u"signature_beneficiary = ?, hash_block = ? "
+                u"WHERE insert_time = ? AND sequence_number_benefactor = ? AND benefactor = ?",
+                data + where)
+            self.commit()
+
+            # The hash of the head changes when the head itself is the block being completed.
+            if self._latest_key == (block.insert_time, block.sequence_number_benefactor, block.benefactor):
+                self._latest_hash = block.hash_block
 
     def get_latest_hash(self):
         """
-        Get the hash of the latest block in the chain for a specific public key.
-        :param public_key: The public_key for which the latest hash has to be found.
+        Get the hash of the latest block in the chain.
         :return: the relevant hash
         """
-        db_query = u"SELECT hash_block FROM block_chain ORDER BY ROWID DESC LIMIT 1;"
-        db_result = self.execute(db_query).fetchone()
+        return self._latest_hash
 
-        return str(db_result[0]) if db_result else ''
+    def get_latest_link_hash(self):
+        return self._latest_link_hash
 
     def get_by_hash(self, hash):
         """
@@ -435,13 +1306,14 @@ class PersistentBackend(Database, Backend, BlockChain):
         :param hash: The hash of the block that needs to be retrieved.
         :return: The block that was requested or None
         """
-        db_query = u"SELECT benefactor, beneficiary, " \
-                   u"agreement_benefactor, agreement_beneficiary, sequence_number_benefactor, " \
-                   u"sequence_number_beneficiary, previous_hash_benefactor, " \
-                   u"previous_hash_beneficiary, signature_benefactor, signature_beneficiary, " \
-                   u"insert_time, hash_block, previous_hash, sequence_number " \
-                   u"FROM `block_chain` WHERE hash_block = ? LIMIT 1"
+        db_query = self.BLOCK_QUERY + u"WHERE hash_block = ? LIMIT 1"
         db_result = self.execute(db_query, (buffer(hash),)).fetchone()
+
+        if db_result is None:
+            db_query = u"SELECT archive FROM archived_block WHERE hash_block = ? LIMIT 1"
+            db_result = self._find_archived(db_query, (buffer(hash),),
+                                            lambda archived: archived.by_hash.get(str(hash)))
+
         # Create a DB Block or return None
         return self._create_database_block(db_result)
 
@@ -451,23 +1323,268 @@ class PersistentBackend(Database, Backend, BlockChain):
         :param public_key: The public key corresponding to the block
         :param sequence_number: The sequence number corresponding to the block.
         :return: The block that was requested or None"""
-        db_query = u"SELECT benefactor, beneficiary, " \
-                   u"agreement_benefactor, agreement_beneficiary, " \
-                   u"sequence_number_benefactor, sequence_number_beneficiary, " \
-                   u"previous_hash_benefactor, previous_hash_beneficiary, " \
-                   u"signature_benefactor, signature_beneficiary, insert_time, " \
-                   u"hash_block, previous_hash, sequence_number " \
-                   u"FROM (" \
-                   u"SELECT *, sequence_number_benefactor AS seq_number, " \
-                   u"benefactor AS pk FROM `block_chain` " \
-                   u"UNION " \
-                   u"SELECT *, sequence_number_beneficiary AS seq_number," \
-                   u"beneficiary AS pk FROM `block_chain`) " \
-                   u"WHERE seq_number = ? AND pk = ? LIMIT 1"
-        db_result = self.execute(db_query, (sequence_number, buffer(public_key))).fetchone()
+        db_query = self.BLOCK_QUERY + u"WHERE benefactor = ? AND sequence_number_benefactor = ? LIMIT 1"
+        db_result = self.execute(db_query, (buffer(public_key), sequence_number)).fetchone()
+
+        if db_result is None:
+            db_query = self.BLOCK_QUERY + u"WHERE beneficiary = ? AND sequence_number_beneficiary = ? LIMIT 1"
+            db_result = self.execute(db_query, (buffer(public_key), sequence_number)).fetchone()
+
+        if db_result is None:
+            db_query = u"SELECT archive FROM archived_block " \
+                       u"WHERE benefactor = ? AND sequence_number_benefactor = ? " \
+                       u"UNION SELECT archive FROM archived_block " \
+                       u"WHERE beneficiary = ? AND sequence_number_beneficiary = ?"
+            db_result = self._find_archived(
+                db_query, (buffer(public_key), sequence_number) * 2,
+                lambda archived: archived.get_by_public_key_and_sequence_number(str(public_key), sequence_number))
+
         # Create a DB Block or return None
         return self._create_database_block(db_result)
 
+    def get_range(self, public_key, from_sequence_number, to_sequence_number):
+        """
+        Returns the blocks of a public key within a range of its sequence numbers.
+        :param public_key: The public key, either as benefactor or as beneficiary
+        :param from_sequence_number: The first sequence number (inclusive)
+        :param to_sequence_number: The last sequence number (inclusive)
+        :return: A list of blocks ordered by the sequence number of the public key
+        """
+        bindings = (buffer(public_key), from_sequence_number, to_sequence_number)
+
+        db_query = self.BLOCK_QUERY + u"WHERE benefactor = ? " \
+                                      u"AND sequence_number_benefactor BETWEEN ? AND ?"
+        blocks = [(row[4], row) for row in self.execute(db_query, bindings).fetchall()]
+
+        db_query = self.BLOCK_QUERY + u"WHERE beneficiary = ? " \
+                                      u"AND sequence_number_beneficiary BETWEEN ? AND ?"
+        blocks.extend((row[5], row) for row in self.execute(db_query, bindings).fetchall())
+
+        db_query = u"SELECT archive FROM archived_block " \
+                   u"WHERE benefactor = ? AND sequence_number_benefactor BETWEEN ? AND ? " \
+                   u"UNION SELECT archive FROM archived_block " \
+                   u"WHERE beneficiary = ? AND sequence_number_beneficiary BETWEEN ? AND ?"
+        for archive, in self.execute(db_query, bindings * 2).fetchall():
+            blocks.extend(self._load_archive(str(archive)).get_range(str(public_key), from_sequence_number,
+                                                                     to_sequence_number))
+
+        # A block in which the key is both benefactor and beneficiary is only returned once.
+        blocks.sort(key=lambda block: block[0])
+
+        result = []
+        seen = set()
+        for _, row in blocks:
+            if str(row[11]) not in seen:
+                seen.add(str(row[11]))
+                result.append(self._create_database_block(row))
+        return result
+
+    def get_incomplete_blocks(self, public_key, limit):
+        """
+        Returns the blocks of a benefactor that lack the signature of the beneficiary.
+        :param public_key: The public key of the benefactor
+        :param limit: The maximum amount of blocks returned
+        :return: A list of blocks ordered by the sequence number of the benefactor
+        """
+        db_query = self.BLOCK_QUERY + u"WHERE benefactor = ? AND length(signature_beneficiary) = 0 " \
+                                      u"ORDER BY sequence_number_benefactor LIMIT ?"
+        return [self._create_database_block(row) for row in
+                self.execute(db_query, (buffer(public_key), limit)).fetchall()]
+
+    def get_checkpoints(self):
+        """
+        Return all checkpoints, oldest first.
+        :return: List of `Checkpoint`
+        """
+        db_query = u"SELECT height, position, hash_block, digest, signer, signature, archive " \
+                   u"FROM block_checkpoint ORDER BY height"
+        return [Checkpoint(height, position, str(hash_block), str(digest), str(signer), str(signature),
+                           archive and str(archive))
+                for height, position, hash_block, digest, signer, signature, archive
+                in self.execute(db_query).fetchall()]
+
+    def create_checkpoint(self, height):
+        """
+        Create a signed checkpoint summarizing the chain up to and including the block at `height`.
+
+        The digest of the checkpoint chains the hashes of all blocks since the previous checkpoint onto the digest of
+        that checkpoint, so it covers the whole chain up to `height`. It is signed with the key of this node.
+        :param height: The sequence number of the block to create the checkpoint at
+        :return: The `Checkpoint`
+        :raises: IndexError if there is no block at `height`, ValueError if `height` is not above the last checkpoint
+        """
+        with self.chain_lock:
+            db_query = u"SELECT ROWID, hash_block FROM block_chain WHERE sequence_number = ? ORDER BY ROWID DESC LIMIT 1"
+            db_result = self.execute(db_query, (height,)).fetchone()
+            if db_result is None:
+                raise IndexError("No block at height %d" % height)
+            position, hash_block = db_result[0], str(db_result[1])
+
+            checkpoints = self.get_checkpoints()
+            previous = checkpoints[-1] if checkpoints else None
+            if previous and previous.height >= height:
+                raise ValueError("Height %d is not above the last checkpoint at %d" % (height, previous.height))
+
+            digest = previous.digest if previous else ''
+            db_query = u"SELECT hash_block FROM block_chain WHERE ROWID > ? AND ROWID <= ? ORDER BY ROWID"
+            for row in self.execute(db_query, (previous.position if previous else 0, position)).fetchall():
+                digest = sha256(digest + str(row[0])).hexdigest()
+
+            ec = ECCrypto()
+            signing_key = ec.key_from_private_bin(self.get_option('user_key_priv').decode('HEX'))
+            signer = str(self.get_option('user_key_pub'))
+            signature = ec.create_signature(signing_key, self._checkpoint_summary(height, hash_block, digest))
+
+            checkpoint = Checkpoint(height, position, hash_block, digest, signer, signature.encode('HEX'), None)
+            self.execute(u"INSERT INTO block_checkpoint (height, position, hash_block, digest, signer, signature) "
+                         u"VALUES (?, ?, ?, ?, ?, ?)", checkpoint[:6])
+            self.commit()
+            return checkpoint
+
+    @staticmethod
+    def _checkpoint_summary(height, hash_block, digest):
+        return "%d:%s:%s" % (height, hash_block, digest)
+
+    @classmethod
+    def checkpoint_valid(cls, checkpoint):
+        """
+        Check the signature of a checkpoint.
+        :param checkpoint: The `Checkpoint`
+        :return: True if the signature is valid, False otherwise
+        """
+        ec = ECCrypto()
+        signing_key = ec.key_from_public_bin(checkpoint.signer.decode('HEX'))
+        return ec.is_valid_signature(signing_key,
+                                     cls._checkpoint_summary(checkpoint.height, checkpoint.hash_block, checkpoint.digest),
+                                     checkpoint.signature.decode('HEX'))
+
+    def archive_blocks(self, height):
+        """
+        Move the blocks up to the checkpoint at `height` from the `block_chain` table to a compressed archive file.
+        Lookups that don't find a block in the table fall through to the archives. Archived blocks can no longer be
+        updated, so blocks that still lack the signature of the beneficiary are only archived once they are older than
+        `INCOMPLETE_BLOCK_TIMEOUT`.
+        :param height: The height of an existing checkpoint below the head of the chain
+        :return: The amount of blocks archived
+        """
+        with self.chain_lock:
+            checkpoint = self._get_archivable_checkpoint(height)
+            if checkpoint is None:
+                return 0
+
+            rows = []
+            for position, row in self.iter_blocks():
+                if position > checkpoint.position:
+                    break
+                rows.append(row)
+            if not rows:
+                return 0
+
+            if not path.exists(self.archive_directory):
+                os.makedirs(self.archive_directory)
+            archive = u"archive-%012d.blk" % height
+            write_archive(path.join(self.archive_directory, archive), rows)
+
+            self._index_archive(archive, rows)
+            self.execute(u"DELETE FROM block_chain WHERE ROWID <= ?", (checkpoint.position,))
+            self.execute(u"UPDATE block_checkpoint SET archive = ? WHERE height = ?", (archive, height))
+            self.commit()
+            return len(rows)
+
+    def _get_archivable_checkpoint(self, height):
+        """
+        Return the checkpoint at `height` if the blocks up to it can be archived, or None if there is nothing to archive.
+        :raises: IndexError if there is no checkpoint at `height`, ValueError if it covers the head of the chain or a
+        recent incomplete block
+        """
+        checkpoint = next((c for c in self.get_checkpoints() if c.height == height), None)
+        if checkpoint is None:
+            raise IndexError("No checkpoint at height %d" % height)
+        head_position = self.execute(u"SELECT MAX(ROWID) FROM block_chain").fetchone()[0]
+        # An empty chain has nothing left to archive
+        if checkpoint.archive or head_position is None:
+            return None
+        if checkpoint.position >= head_position:
+            raise ValueError("The head of the chain can't be archived")
+        incomplete = self._get_first_incomplete_block()
+        if incomplete and checkpoint.position >= incomplete[0]:
+            raise ValueError("The incomplete block at height %d can't be archived" % incomplete[1])
+        return checkpoint
+
+    def checkpoint_and_archive(self, keep_blocks=10000):
+        """
+        Checkpoint the chain `keep_blocks` below its head and archive everything up to that checkpoint. The
+        checkpoint is kept below the first incomplete block, as only the `block_chain` table can still complete it.
+        :param keep_blocks: The amount of latest blocks that are kept in the `block_chain` table
+        :return: The amount of blocks archived
+        """
+        with self.chain_lock:
+            height = self.get_latest_sequence_number() - keep_blocks
+            incomplete = self._get_first_incomplete_block()
+            if incomplete:
+                height = min(height, incomplete[1] - 1)
+            checkpoints = self.get_checkpoints()
+            if height <= 0 or (checkpoints and checkpoints[-1].height >= height):
+                return 0
+            try:
+                self.create_checkpoint(height)
+            except IndexError:
+                return 0
+            return self.archive_blocks(height)
+
+    def _get_first_incomplete_block(self):
+        """
+        Return the (ROWID, height) of the first block that lacks the signature of its beneficiary and isn't older than
+        `INCOMPLETE_BLOCK_TIMEOUT`, or None. The genesis block has no beneficiary and doesn't count.
+        """
+        db_query = u"SELECT ROWID, sequence_number FROM block_chain INDEXED BY block_chain_incomplete_idx " \
+                   u"WHERE length(signature_beneficiary) = 0 AND length(benefactor) > 0 AND insert_time > ? " \
+                   u"ORDER BY ROWID LIMIT 1"
+        return self.execute(db_query, (int(time.time()) - self.INCOMPLETE_BLOCK_TIMEOUT,)).fetchone()
+
+    def _index_archive(self, archive, rows):
+        self.executemany(u"INSERT INTO archived_block (hash_block, benefactor, sequence_number_benefactor, "
+                         u"beneficiary, sequence_number_beneficiary, archive) VALUES (?, ?, ?, ?, ?, ?)",
+                         [(buffer(str(row[11])), buffer(str(row[0])), row[4], buffer(str(row[1])), row[5], archive)
+                          for row in rows])
+
+    def _load_archive(self, archive):
+        """
+        Return the `ArchivedBlocks` of an archive file. Recently used archives are kept in memory.
+        """
+        cached = next((archived for name, archived in self._archive_cache if name == archive), None)
+        if cached is None:
+            cached = ArchivedBlocks(read_archive(path.join(self.archive_directory, archive)))
+            self._archive_cache.insert(0, (archive, cached))
+            del self._archive_cache[self.ARCHIVE_CACHE_SIZE:]
+        return cached
+
+    def _find_archived(self, db_query, bindings, lookup):
+        """
+        Return the first row found by `lookup` in the archives the index query `db_query` returns, or None.
+        """
+        for archive, in self.execute(db_query, bindings).fetchall():
+            row = lookup(self._load_archive(str(archive)))
+            if row is not None:
+                return row
+        return None
+
+    def iter_blocks(self, after_position=0, page_size=1000):
+        """
+        Iterate over the blocks in ROWID order.
+        :param after_position: Only return the blocks after this ROWID
+        :param page_size: Amount of blocks fetched per query
+        :return: Generator of (ROWID, row) tuples
+        """
+        db_query = u"SELECT ROWID, " + self.BLOCK_QUERY[len(u"SELECT "):] + u"WHERE ROWID > ? ORDER BY ROWID LIMIT ?"
+        while True:
+            db_result = self.execute(db_query, (after_position, page_size)).fetchall()
+            for row in db_result:
+                yield row[0], tuple(str(column) if isinstance(column, buffer) else column for column in row[1:])
+            if len(db_result) < page_size:
+                return
+            after_position = db_result[-1][0]
+
     def _create_database_block(self, db_result):
         """
         Create a Database block or return None.
@@ -475,73 +1592,73 @@ class PersistentBackend(Database, Backend, BlockChain):
         :return: DatabaseBlock if db_result else None
         """
         if db_result:
-            return DatabaseBlock(db_result)
+            return DatabaseBlock.from_row(db_result)
         else:
             return None
 
     def get_latest_sequence_number(self):
         """
-        Return the latest sequence number known for this public_key.
-        If no block for the pk is known returns 0.
-        :param public_key: Corresponding public key
+        Return the latest sequence number.
+        If no block is known returns 0.
         :return: sequence number (integer) or 0 if no block is known
         """
-        db_query = u"SELECT sequence_number FROM block_chain ORDER BY ROWID DESC LIMIT 1;"
-        db_result = self.execute(db_query).fetchone()
-        return db_result[0] if db_result is not None else 0
+        return self._latest_sequence_number
 
     def get_next_sequence_number(self):
         """
-        Return the next sequence number for this public_key.
-        If no block for the pk is known return 0, else return latest sequence number + 1.
+        Return the next sequence number.
+        If no block is known return 0, else return latest sequence number + 1.
         :return: sequence number (integer)
         """
-        sequence_number = self.get_latest_sequence_number()
-
-        if sequence_number == 0:
-            return sequence_number
+        if self._chain_length == 0:
+            return 0
         else:
-            return sequence_number + 1
-
-    def create_genesis_block(self):
-        """
-        Generates the genesis block.
-        :return: DatabaseBlock, the genesis block
-        """
-        packet = encode(
-            (
-                str(''),  # benefactor,
-                str(''),  # beneficiary,
-                str(None),  # agreement_benefactor,
-                str(None),  # agreement_beneficiary,
-                0,  # sequence_number_benefactor,
-                0,  # sequence_number_beneficiary,
-                str(''),  # previous_hash_benefactor,
-                str(''),  # previous_hash_beneficiary,
-                str(''),  # signature_benefactor,
-                str(''),  # signature_beneficiary,
-                0  # insert_time
-            )
-        )
-        hash = sha256(packet).hexdigest()
-
-        return DatabaseBlock((str(''), str(''), str(None), str(None), 0, 0,
-                              str(''), str(''), str(''), str(''), 0, str(hash)))
+            return self._latest_sequence_number + 1
 
     def check_add_genesis_block(self):
         """
         Persist the genesis block if there are no blocks yet in the blockchain.
         """
-        db_query = u"SELECT COUNT(*) FROM block_chain"
-        db_result = self.execute(db_query).fetchone()
+        with self.chain_lock:
+            if self._chain_length == 0:
+                genesis_block = self.create_genesis_block()
+                self.add_block(genesis_block)
 
-        if db_result[0] == 0:
-            genesis_block = self.create_genesis_block()
-            self.add_block(genesis_block)
 
+class ReadOnlyBackend(PersistentBackend):
+    """
+    A `PersistentBackend` on a single read only connection, for the threads that only read the database another backend
+    writes.
 
-class DatabaseBlock:
-    """ DataClass for a blockchain block. """
+    The journal mode, the schema and the chain head cache are left to the writing backend, so opening it only opens the
+    connection. The chain is read by hash, range and sequence number, not through the head cache.
+    """
+
+    def __init__(self, working_directory, database_name=PersistentBackend.DATABASE_PATH):
+        super(ReadOnlyBackend, self).__init__(working_directory, database_name, readers=0)
+
+    def open(self, initial_statements=True, prepare_visioning=True):
+        result = Database.open(self, initial_statements, prepare_visioning)
+        self.execute(u"PRAGMA query_only = ON")
+        return result
+
+    def check_database(self, database_version):
+        # Creating and upgrading the schema is up to the writing backend
+        return int(database_version)
+
+
+class DatabaseBlock(object):
+    """
+    DataClass for a blockchain block.
+
+    The hash of the block is only computed when it is first needed. Blocks read from the database with `from_row` use
+    the stored hash instead, `verify` checks it against the contents of the block.
+    """
+
+    __slots__ = ('benefactor', 'beneficiary', 'agreement_benefactor', 'agreement_beneficiary',
+                 'sequence_number_benefactor', 'sequence_number_beneficiary',
+                 'previous_hash_benefactor', 'previous_hash_beneficiary', 'signature_benefactor', 'signature_beneficiary',
+                 'insert_time', 'previous_hash', 'sequence_number', '_hash_block')
 
     def __init__(self, data):
         """ Create a block from data """
@@ -558,11 +1675,69 @@ class DatabaseBlock:
 
         self.insert_time = data[10]
 
-        self.hash_block = sha256(self.hash()).hexdigest()
+        self._hash_block = None
         if len(data) > 12:
             self.previous_hash = str(data[12])
             self.sequence_number = data[13]
 
+    @classmethod
+    def from_row(cls, row):
+        """
+        Create a block from a `block_chain` row, trusting the stored hash.
+        :param row: The columns of the block, in the order of `PersistentBackend.BLOCK_QUERY`
+        :return: DatabaseBlock
+        """
+        block = cls.__new__(cls)
+        (block.benefactor, block.beneficiary, block.agreement_benefactor, block.agreement_beneficiary,
+         block.previous_hash_benefactor, block.previous_hash_beneficiary, block.signature_benefactor,
+         block.signature_beneficiary, block._hash_block, block.previous_hash) = \
+            (str(row[0]), str(row[1]), str(row[2]), str(row[3]), str(row[6]), str(row[7]), str(row[8]), str(row[9]),
+             str(row[11]), str(row[12]))
+        block.sequence_number_benefactor = row[4]
+        block.sequence_number_beneficiary = row[5]
+        block.insert_time = row[10]
+        block.sequence_number = row[13]
+        return block
+
+    def to_row(self):
+        """
+        :return: The columns of the block, in the order of `PersistentBackend.BLOCK_QUERY`
+        """
+        return (self.benefactor, self.beneficiary, self.agreement_benefactor, self.agreement_beneficiary,
+                self.sequence_number_benefactor, self.sequence_number_beneficiary, self.previous_hash_benefactor,
+                self.previous_hash_beneficiary, self.signature_benefactor, self.signature_beneficiary,
+                self.insert_time, self.hash_block, self.previous_hash, self.sequence_number)
+
+    @property
+    def hash_block(self):
+        if self._hash_block is None:
+            self._hash_block = self.compute_hash()
+        return self._hash_block
+
+    def compute_hash(self):
+        """
+        Compute the hash over the contents of the block.
+        """
+        return sha256(self.hash()).hexdigest()
+
+    def verify(self):
+        """
+        Check the hash of the block against its contents.
+        :return: True if the hash matches, False otherwise
+        """
+        return self.hash_block == self.compute_hash()
+
+    def link_hash(self):
+        """
+        Compute the hash the next block in the chain refers to as its `previous_hash`. The blocks of the parties of
+        an agreement refer to it as their `previous_hash_benefactor` and `previous_hash_beneficiary` as well.
+
+        Only the half of the benefactor and the link to the preceding block are covered, since the half of the
+        beneficiary may still be filled in after the next block was added.
+        """
+        return sha256(encode((self.benefactor, self.agreement_benefactor, self.sequence_number_benefactor,
+                              self.previous_hash_benefactor, self.insert_time, self.previous_hash))).hexdigest()
+
     def hash(self):
         packet = encode(
             (
@@ -0,0 +1,218 @@
+"""
+A content addressed store for the data of documents.
+
+Every blob is stored once, in a file named after the SHA-256 hash of its content, under a directory named after the
+first two characters of the hash. Next to it, a `.refs` file holds the amount of references to the blob, so storing the
+same document twice costs no extra space and the file is only removed once the last reference is released.
+
+Blobs are written and read in chunks, and can be read through their path or a read only memory map, so large documents
+are never held in memory as a whole.
+"""
+import mmap
+import os
+import re
+import tempfile
+from hashlib import sha256
+from threading import RLock
+
+# Size of the chunks in which blobs are written and read.
+CHUNK_SIZE = 64 * 1024
+
+BLOB_HASH = re.compile(r'^[0-9a-f]{64}$')
+
+
+class BlobStore(object):
+    """
+    Stores blobs on disk by the SHA-256 hash of their content, with reference counting.
+    """
+
+    REFS_SUFFIX = '.refs'
+
+    def __init__(self, directory, chunk_size=CHUNK_SIZE):
+        """
+        :param directory: The directory holding the blobs
+        :param chunk_size: The size of the chunks in which blobs are written and read
+        """
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self._lock = RLock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def path(self, blob_hash):
+        """
+        :return: The path of the file holding the blob
+        """
+        if not BLOB_HASH.match(blob_hash):
+            raise ValueError("Invalid blob hash %r" % blob_hash)
+        return os.path.join(self.directory, blob_hash[:2], blob_hash[2:])
+
+    def contains(self, blob_hash):
+        return os.path.isfile(self.path(blob_hash))
+
+    def size(self, blob_hash):
+        return os.path.getsize(self.path(blob_hash))
+
+    def put_file(self, file_path):
+        """
+        Store the content of a file.
+        :return: Tuple of the hash and size of the blob
+        """
+        with open(file_path, 'rb') as input_file:
+            return self.put_stream(input_file)
+
+    def put_stream(self, input_file):
+        """
+        Store the content read from a file object, chunk by chunk, and add a reference to it.
+        :return: Tuple of the hash and size of the blob
+        """
+        writer = self.writer()
+        try:
+            chunk = input_file.read(self.chunk_size)
+            while chunk:
+                writer.write(chunk)
+                chunk = input_file.read(self.chunk_size)
+        except Exception:
+            writer.abort()
+            raise
+        return writer.commit()
+
+    def writer(self):
+        """
+        :return: A `BlobWriter` to store a blob whose content is written piece by piece
+        """
+        return BlobWriter(self)
+
+    def _store(self, temporary_path, blob_hash):
+        """
+        Move a completely written temporary file into place as a blob, or drop it if the blob is already stored, and
+        add a reference to the blob.
+        """
+        with self._lock:
+            blob_path = self.path(blob_hash)
+            if os.path.isfile(blob_path):
+                # Already stored, only the reference is new
+                os.remove(temporary_path)
+            else:
+                if not os.path.isdir(os.path.dirname(blob_path)):
+                    os.makedirs(os.path.dirname(blob_path))
+                os.rename(temporary_path, blob_path)
+            self._set_references(blob_hash, self.references(blob_hash) + 1)
+
+    def references(self, blob_hash):
+        """
+        :return: The amount of references to the blob, 0 if it isn't stored
+        """
+        try:
+            with open(self.path(blob_hash) + self.REFS_SUFFIX, 'rb') as refs_file:
+                return int(refs_file.read() or 0)
+        except IOError:
+            return 0
+
+    def _set_references(self, blob_hash, references):
+        refs_path = self.path(blob_hash) + self.REFS_SUFFIX
+        with open(refs_path + '.tmp', 'wb') as refs_file:
+            refs_file.write(str(references))
+        os.rename(refs_path + '.tmp', refs_path)
+
+    def add_reference(self, blob_hash):
+        """
+        Add a reference to a stored blob.
+        :raises KeyError: If the blob isn't stored
+        """
+        with self._lock:
+            if not self.contains(blob_hash):
+                raise KeyError(blob_hash)
+            self._set_references(blob_hash, self.references(blob_hash) + 1)
+
+    def release(self, blob_hash):
+        """
+        Release a reference to a blob, removing the blob once no references are left.
+        :return: True if the blob was removed, False otherwise
+        """
+        with self._lock:
+            references = self.references(blob_hash) - 1
+            if references > 0:
+                self._set_references(blob_hash, references)
+                return False
+
+            blob_path = self.path(blob_hash)
+            for file_path in (blob_path, blob_path + self.REFS_SUFFIX):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            return True
+
+    def open(self, blob_hash):
+        """
+        :return: The file holding the blob, opened for reading
+        """
+        return open(self.path(blob_hash), 'rb')
+
+    def iter_chunks(self, blob_hash):
+        """
+        Read a blob chunk by chunk.
+        """
+        with self.open(blob_hash) as blob_file:
+            chunk = blob_file.read(self.chunk_size)
+            while chunk:
+                yield chunk
+                chunk = blob_file.read(self.chunk_size)
+
+    def map(self, blob_hash):
+        """
+        Map a blob into memory, read only. An empty blob can't be mapped and is returned as an empty string.
+        :return: An `mmap.mmap` or ''
+        """
+        with self.open(blob_hash) as blob_file:
+            if not os.fstat(blob_file.fileno()).st_size:
+                return ''
+            return mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class BlobWriter(object):
+    """
+    Writes a blob in order, hashing it on the way, into a temporary file that only becomes the blob once committed.
+    """
+
+    def __init__(self, blob_store):
+        self._blob_store = blob_store
+        self._digest = sha256()
+        self.size = 0
+        descriptor, self._temporary_path = tempfile.mkstemp(prefix='.blob-', dir=blob_store.directory)
+        self._file = os.fdopen(descriptor, 'wb')
+
+    def write(self, data):
+        self._digest.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def commit(self, expected_hash=None):
+        """
+        Store the written data as a blob and add a reference to it.
+        :param expected_hash: The hash the data must have, if known
+        :return: Tuple of the hash and size of the blob
+        :raises ValueError: If the data doesn't have the expected hash, in which case the data is dropped
+        """
+        blob_hash = self._digest.hexdigest()
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            if expected_hash is not None and blob_hash != expected_hash:
+                raise ValueError("Blob hash %s doesn't match the expected %s" % (blob_hash, expected_hash))
+            self._blob_store._store(self._temporary_path, blob_hash)
+        except Exception:
+            self.abort()
+            raise
+        return blob_hash, self.size
+
+    def abort(self):
+        """
+        Drop the written data.
+        """
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self._temporary_path):
+            os.remove(self._temporary_path)
+
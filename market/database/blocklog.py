@@ -0,0 +1,609 @@
+"""
+An append-only, segmented log implementation of the `BlockChain`.
+
+Every record in the log is a length and CRC32 prefixed `market.community.encoding` tuple. There are two kinds of
+records:
+
+    ('b', <the 14 columns of a block, in the order of `PersistentBackend.BLOCK_QUERY`>)
+    ('a', <block number>, <the columns changed by `update_block_with_beneficiary`>)
+
+Completing a block with the beneficiary's half thus appends an amendment record instead of rewriting the block. The log
+is split over segment files of a maximum size.
+
+The index is kept in files of its own next to the segments, and memory mapped:
+
+    offsets.idx     per block number the location of its block record and of its latest amendment
+    keys.idx        a hash table from the hash, the identity and the (public key, sequence number) of a block to its
+                    block number, with the location up to which the log is indexed in its header
+    incomplete.idx  the block numbers of the blocks without the signature of the beneficiary
+
+Opening the log only indexes the records appended after that location, so it takes time and memory independent of the
+length of the chain. The index is rebuilt from the segments when it is missing or ahead of them. Records are decoded
+straight from buffers into the read-only mmaps of the segments.
+"""
+import mmap
+import os
+import struct
+import zlib
+from hashlib import sha1
+from threading import RLock
+
+from market.community.encoding import encode, decode
+from market.database.backends import BlockChain, DatabaseBlock
+
+# Length and CRC32 of the encoded record.
+RECORD_HEADER = struct.Struct('>II')
+
+BLOCK_RECORD = 'b'
+AMENDMENT_RECORD = 'a'
+
+# Indexes of the columns of a block row, see `PersistentBackend.BLOCK_QUERY`.
+BENEFACTOR, BENEFICIARY, SEQUENCE_NUMBER_BENEFACTOR, SEQUENCE_NUMBER_BENEFICIARY, SIGNATURE_BENEFICIARY, \
+    INSERT_TIME, HASH_BLOCK, SEQUENCE_NUMBER = 0, 1, 4, 5, 9, 10, 11, 13
+# The columns replaced by an amendment record.
+AMENDED_COLUMNS = (1, 3, 5, 7, 8, 9, 11)
+
+# Kinds of keys in the `KeyIndex`.
+HASH_KEY = 'h'
+IDENTITY_KEY = 'i'
+PUBLIC_KEY = 'k'
+
+
+def fingerprint(*key):
+    """
+    :return: The 64 bit fingerprint a key is stored under in the `KeyIndex`.
+    """
+    return struct.unpack_from('>Q', sha1(encode(key)).digest())[0]
+
+
+class OffsetIndex(object):
+    """
+    The locations of the block records and of their latest amendments, as fixed size entries in a file that is read
+    through an mmap.
+    """
+
+    # Segment and offset of the block record and of its latest amendment.
+    ENTRY = struct.Struct('>IQIQ')
+    NO_AMENDMENT = 0xffffffff
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self._file = open(path, 'r+b', 0)
+        size = os.fstat(self._file.fileno()).st_size
+        # An entry torn by a crash is dropped, its record is indexed again
+        self._count = size // self.ENTRY.size
+        if size % self.ENTRY.size:
+            self._file.truncate(self._count * self.ENTRY.size)
+        self._map = None
+
+    def __len__(self):
+        return self._count
+
+    def append(self, location):
+        self._write(self._count, location + (self.NO_AMENDMENT, 0))
+        self._count += 1
+
+    def set_amendment(self, block_number, location):
+        self._file.seek(block_number * self.ENTRY.size + 12)
+        self._file.write(struct.pack('>IQ', *location))
+
+    def truncate(self, count):
+        self._count = count
+        self._file.truncate(count * self.ENTRY.size)
+        self._map = None
+
+    def get(self, block_number):
+        """
+        :return: The location of the block record and of its latest amendment, None if it has none
+        """
+        position = block_number * self.ENTRY.size
+        if self._map is None or len(self._map) < position + self.ENTRY.size:
+            # The old map stays valid for the readers still using it
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        segment, offset, amendment_segment, amendment_offset = self.ENTRY.unpack_from(self._map, position)
+        amendment = (amendment_segment, amendment_offset) if amendment_segment != self.NO_AMENDMENT else None
+        return (segment, offset), amendment
+
+    def _write(self, block_number, entry):
+        self._file.seek(block_number * self.ENTRY.size)
+        self._file.write(self.ENTRY.pack(*entry))
+
+    def sync(self):
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._map = None
+        self._file.close()
+
+
+class KeyIndex(object):
+    """
+    An open addressing hash table in a memory mapped file, from the fingerprints of keys to block numbers.
+
+    Several blocks may share a key and fingerprints may collide, so the caller checks the blocks found against the key.
+    Entries are never removed: an amended block leaves its old keys behind, which no longer match. The table doubles
+    once it is half full.
+    """
+
+    # Amount of slots, amount of slots used, and the location up to which the log is indexed.
+    HEADER = struct.Struct('>QQIQ')
+    # Fingerprint and block number plus one, 0 marking an empty slot.
+    SLOT = struct.Struct('>QI')
+    INITIAL_SLOTS = 1024
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            self._create(path, self.INITIAL_SLOTS)
+        self._open()
+
+    @classmethod
+    def _create(cls, path, slots):
+        with open(path, 'wb') as index_file:
+            index_file.write(cls.HEADER.pack(slots, 0, 0, 0))
+            index_file.truncate(cls.HEADER.size + slots * cls.SLOT.size)
+
+    def _open(self):
+        self._file = open(self.path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        self.slots, self.used, segment, offset = self.HEADER.unpack_from(self._map, 0)
+        self.end = (segment, offset)
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def sync(self):
+        self._map.flush()
+
+    def set_end(self, location):
+        """
+        Record that the log is indexed up to a location.
+        """
+        self.end = location
+        self.HEADER.pack_into(self._map, 0, self.slots, self.used, location[0], location[1])
+
+    def add(self, key_fingerprint, block_number):
+        if (self.used + 1) * 2 > self.slots:
+            self._grow()
+        if self._insert(self._map, self.slots, key_fingerprint, block_number + 1):
+            self.used += 1
+
+    @classmethod
+    def _insert(cls, table, slots, key_fingerprint, value):
+        """
+        :return: True if a slot was taken, False if the entry was already there
+        """
+        slot = key_fingerprint % slots
+        while True:
+            position = cls.HEADER.size + slot * cls.SLOT.size
+            stored_fingerprint, stored_value = cls.SLOT.unpack_from(table, position)
+            if not stored_value:
+                cls.SLOT.pack_into(table, position, key_fingerprint, value)
+                return True
+            if (stored_fingerprint, stored_value) == (key_fingerprint, value):
+                return False
+            slot = (slot + 1) % slots
+
+    def find(self, key_fingerprint):
+        """
+        :return: The block numbers stored under a fingerprint
+        """
+        slot = key_fingerprint % self.slots
+        while True:
+            stored_fingerprint, stored_value = self.SLOT.unpack_from(self._map,
+                                                                     self.HEADER.size + slot * self.SLOT.size)
+            if not stored_value:
+                return
+            if stored_fingerprint == key_fingerprint:
+                yield stored_value - 1
+            slot = (slot + 1) % self.slots
+
+    def _grow(self):
+        slots = self.slots * 2
+        temporary_path = self.path + '.tmp'
+        self._create(temporary_path, slots)
+        with open(temporary_path, 'r+b') as table_file:
+            table = mmap.mmap(table_file.fileno(), 0)
+            for slot in xrange(self.slots):
+                stored_fingerprint, stored_value = self.SLOT.unpack_from(self._map,
+                                                                         self.HEADER.size + slot * self.SLOT.size)
+                if stored_value:
+                    self._insert(table, slots, stored_fingerprint, stored_value)
+            self.HEADER.pack_into(table, 0, slots, self.used, self.end[0], self.end[1])
+            table.close()
+        self.close()
+        os.rename(temporary_path, self.path)
+        self._open()
+
+
+class BlockLog(BlockChain):
+    """
+    A `BlockChain` stored in append-only segment files.
+    """
+
+    SEGMENT_NAME = "segment-%06d.log"
+    OFFSETS_NAME = "offsets.idx"
+    KEYS_NAME = "keys.idx"
+    INCOMPLETE_NAME = "incomplete.idx"
+    INCOMPLETE_ENTRY = struct.Struct('>I')
+    # Maximum size of a segment in bytes.
+    SEGMENT_SIZE = 64 * 1024 * 1024
+    # Maximum amount of appended records kept in memory, the segment is only remapped to read the older ones.
+    TAIL_SIZE = 1024
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE, sync=False):
+        """
+        :param directory: The directory holding the segment files
+        :param segment_size: A new segment is started once the current one has reached this size
+        :param sync: fsync after every append
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.sync = sync
+        self.chain_lock = RLock()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.open()
+
+    def open(self):
+        self._maps = {}
+        # Location -> record appended since the segments were mapped.
+        self._tail = {}
+        # The row of the latest block and its link hash, computed when first needed.
+        self._head = None
+        self._head_link_hash = None
+        self._segments = 0
+        self._file = None
+
+        while os.path.exists(self._segment_path(self._segments)):
+            self._segments += 1
+
+        self._open_index()
+        if not self._index_valid():
+            self._remove_index()
+            self._open_index()
+
+        segment, offset = self._keys.end
+        for segment in xrange(segment, self._segments):
+            self._load_segment(segment, offset, last=segment == self._segments - 1)
+            offset = 0
+
+        if self._offsets:
+            self._head = self._get_row(len(self._offsets) - 1)
+        if self._segments == 0:
+            self._segments = 1
+        self._file = open(self._segment_path(self._segments - 1), 'ab')
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+            self._write_incomplete()
+            self._incomplete_file.close()
+            self._offsets.close()
+            self._keys.close()
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = {}
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, self.SEGMENT_NAME % segment)
+
+    def _open_index(self):
+        self._offsets = OffsetIndex(os.path.join(self.directory, self.OFFSETS_NAME))
+        self._keys = KeyIndex(os.path.join(self.directory, self.KEYS_NAME))
+        # Block numbers of the blocks that may still be incomplete. New ones are appended to the file, the completed
+        # ones are only left out when it is rewritten.
+        self._incomplete = []
+        path = os.path.join(self.directory, self.INCOMPLETE_NAME)
+        if os.path.exists(path):
+            with open(path, 'rb') as incomplete_file:
+                data = incomplete_file.read()
+            for position in xrange(0, len(data) - len(data) % self.INCOMPLETE_ENTRY.size,
+                                   self.INCOMPLETE_ENTRY.size):
+                block_number, = self.INCOMPLETE_ENTRY.unpack_from(data, position)
+                if block_number < len(self._offsets) and block_number not in self._incomplete:
+                    self._incomplete.append(block_number)
+        self._write_incomplete()
+
+    def _index_valid(self):
+        """
+        Check that the index doesn't refer beyond the segments, as it would after losing the end of the log.
+        """
+        segment, offset = self._keys.end
+        if (segment, offset) == (0, 0):
+            return not len(self._offsets)
+        if segment >= self._segments or offset > os.path.getsize(self._segment_path(segment)):
+            return False
+        # The end is only recorded after the block record it follows has been indexed
+        return not len(self._offsets) or self._offsets.get(len(self._offsets) - 1)[0] <= (segment, offset)
+
+    def _remove_index(self):
+        self._offsets.close()
+        self._keys.close()
+        self._incomplete_file.close()
+        for name in (self.OFFSETS_NAME, self.KEYS_NAME, self.INCOMPLETE_NAME):
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _write_incomplete(self):
+        """
+        Rewrite the file of incomplete blocks from the list, and keep it open to append to.
+        """
+        if getattr(self, '_incomplete_file', None) and not self._incomplete_file.closed:
+            self._incomplete_file.close()
+        path = os.path.join(self.directory, self.INCOMPLETE_NAME)
+        with open(path + '.tmp', 'wb') as incomplete_file:
+            incomplete_file.write(''.join(self.INCOMPLETE_ENTRY.pack(block_number)
+                                          for block_number in self._incomplete))
+        os.rename(path + '.tmp', path)
+        self._incomplete_file = open(path, 'ab', 0)
+
+    def _load_segment(self, segment, offset, last):
+        """
+        Index the records of a segment from an offset on. A torn record at the end of the last segment is cut off.
+        """
+        path = self._segment_path(segment)
+        size = os.path.getsize(path)
+
+        if offset < size:
+            segment_map = self._map(segment, size)
+            while offset < size:
+                record = self._read_record(segment_map, offset, size)
+                if record is None:
+                    break
+                length, data = record
+                self._index_record(data, (segment, offset))
+                offset += RECORD_HEADER.size + length
+                self._keys.set_end((segment, offset))
+
+        if offset < size:
+            if not last:
+                raise IOError("Corrupt record in %s at offset %d" % (path, offset))
+            self._maps.pop(segment).close()
+            with open(path, 'r+b') as segment_file:
+                segment_file.truncate(offset)
+        elif offset == size and (segment, offset) > self._keys.end:
+            self._keys.set_end((segment, offset))
+
+    @staticmethod
+    def _read_record(segment_map, offset, size):
+        """
+        :return: (length, decoded record) or None if the record is incomplete or corrupt.
+        """
+        if offset + RECORD_HEADER.size > size:
+            return None
+        length, crc = RECORD_HEADER.unpack_from(segment_map, offset)
+        start = offset + RECORD_HEADER.size
+        if start + length > size:
+            return None
+        payload = buffer(segment_map, start, length)
+        if zlib.crc32(payload) & 0xffffffff != crc:
+            return None
+        return length, decode(payload)[1]
+
+    def _map(self, segment, size=None):
+        """
+        Return a read only mmap of a segment, remapping it when it has grown beyond `size`. A replaced map is not
+        closed, it is released once no reader holds a buffer into it anymore.
+        """
+        segment_map = self._maps.get(segment)
+        if segment_map is None or (size is not None and len(segment_map) < size):
+            with open(self._segment_path(segment), 'rb') as segment_file:
+                segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        return segment_map
+
+    def _read_buffer(self, location):
+        """
+        :return: A buffer into the mmap of a segment holding the encoded record at a location, without copying it
+        """
+        segment, offset = location
+        segment_map = self._map(segment)
+        if offset + RECORD_HEADER.size > len(segment_map):
+            segment_map = self._map(segment, offset + RECORD_HEADER.size)
+        length, _ = RECORD_HEADER.unpack_from(segment_map, offset)
+        start = offset + RECORD_HEADER.size
+        if start + length > len(segment_map):
+            segment_map = self._map(segment, start + length)
+        return buffer(segment_map, start, length)
+
+    def _read(self, location):
+        data = self._tail.get(location)
+        if data is not None:
+            return data
+        return decode(self._read_buffer(location))[1]
+
+    def _index_record(self, data, location):
+        if data[0] == BLOCK_RECORD:
+            row = data[1:]
+            # The record may have been indexed in part before a crash
+            if len(self._offsets) and self._offsets.get(len(self._offsets) - 1)[0] == location:
+                block_number = len(self._offsets) - 1
+            else:
+                block_number = len(self._offsets)
+                self._offsets.append(location)
+            self._add_keys(row, block_number)
+            self._keys.add(fingerprint(IDENTITY_KEY, row[INSERT_TIME], row[SEQUENCE_NUMBER_BENEFACTOR],
+                                       row[BENEFACTOR]), block_number)
+            if not row[SIGNATURE_BENEFICIARY] and block_number not in self._incomplete:
+                self._incomplete.append(block_number)
+                self._incomplete_file.write(self.INCOMPLETE_ENTRY.pack(block_number))
+            self._head = tuple(row)
+            self._head_link_hash = None
+        elif data[0] == AMENDMENT_RECORD:
+            block_number = data[1]
+            self._offsets.set_amendment(block_number, location)
+            row = self._get_row(block_number)
+            self._add_keys(row, block_number)
+            if row[SIGNATURE_BENEFICIARY] and block_number in self._incomplete:
+                # Left in the file until it is rewritten, it is checked against the row when read back
+                self._incomplete.remove(block_number)
+            if block_number == len(self._offsets) - 1:
+                self._head = row
+
+    def _add_keys(self, row, block_number):
+        self._keys.add(fingerprint(HASH_KEY, row[HASH_BLOCK]), block_number)
+        for public_key, sequence_number in ((row[BENEFACTOR], row[SEQUENCE_NUMBER_BENEFACTOR]),
+                                            (row[BENEFICIARY], row[SEQUENCE_NUMBER_BENEFICIARY])):
+            if public_key:
+                self._keys.add(fingerprint(PUBLIC_KEY, public_key, sequence_number), block_number)
+
+    def _find(self, key, matches):
+        """
+        :param key: The key of the blocks, as passed to `fingerprint`
+        :param matches: Callable telling whether a row has the key
+        :return: Sorted list of the block numbers and rows of the blocks that have the key
+        """
+        found = {}
+        for block_number in self._keys.find(fingerprint(*key)):
+            if block_number not in found and block_number < len(self._offsets):
+                row = self._get_row(block_number)
+                if matches(row):
+                    found[block_number] = row
+        return sorted(found.items())
+
+    def _find_by_public_key(self, public_key, sequence_number):
+        return self._find((PUBLIC_KEY, public_key, sequence_number),
+                          lambda row: (row[BENEFACTOR], row[SEQUENCE_NUMBER_BENEFACTOR]) == (public_key, sequence_number)
+                          or (row[BENEFICIARY], row[SEQUENCE_NUMBER_BENEFICIARY]) == (public_key, sequence_number))
+
+    def _get_row(self, block_number):
+        """
+        Return the row of a block, with its latest amendment applied.
+        """
+        location, amendment_location = self._offsets.get(block_number)
+        row = list(self._read(location)[1:])
+        if amendment_location:
+            amendment = self._read(amendment_location)
+            for column, value in zip(AMENDED_COLUMNS, amendment[2:]):
+                row[column] = value
+        return tuple(row)
+
+    def _append(self, data):
+        """
+        Append a record to the log.
+        :return: The location of the record
+        """
+        if self._file.tell() >= self.segment_size:
+            self._file.close()
+            self._segments += 1
+            self._file = open(self._segment_path(self._segments - 1), 'ab')
+
+        payload = encode(data)
+        location = (self._segments - 1, self._file.tell())
+        self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + payload)
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+
+        if len(self._tail) >= self.TAIL_SIZE:
+            self._tail.clear()
+        self._tail[location] = data
+        self._index_record(data, location)
+        self._keys.set_end((location[0], self._file.tell()))
+        if self.sync:
+            self._offsets.sync()
+            self._keys.sync()
+        return location
+
+    def append_row(self, row):
+        """
+        Append a block row as is, keeping its stored hash, previous hash and sequence number.
+        :param row: The columns of the block, in the order of `PersistentBackend.BLOCK_QUERY`
+        """
+        with self.chain_lock:
+            self._append((BLOCK_RECORD,) + tuple(row))
+
+    def add_block(self, block):
+        with self.chain_lock:
+            block.previous_hash = self.get_latest_link_hash()
+            block.sequence_number = self.get_next_sequence_number()
+            self.append_row((block.benefactor, block.beneficiary, block.agreement_benefactor,
+                             block.agreement_beneficiary, block.sequence_number_benefactor,
+                             block.sequence_number_beneficiary, block.previous_hash_benefactor,
+                             block.previous_hash_beneficiary, block.signature_benefactor, block.signature_beneficiary,
+                             block.insert_time, block.hash_block, block.previous_hash, block.sequence_number))
+
+    def update_block_with_beneficiary(self, block):
+        with self.chain_lock:
+            found = self._find((IDENTITY_KEY, block.insert_time, block.sequence_number_benefactor, block.benefactor),
+                               lambda row: (row[INSERT_TIME], row[SEQUENCE_NUMBER_BENEFACTOR], row[BENEFACTOR]) ==
+                               (block.insert_time, block.sequence_number_benefactor, block.benefactor))
+            if found:
+                self._append((AMENDMENT_RECORD, found[-1][0], block.beneficiary, block.agreement_beneficiary,
+                              block.sequence_number_beneficiary, block.previous_hash_beneficiary,
+                              block.signature_benefactor, block.signature_beneficiary, block.hash_block))
+
+    def get_latest_hash(self):
+        return self._head[HASH_BLOCK] if self._head else ''
+
+    def get_latest_link_hash(self):
+        with self.chain_lock:
+            if self._head and self._head_link_hash is None:
+                self._head_link_hash = DatabaseBlock.from_row(self._head).link_hash()
+            return self._head_link_hash if self._head else ''
+
+    def get_by_hash(self, hash):
+        found = self._find((HASH_KEY, hash), lambda row: row[HASH_BLOCK] == hash)
+        return self._create_database_block(found[-1][1]) if found else None
+
+    def get_by_public_key_and_sequence_number(self, public_key, sequence_number):
+        found = self._find_by_public_key(public_key, sequence_number)
+        return self._create_database_block(found[0][1]) if found else None
+
+    def get_range(self, public_key, from_sequence_number, to_sequence_number):
+        """
+        Looks up every sequence number of the range, so the range should be bounded by the caller.
+        """
+        result = []
+        seen = set()
+        for sequence_number in xrange(from_sequence_number, to_sequence_number + 1):
+            for block_number, row in self._find_by_public_key(public_key, sequence_number):
+                if block_number not in seen:
+                    seen.add(block_number)
+                    result.append(self._create_database_block(row))
+        return result
+
+    def get_incomplete_blocks(self, public_key, limit):
+        with self.chain_lock:
+            result = []
+            for block_number in sorted(self._incomplete):
+                row = self._get_row(block_number)
+                if row[BENEFACTOR] == public_key and not row[SIGNATURE_BENEFICIARY]:
+                    result.append(self._create_database_block(row))
+                    if len(result) == limit:
+                        break
+            return sorted(result, key=lambda block: block.sequence_number_benefactor)
+
+    def iter_blocks(self, after_position=0):
+        """
+        Iterate over the blocks in the order they were appended, the position being the block number plus one.
+        """
+        for block_number in xrange(after_position, len(self._offsets)):
+            yield block_number + 1, self._get_row(block_number)
+
+    def _create_database_block(self, db_result):
+        if db_result:
+            return DatabaseBlock.from_row(db_result)
+        else:
+            return None
+
+    def get_latest_sequence_number(self):
+        return self._head[SEQUENCE_NUMBER] if self._head else 0
+
+    def get_next_sequence_number(self):
+        if not len(self._offsets):
+            return 0
+        return self.get_latest_sequence_number() + 1
+
+    def check_add_genesis_block(self):
+        with self.chain_lock:
+            if not len(self._offsets):
+                self.add_block(self.create_genesis_block())
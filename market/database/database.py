@@ -1,5 +1,7 @@
 from market.database.backends import Backend
 from market.models import DatabaseModel
+from market.models.document import Document
+from market.models.loans import Investment
 
 
 class Database(object):
@@ -61,10 +63,15 @@ class MarketDatabase(Database):
 
     # TODO: Refactor name.
 
-    def __init__(self, backend):
+    def __init__(self, backend, blob_store=None):
+        """
+        :param backend: The `Backend` storing the models
+        :param blob_store: The `BlobStore` holding the data of the documents, released when a document is deleted
+        """
         assert isinstance(backend, Backend)
 
         self._backend = backend
+        self.blob_store = blob_store
 
     def get(self, _type, _id):
         try:
@@ -80,7 +87,9 @@ class MarketDatabase(Database):
                 _id = obj.generate_id(force=True)
 
             obj.save(_id)
-            self.backend.post(_type, _id, obj.encode())
+            with self.backend.transaction():
+                self.backend.post(_type, _id, obj.encode())
+                self._index(obj)
             return _id
         except IndexError:
             return False
@@ -92,13 +101,54 @@ class MarketDatabase(Database):
         assert _id == obj.id
 
         try:
-            return self.backend.put(_type, _id, obj.encode())
+            with self.backend.transaction():
+                if not self.backend.put(_type, _id, obj.encode()):
+                    return False
+                self._index(obj)
+                return True
         except IndexError:
             return False
 
     def delete(self, obj):
         assert isinstance(obj, DatabaseModel)
-        return self.backend.delete(obj)
+        # The stored document refers to the data, a pending copy of it may not
+        stored = self.get(Document.type, obj.id) if isinstance(obj, Document) else None
+        with self.backend.transaction():
+            if isinstance(obj, Investment):
+                self.backend.delete_investment_index(obj.id)
+            deleted = self.backend.delete(obj)
+        if deleted and stored and stored.blob_hash and self.blob_store:
+            self.blob_store.release(stored.blob_hash)
+        return deleted
+
+    def _index(self, obj):
+        """
+        Update the secondary indexes of the backend over a stored model.
+        """
+        if isinstance(obj, Investment):
+            self.backend.put_investment_index(obj.id, obj.mortgage_id, obj.investor_key, obj.status.value)
+
+    def investments_for_mortgage(self, mortgage_id, status=None):
+        """
+        Return the investments made in a mortgage, using the index of the backend.
+        :param mortgage_id: The id of the mortgage
+        :param status: The `STATUS` of the investments to return, all investments if None
+        :return: The list of `Investment`s, in the order they were stored
+        """
+        return self._investments(mortgage_id=mortgage_id, status=status)
+
+    def investments_for_investor(self, investor_key, status=None):
+        """
+        Return the investments made by an investor, using the index of the backend.
+        :param investor_key: The id of the investor
+        :param status: The `STATUS` of the investments to return, all investments if None
+        :return: The list of `Investment`s, in the order they were stored
+        """
+        return self._investments(investor_key=investor_key, status=status)
+
+    def _investments(self, mortgage_id=None, investor_key=None, status=None):
+        values = self.backend.get_investments(mortgage_id, investor_key, status.value if status is not None else None)
+        return [DatabaseModel.decode(value) for value in values]
 
     def get_all(self, _type):
         try:
@@ -108,6 +158,18 @@ class MarketDatabase(Database):
         except KeyError:
             return None
 
+    def read_transaction(self):
+        """
+        Context manager running the reads within it on a consistent snapshot, see `Backend.read_transaction`.
+        """
+        return self.backend.read_transaction()
+
+    def transaction(self):
+        """
+        Context manager applying the writes within it as a single unit of work, see `Backend.transaction`.
+        """
+        return self.backend.transaction()
+
     @property
     def backend(self):
         return self._backend
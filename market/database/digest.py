@@ -0,0 +1,110 @@
+"""
+Bucketed hash digests over the models stored in a backend.
+
+Every stored model has a digest over its (type, id, value). Since the value changes whenever a new version of a model
+is saved, the digest identifies a specific version of a model. The models are spread over `DIGEST_BUCKETS` buckets by
+their (type, id). The digest of a bucket is the XOR of the digests of its models, so it can be updated incrementally
+when a model is posted, replaced or deleted.
+
+A merkle tree over the bucket digests allows two nodes to find the buckets they differ in with one exchange per level
+of the tree, see `find_differing_buckets`.
+"""
+from hashlib import sha256
+
+# Amount of buckets, must be a power of two.
+DIGEST_BUCKETS = 256
+# Digest of an empty bucket.
+EMPTY_DIGEST = '\x00' * 32
+
+
+def model_digest(type_name, value_id, value):
+    """
+    Return the digest of a stored model.
+
+    :param type_name: The type name of the value
+    :param value_id: The id of the value
+    :param value: The stored (encoded) value
+    :return: A 32 byte digest
+    """
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return sha256("%s:%s:%s" % (type_name, value_id, sha256(str(value)).digest())).digest()
+
+
+def model_bucket(type_name, value_id):
+    """
+    Return the bucket a model belongs to. All versions of a model fall in the same bucket.
+    """
+    return int(sha256("%s:%s" % (type_name, value_id)).hexdigest()[:8], 16) % DIGEST_BUCKETS
+
+
+def xor_digest(digest1, digest2):
+    """
+    Combine two digests. Combining the same digest twice cancels it out again.
+    """
+    return ''.join(chr(ord(a) ^ ord(b)) for a, b in zip(digest1, digest2))
+
+
+class DigestTree(object):
+    """
+    A merkle tree over the bucket digests of a backend.
+
+    Level 0 contains the root, the last level contains the bucket digests themselves.
+    """
+
+    def __init__(self, bucket_digests):
+        assert len(bucket_digests) == DIGEST_BUCKETS
+
+        self._levels = [list(bucket_digests)]
+        while len(self._levels[0]) > 1:
+            below = self._levels[0]
+            self._levels.insert(0, [sha256(below[i] + below[i + 1]).digest() for i in xrange(0, len(below), 2)])
+
+    @property
+    def root(self):
+        return self._levels[0][0]
+
+    @property
+    def depth(self):
+        """
+        The index of the level containing the bucket digests.
+        """
+        return len(self._levels) - 1
+
+    def get_nodes(self, level, indexes):
+        """
+        Return the digests of the given nodes on a level of the tree.
+        :param level: The level of the tree, 0 being the root
+        :param indexes: The indexes of the nodes on that level
+        :return: A list of digests, in the order of `indexes`
+        """
+        return [self._levels[level][index] for index in indexes]
+
+
+def find_differing_buckets(local_tree, get_remote_nodes):
+    """
+    Find the buckets in which a local and a remote tree differ.
+
+    Descends both trees from the root, only following the nodes that differ. This takes one exchange per level of the
+    tree, each exchange requesting the children of the nodes that differed on the level above.
+
+    :param local_tree: The local `DigestTree`
+    :param get_remote_nodes: Callable(level, indexes) returning the remote digests of the given nodes
+    :return: A tuple with the sorted list of differing bucket indexes and the amount of exchanges used.
+    """
+    assert isinstance(local_tree, DigestTree)
+
+    indexes = [0]
+    exchanges = 0
+    for level in xrange(local_tree.depth + 1):
+        remote_nodes = get_remote_nodes(level, indexes)
+        exchanges += 1
+
+        differing = [index for index, remote in zip(indexes, remote_nodes)
+                     if local_tree.get_nodes(level, [index])[0] != remote]
+        if level == local_tree.depth or not differing:
+            return differing, exchanges
+
+        indexes = [child for index in differing for child in (2 * index, 2 * index + 1)]
+
+    return [], exchanges
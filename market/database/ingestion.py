@@ -0,0 +1,109 @@
+"""
+Storing document files in the `BlobStore` off the reactor thread.
+
+`DocumentIngestion` copies files into the blob store on a worker thread of its own, chunk by chunk, in the order they
+were queued. Progress and results are handed back on the reactor thread, so a profile with large documents can be saved
+right away while its documents are still being stored.
+"""
+import logging
+import os
+from Queue import Queue
+from threading import Thread
+
+from twisted.internet.defer import Deferred
+from twisted.python.failure import Failure
+
+logger = logging.getLogger(__name__)
+
+# Minimum amount of bytes stored between two progress reports of a file.
+PROGRESS_INTERVAL = 1024 * 1024
+
+
+class DocumentIngestion(object):
+    """
+    Stores files in a `BlobStore` on a worker thread.
+    """
+
+    def __init__(self, blob_store, call_in_reactor=None, progress_interval=PROGRESS_INTERVAL):
+        """
+        :param blob_store: The `BlobStore` to store the files in
+        :param call_in_reactor: Callable used to run the callbacks on the reactor thread, defaults to
+        `reactor.callFromThread`
+        :param progress_interval: Minimum amount of bytes stored between two progress reports of a file
+        """
+        if call_in_reactor is None:
+            from twisted.internet import reactor
+            call_in_reactor = reactor.callFromThread
+
+        self.blob_store = blob_store
+        self.call_in_reactor = call_in_reactor
+        self.progress_interval = progress_interval
+        self._queue = Queue()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        self._thread = Thread(target=self._run, name="document-ingestion")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop the worker thread once the files queued before have been stored.
+        """
+        if not self.running:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def ingest(self, path, progress=None):
+        """
+        Queue a file to be stored.
+        :param path: The path of the file
+        :param progress: Callable called with the amount of bytes stored and the size of the file, now and then while
+        the file is stored
+        :return: Deferred firing with the hash and size of the blob, or failing if the file couldn't be stored
+        """
+        deferred = Deferred()
+        self._queue.put((path, progress, deferred))
+        return deferred
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            path, progress, deferred = job
+            try:
+                result = self._store(path, progress)
+            except Exception:
+                logger.exception("Unable to store %s", path)
+                self.call_in_reactor(deferred.errback, Failure())
+            else:
+                self.call_in_reactor(deferred.callback, result)
+
+    def _store(self, path, progress):
+        with open(path, 'rb') as input_file:
+            size = os.fstat(input_file.fileno()).st_size
+            writer = self.blob_store.writer()
+            try:
+                reported = 0
+                chunk = input_file.read(self.blob_store.chunk_size)
+                while chunk:
+                    writer.write(chunk)
+                    if progress and writer.size - reported >= self.progress_interval:
+                        reported = writer.size
+                        self.call_in_reactor(progress, writer.size, size)
+                    chunk = input_file.read(self.blob_store.chunk_size)
+            except Exception:
+                writer.abort()
+                raise
+            result = writer.commit()
+        if progress:
+            self.call_in_reactor(progress, writer.size, writer.size)
+        return result
@@ -0,0 +1,269 @@
+"""
+A backend spreading its data over multiple SQLite files.
+
+Every model type is stored in a shard of its own and the block chain in another one, each shard being a
+`PersistentBackend` with its own connection, page cache and write-ahead log. Writes of one type, such as large document
+blobs, thus no longer contend with the writes of the other types.
+
+The options are stored in the chain shard, next to the chain whose checkpoints are signed with the key they hold.
+"""
+import os
+import sys
+from contextlib import contextmanager
+
+from market.database.backends import Backend, BlockChain, PersistentBackend, DEFAULT_DURABILITY
+from market.database.digest import DIGEST_BUCKETS, EMPTY_DIGEST, xor_digest
+
+
+class ShardedBackend(Backend, BlockChain):
+    """
+    A `Backend` and `BlockChain` routing every model type, and the block chain, to its own database file.
+    """
+
+    CHAIN_SHARD = u"chain"
+    SHARD_NAME = u"%s.db"
+
+    def __init__(self, directory, durability=DEFAULT_DURABILITY):
+        """
+        :param directory: The directory holding the shard files
+        :param durability: The durability profile of the shards, see `DURABILITY_PROFILES`
+        """
+        self.directory = directory
+        self.durability = durability
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.chain = self._open_shard(self.CHAIN_SHARD)
+        self._shards = {}
+        # The entered transactions of the shards while a `transaction` is open, None otherwise.
+        self._transactions = None
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.startswith(u"type-") and file_name.endswith(u".db"):
+                type_name = file_name[len(u"type-"):-len(u".db")]
+                self._shards[type_name] = self._open_shard(u"type-" + type_name)
+
+    def _open_shard(self, name):
+        return PersistentBackend(self.directory, self.SHARD_NAME % name, self.durability)
+
+    def _shard(self, type_name):
+        """
+        Return the shard of a model type, creating it when the type is stored for the first time. A shard created
+        within a `transaction` joins it.
+        """
+        shard = self._shards.get(type_name)
+        if shard is None:
+            shard = self._shards[type_name] = self._open_shard(u"type-" + type_name)
+            if self._transactions is not None:
+                self._join_transaction(shard)
+        return shard
+
+    @property
+    def shards(self):
+        """
+        All shards, the chain shard first.
+        """
+        return [self.chain] + [self._shards[type_name] for type_name in sorted(self._shards)]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def maintenance(self):
+        for shard in self.shards:
+            shard.maintenance()
+
+    def get(self, type_name, value_id):
+        if type_name not in self._shards:
+            raise IndexError
+        return self._shards[type_name].get(type_name, value_id)
+
+    def post(self, type_name, value_id, obj):
+        if not self.id_available(value_id):
+            raise IndexError("Index already in use")
+        return self._shard(type_name).post(type_name, value_id, obj)
+
+    def put(self, type_name, value_id, obj):
+        return self._shard(type_name).put(type_name, value_id, obj)
+
+    def delete(self, obj):
+        if obj.type in self._shards:
+            return self._shards[obj.type].delete(obj)
+        return False
+
+    def id_available(self, value_id):
+        return all(shard.id_available(value_id) for shard in self._shards.itervalues())
+
+    def exists(self, type_name, value_id):
+        return type_name in self._shards and self._shards[type_name].exists(type_name, value_id)
+
+    def clear(self):
+        for shard in self.shards:
+            shard.clear()
+
+    def get_all(self, type_name):
+        if type_name not in self._shards:
+            return []
+        return self._shards[type_name].get_all(type_name)
+
+    def set_option(self, option_name, value):
+        self.chain.set_option(option_name, value)
+
+    def get_option(self, option_name):
+        return self.chain.get_option(option_name)
+
+    def save_task(self, task_id, name, arguments, status, attempts, error, after):
+        self.chain.save_task(task_id, name, arguments, status, attempts, error, after)
+
+    def get_tasks(self, statuses=None):
+        return self.chain.get_tasks(statuses)
+
+    def delete_task(self, task_id):
+        self.chain.delete_task(task_id)
+
+    def put_inbox_entry(self, bank_id, loan_request_id, status, received_at=None):
+        self.chain.put_inbox_entry(bank_id, loan_request_id, status, received_at)
+
+    def get_inbox(self, bank_id, status=None, limit=None, offset=0):
+        return self.chain.get_inbox(bank_id, status, limit, offset)
+
+    def count_inbox(self, bank_id, status=None):
+        return self.chain.count_inbox(bank_id, status)
+
+    def delete_inbox_entry(self, bank_id, loan_request_id):
+        self.chain.delete_inbox_entry(bank_id, loan_request_id)
+
+    # The investments are indexed in their own shard, so the index can be joined with them.
+
+    def put_investment_index(self, investment_id, mortgage_id, investor_key, status):
+        self._shard(u"investment").put_investment_index(investment_id, mortgage_id, investor_key, status)
+
+    def delete_investment_index(self, investment_id):
+        if u"investment" in self._shards:
+            self._shards[u"investment"].delete_investment_index(investment_id)
+
+    def get_investments(self, mortgage_id=None, investor_key=None, status=None):
+        if u"investment" not in self._shards:
+            return []
+        return self._shards[u"investment"].get_investments(mortgage_id, investor_key, status)
+
+    def get_bucket_digests(self):
+        digests = [EMPTY_DIGEST] * DIGEST_BUCKETS
+        for shard in self._shards.itervalues():
+            digests = [xor_digest(digest, shard_digest)
+                       for digest, shard_digest in zip(digests, shard.get_bucket_digests())]
+        return digests
+
+    def get_bucket_entries(self, bucket):
+        entries = []
+        for shard in self._shards.itervalues():
+            entries.extend(shard.get_bucket_entries(bucket))
+        return sorted(entries)
+
+    @contextmanager
+    def read_transaction(self):
+        """
+        Run the reads within the block on a snapshot of every shard. The snapshots are taken one after the other, so
+        they are consistent per shard only.
+        """
+        with self._nested([shard.read_transaction for shard in self.shards]):
+            yield
+
+    @contextmanager
+    def transaction(self):
+        """
+        Hold back the commits of all shards until the end of the block, and roll back every shard if the block raises.
+        Nested transactions join the outer one.
+
+        The shards are committed one after the other, in the reverse order of joining the transaction. A crash in
+        between the commits leaves the shards committed before it with their writes.
+        """
+        if self._transactions is not None:
+            yield
+            return
+
+        self._transactions = []
+        try:
+            for shard in self.shards:
+                self._join_transaction(shard)
+            yield
+        except:
+            self._end_transactions(sys.exc_info())
+            raise
+        else:
+            self._end_transactions((None, None, None))
+
+    def _join_transaction(self, shard):
+        transaction = shard.transaction()
+        transaction.__enter__()
+        self._transactions.append(transaction)
+
+    def _end_transactions(self, exc_info):
+        transactions, self._transactions = self._transactions, None
+        self._exit_transactions(transactions, exc_info)
+
+    def _exit_transactions(self, transactions, exc_info):
+        """
+        Exit the transactions of the shards in reverse order. When a commit fails, the shards that follow are rolled
+        back and its error is raised.
+        """
+        if not transactions:
+            return
+        try:
+            transactions[-1].__exit__(*exc_info)
+        except Exception:
+            self._exit_transactions(transactions[:-1], sys.exc_info())
+            raise
+        self._exit_transactions(transactions[:-1], exc_info)
+
+    @staticmethod
+    @contextmanager
+    def _nested(context_factories):
+        """
+        Enter the contexts in order and exit them in reverse order.
+        """
+        if not context_factories:
+            yield
+            return
+        with context_factories[0]():
+            with ShardedBackend._nested(context_factories[1:]):
+                yield
+
+    def add_block(self, block):
+        return self.chain.add_block(block)
+
+    def update_block_with_beneficiary(self, block):
+        return self.chain.update_block_with_beneficiary(block)
+
+    def get_latest_hash(self):
+        return self.chain.get_latest_hash()
+
+    def get_latest_link_hash(self):
+        return self.chain.get_latest_link_hash()
+
+    def get_by_hash(self, hash):
+        return self.chain.get_by_hash(hash)
+
+    def get_by_public_key_and_sequence_number(self, public_key, sequence_number):
+        return self.chain.get_by_public_key_and_sequence_number(public_key, sequence_number)
+
+    def get_range(self, public_key, from_sequence_number, to_sequence_number):
+        return self.chain.get_range(public_key, from_sequence_number, to_sequence_number)
+
+    def get_incomplete_blocks(self, public_key, limit):
+        return self.chain.get_incomplete_blocks(public_key, limit)
+
+    def iter_blocks(self, after_position=0):
+        return self.chain.iter_blocks(after_position)
+
+    def get_latest_sequence_number(self):
+        return self.chain.get_latest_sequence_number()
+
+    def get_next_sequence_number(self):
+        return self.chain.get_next_sequence_number()
+
+    def check_add_genesis_block(self):
+        return self.chain.check_add_genesis_block()
+
+    def checkpoint_and_archive(self, keep_blocks=10000):
+        return self.chain.checkpoint_and_archive(keep_blocks)
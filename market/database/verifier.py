@@ -0,0 +1,179 @@
+"""
+Streaming verification of a node's block chain.
+
+The blocks are read in chain order. Recomputing the hashes and checking the signatures of the embedded agreements is
+spread over a process pool, while the checks between consecutive blocks, the `previous_hash` links and the sequence
+numbers, are done in order in the calling process. A block links to the `DatabaseBlock.link_hash` of the preceding
+block, which doesn't change when the preceding block is completed by its beneficiary later on.
+
+A checkpoint file records where the last run stopped, so a next run only verifies the blocks appended since. The
+checkpoint never moves past a block with problems, so a next run reports them again.
+"""
+import json
+import os
+from multiprocessing import Pool
+
+from market.database.backends import DatabaseBlock
+from market.models import DatabaseModel
+
+# Amount of blocks handed to a worker process at once.
+CHUNK_SIZE = 256
+# Amount of verified blocks between two checkpoint writes.
+CHECKPOINT_INTERVAL = 10000
+# Version of the checkpoint file. Checkpoints of version 1 hold the full hash of the last verified block rather than its
+# link hash, and are ignored.
+CHECKPOINT_VERSION = 2
+
+
+def check_block(item):
+    """
+    Check a single block. Runs in a worker process.
+
+    Blocks are passed as rows, since slotted `DatabaseBlock` objects don't pickle.
+    :param item: Tuple of the position of the block and its row in the order of `PersistentBackend.BLOCK_QUERY`
+    :return: Tuple of the position, a list of problems found and the link hash of the block
+    """
+    position, row = item
+    block = DatabaseBlock.from_row(row)
+    problems = []
+
+    if not block.verify():
+        problems.append("hash mismatch")
+
+    # The genesis block has no agreements.
+    if block.sequence_number != 0:
+        for side, agreement in (('benefactor', block.agreement_benefactor),
+                                ('beneficiary', block.agreement_beneficiary)):
+            if not agreement or agreement == str(None):
+                continue
+            model = DatabaseModel.decode(agreement)
+            if not isinstance(model, DatabaseModel):
+                problems.append("agreement of the %s can't be decoded" % side)
+            elif model._has_signature() and not DatabaseModel.signature_valid(model):
+                problems.append("invalid signature on the agreement of the %s" % side)
+
+    return position, problems, block.link_hash()
+
+
+class VerificationReport(object):
+    """
+    The result of a verification run.
+    """
+
+    def __init__(self, start_position):
+        self.start_position = start_position
+        self.last_position = start_position
+        self.blocks_verified = 0
+        # List of (position, problem) tuples
+        self.errors = []
+
+    @property
+    def valid(self):
+        return not self.errors
+
+    def add_error(self, position, problem):
+        self.errors.append((position, problem))
+
+
+class ChainVerifier(object):
+    """
+    Verifies the block chain of a `BlockChain` backend that supports `iter_blocks`.
+    """
+
+    def __init__(self, backend, checkpoint_path=None, processes=None):
+        """
+        :param backend: The backend holding the chain
+        :param checkpoint_path: File to resume from and to store the checkpoint in, or None to verify the whole chain
+        :param processes: Size of the process pool, defaults to the amount of CPUs
+        """
+        self.backend = backend
+        self.checkpoint_path = checkpoint_path
+        self.processes = processes
+
+    def load_checkpoint(self):
+        """
+        :return: The checkpoint dictionary with the position, link hash and sequence number of the last verified
+        block.
+        """
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path, 'r') as checkpoint_file:
+                checkpoint = json.load(checkpoint_file)
+            if checkpoint.get('version') == CHECKPOINT_VERSION:
+                return checkpoint
+        return {'position': 0, 'hash': '', 'sequence_number': None}
+
+    def save_checkpoint(self, position, hash, sequence_number):
+        if not self.checkpoint_path:
+            return
+
+        # Write to a temporary file first, so an interrupted write doesn't leave a broken checkpoint.
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            json.dump({'version': CHECKPOINT_VERSION, 'position': position, 'hash': hash,
+                       'sequence_number': sequence_number}, checkpoint_file)
+        os.rename(temporary_path, self.checkpoint_path)
+
+    def run(self):
+        """
+        Verify all blocks after the checkpoint.
+        :return: `VerificationReport`
+        """
+        checkpoint = self.load_checkpoint()
+        report = VerificationReport(checkpoint['position'])
+
+        previous_hash = checkpoint['hash']
+        previous_sequence_number = checkpoint['sequence_number']
+        # The position, link hash and sequence number of the last block before the first block with problems
+        verified = (checkpoint['position'], previous_hash, previous_sequence_number)
+        since_checkpoint = 0
+
+        pool = Pool(self.processes)
+        try:
+            for batch in self._batches(self.backend.iter_blocks(checkpoint['position']), CHUNK_SIZE * 16):
+                results = pool.map(check_block, batch, CHUNK_SIZE)
+
+                # The links are checked in order, with the link hashes computed by the workers.
+                for (_, row), (position, problems, link_hash) in zip(batch, results):
+                    block = DatabaseBlock.from_row(row)
+
+                    if block.previous_hash != previous_hash:
+                        problems.append("previous hash does not match the preceding block")
+                    expected = 0 if previous_sequence_number is None else previous_sequence_number + 1
+                    if block.sequence_number != expected:
+                        problems.append("sequence number %d, expected %d" % (block.sequence_number, expected))
+
+                    for problem in problems:
+                        report.add_error(position, problem)
+
+                    previous_hash = link_hash
+                    previous_sequence_number = block.sequence_number
+                    if report.valid:
+                        verified = (position, previous_hash, previous_sequence_number)
+
+                report.blocks_verified += len(batch)
+                report.last_position = batch[-1][0]
+
+                since_checkpoint += len(batch)
+                if since_checkpoint >= CHECKPOINT_INTERVAL:
+                    self.save_checkpoint(*verified)
+                    since_checkpoint = 0
+        finally:
+            pool.close()
+            pool.join()
+
+        if verified[0] != checkpoint['position']:
+            self.save_checkpoint(*verified)
+
+        report.errors.sort(key=lambda error: error[0])
+        return report
+
+    @staticmethod
+    def _batches(iterable, size):
+        batch = []
+        for item in iterable:
+            batch.append(item)
+            if len(batch) == size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
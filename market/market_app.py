@@ -24,6 +24,14 @@ class MarketApplication(QApplication):
     bank_status = {}
     port = 1236
     database_prefix = 'market'
+    # Durability profile of the database, None for the default profile
+    durability = None
+    # Transport to send documents with, None for the default transport
+    document_transport = None
+    # The `tftp_server.Server` receiving the documents of this node, if any
+    tftp_server = None
+    # Directory of the `BlockLog` to keep the block chain in, None to keep it in the database
+    chain_store = None
 
     def __init__(self, *argv):
         QApplication.__init__(self, *argv)
@@ -31,6 +39,21 @@ class MarketApplication(QApplication):
 
     def initialize(self):
         self.initialize_api()
+        if self.document_transport:
+            self.api.document_transport = self.document_transport
+        if self.api.async_db:
+            self.api.async_db.start()
+        # Store the documents of a profile in the background, moving the ones stored inline by an older version to the
+        # blob store and resuming the ones a previous run left pending
+        from market.database.ingestion import DocumentIngestion
+        self.api.ingestion = DocumentIngestion(self.api.blob_store)
+        self.api.ingestion.start()
+        self.api.upgrade_documents()
+        self.api.resume_documents()
+        # Run the side effects of actions in the background, resuming the unfinished ones
+        from market.api.tasks import TaskRunner
+        self.api.use_task_runner(TaskRunner(self.api.db.backend))
+        self.api.task_runner.start()
 
         # Load banks
         from market import Global
@@ -60,15 +83,41 @@ class MarketApplication(QApplication):
     def close(self, *_):
         from twisted.internet import reactor
         self.dispersy.stop()
+        if self.api.async_db:
+            self.api.async_db.stop(timeout=1.0)
+        if self.api.ingestion:
+            self.api.ingestion.stop(timeout=1.0)
+        if self.api.task_runner:
+            self.api.task_runner.stop()
+        if self.chain_store:
+            self.api.block_chain.close()
         reactor.stop()
         time.sleep(2)
         os._exit(1)
 
     def initialize_api(self):
         from market.api.api import MarketAPI
-        from market.database.backends import PersistentBackend, MemoryBackend
         from market.database.database import MarketDatabase
-        self._api = MarketAPI(MarketDatabase(PersistentBackend('.', u'sqlite/market.db')))
+        self._api = MarketAPI(MarketDatabase(self._create_backend(u'sqlite/market.db')),
+                              block_chain=self._create_block_chain())
+        self._api.async_db = self._create_async_database(u'sqlite/market.db')
+
+    def _create_backend(self, database_name):
+        from market.database.backends import PersistentBackend, DEFAULT_DURABILITY
+        return PersistentBackend('.', database_name, self.durability or DEFAULT_DURABILITY)
+
+    def _create_async_database(self, database_name):
+        from market.database.asynchronous import AsyncMarketDatabase
+        from market.database.backends import ReadOnlyBackend
+        from market.database.database import MarketDatabase
+        return AsyncMarketDatabase(lambda: MarketDatabase(self._create_backend(database_name)),
+                                   reader_factory=lambda: MarketDatabase(ReadOnlyBackend('.', database_name)))
+
+    def _create_block_chain(self):
+        if self.chain_store:
+            from market.database.blocklog import BlockLog
+            return BlockLog(self.chain_store, sync=self.durability == 'strict')
+        return None
 
     def identify(self):
         """
@@ -92,7 +141,11 @@ class MarketApplication(QApplication):
         from dispersy.dispersy import Dispersy
         from dispersy.endpoint import StandaloneEndpoint
         from market import Global
-        from market.community.community import MortgageMarketCommunity
+        from market.community.community import MortgageMarketCommunity, MODEL_SYNC_INTERVAL, \
+            BLOCK_SYNC_INTERVAL
+        from market.community.signing import SIGNING_STATS_INTERVAL
+        from market.community.transfer import DOCUMENT_TIMEOUT
+        from market.database.backends import MAINTENANCE_INTERVAL
         from twisted.internet.task import LoopingCall
 
         self.dispersy = Dispersy(StandaloneEndpoint(self.port, '0.0.0.0'), unicode('.'), u'dispersy-%s.db' % self.database_prefix)
@@ -113,6 +166,26 @@ class MarketApplication(QApplication):
         # Send messages from the queue every 3 seconds
         LoopingCall(self.api.outgoing_queue.process).start(3.0)
         LoopingCall(self.api.incoming_queue.process).start(3.0)
+        LoopingCall(self.community.signing_pipeline.process).start(3.0)
+
+        # Log the throughput and latency of the signature requests
+        LoopingCall(self.community.signing_pipeline.log_stats).start(SIGNING_STATS_INTERVAL, now=False)
+
+        # Send the unacknowledged document chunks again
+        LoopingCall(self.community.document_transfers.process).start(DOCUMENT_TIMEOUT / 2, now=False)
+
+        # Catch up on missed public models
+        LoopingCall(self.community.send_model_sync_request).start(MODEL_SYNC_INTERVAL, now=False)
+
+        # Request the missing halves of blocks whose signature response never arrived
+        LoopingCall(self.community.request_incomplete_blocks).start(BLOCK_SYNC_INTERVAL, now=False)
+
+        # Move finalized blocks out of the block_chain table every hour
+        if self.api.block_chain is self.api.db.backend:
+            LoopingCall(self.api.db.backend.checkpoint_and_archive).start(3600.0, now=False)
+
+        # Checkpoint the write-ahead log and keep the query planner statistics up to date
+        LoopingCall(self.api.db.backend.maintenance).start(MAINTENANCE_INTERVAL, now=False)
 
     def _scenario(self):
         for bank_id in Global.BANKS:
@@ -137,8 +210,10 @@ class MarketApplicationBank(MarketApplication):
     def initialize_api(self):
         from market.api.api import MarketAPI
         from market.database.database import MarketDatabase
-        from market.database.backends import PersistentBackend
-        self._api = MarketAPI(MarketDatabase(PersistentBackend('.', u'sqlite/%s-market.db' % self.database_prefix)))
+        database_name = u'sqlite/%s-market.db' % self.database_prefix
+        self._api = MarketAPI(MarketDatabase(self._create_backend(database_name)),
+                              block_chain=self._create_block_chain())
+        self._api.async_db = self._create_async_database(database_name)
 
     def identify(self):
         from market import Global
@@ -4,33 +4,124 @@ from market.models import DatabaseModel
 
 
 class Document(DatabaseModel):
+    """
+    A document of a borrower. The data itself is kept in a `BlobStore`, the model only refers to it by its hash.
+    A document whose data is still being stored is pending, and has no hash yet. It keeps the path of the file it is
+    stored from, so the file can be stored again if the application stopped before it was.
+
+    Older versions kept the base64 encoded data in the model itself, `store_inline_data` moves it to the blob store.
+    """
     type = 'document'
 
-    def __init__(self, mime, data, name):
+    def __init__(self, mime, blob_hash, size, name, source=None):
         super(Document, self).__init__()
         assert isinstance(mime, str)
-        assert isinstance(data, str)
+        assert blob_hash is None or isinstance(blob_hash, str)
+        assert isinstance(size, (int, long))
 
         self._mime = mime
-        self._data = data
+        self._blob_hash = blob_hash
+        self._size = size
         self._name = name
+        self._source = source
 
     @property
     def mime(self):
         return self._mime
 
     @property
-    def data(self):
-        return self._data
+    def blob_hash(self):
+        # Documents stored inline have no hash until their data is moved to the blob store
+        return getattr(self, '_blob_hash', None)
+
+    @property
+    def size(self):
+        return getattr(self, '_size', 0)
 
     @property
     def name(self):
         return self._name
 
-    def decode_document(self, path):
-        with open(path, 'wb') as f:
-            f.write(self.data.decode('base64'))
+    @property
+    def pending(self):
+        return self.blob_hash is None and self.inline_data is None
+
+    @property
+    def inline_data(self):
+        """
+        :return: The base64 encoded data of a document stored by an older version, None for other documents
+        """
+        return getattr(self, '_data', None)
+
+    @property
+    def source(self):
+        """
+        :return: The path of the file a pending document is stored from, None once stored
+        """
+        # Documents stored before the source was kept have none
+        return getattr(self, '_source', None)
+
+    def stored(self, blob_hash, size):
+        """
+        Refer to the data of a pending document, once it is stored.
+        """
+        self._blob_hash = blob_hash
+        self._size = size
+        self._source = None
+
+    def store_inline_data(self, blob_store):
+        """
+        Move the data of a document stored inline into the blob store, the document refers to it afterwards.
+        """
+        writer = blob_store.writer()
+        try:
+            writer.write(self.inline_data.decode('base64'))
+        except Exception:
+            writer.abort()
+            raise
+        self.stored(*writer.commit())
+        del self._data
+
+    def path(self, blob_store):
+        """
+        :return: The path of the file holding the document data
+        """
+        return blob_store.path(self.blob_hash)
+
+    def open(self, blob_store):
+        """
+        :return: The document data, opened for reading
+        """
+        return blob_store.open(self.blob_hash)
+
+    def map(self, blob_store):
+        """
+        :return: The document data, mapped into memory read only
+        """
+        return blob_store.map(self.blob_hash)
+
+    @staticmethod
+    def store_document(name, path, blob_store):
+        """
+        Store a file in the blob store and create the document referring to it.
+        :param name: The name of the document
+        :param path: The path of the file
+        :param blob_store: The `BlobStore` to store the data in
+        :return: The new document
+        """
+        blob_hash, size = blob_store.put_file(path)
+        return Document(Document.guess_mime(path), blob_hash, size, name)
+
+    @staticmethod
+    def pending_document(name, path):
+        """
+        Create a pending document for a file that is yet to be stored.
+        :param name: The name of the document
+        :param path: The path of the file
+        :return: The new document
+        """
+        return Document(Document.guess_mime(path), None, 0, name, path)
 
     @staticmethod
-    def encode_document(name, path):
-        return Document(mimetypes.guess_type(path)[0], open(path, 'rb').read().encode('base64', 'strict'), name)
+    def guess_mime(path):
+        return mimetypes.guess_type(path)[0] or 'application/octet-stream'
@@ -678,7 +678,7 @@ class APITestSuite(unittest.TestCase):
         """
         This test checks the functionality of a borrower creating a loan request
         When a borrower creates a loan request, a loan request should be added to
-        Borrower.loan_request_ids and to Bank.loan_request_ids for the selected banks.
+        Borrower.loan_request_ids and to the inboxes of the selected banks.
         The status of the loan request should be set to STATUS.PENDING for each
         selected bank
         """
@@ -705,11 +705,10 @@ class APITestSuite(unittest.TestCase):
         # Check if the status is set to pending
         for bank in loan_request_1.status:
             self.assertEqual(loan_request_1.status[bank], STATUS.PENDING)
-        # Check if the loan request has been added to the banks' lists
-        updated_bank1 = self.api.db.get(User.type, bank1.id)
-        updated_bank2 = self.api.db.get(User.type, bank2.id)
-        self.assertIn(loan_request_1.id, updated_bank1.loan_request_ids)
-        self.assertIn(loan_request_1.id, updated_bank2.loan_request_ids)
+        # Check if the loan request has been added to the banks' inboxes
+        for bank in (bank1, bank2):
+            self.assertEqual([entry[:2] for entry in self.api.db.backend.get_inbox(bank.id)],
+                             [(loan_request_1.id, STATUS.PENDING.value)])
 
         # Create another loan request; should not be possible
         self.payload['user_key'] = user.id  # set user_key to the borrower's public key
@@ -811,6 +810,14 @@ class APITestSuite(unittest.TestCase):
         self.assertIn(loan_request_2, pending_loan_requests[0])
         self.assertIn(loan_request_3, pending_loan_requests[1])
 
+        # Check if the loan requests can be loaded a page at a time
+        self.assertEqual(self.api.count_loan_requests(updated_bank), 2)
+        self.assertEqual([loan_request for loan_request, _ in self.api.load_all_loan_requests(updated_bank, limit=1)],
+                         [loan_request_2])
+        self.assertEqual([loan_request for loan_request, _ in
+                          self.api.load_all_loan_requests(updated_bank, limit=1, offset=1)], [loan_request_3])
+        self.assertEqual(self.api.load_all_loan_requests(updated_bank, limit=1, offset=2), [])
+
     def test_load_single_loan_request(self):
         """
         This test checks the functionality of displaying a single loan request
@@ -919,8 +926,9 @@ class APITestSuite(unittest.TestCase):
         rejected_loan_request1 = self.api.reject_loan_request(bank1, self.payload_loan_request)
         # Check if the status has changed to rejected
         self.assertEqual(rejected_loan_request1.status[bank1.id], STATUS.REJECTED)
-        # Check if the loan request has been removed from bank1's loan request list
-        self.assertNotIn(rejected_loan_request1, bank1.loan_request_ids)
+        # Check if the loan request is no longer pending for bank1
+        self.assertEqual(self.api.load_all_loan_requests(bank1), [])
+        self.assertEqual(self.api.count_loan_requests(bank1, STATUS.REJECTED), 1)
         # Check if the loan request hasn't been removed from borrower
         updated_borrower = self.api.db.get(User.type, borrower.id)
         self.assertTrue(updated_borrower.loan_request_ids)
@@ -929,8 +937,9 @@ class APITestSuite(unittest.TestCase):
         rejected_loan_request2 = self.api.reject_loan_request(bank2, self.payload_loan_request)
         # Check if the status has changed to rejected
         self.assertEqual(rejected_loan_request2.status[bank2.id], STATUS.REJECTED)
-        # Check if the loan request has been removed from bank2's loan request list
-        self.assertNotIn(rejected_loan_request2, bank2.loan_request_ids)
+        # Check if the loan request is no longer pending for bank2
+        self.assertEqual(self.api.load_all_loan_requests(bank2), [])
+        self.assertEqual(self.api.count_loan_requests(bank2, STATUS.REJECTED), 1)
         # Check if the loan request has been removed from borrower
         updated_borrower = self.api.db.get(User.type, borrower.id)
         self.assertFalse(updated_borrower.loan_request_ids)
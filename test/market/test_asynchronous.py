@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+import os
+import sqlite3
+import threading
+import unittest
+
+from market.api.api import MarketAPI
+from market.database.asynchronous import AsyncMarketDatabase
+from market.database.backends import PersistentBackend, ReadOnlyBackend
+from market.database.database import MarketDatabase
+from market.models.house import House
+
+DATABASE_NAME = u'test_asynchronous.db'
+
+
+def call_directly(func, *args):
+    func(*args)
+
+
+class AsyncMarketDatabaseTestSuite(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(DATABASE_NAME):
+            os.remove(DATABASE_NAME)
+        self.database = MarketDatabase(PersistentBackend('.', DATABASE_NAME))
+        # Callbacks fire on the database threads, as there is no reactor running
+        self.async_db = AsyncMarketDatabase(lambda: MarketDatabase(PersistentBackend('.', DATABASE_NAME)),
+                                            call_in_reactor=call_directly,
+                                            reader_factory=lambda: MarketDatabase(ReadOnlyBackend('.', DATABASE_NAME)))
+
+    def start(self):
+        """
+        Start the database threads once the connection of the test is done writing, so the writer thread never waits
+        on a lock it holds.
+        """
+        self.database.backend.commit()
+        self.async_db.start()
+
+    def tearDown(self):
+        self.async_db.stop()
+        self.database.backend.close()
+        os.remove(DATABASE_NAME)
+
+    def wait(self, deferred):
+        """
+        Block until the deferred has fired, returning its result or raising its failure.
+        """
+        done = threading.Event()
+        results = []
+        deferred.addBoth(lambda result: results.append(result) or done.set())
+        self.assertTrue(done.wait(5))
+        if hasattr(results[0], 'raiseException'):
+            results[0].raiseException()
+        return results[0]
+
+    def test_write_then_read(self):
+        self.start()
+        house = House('2500AA', '34', 'Aa Weg', 1000)
+        deferred = self.async_db.post(House.type, house)
+        deferred.addCallback(lambda house_id: self.async_db.get(House.type, house_id))
+
+        self.assertEqual(self.wait(deferred), house)
+        # The write is visible to the connection of the test as well
+        self.assertEqual(self.database.get(House.type, house.id), house)
+
+    def test_writes_are_ordered(self):
+        self.start()
+        houses = [House('2500AA', str(i), 'Aa Weg', 1000) for i in range(20)]
+        for house in houses[:-1]:
+            self.async_db.post(House.type, house)
+        self.wait(self.async_db.post(House.type, houses[-1]))
+
+        self.assertEqual(len(self.wait(self.async_db.get_all(House.type))), 20)
+
+        self.wait(self.async_db.delete(houses[0]))
+        self.assertEqual(len(self.wait(self.async_db.get_all(House.type))), 19)
+
+    def test_read_after_write(self):
+        house = House('2500AA', '34', 'Aa Weg', 1000)
+        self.database.post(House.type, house)
+        self.start()
+
+        # The write of the reactor thread is visible to the readers
+        self.assertEqual(self.wait(self.async_db.get(House.type, house.id)), house)
+
+    def test_reads(self):
+        for i in range(20):
+            self.database.post(House.type, House('2500AA', str(i), 'Aa Weg', 1000))
+        self.start()
+
+        deferreds = [self.async_db.get_all(House.type) for _ in range(10)]
+        self.assertEqual([len(self.wait(deferred)) for deferred in deferreds], [20] * 10)
+
+    def test_readers_are_read_only(self):
+        self.start()
+        house = House('2500AA', '34', 'Aa Weg', 1000)
+        self.assertRaises(sqlite3.OperationalError, self.wait,
+                          self.async_db.run_read(lambda database: database.post(House.type, house)))
+
+    def test_failure(self):
+        self.start()
+
+        def fail(database):
+            raise ValueError("failed")
+
+        self.assertRaises(ValueError, self.wait, self.async_db.run_read(fail))
+
+    def test_api_loader(self):
+        self.start()
+        api = MarketAPI(self.database)
+        self.assertEqual(self.wait(api.load_open_market_async()), [])
+
+        api.async_db = self.async_db
+        self.assertEqual(self.wait(api.load_open_market_async()), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,12 @@
 from __future__ import absolute_import
+import os
+import time
 import unittest
 
-from market.database.backends import Backend, MemoryBackend, PersistentBackend
+from dispersy.crypto import ECCrypto
+from market.database.archive import read_archive, write_archive
+from market.database.backends import DEFAULT_DURABILITY, Backend, MemoryBackend, PersistentBackend, DatabaseBlock
+from market.database.digest import model_bucket
 from market.models import DatabaseModel
 
 
@@ -37,6 +42,38 @@ class BackendTestSuite(unittest.TestCase):
         with self.assertRaises(NotImplementedError):
             self.backend.get_all(None)
 
+    def test_digests(self):
+        with self.assertRaises(NotImplementedError):
+            self.backend.get_bucket_digests()
+        with self.assertRaises(NotImplementedError):
+            self.backend.get_bucket_entries(0)
+
+    def test_tasks(self):
+        with self.assertRaises(NotImplementedError):
+            self.backend.save_task('1', 'name', '', 'pending', 0, None, None)
+        with self.assertRaises(NotImplementedError):
+            self.backend.get_tasks()
+        with self.assertRaises(NotImplementedError):
+            self.backend.delete_task('1')
+
+    def test_inbox(self):
+        with self.assertRaises(NotImplementedError):
+            self.backend.put_inbox_entry('bank', '1', 1)
+        with self.assertRaises(NotImplementedError):
+            self.backend.get_inbox('bank')
+        with self.assertRaises(NotImplementedError):
+            self.backend.count_inbox('bank')
+        with self.assertRaises(NotImplementedError):
+            self.backend.delete_inbox_entry('bank', '1')
+
+    def test_investment_index(self):
+        with self.assertRaises(NotImplementedError):
+            self.backend.put_investment_index('1', 'mortgage', 'investor', 1)
+        with self.assertRaises(NotImplementedError):
+            self.backend.delete_investment_index('1')
+        with self.assertRaises(NotImplementedError):
+            self.backend.get_investments('mortgage')
+
 
 class MemoryBackendTestSuite(unittest.TestCase):
     def setUp(self):
@@ -61,6 +98,15 @@ class MemoryBackendTestSuite(unittest.TestCase):
             self.backend.get('test', self.block1.id)
 
 
+    def test_instances(self):
+        other = MemoryBackend()
+        self.backend.post('test', self.block1.id, self.block1)
+
+        # Every backend keeps its own models and digests
+        self.assertFalse(other.exists('test', self.block1.id))
+        self.assertEqual(other.get_digest_root(), MemoryBackend().get_digest_root())
+        self.assertNotEqual(self.backend.get_digest_root(), other.get_digest_root())
+
     def test_post(self):
         self.backend.clear()
         self.backend.post('test', self.block1.id, self.block1)
@@ -199,6 +245,296 @@ class PersistentBackendTestSuite(unittest.TestCase):
         self.assertIn(self.block2.encode(), all_tests)
         self.assertNotIn(self.block3.encode(), all_tests)
 
+    def test_digests(self):
+        self.backend.clear()
+        memory_backend = MemoryBackend()
+        memory_backend.clear()
+        for backend in [self.backend, memory_backend]:
+            backend.post(self.block1.type, self.block1.id, self.block1.encode())
+            backend.post(self.block2.type, self.block2.id, self.block2.encode())
+            backend.put(self.block1.type, self.block1.id, self.block3.encode())
+            backend.delete(self.block2)
+
+        self.assertEqual(self.backend.get_bucket_digests(), memory_backend.get_bucket_digests())
+        bucket = model_bucket(self.block1.type, self.block1.id)
+        self.assertEqual(self.backend.get_bucket_entries(bucket), memory_backend.get_bucket_entries(bucket))
+
+        root = self.backend.get_digest_root()
+        self.backend.rebuild_digests()
+        self.assertEqual(self.backend.get_digest_root(), root)
+
+    def test_tasks(self):
+        self.backend.clear()
+        memory_backend = MemoryBackend()
+        memory_backend.clear()
+        for backend in [self.backend, memory_backend]:
+            backend.save_task('1', 'sign', 'arguments', 'pending', 0, None, None)
+            backend.save_task('2', 'send', 'arguments', 'pending', 0, None, '1')
+            backend.save_task('1', 'sign', 'arguments', 'done', 1, None, None)
+            backend.save_task('3', 'send', 'arguments', 'failed', 5, 'Timed out', None)
+            backend.delete_task('3')
+
+            # Updated tasks keep their place
+            self.assertEqual([tuple(task) for task in backend.get_tasks()],
+                             [('1', 'sign', 'arguments', 'done', 1, None, None),
+                              ('2', 'send', 'arguments', 'pending', 0, None, '1')])
+            self.assertEqual([task[0] for task in backend.get_tasks(['pending', 'running'])], ['2'])
+
+    def test_inbox(self):
+        self.backend.clear()
+        memory_backend = MemoryBackend()
+        memory_backend.clear()
+        for backend in [self.backend, memory_backend]:
+            backend.put_inbox_entry('bank', '2', 1, 20.0)
+            backend.put_inbox_entry('bank', '1', 1, 10.0)
+            backend.put_inbox_entry('bank', '3', 1, 30.0)
+            backend.put_inbox_entry('other', '4', 1, 5.0)
+            # Updating the status keeps the time the loan request was received
+            backend.put_inbox_entry('bank', '1', 3, 40.0)
+
+            self.assertEqual([tuple(entry) for entry in backend.get_inbox('bank')],
+                             [('1', 3, 10.0), ('2', 1, 20.0), ('3', 1, 30.0)])
+            self.assertEqual([entry[0] for entry in backend.get_inbox('bank', 1)], ['2', '3'])
+            self.assertEqual([entry[0] for entry in backend.get_inbox('bank', 1, limit=1, offset=1)], ['3'])
+            self.assertEqual((backend.count_inbox('bank'), backend.count_inbox('bank', 1)), (3, 2))
+
+            backend.delete_inbox_entry('bank', '2')
+            self.assertEqual([entry[0] for entry in backend.get_inbox('bank')], ['1', '3'])
+            self.assertEqual(backend.count_inbox('other', 3), 0)
+
+    def test_chain_head(self):
+        self.backend.clear()
+        self.assertEqual(self.backend.get_latest_hash(), '')
+        self.assertEqual(self.backend.get_next_sequence_number(), 0)
+
+        self.backend.check_add_genesis_block()
+        genesis_hash = self.backend.get_latest_hash()
+
+        block = DatabaseBlock(('benefactor', '', 'agreement', '', 1, 0, genesis_hash, '', 'signature', '', 1))
+        self.backend.add_block(block)
+        self.assertEqual(block.previous_hash, self.backend.get_by_hash(genesis_hash).link_hash())
+        self.assertEqual(block.sequence_number, 1)
+        self.assertEqual(self.backend.get_latest_hash(), block.hash_block)
+
+        # Completing the head block changes its hash
+        completed = DatabaseBlock(('benefactor', 'beneficiary', 'agreement', 'agreement', 1, 1, genesis_hash, '',
+                                   'signature', 'signature', 1))
+        self.backend.update_block_with_beneficiary(completed)
+        self.assertEqual(self.backend.get_latest_hash(), completed.hash_block)
+
+        # The head is loaded again when reopening the database
+        self.backend.close()
+        self.backend.open()
+        self.assertEqual(self.backend.get_latest_hash(), completed.hash_block)
+        self.assertEqual(self.backend.get_next_sequence_number(), 2)
+
+        # The next block links to the half of the benefactor, which completing the block didn't change
+        next_block = DatabaseBlock(('benefactor', '', 'agreement', '', 2, 0, '', '', 'signature', '', 2))
+        self.backend.add_block(next_block)
+        self.assertEqual(next_block.previous_hash, block.link_hash())
+        self.assertEqual(self.backend.get_latest_link_hash(), next_block.link_hash())
+
+    def test_get_range(self):
+        self.backend.clear()
+        for i in range(1, 6):
+            self.backend.add_block(DatabaseBlock(('a', 'b', 'agreement', 'agreement', i, 10 + i, '', '', '', '', i)))
+        self.backend.add_block(DatabaseBlock(('b', 'a', 'agreement', 'agreement', 20, 6, '', '', '', '', 6)))
+
+        blocks = self.backend.get_range('a', 4, 10)
+        self.assertEqual([(block.benefactor, block.insert_time) for block in blocks], [('a', 4), ('a', 5), ('b', 6)])
+        self.assertEqual(self.backend.get_by_public_key_and_sequence_number('b', 12).insert_time, 2)
+        self.assertEqual(self.backend.get_by_public_key_and_sequence_number('b', 20).insert_time, 6)
+        self.assertIsNone(self.backend.get_by_public_key_and_sequence_number('a', 7))
+
+    def test_durability(self):
+        self.assertEqual(self.backend.durability, DEFAULT_DURABILITY)
+        self.assertEqual(self.backend.journal_mode, 'wal')
+        self.assertEqual(self.backend.execute(u"PRAGMA synchronous").fetchone()[0], 1)
+
+        self.backend.clear()
+        self.backend.post('test', self.block1.id, self.block1)
+        self.backend.maintenance()
+        self.assertTrue(self.backend.execute(u"SELECT COUNT(*) FROM sqlite_stat1").fetchone()[0])
+        # Later runs only optimize
+        self.backend.maintenance()
+        self.backend.close()
+
+        self.backend = PersistentBackend('.', durability='strict')
+        self.assertEqual(self.backend.journal_mode, 'delete')
+        self.assertEqual(self.backend.execute(u"PRAGMA synchronous").fetchone()[0], 2)
+        self.assertTrue(self.backend.exists('test', self.block1.id))
+
+        with self.assertRaises(ValueError):
+            PersistentBackend('.', durability='unknown')
+
+    def test_read_transaction(self):
+        self.backend.clear()
+        self.backend.post('test', '1', 'value 1')
+
+        with self.backend.read_transaction():
+            self.assertEqual(self.backend.get('test', '1'), 'value 1')
+
+            # Writes made during the transaction are not seen by it
+            self.backend.put('test', '1', 'value 2')
+            self.backend.post('test', '2', 'value 3')
+            with self.backend.read_transaction():
+                self.assertEqual(self.backend.get('test', '1'), 'value 1')
+            self.assertFalse(self.backend.exists('test', '2'))
+            self.assertEqual(len(self.backend.get_all('test')), 1)
+
+        self.assertEqual(self.backend.get('test', '1'), 'value 2')
+        with self.backend.read_transaction():
+            self.assertEqual(len(self.backend.get_all('test')), 2)
+
+    def test_get_incomplete_blocks(self):
+        self.backend.clear()
+        for i in range(1, 6):
+            signature = '' if i % 2 else 'signature'
+            self.backend.add_block(DatabaseBlock(('a', 'b', 'agreement', 'agreement', i, 10 + i, '', '', '',
+                                                  signature, i)))
+
+        blocks = self.backend.get_incomplete_blocks('a', 2)
+        self.assertEqual([block.sequence_number_benefactor for block in blocks], [1, 3])
+        self.assertEqual(self.backend.get_incomplete_blocks('b', 10), [])
+        self.assertEqual(DatabaseBlock.from_row(blocks[0].to_row()).hash_block, blocks[0].hash_block)
+
+    def test_block_from_row(self):
+        self.backend.clear()
+        block = DatabaseBlock(('a', 'b', 'agreement', 'agreement', 1, 2, '', '', 'signature', 'signature', 1))
+        self.backend.add_block(block)
+
+        stored = self.backend.get_by_hash(block.hash_block)
+        self.assertEqual(stored.hash_block, block.hash_block)
+        self.assertEqual(stored.previous_hash, block.previous_hash)
+        self.assertTrue(stored.verify())
+
+        # A block read from the database keeps its stored hash until verified
+        self.backend.execute(u"UPDATE block_chain SET signature_beneficiary = ?", (buffer('forged'),))
+        forged = self.backend.get_by_hash(block.hash_block)
+        self.assertEqual(forged.hash_block, block.hash_block)
+        self.assertFalse(forged.verify())
+
+    def test_checkpoint_and_archive(self):
+        self.backend.clear()
+        crypto = ECCrypto()
+        key = crypto.generate_key(u'high')
+        self.backend.set_option('user_key_pub', crypto.key_to_bin(key.pub()).encode("HEX"))
+        self.backend.set_option('user_key_priv', crypto.key_to_bin(key).encode("HEX"))
+
+        self.backend.check_add_genesis_block()
+        blocks = []
+        for i in range(1, 30):
+            blocks.append(DatabaseBlock(('a', 'b', 'agreement', 'agreement', i, 100 + i, '', '', 'signature',
+                                         'signature', i)))
+            self.backend.add_block(blocks[-1])
+
+        self.assertEqual(self.backend.checkpoint_and_archive(keep_blocks=10), 20)
+        checkpoint, = self.backend.get_checkpoints()
+        self.assertEqual(checkpoint.height, 19)
+        self.assertEqual(checkpoint.hash_block, blocks[18].hash_block)
+        self.assertTrue(PersistentBackend.checkpoint_valid(checkpoint))
+        self.assertFalse(PersistentBackend.checkpoint_valid(checkpoint._replace(height=20)))
+
+        # Only the blocks above the checkpoint are left in the table
+        self.assertEqual([position for position, _ in self.backend.iter_blocks()], range(21, 31))
+
+        # Lookups fall through to the archive
+        self.assertEqual(self.backend.get_by_hash(blocks[4].hash_block).insert_time, 5)
+        self.assertEqual(self.backend.get_by_public_key_and_sequence_number('b', 105).insert_time, 5)
+        self.assertEqual([block.insert_time for block in self.backend.get_range('a', 17, 22)], range(17, 23))
+        self.assertIsNone(self.backend.get_by_hash('unknown'))
+
+        # The archives are found through their index after reopening
+        self.backend.close()
+        self.backend = PersistentBackend('.')
+        self.assertEqual(self.backend.get_by_public_key_and_sequence_number('a', 3).insert_time, 3)
+        self.assertEqual([block.insert_time for block in self.backend.get_range('b', 101, 103)], [1, 2, 3])
+
+    def test_upgrade_to_8(self):
+        self.backend.clear()
+        crypto = ECCrypto()
+        key = crypto.generate_key(u'high')
+        self.backend.set_option('user_key_pub', crypto.key_to_bin(key.pub()).encode("HEX"))
+        self.backend.set_option('user_key_priv', crypto.key_to_bin(key).encode("HEX"))
+        self.backend.check_add_genesis_block()
+        for i in range(1, 20):
+            self.backend.add_block(DatabaseBlock(('a', 'b', 'agreement', 'agreement', i, 100 + i, '', '', 'signature',
+                                                  'signature', i)))
+        self.backend.checkpoint_and_archive(keep_blocks=10)
+        checkpoint, = self.backend.get_checkpoints()
+        archive_path = os.path.join(self.backend.archive_directory, checkpoint.archive)
+
+        def read_chain():
+            return [DatabaseBlock.from_row(row) for row in read_archive(archive_path)] + \
+                   [DatabaseBlock.from_row(row) for _, row in self.backend.iter_blocks()]
+
+        # Link the blocks by their full hashes, as before version 8
+        chain = read_chain()
+        for previous, block in zip(chain, chain[1:]):
+            block.previous_hash = previous.hash_block
+        archived = len(read_archive(archive_path))
+        write_archive(archive_path, [block.to_row() for block in chain[:archived]])
+        for (position, _), block in zip(list(self.backend.iter_blocks()), chain[archived:]):
+            self.backend.execute(u"UPDATE block_chain SET previous_hash = ? WHERE ROWID = ?",
+                                 (buffer(block.previous_hash), position))
+
+        self.backend._upgrade_to_8()
+        self.backend.commit()
+        self.backend.close()
+        self.backend = PersistentBackend('.')
+
+        # The archived blocks and the blocks in the table link by the link hash, across the archive
+        chain = read_chain()
+        for previous, block in zip(chain, chain[1:]):
+            self.assertEqual(block.previous_hash, previous.link_hash())
+        self.assertEqual(chain[0].previous_hash, '')
+        self.assertEqual(self.backend.get_latest_link_hash(), chain[-1].link_hash())
+
+    def test_archive_incomplete(self):
+        self.backend.clear()
+        crypto = ECCrypto()
+        key = crypto.generate_key(u'high')
+        self.backend.set_option('user_key_pub', crypto.key_to_bin(key.pub()).encode("HEX"))
+        self.backend.set_option('user_key_priv', crypto.key_to_bin(key).encode("HEX"))
+
+        # An empty chain has nothing to archive
+        self.assertEqual(self.backend.checkpoint_and_archive(keep_blocks=10), 0)
+
+        self.backend.check_add_genesis_block()
+        for i in range(1, 30):
+            signature = '' if i == 8 else 'signature'
+            insert_time = int(time.time()) if i == 8 else i
+            self.backend.add_block(DatabaseBlock(('a', 'b', 'agreement', 'agreement', i, 100 + i, '', '', 'signature',
+                                                  signature, insert_time)))
+
+        # Only the blocks below the incomplete block are archived, so it can still be completed
+        self.assertEqual(self.backend.checkpoint_and_archive(keep_blocks=10), 8)
+        self.assertEqual(self.backend.get_checkpoints()[0].height, 7)
+        self.assertEqual([block.sequence_number_benefactor
+                          for block in self.backend.get_incomplete_blocks('a', 10)], [8])
+
+        self.backend.create_checkpoint(20)
+        with self.assertRaises(ValueError):
+            self.backend.archive_blocks(20)
+
+    def test_archive_expired_incomplete(self):
+        self.backend.clear()
+        crypto = ECCrypto()
+        key = crypto.generate_key(u'high')
+        self.backend.set_option('user_key_pub', crypto.key_to_bin(key.pub()).encode("HEX"))
+        self.backend.set_option('user_key_priv', crypto.key_to_bin(key).encode("HEX"))
+
+        self.backend.check_add_genesis_block()
+        for i in range(1, 30):
+            signature = '' if i == 8 else 'signature'
+            self.backend.add_block(DatabaseBlock(('a', 'b', 'agreement', 'agreement', i, 100 + i, '', '', 'signature',
+                                                  signature, i)))
+
+        # The incomplete block is older than the timeout, so it no longer holds back archiving
+        self.assertEqual(self.backend.checkpoint_and_archive(keep_blocks=10), 20)
+        self.assertEqual(self.backend.get_checkpoints()[0].height, 19)
+        self.assertEqual(self.backend.get_incomplete_blocks('a', 10), [])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,79 @@
+import os
+import shutil
+import unittest
+from StringIO import StringIO
+from hashlib import sha256
+
+from market.database.blobstore import BlobStore
+
+
+class BlobStoreTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(os.getcwd(), 'test_blobs')
+        self.store = BlobStore(self.directory, chunk_size=16)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_put_stream(self):
+        data = 'document data ' * 100
+        blob_hash, size = self.store.put_stream(StringIO(data))
+
+        self.assertEqual(blob_hash, sha256(data).hexdigest())
+        self.assertEqual(size, len(data))
+        self.assertTrue(self.store.contains(blob_hash))
+        self.assertEqual(self.store.size(blob_hash), len(data))
+        self.assertEqual(''.join(self.store.iter_chunks(blob_hash)), data)
+        self.assertTrue(all(len(chunk) <= 16 for chunk in self.store.iter_chunks(blob_hash)))
+
+        blob_map = self.store.map(blob_hash)
+        self.assertEqual(blob_map[:], data)
+        blob_map.close()
+
+    def test_put_file(self):
+        file_path = os.path.join(self.directory, 'file.pdf')
+        with open(file_path, 'wb') as output_file:
+            output_file.write('pdf')
+
+        blob_hash, size = self.store.put_file(file_path)
+
+        self.assertEqual(size, 3)
+        with open(self.store.path(blob_hash), 'rb') as blob_file:
+            self.assertEqual(blob_file.read(), 'pdf')
+
+    def test_deduplication(self):
+        first_hash, _ = self.store.put_stream(StringIO('same'))
+        second_hash, _ = self.store.put_stream(StringIO('same'))
+
+        self.assertEqual(first_hash, second_hash)
+        self.assertEqual(self.store.references(first_hash), 2)
+        blob_files = [file_name for _, _, file_names in os.walk(self.directory) for file_name in file_names
+                      if not file_name.endswith(BlobStore.REFS_SUFFIX)]
+        self.assertEqual(len(blob_files), 1)
+
+    def test_reference_counting(self):
+        blob_hash, _ = self.store.put_stream(StringIO('data'))
+        self.store.add_reference(blob_hash)
+
+        self.assertFalse(self.store.release(blob_hash))
+        self.assertTrue(self.store.contains(blob_hash))
+        self.assertTrue(self.store.release(blob_hash))
+        self.assertFalse(self.store.contains(blob_hash))
+        self.assertEqual(self.store.references(blob_hash), 0)
+
+        with self.assertRaises(KeyError):
+            self.store.add_reference(blob_hash)
+
+    def test_empty_blob(self):
+        blob_hash, size = self.store.put_stream(StringIO(''))
+
+        self.assertEqual(size, 0)
+        self.assertEqual(self.store.map(blob_hash), '')
+
+    def test_invalid_hash(self):
+        with self.assertRaises(ValueError):
+            self.store.path('../../etc/passwd')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+from __future__ import absolute_import
+import os
+import shutil
+import unittest
+
+from market.api.api import MarketAPI
+from market.database.backends import DatabaseBlock, MemoryBackend, PersistentBackend
+from market.database.database import MarketDatabase
+from market.database.blocklog import BlockLog
+
+BLOCK_LOG_PATH = 'test_blocklog'
+
+
+class BlockLogTestSuite(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(BLOCK_LOG_PATH):
+            shutil.rmtree(BLOCK_LOG_PATH)
+        self.log = BlockLog(BLOCK_LOG_PATH, segment_size=1024)
+
+    def tearDown(self):
+        self.log.close()
+        shutil.rmtree(BLOCK_LOG_PATH)
+
+    def create_block(self, i, beneficiary=''):
+        return DatabaseBlock(('benefactor', beneficiary, 'agreement', beneficiary and 'agreement', i,
+                              beneficiary and i + 100 or 0, '', '', 'signature', beneficiary and 'signature', i))
+
+    def test_add_block(self):
+        self.log.check_add_genesis_block()
+        genesis_hash = self.log.get_latest_hash()
+        self.assertEqual(genesis_hash, self.log.create_genesis_block().hash_block)
+
+        block = self.create_block(1)
+        self.log.add_block(block)
+
+        self.assertEqual(block.previous_hash, self.log.get_by_hash(genesis_hash).link_hash())
+        self.assertEqual(block.sequence_number, 1)
+        self.assertEqual(self.log.get_latest_hash(), block.hash_block)
+        self.assertEqual(self.log.get_latest_link_hash(), block.link_hash())
+        self.assertEqual(self.log.get_by_hash(block.hash_block).signature_benefactor, 'signature')
+        self.assertEqual(self.log.get_by_public_key_and_sequence_number('benefactor', 1).hash_block, block.hash_block)
+
+    def test_amendment(self):
+        self.log.add_block(self.create_block(1))
+        completed = self.create_block(1, 'beneficiary')
+        self.log.update_block_with_beneficiary(completed)
+
+        self.assertEqual(self.log.get_latest_hash(), completed.hash_block)
+        result = self.log.get_by_public_key_and_sequence_number('beneficiary', 101)
+        self.assertEqual(result.hash_block, completed.hash_block)
+        self.assertTrue(result.verify())
+        self.assertIsNone(self.log.get_by_public_key_and_sequence_number('', 0))
+
+    def test_get_incomplete_blocks(self):
+        for i in range(1, 4):
+            self.log.add_block(self.create_block(i))
+        self.log.update_block_with_beneficiary(self.create_block(2, 'beneficiary'))
+
+        blocks = self.log.get_incomplete_blocks('benefactor', 10)
+        self.assertEqual([block.sequence_number_benefactor for block in blocks], [1, 3])
+        self.assertEqual(len(self.log.get_incomplete_blocks('benefactor', 1)), 1)
+
+    def test_reopen(self):
+        for i in range(1, 40):
+            self.log.add_block(self.create_block(i))
+        self.log.update_block_with_beneficiary(self.create_block(5, 'beneficiary'))
+        latest_hash = self.log.get_latest_hash()
+        self.log.close()
+
+        # Tear the last record, as a crash in the middle of an append would
+        segments = sorted(os.listdir(BLOCK_LOG_PATH))
+        self.assertGreater(len(segments), 1)
+        with open(os.path.join(BLOCK_LOG_PATH, segments[-1]), 'ab') as segment:
+            segment.write('\x00\x00\x01\x00garbage')
+
+        self.log.open()
+        self.assertEqual(self.log.get_latest_hash(), latest_hash)
+        self.assertEqual(self.log.get_next_sequence_number(), 39)
+        self.assertEqual(len(self.log.get_range('benefactor', 10, 19)), 10)
+        self.assertEqual(self.log.get_range('beneficiary', 0, 200)[0].insert_time, 5)
+        self.assertEqual([position for position, _ in self.log.iter_blocks(35)], [36, 37, 38, 39])
+
+        block = self.create_block(40)
+        self.log.add_block(block)
+        self.assertEqual(block.previous_hash, self.log.get_by_hash(latest_hash).link_hash())
+        self.assertEqual(block.sequence_number, 39)
+
+    def test_reopen_indexed(self):
+        for i in range(1, 10):
+            self.log.add_block(self.create_block(i))
+        self.log.update_block_with_beneficiary(self.create_block(5, 'beneficiary'))
+        latest_hash = self.log.get_latest_hash()
+        self.log.close()
+
+        indexed = []
+        self.log._index_record = lambda data, location: indexed.append(location)
+        self.log.open()
+        del self.log._index_record
+
+        self.assertEqual(indexed, [])
+        self.assertEqual(self.log.get_latest_hash(), latest_hash)
+        self.assertEqual(self.log.get_by_public_key_and_sequence_number('beneficiary', 105).insert_time, 5)
+        self.assertEqual([block.sequence_number_benefactor
+                          for block in self.log.get_incomplete_blocks('benefactor', 10)], [1, 2, 3, 4, 6, 7, 8, 9])
+
+    def test_rebuild_index(self):
+        for i in range(1, 300):
+            self.log.add_block(self.create_block(i))
+        self.log.update_block_with_beneficiary(self.create_block(5, 'beneficiary'))
+        self.log.close()
+
+        for name in (BlockLog.OFFSETS_NAME, BlockLog.KEYS_NAME, BlockLog.INCOMPLETE_NAME):
+            os.remove(os.path.join(BLOCK_LOG_PATH, name))
+        self.log.open()
+
+        self.assertEqual(self.log.get_next_sequence_number(), 299)
+        self.assertEqual(len(self.log.get_range('benefactor', 100, 199)), 100)
+        self.assertEqual(self.log.get_by_public_key_and_sequence_number('beneficiary', 105).insert_time, 5)
+        self.assertEqual(len(self.log.get_incomplete_blocks('benefactor', 1000)), 298)
+
+    def test_read_buffer(self):
+        block = self.create_block(1)
+        self.log.add_block(block)
+        self.log._tail.clear()
+
+        self.assertIsInstance(self.log._read_buffer((0, 0)), buffer)
+        self.assertEqual(self.log.get_by_hash(block.hash_block).insert_time, 1)
+
+    def test_tail(self):
+        self.log.TAIL_SIZE = 2
+        blocks = [self.create_block(i) for i in range(1, 6)]
+        for block in blocks:
+            self.log.add_block(block)
+        self.assertEqual(len(self.log._tail), 1)
+
+        for block in blocks:
+            self.assertEqual(self.log.get_by_hash(block.hash_block).insert_time, block.insert_time)
+        for previous, block in zip(blocks, blocks[1:]):
+            self.assertEqual(block.previous_hash, previous.link_hash())
+
+    def test_convert(self):
+        backend = PersistentBackend('.', u'blocklog.db')
+        backend.clear()
+        backend.check_add_genesis_block()
+        for i in range(1, 5):
+            backend.add_block(self.create_block(i))
+
+        for _, row in backend.iter_blocks():
+            self.log.append_row(row)
+
+        self.assertEqual(self.log.get_latest_hash(), backend.get_latest_hash())
+        self.assertEqual([row for _, row in self.log.iter_blocks()], [row for _, row in backend.iter_blocks()])
+        backend.close()
+
+    def test_chain_store(self):
+        database = MarketDatabase(MemoryBackend())
+        self.assertIs(MarketAPI(database).block_chain, database.backend)
+        self.assertIs(MarketAPI(database, block_chain=self.log).block_chain, self.log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,4 +1,6 @@
 import datetime
+import os
+import shutil
 import unittest
 from twisted.python.threadable import registerAsIOThread
 
@@ -6,6 +8,7 @@ import mock
 import sys
 from mock import Mock
 
+from dispersy.bloomfilter import BloomFilter
 from dispersy.candidate import LoopbackCandidate
 from dispersy.dispersy import Dispersy
 from dispersy.endpoint import ManualEnpoint
@@ -13,12 +16,14 @@ from dispersy.member import DummyMember, Member
 from market import Global
 from market.api import APIMessage
 from market.api.api import MarketAPI, STATUS
-from market.community.community import MortgageMarketCommunity
+from market.community.community import MortgageMarketCommunity, model_sync_key
 from market.community.conversion import MortgageMarketConversion
-from market.community.payload import SignedConfirmPayload
-from market.database.backends import MemoryBackend
+from market.community.payload import SignedConfirmPayload, ModelSyncRequestPayload, ModelBatchPayload
+from market.database.backends import MemoryBackend, DatabaseBlock
+from market.database.blobstore import BlobStore
 from market.database.database import MarketDatabase
 from market.models import DatabaseModel
+from market.models.document import Document
 from market.models.house import House
 from market.models.loans import LoanRequest, Mortgage, Campaign, Investment
 from market.models.profiles import BorrowersProfile, Profile
@@ -203,6 +208,8 @@ class CommunityTestSuite(unittest.TestCase):
         self.assertTrue(self.isModelInDB(self.api_bank, self.loan_request))
         self.assertTrue(self.isModelInDB(self.api_bank, self.borrowers_profile))
         self.assertTrue(self.isModelInDB(self.api_bank, self.house))
+        # The loan request is in the inbox of the selected bank
+        self.assertEqual(self.api_bank.count_loan_requests(self.bank), 1)
 
     def test_on_loan_request_reject(self):
         """
@@ -648,7 +655,7 @@ class CommunityTestSuite(unittest.TestCase):
         self.assertEqual(self.user.id, args[1].id)
 
     @mock.patch('market.community.community.MortgageMarketCommunity.create_signature_request')
-    @mock.patch('market.community.community.MortgageMarketCommunity._get_latest_hash')
+    @mock.patch('market.community.community.MortgageMarketCommunity._get_latest_link_hash')
     @mock.patch('market.community.community.MortgageMarketCommunity._get_next_sequence_number')
     @mock.patch('market.community.community.MortgageMarketCommunity.update_signature')
     @mock.patch('market.community.community.MortgageMarketCommunity.persist_signature')
@@ -673,7 +680,7 @@ class CommunityTestSuite(unittest.TestCase):
 
 
     @mock.patch('market.community.community.MortgageMarketCommunity.create_signature_request')
-    @mock.patch('market.community.community.MortgageMarketCommunity._get_latest_hash')
+    @mock.patch('market.community.community.MortgageMarketCommunity._get_latest_link_hash')
     @mock.patch('market.community.community.MortgageMarketCommunity._get_next_sequence_number')
     @mock.patch('market.community.community.MortgageMarketCommunity.update_signature')
     @mock.patch('market.community.community.MortgageMarketCommunity.persist_signature')
@@ -719,6 +726,14 @@ class CommunityTestSuite(unittest.TestCase):
         self.assertEqual(message.payload.benefactor, message2.payload.benefactor)
         self.assertNotEqual(message.payload.beneficiary, message2.payload.beneficiary)
 
+        # A repeated request is answered with the block persisted for the first one
+        persist.reset_mock()
+        with mock.patch('market.community.community.MortgageMarketCommunity._get_beneficiary_block') as block:
+            block.return_value = DatabaseBlock.from_signed_confirm_message(message2)
+            message3 = self.community.allow_signed_confirm_request(message)
+        self.assertFalse(persist.called)
+        self.assertEqual(message3.payload.sequence_number_beneficiary, message2.payload.sequence_number_beneficiary)
+
         # Finally check if the update call works
         persist.reset_mock()
         next_hash.reset_mock()
@@ -735,6 +750,177 @@ class CommunityTestSuite(unittest.TestCase):
 
         self.assertTrue(update.called)
 
+    @mock.patch('dispersy.dispersy.Dispersy.store_update_forward')
+    def test_model_sync(self, patch):
+        """
+        Test an investor that missed a campaign catching up through the bank.
+
+        investor -> bank
+        bank -> investor
+        """
+        # Signed by the investor, whose keys are those of self.api
+        self.mortgage.sign(self.api)
+        self.campaign.sign(self.api)
+        self.mortgage.post_or_put(self.api_bank.db)
+        self.campaign.post_or_put(self.api_bank.db)
+        self.mortgage.post_or_put(self.api_investor.db)
+
+        self.assertTrue(self.community_investor.send_model_sync_request(LoopbackCandidate()))
+        request = patch.call_args[0][0][0]
+        self.assertIsInstance(request.payload, ModelSyncRequestPayload.Implementation)
+        self.assertIn(model_sync_key(self.mortgage), request.payload.bloom_filter)
+
+        # The bank only sends the campaign, the investor already has the mortgage
+        patch.reset_mock()
+        message = FakeMessage(request.payload)
+        message.candidate = LoopbackCandidate()
+        self.community_bank.on_model_sync_request([message])
+
+        response = patch.call_args[0][0][0]
+        self.assertIsInstance(response.payload, ModelBatchPayload.Implementation)
+        self.assertEqual(response.payload.models, [self.campaign])
+
+        self.assertFalse(self.isModelInDB(self.api_investor, self.campaign))
+        self.community_investor.on_model_sync_response([response])
+        self.assertTrue(self.isModelInDB(self.api_investor, self.campaign))
+
+    @mock.patch('dispersy.dispersy.Dispersy.store_update_forward')
+    def test_model_sync_newer_version(self, patch):
+        self.mortgage.sign(self.api)
+        self.mortgage.post_or_put(self.api_investor.db)
+        self.mortgage.status = STATUS.ACCEPTED
+        self.mortgage.sign(self.api)
+        self.mortgage._time_signed = sys.maxint
+        self.mortgage.post_or_put(self.api_bank.db)
+
+        self.community_investor.send_model_sync_request(LoopbackCandidate())
+        message = FakeMessage(patch.call_args[0][0][0].payload)
+        message.candidate = LoopbackCandidate()
+        patch.reset_mock()
+
+        self.community_bank.on_model_sync_request([message])
+        self.community_investor.on_model_sync_response([patch.call_args[0][0][0]])
+
+        self.assertEqual(self.api_investor.db.get(self.mortgage.type, self.mortgage.id).status, STATUS.ACCEPTED)
+
+    @mock.patch('dispersy.dispersy.Dispersy.store_update_forward')
+    def test_model_sync_unsigned(self, patch):
+        self.campaign.post_or_put(self.api_bank.db)
+        self.mortgage.sign(self.api)
+        self.mortgage.status = STATUS.ACCEPTED
+        self.mortgage.post_or_put(self.api_bank.db)
+
+        self.community_investor.send_model_sync_request(LoopbackCandidate())
+        message = FakeMessage(patch.call_args[0][0][0].payload)
+        message.candidate = LoopbackCandidate()
+        patch.reset_mock()
+        self.community_bank.on_model_sync_request([message])
+        self.community_investor.on_model_sync_response([patch.call_args[0][0][0]])
+
+        # Neither the unsigned campaign nor the mortgage changed after signing is stored
+        self.assertFalse(self.isModelInDB(self.api_investor, self.campaign))
+        self.assertFalse(self.isModelInDB(self.api_investor, self.mortgage))
+
+    @mock.patch('dispersy.dispersy.Dispersy.store_update_forward')
+    def test_model_sync_bounded(self, patch):
+        self.mortgage.post_or_put(self.api_bank.db)
+        self.campaign.post_or_put(self.api_bank.db)
+        self.house.post_or_put(self.api_bank.db)
+
+        self.community_investor.send_model_sync_request(LoopbackCandidate())
+        message = FakeMessage(patch.call_args[0][0][0].payload)
+        message.candidate = LoopbackCandidate()
+        patch.reset_mock()
+
+        # Only room for a single model per response message, and two in total
+        self.community_bank.model_sync_batch_bytes = 1
+        self.community_bank.model_sync_max_bytes = len(self.mortgage.encode()) + len(self.campaign.encode()) + \
+                                                   len(self.house.encode()) - 1
+        self.community_bank.on_model_sync_request([message])
+
+        self.assertEqual(patch.call_count, 2)
+        for args, _ in patch.call_args_list:
+            self.assertEqual(len(args[0][0].payload.models), 1)
+
+    @mock.patch('dispersy.dispersy.Dispersy.store_update_forward')
+    def test_model_sync_oversized(self, patch):
+        self.campaign.post_or_put(self.api_bank.db)
+
+        self.community_investor.send_model_sync_request(LoopbackCandidate())
+        message = FakeMessage(patch.call_args[0][0][0].payload)
+        message.candidate = LoopbackCandidate()
+        patch.reset_mock()
+
+        # The campaign is larger than a whole response, and is sent on its own
+        self.community_bank.model_sync_max_bytes = len(self.campaign.encode()) - 1
+        self.community_bank.on_model_sync_request([message])
+
+        self.assertEqual(patch.call_count, 1)
+        self.assertEqual(patch.call_args[0][0][0].payload.models, [self.campaign])
+
+    @mock.patch('dispersy.dispersy.Dispersy.store_update_forward')
+    def test_model_sync_random_candidate(self, patch):
+        candidates = [LoopbackCandidate(), LoopbackCandidate()]
+        self.community_investor.dispersy_yield_verified_candidates = lambda: iter(candidates)
+
+        with mock.patch('random.choice', side_effect=lambda items: items[-1]) as choice:
+            self.assertTrue(self.community_investor.send_model_sync_request())
+
+        self.assertEqual(choice.call_args[0][0], candidates)
+
+    @mock.patch('dispersy.dispersy.Dispersy.store_update_forward')
+    def test_document_transfer(self, patch):
+        """
+        Test a borrower sending a document to a bank in chunks, with a chunk that is lost and sent again.
+
+        borrower -> bank
+        bank -> borrower
+        """
+        self.api.db.blob_store = BlobStore(os.path.join('test_blobs', 'borrower'))
+        self.api_bank.db.blob_store = BlobStore(os.path.join('test_blobs', 'bank'))
+        self.community.document_transfers.timeout = 0
+        self.community_bank.document_transfers.received_directory = os.path.join('test_blobs', 'received')
+
+        data = os.urandom(5000)
+        writer = self.api.blob_store.writer()
+        writer.write(data)
+        blob_hash, size = writer.commit()
+        document = Document('application/pdf', blob_hash, size, 'Passport')
+
+        lost = [2]
+
+        def deliver(messages, store, update, forward):
+            for message in messages:
+                if message.name == u"document_chunk" and message.payload.index in lost:
+                    lost.remove(message.payload.index)
+                    continue
+                received = FakeMessage(message.payload)
+                received.authentication = message.authentication
+                received.candidate = LoopbackCandidate()
+                community = self.community_bank if message.authentication.member == self.member else self.community
+                getattr(community, 'on_' + message.name)([received])
+
+        patch.side_effect = deliver
+        results = []
+        # The bank only accepts the documents of a loan request it received
+        self.loan_request.post_or_put(self.api_bank.db)
+        folder = str(self.loan_request.id)
+        try:
+            self.community.document_transfers.send(self.bank.id, LoopbackCandidate(), folder, document) \
+                .addCallback(results.append)
+            self.assertEqual(results, [])
+
+            self.community.document_transfers.process()
+            self.assertEqual(results, [True])
+
+            received = self.api_bank.db.get_all(Document.type)
+            self.assertEqual([model.blob_hash for model in received], [blob_hash])
+            with received[0].open(self.api_bank.blob_store) as blob_file:
+                self.assertEqual(blob_file.read(), data)
+            self.assertTrue(os.path.isfile(os.path.join('test_blobs', 'received', folder, 'Passport.pdf')))
+        finally:
+            shutil.rmtree('test_blobs')
+
 
 
 
@@ -1011,6 +1197,85 @@ class ConversionTestCase(unittest.TestCase):
         self.assertEqual(message.payload.fields, decoded_payload.fields)
         self.assertEqual(message.payload.models, decoded_payload.models)
 
+    def test_encode_block_range_request(self):
+        meta = self.community.get_meta_message(u"block_range_request")
+        message = meta.impl(authentication=(self.member,),
+                            distribution=(self.community.claim_global_time(),),
+                            payload=(self.user.id, 3, 7),
+                            destination=(LoopbackCandidate(),))
+
+        encoded_message = self.conversion._encode_block_range_request(message)[0]
+        decoded_payload = self.conversion._decode_block_range_request(message, 0, encoded_message)[1]
+
+        self.assertEqual(decoded_payload.public_key, self.user.id)
+        self.assertEqual(decoded_payload.from_sequence_number, 3)
+        self.assertEqual(decoded_payload.to_sequence_number, 7)
+
+    def test_encode_document_offer(self):
+        meta = self.community.get_meta_message(u"document_offer")
+        message = meta.impl(authentication=(self.member,),
+                            distribution=(self.community.claim_global_time(),),
+                            payload=('transfer', '1', 'Passport.pdf', 'application/pdf', 'ab' * 32, 5000, 1024),
+                            destination=(LoopbackCandidate(),))
+
+        encoded_message = self.conversion._encode_document_offer(message)[0]
+        decoded_payload = self.conversion._decode_document_offer(message, 0, encoded_message)[1]
+
+        self.assertEqual(decoded_payload.transfer_id, 'transfer')
+        self.assertEqual(decoded_payload.folder, '1')
+        self.assertEqual(decoded_payload.name, 'Passport.pdf')
+        self.assertEqual(decoded_payload.mime, 'application/pdf')
+        self.assertEqual(decoded_payload.blob_hash, 'ab' * 32)
+        self.assertEqual(decoded_payload.size, 5000)
+        self.assertEqual(decoded_payload.chunk_size, 1024)
+
+    def test_encode_document_chunk(self):
+        meta = self.community.get_meta_message(u"document_chunk")
+        message = meta.impl(authentication=(self.member,),
+                            distribution=(self.community.claim_global_time(),),
+                            payload=('transfer', 3, 'hash', 'data'),
+                            destination=(LoopbackCandidate(),))
+
+        encoded_message = self.conversion._encode_document_chunk(message)[0]
+        decoded_payload = self.conversion._decode_document_chunk(message, 0, encoded_message)[1]
+
+        self.assertEqual(decoded_payload.transfer_id, 'transfer')
+        self.assertEqual(decoded_payload.index, 3)
+        self.assertEqual(decoded_payload.chunk_hash, 'hash')
+        self.assertEqual(decoded_payload.data, 'data')
+
+    def test_encode_document_ack(self):
+        meta = self.community.get_meta_message(u"document_ack")
+        message = meta.impl(authentication=(self.member,),
+                            distribution=(self.community.claim_global_time(),),
+                            payload=('transfer', 2, [4, 5]),
+                            destination=(LoopbackCandidate(),))
+
+        encoded_message = self.conversion._encode_document_ack(message)[0]
+        decoded_payload = self.conversion._decode_document_ack(message, 0, encoded_message)[1]
+
+        self.assertEqual(decoded_payload.transfer_id, 'transfer')
+        self.assertEqual(decoded_payload.next_index, 2)
+        self.assertEqual(decoded_payload.received, [4, 5])
+
+    def test_encode_block_batch(self):
+        block = DatabaseBlock((self.user.id, self.bank.id, 'agreement', 'agreement', 3, 4, 'prev_hash_bene',
+                               'prev_hash_beni', 'sig_bene', 'sig_beni', 1000))
+        block.previous_hash = 'previous_hash'
+        block.sequence_number = 5
+
+        meta = self.community.get_meta_message(u"block_range_response")
+        message = meta.impl(authentication=(self.member,),
+                            distribution=(self.community.claim_global_time(),),
+                            payload=([block.to_row()],),
+                            destination=(LoopbackCandidate(),))
+
+        encoded_message = self.conversion._encode_block_batch(message)[0]
+        decoded_payload = self.conversion._decode_block_batch(message, 0, encoded_message)[1]
+
+        self.assertEqual(decoded_payload.blocks, [block.to_row()])
+        self.assertTrue(DatabaseBlock.from_row(decoded_payload.blocks[0]).verify())
+
 
     def test_encode_api_request_community(self):
         meta = self.community.get_meta_message(u"api_message_community")
@@ -1080,6 +1345,36 @@ class ConversionTestCase(unittest.TestCase):
         self.assertEqual(p1.signature_benefactor, p1.signature_benefactor)
         self.assertEqual(p1.insert_time, p2.insert_time)
 
+    def test_encode_model_sync_request(self):
+        meta = self.community.get_meta_message(u"model_sync_request")
+        bloom_filter = BloomFilter(1024, 0.01, prefix='a')
+        bloom_filter.add(model_sync_key(self.house))
+        message = meta.impl(authentication=(self.member,),
+                            distribution=(self.community.claim_global_time(),),
+                            payload=([House.type], 0, 1, bloom_filter),
+                            destination=(LoopbackCandidate(),))
+
+        encoded_message = self.conversion._encode_model_sync_request(message)[0]
+        decoded_payload = self.conversion._decode_model_sync_request(message, 0, encoded_message)[1]
+
+        self.assertEqual(decoded_payload.types, [House.type])
+        self.assertEqual(decoded_payload.slice_index, 0)
+        self.assertEqual(decoded_payload.slice_count, 1)
+        self.assertIn(model_sync_key(self.house), decoded_payload.bloom_filter)
+        self.assertNotIn(model_sync_key(self.loan_request), decoded_payload.bloom_filter)
+
+    def test_encode_model_batch(self):
+        meta = self.community.get_meta_message(u"model_sync_response")
+        message = meta.impl(authentication=(self.member,),
+                            distribution=(self.community.claim_global_time(),),
+                            payload=([self.house, self.loan_request],),
+                            destination=(LoopbackCandidate(),))
+
+        encoded_message = self.conversion._encode_model_batch(message)[0]
+        decoded_payload = self.conversion._decode_model_batch(message, 0, encoded_message)[1]
+
+        self.assertEqual(message.payload.models, decoded_payload.models)
+
 
 if __name__ == '__main__':
     unittest.main()
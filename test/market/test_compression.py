@@ -0,0 +1,78 @@
+from __future__ import absolute_import
+import os
+import unittest
+import zlib
+
+from tftp_compression import CompressingReader, Decompressor, ZLIB, choose_codec, compressed_name, sample_ratio, \
+    split_codec
+
+
+class CompressionTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.path = os.path.join(os.getcwd(), 'compression_test.pdf')
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def write(self, data):
+        with open(self.path, 'wb') as f:
+            f.write(data)
+
+    def read_all(self, reader, size=512):
+        chunks = []
+        chunk = reader.read(size)
+        while chunk:
+            chunks.append(chunk)
+            chunk = reader.read(size)
+        return ''.join(chunks)
+
+    def test_compressible(self):
+        self.write('%PDF-1.4 loan request document ' * 2000)
+        self.assertLess(sample_ratio(self.path), 0.1)
+        self.assertEqual(choose_codec(self.path, [ZLIB]), ZLIB)
+        # The server has to accept the codec
+        self.assertIsNone(choose_codec(self.path, []))
+
+    def test_bypass_compressed_data(self):
+        self.write(os.urandom(100 * 1024))
+        self.assertGreater(sample_ratio(self.path), 0.9)
+        self.assertIsNone(choose_codec(self.path, [ZLIB]))
+
+    def test_bypass_small_file(self):
+        self.write('a' * 100)
+        self.assertIsNone(choose_codec(self.path, [ZLIB]))
+
+    def test_reader_round_trip(self):
+        data = ''.join(str(i) for i in xrange(50000))
+        self.write(data)
+
+        reader = CompressingReader(self.path)
+        compressed = self.read_all(reader)
+        reader.close()
+
+        self.assertTrue(reader.closed)
+        self.assertEqual(zlib.decompress(compressed), data)
+        self.assertEqual(reader.raw_bytes, len(data))
+        self.assertEqual(reader.compressed_bytes, len(compressed))
+
+    def test_decompressor_limit(self):
+        compressed = zlib.compress('a' * 10000)
+
+        self.assertIsNone(Decompressor(ZLIB).decompress(compressed, 9999))
+
+        decompressor = Decompressor(ZLIB)
+        data = decompressor.decompress(compressed, 10000)
+        self.assertEqual(data + decompressor.flush(), 'a' * 10000)
+
+    def test_decompressor_corrupt(self):
+        self.assertRaises(zlib.error, Decompressor(ZLIB).decompress, 'corrupt data', 1000)
+
+    def test_codec_names(self):
+        self.assertEqual(compressed_name('1/passport.pdf', ZLIB), '1/passport.pdf.zlib')
+        self.assertEqual(split_codec('1/passport.pdf.zlib'), ('1/passport.pdf', ZLIB))
+        self.assertEqual(split_codec('1/passport.pdf'), ('1/passport.pdf', None))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,11 +1,14 @@
 from __future__ import absolute_import
 import unittest
+from uuid import uuid4
 
 from mock import mock, Mock
 
+from market.api.api import STATUS
 from market.database.backends import MemoryBackend, PersistentBackend
 from market.database.database import Database, MarketDatabase
 from market.models import DatabaseModel
+from market.models.loans import Investment
 
 
 class DatabaseTestSuite(unittest.TestCase):
@@ -139,6 +142,30 @@ class MarketDatabaseTestSuite(unittest.TestCase):
         self.assertEqual(model2.id, unique_id)
         self.assertEqual(model2.generate_id.call_count, 2)
 
+    def test_investments(self):
+        self.database.backend.clear()
+        mortgage_id = uuid4()
+        investment1 = Investment('investor1', 1000, 10, 5.0, mortgage_id, STATUS.PENDING)
+        investment2 = Investment('investor2', 2000, 10, 5.0, mortgage_id, STATUS.PENDING)
+        investment3 = Investment('investor1', 3000, 10, 5.0, uuid4(), STATUS.PENDING)
+        for investment in (investment1, investment2, investment3):
+            self.database.post(Investment.type, investment)
+
+        self.assertEqual(self.database.investments_for_mortgage(mortgage_id), [investment1, investment2])
+        self.assertEqual(self.database.investments_for_investor('investor1'), [investment1, investment3])
+
+        # The index follows the changes of the investments
+        investment1.status = STATUS.ACCEPTED
+        self.database.put(Investment.type, investment1.id, investment1)
+        self.assertEqual(self.database.investments_for_mortgage(mortgage_id, STATUS.PENDING), [investment2])
+        self.assertEqual(self.database.investments_for_mortgage(mortgage_id, STATUS.ACCEPTED)[0].status,
+                         STATUS.ACCEPTED)
+        self.assertEqual(self.database.investments_for_mortgage(mortgage_id), [investment1, investment2])
+
+        self.database.delete(investment2)
+        self.assertEqual(self.database.investments_for_mortgage(mortgage_id, STATUS.PENDING), [])
+        self.assertEqual(self.database.investments_for_investor('investor2'), [])
+
 
 class DatabasePersistentTestSuite(MarketDatabaseTestSuite):
     def setUp(self):
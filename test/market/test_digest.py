@@ -0,0 +1,144 @@
+from __future__ import absolute_import
+import random
+import unittest
+
+from market.database.backends import MemoryBackend
+from market.database.digest import DIGEST_BUCKETS, EMPTY_DIGEST, DigestTree, find_differing_buckets, model_bucket, \
+    model_digest, xor_digest
+
+
+class T(object):
+    def __init__(self, type, id):
+        self.type = type
+        self.id = id
+
+
+class DigestTestSuite(unittest.TestCase):
+    def test_xor_digest(self):
+        digest1 = model_digest('test', '1', 'value')
+        digest2 = model_digest('test', '2', 'value')
+
+        self.assertEqual(xor_digest(xor_digest(digest1, digest2), digest2), digest1)
+        self.assertEqual(xor_digest(digest1, digest1), EMPTY_DIGEST)
+
+    def test_model_digest_version(self):
+        self.assertNotEqual(model_digest('test', '1', 'value1'), model_digest('test', '1', 'value2'))
+        self.assertEqual(model_digest('test', '1', u'value'), model_digest('test', '1', 'value'))
+
+    def test_model_bucket(self):
+        for i in xrange(100):
+            self.assertTrue(0 <= model_bucket('test', str(i)) < DIGEST_BUCKETS)
+
+    def test_tree(self):
+        tree = DigestTree([EMPTY_DIGEST] * DIGEST_BUCKETS)
+        self.assertEqual(len(tree.get_nodes(0, [0])), 1)
+        self.assertEqual(tree.get_nodes(tree.depth, range(DIGEST_BUCKETS)), [EMPTY_DIGEST] * DIGEST_BUCKETS)
+
+        other = DigestTree([EMPTY_DIGEST] * (DIGEST_BUCKETS - 1) + [model_digest('test', '1', 'value')])
+        self.assertNotEqual(tree.root, other.root)
+
+
+class ReconciliationTestSuite(unittest.TestCase):
+    """
+    Two in memory backends that start out equal and then diverge in random ways.
+    """
+
+    def setUp(self):
+        self.random = random.Random(42)
+
+        self.local = MemoryBackend()
+        self.local.clear()
+        self.remote = MemoryBackend()
+        self.remote.clear()
+
+        self.types = ['campaign', 'mortgage', 'house']
+        self.new_ids = 0
+        self.ids = []
+        for i in xrange(500):
+            type_name = self.random.choice(self.types)
+            value_id = 'id%d' % i
+            self.local.post(type_name, value_id, 'value%d' % i)
+            self.remote.post(type_name, value_id, 'value%d' % i)
+            self.ids.append((type_name, value_id))
+
+    def diverge(self, changes):
+        """
+        Apply random changes to either backend.
+        :return: The set of buckets that were changed.
+        """
+        changed = set()
+        for i in xrange(changes):
+            backend = self.random.choice([self.local, self.remote])
+            action = self.random.choice(['post', 'put', 'delete'])
+            if action == 'post':
+                self.new_ids += 1
+                type_name, value_id = self.random.choice(self.types), 'new%d' % self.new_ids
+                backend.post(type_name, value_id, 'new value %d' % self.new_ids)
+            else:
+                type_name, value_id = self.random.choice(self.ids)
+                if action == 'put':
+                    backend.put(type_name, value_id, 'changed value %d' % i)
+                else:
+                    backend.delete(T(type_name, value_id))
+            changed.add(model_bucket(type_name, value_id))
+        return changed
+
+    def differing_buckets(self):
+        remote_tree = self.remote.get_digest_tree()
+        return find_differing_buckets(self.local.get_digest_tree(), remote_tree.get_nodes)
+
+    def reconcile(self, buckets):
+        """
+        Make the local backend equal to the remote backend, only looking at the given buckets.
+        """
+        for bucket in buckets:
+            local = dict(((t, i), d) for t, i, d in self.local.get_bucket_entries(bucket))
+            remote = dict(((t, i), d) for t, i, d in self.remote.get_bucket_entries(bucket))
+
+            for (type_name, value_id), digest in remote.iteritems():
+                if (type_name, value_id) not in local:
+                    self.local.post(type_name, value_id, self.remote.get(type_name, value_id))
+                elif local[(type_name, value_id)] != digest:
+                    self.local.put(type_name, value_id, self.remote.get(type_name, value_id))
+            for (type_name, value_id) in local:
+                if (type_name, value_id) not in remote:
+                    self.local.delete(T(type_name, value_id))
+
+    def test_equal(self):
+        self.assertEqual(self.local.get_digest_root(), self.remote.get_digest_root())
+        buckets, exchanges = self.differing_buckets()
+        self.assertEqual(buckets, [])
+        self.assertEqual(exchanges, 1)
+
+    def test_incremental(self):
+        self.diverge(50)
+
+        for backend in [self.local, self.remote]:
+            digests = [EMPTY_DIGEST] * DIGEST_BUCKETS
+            for bucket in xrange(DIGEST_BUCKETS):
+                for type_name, value_id, digest in backend.get_bucket_entries(bucket):
+                    self.assertEqual(digest, model_digest(type_name, value_id, backend.get(type_name, value_id)))
+                    digests[bucket] = xor_digest(digests[bucket], digest)
+
+            self.assertEqual(backend.get_bucket_digests(), digests)
+
+    def test_find_differing(self):
+        for changes in [1, 5, 20]:
+            changed = self.diverge(changes)
+            buckets, exchanges = self.differing_buckets()
+
+            # A change can be undone by a later one, but never shows up outside a changed bucket.
+            self.assertTrue(set(buckets) <= changed)
+            self.assertEqual(buckets, sorted(buckets))
+            self.assertLessEqual(exchanges, self.local.get_digest_tree().depth + 1)
+
+            for bucket in changed - set(buckets):
+                self.assertEqual(self.local.get_bucket_entries(bucket), self.remote.get_bucket_entries(bucket))
+
+            self.reconcile(buckets)
+            self.assertEqual(self.local.get_digest_root(), self.remote.get_digest_root())
+            self.assertEqual(self.differing_buckets()[0], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,306 @@
+from __future__ import absolute_import
+import os
+import shutil
+import unittest
+from collections import namedtuple
+from hashlib import sha256
+from uuid import uuid4
+
+from market.community.transfer import DocumentTransfers, REJECTED, get_chunk_count
+from market.database.backends import PersistentBackend
+from market.database.blobstore import BlobStore
+from market.database.database import MarketDatabase
+from market.models.document import Document
+from market.models.loans import LoanRequest
+
+Offer = namedtuple('Offer', ['transfer_id', 'folder', 'name', 'mime', 'blob_hash', 'size', 'chunk_size'])
+Chunk = namedtuple('Chunk', ['transfer_id', 'index', 'chunk_hash', 'data'])
+Ack = namedtuple('Ack', ['transfer_id', 'next_index', 'received'])
+User = namedtuple('User', ['id'])
+
+
+class FakeAPI(object):
+    def __init__(self, directory):
+        self.blob_store = BlobStore(os.path.join(directory, 'blobs'))
+        self.db = MarketDatabase(PersistentBackend(directory, u'market.db'))
+
+
+class Network(object):
+    """
+    Delivers the messages of the fake communities in order, dropping the ones `drop` returns True for.
+    """
+
+    def __init__(self):
+        self.queue = []
+        self.drop = lambda kind, payload: False
+        self.delivered = []
+
+    def deliver(self):
+        while self.queue:
+            kind, sender, receiver, payload = self.queue.pop(0)
+            if self.drop(kind, payload):
+                continue
+            self.delivered.append((kind, payload))
+            transfers = receiver.document_transfers
+            if kind == 'offer':
+                transfers.on_offer(sender.key, sender.candidate, payload)
+            elif kind == 'chunk':
+                transfers.on_chunk(sender.key, sender.candidate, payload)
+            else:
+                transfers.on_ack(sender.key, payload)
+
+
+class FakeCommunity(object):
+    """
+    Sends the document transfer messages to its peer over a `Network`, instead of over dispersy.
+    """
+
+    def __init__(self, key, directory, network):
+        self.key = key
+        self.candidate = key + '-candidate'
+        self.user = User(key)
+        self.api = FakeAPI(directory)
+        self.network = network
+        self.peer = None
+        self.document_transfers = DocumentTransfers(self, window=4, chunk_size=16, timeout=0, retries=2,
+                                                    received_directory=os.path.join(directory, 'received'))
+
+    def send_document_offer(self, candidate, *payload):
+        self.network.queue.append(('offer', self, self.peer, Offer(*payload)))
+
+    def send_document_chunk(self, candidate, *payload):
+        self.network.queue.append(('chunk', self, self.peer, Chunk(*payload)))
+
+    def send_document_ack(self, candidate, *payload):
+        self.network.queue.append(('ack', self, self.peer, Ack(*payload)))
+
+
+class DocumentTransfersTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(os.getcwd(), 'test_document_transfer')
+        self.network = Network()
+        self.sender = FakeCommunity('borrower', os.path.join(self.directory, 'borrower'), self.network)
+        self.receiver = FakeCommunity('bank', os.path.join(self.directory, 'bank'), self.network)
+        self.sender.peer = self.receiver
+        self.receiver.peer = self.sender
+
+        # The documents are only accepted for a loan request of the borrower with the bank
+        self.loan_request = LoanRequest('borrower', uuid4(), '', '', '', 1, ['bank'], u'', 10000, {})
+        self.receiver.api.db.post(LoanRequest.type, self.loan_request)
+        self.folder = str(self.loan_request.id)
+
+        self.data = ''.join(chr(i % 256) for i in range(200))
+        self.document = self._store(self.data, 'Passport')
+        self.results = []
+
+    def tearDown(self):
+        self.sender.api.db.backend.close()
+        self.receiver.api.db.backend.close()
+        shutil.rmtree(self.directory)
+
+    def _store(self, data, name):
+        writer = self.sender.api.blob_store.writer()
+        writer.write(data)
+        blob_hash, size = writer.commit()
+        return Document('application/pdf', blob_hash, size, name)
+
+    def _send(self, document=None, folder=None):
+        deferred = self.sender.document_transfers.send('bank', self.receiver.candidate, folder or self.folder,
+                                                       document or self.document)
+        deferred.addCallback(self.results.append)
+
+    def _received_documents(self):
+        return self.receiver.api.db.get_all(Document.type) or []
+
+    def assertReceived(self, document):
+        received = self._received_documents()
+        self.assertEqual(len(received), 1)
+        self.assertEqual(received[0].blob_hash, document.blob_hash)
+        self.assertEqual(received[0].name, document.name + '.pdf')
+        with received[0].open(self.receiver.api.blob_store) as blob_file:
+            self.assertEqual(blob_file.read(), self.data)
+        with open(os.path.join(self.directory, 'bank', 'received', self.folder, document.name + '.pdf'), 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_chunk_count(self):
+        self.assertEqual(get_chunk_count(0, 16), 1)
+        self.assertEqual(get_chunk_count(16, 16), 1)
+        self.assertEqual(get_chunk_count(17, 16), 2)
+
+    def test_transfer(self):
+        self._send()
+        self.network.deliver()
+
+        self.assertEqual(self.results, [True])
+        self.assertReceived(self.document)
+        self.assertEqual(self.sender.document_transfers.outgoing, 0)
+        self.assertEqual(self.receiver.document_transfers.incoming, 0)
+        chunks = [payload.index for kind, payload in self.network.delivered if kind == 'chunk']
+        self.assertEqual(chunks, range(get_chunk_count(len(self.data), 16)))
+
+    def test_empty_document(self):
+        self.data = ''
+        document = self._store('', 'Empty')
+        self._send(document)
+        self.network.deliver()
+
+        self.assertEqual(self.results, [True])
+        self.assertReceived(document)
+
+    def test_window(self):
+        self._send()
+        # Hold back the acks of the chunks, the sender must stop after a full window
+        self.network.drop = lambda kind, payload: kind == 'ack' and payload.next_index > 0
+        self.network.deliver()
+
+        chunks = [payload.index for kind, payload in self.network.delivered if kind == 'chunk']
+        self.assertEqual(chunks, [0, 1, 2, 3])
+
+    def test_retransmit_lost_chunks(self):
+        lost = set([2, 5, 6])
+        self.network.drop = lambda kind, payload: kind == 'chunk' and payload.index in lost and \
+            not lost.remove(payload.index)
+        self._send()
+        self.network.deliver()
+        self.assertEqual(self.results, [])
+
+        # The chunks after the lost ones were buffered and acknowledged, only the lost ones are sent again
+        self.sender.document_transfers.process()
+        self.network.deliver()
+        self.sender.document_transfers.process()
+        self.network.deliver()
+
+        self.assertEqual(self.results, [True])
+        self.assertReceived(self.document)
+        indices = [payload.index for kind, payload in self.network.delivered if kind == 'chunk']
+        self.assertEqual(sorted(indices), range(get_chunk_count(len(self.data), 16)))
+
+    def test_lost_offer(self):
+        lost = ['offer']
+        self.network.drop = lambda kind, payload: kind in lost and not lost.remove(kind)
+        self._send()
+        self.network.deliver()
+        self.assertEqual(self.receiver.document_transfers.incoming, 0)
+
+        self.sender.document_transfers.process()
+        self.network.deliver()
+
+        self.assertEqual(self.results, [True])
+        self.assertReceived(self.document)
+
+    def test_give_up(self):
+        self.network.drop = lambda kind, payload: kind == 'chunk'
+        self._send()
+        self.network.deliver()
+
+        for _ in range(3):
+            self.sender.document_transfers.process()
+            self.network.deliver()
+
+        self.assertEqual(self.results, [False])
+        self.assertEqual(self.sender.document_transfers.outgoing, 0)
+
+        # The receiver drops the incomplete transfer without leaving anything behind
+        self.receiver.document_transfers.process()
+        self.assertEqual(self.receiver.document_transfers.incoming, 0)
+        self.assertEqual(self._received_documents(), [])
+
+    def test_corrupt_chunk(self):
+        corrupted = []
+
+        def corrupt(kind, payload):
+            if kind == 'chunk' and payload.index == 1 and not corrupted:
+                corrupted.append(payload)
+                self.network.queue.insert(0, ('chunk', self.sender, self.receiver,
+                                              payload._replace(data='x' * len(payload.data))))
+                return True
+            return False
+
+        self.network.drop = corrupt
+        self._send()
+        self.network.deliver()
+        self.sender.document_transfers.process()
+        self.network.deliver()
+
+        self.assertEqual(self.results, [True])
+        self.assertReceived(self.document)
+
+    def test_already_stored(self):
+        writer = self.receiver.api.blob_store.writer()
+        writer.write(self.data)
+        writer.commit()
+
+        self._send()
+        self.network.deliver()
+
+        self.assertEqual(self.results, [True])
+        self.assertReceived(self.document)
+        self.assertFalse(any(kind == 'chunk' for kind, _ in self.network.delivered))
+        self.assertEqual(self.receiver.api.blob_store.references(self.document.blob_hash), 2)
+
+    def test_reject_invalid_offer(self):
+        self.sender.document_transfers.chunk_size = 64 * 1024
+        self._send()
+        self.network.deliver()
+
+        self.assertEqual(self.results, [False])
+        self.assertEqual([payload.next_index for kind, payload in self.network.delivered if kind == 'ack'],
+                         [REJECTED])
+
+    def test_reject_invalid_folder(self):
+        for folder in ('..', 'folder/.', str(uuid4())):
+            self._send(folder=folder)
+        self.network.deliver()
+        self.assertEqual(self.results, [False] * 3)
+
+        # A name that would leave the folder
+        offer = Offer('transfer', self.folder, 'folder/..', 'application/pdf', self.document.blob_hash,
+                      self.document.size, 16)
+        self.receiver.document_transfers.on_offer('borrower', self.sender.candidate, offer)
+        self.assertEqual(self.network.queue[-1][3].next_index, REJECTED)
+        self.assertEqual(self._received_documents(), [])
+
+    def test_reject_other_borrower(self):
+        self.loan_request.banks.remove('bank')
+        self.receiver.api.db.put(LoanRequest.type, self.loan_request.id, self.loan_request)
+        self._send()
+        self.network.deliver()
+
+        self.assertEqual(self.results, [False])
+        self.assertEqual(self._received_documents(), [])
+
+    def test_hash_mismatch(self):
+        # Chunks with valid chunk hashes, of other data than the offered document
+        forged = Document('application/pdf', sha256('other').hexdigest(), len(self.data), 'Forged')
+        self.sender.api.blob_store.map = lambda blob_hash: self.data
+        self._send(forged)
+        self.network.deliver()
+
+        self.assertEqual(self.results, [False])
+        self.assertEqual(self._received_documents(), [])
+        self.assertEqual(self.receiver.document_transfers.incoming, 0)
+        self.assertFalse(self.receiver.api.blob_store.contains(forged.blob_hash))
+
+    def test_ack_from_other_member(self):
+        self._send()
+        transfer_id = self.network.queue[0][3].transfer_id
+        self.sender.document_transfers.on_ack('mallory', Ack(transfer_id, REJECTED, []))
+
+        self.assertEqual(self.results, [])
+        self.network.deliver()
+        self.assertEqual(self.results, [True])
+
+    def test_chunk_from_other_member(self):
+        self._send()
+        offer = self.network.queue[0][3]
+        self.network.deliver()
+
+        # A chunk of the same transfer id signed by another member is no part of the transfer
+        self.receiver.document_transfers.on_chunk('mallory', 'mallory-candidate',
+                                                  Chunk(offer.transfer_id, 0, sha256('x').digest(), 'x'))
+        self.assertEqual(self.network.queue, [])
+        self.assertReceived(self.document)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,6 +16,7 @@ from market.controllers.openmarket_controller import OpenMarketController
 from market.market_app import TestMarketApplication
 from market.models.role import Role
 from market.models.user import User
+from tftp_server import ReceivedFile
 
 
 class GUITestSuite(unittest.TestCase):
@@ -1349,6 +1350,34 @@ class GUITestSuite(unittest.TestCase):
         self.assertEqual(self.window.fiplr2_property_value_lineedit.text(), '123456')
         self.assertEqual(self.window.fiplr2_description_textedit.toPlainText(), u'I want to buy a house')
 
+    def test_pending_loan_request_documents_received(self):
+        """
+        This test checks if the documents received by the TFTP server are shown without searching the folder again
+        """
+        self.window.fiplr2_controller.tftp_server = MagicMock()
+        self.window.fiplr2_controller.search = MagicMock(return_value=['/received/TestDocument1.pdf'])
+        self.window.app.user = self.window.app.bank1
+
+        borrower, _, _ = self.window.api.create_user()
+        borrower.role_id = Role.BORROWER.value
+        self.window.api.db.put(User.type, borrower.id, borrower)
+        self.window.api.create_profile(borrower, self.payload_borrower_profile)
+        borrower = self.window.api.db.get(User.type, borrower.id)
+        loan_request = self.window.api.create_loan_request(borrower, self.payload_loan_request)
+
+        self.window.fiplr2_controller.setup_view(loan_request.id)
+        self.assertEqual(self.window.fiplr2_documents_table.rowCount(), 1)
+
+        self.window.fiplr2_controller.add_document(ReceivedFile('127.0.0.1', str(loan_request.id), 'TestDocument2.pdf',
+                                                                '/received/TestDocument2.pdf', 'ab' * 32, 10))
+        self.assertEqual(self.window.fiplr2_documents_table.rowCount(), 2)
+        self.assertEqual(self.window.fiplr2_documents_table.item(1, 0).text(), 'TestDocument2.pdf')
+
+        self.window.fiplr2_controller.setup_view(loan_request.id)
+        self.assertEqual(self.window.fiplr2_documents_table.rowCount(), 2)
+        self.window.fiplr2_controller.search.assert_called_once_with(
+            os.getcwd() + '/resources/received/' + str(loan_request.id) + '/*.pdf')
+
     def test_pending_loan_request_accept_empty(self):
         """
         This test checks if a dialog pops up when clicking the 'accept' button in the 'pending loan request'
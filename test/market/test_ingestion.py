@@ -0,0 +1,235 @@
+from __future__ import absolute_import
+import os
+import shutil
+import threading
+import unittest
+from hashlib import sha256
+
+from market.api.api import MarketAPI
+from market.database.backends import PersistentBackend
+from market.database.blobstore import BlobStore
+from market.database.database import MarketDatabase
+from market.database.ingestion import DocumentIngestion
+from market.models.document import Document
+from market.models.profiles import BorrowersProfile
+
+
+class ReactorQueue(object):
+    """
+    Collects the calls the ingestion hands to the reactor thread, to run them on the test thread.
+    """
+
+    def __init__(self):
+        self.calls = []
+        self.condition = threading.Condition()
+
+    def __call__(self, func, *args):
+        with self.condition:
+            self.calls.append((func, args))
+            self.condition.notify()
+
+    def run_until(self, predicate, timeout=5.0):
+        while not predicate():
+            with self.condition:
+                if not self.calls:
+                    self.condition.wait(timeout)
+                    if not self.calls:
+                        raise AssertionError("Timed out")
+                func, args = self.calls.pop(0)
+            func(*args)
+
+
+class IngestionTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(os.getcwd(), 'test_ingestion')
+        os.makedirs(self.directory)
+        self.blob_store = BlobStore(os.path.join(self.directory, 'blobs'), chunk_size=1024)
+        self.reactor = ReactorQueue()
+        self.ingestion = DocumentIngestion(self.blob_store, self.reactor, progress_interval=4096)
+        self.ingestion.start()
+
+        self.data = os.urandom(10000)
+        self.path = self._write('passport.pdf', self.data)
+        self.results = []
+        self.progress = []
+
+    def tearDown(self):
+        self.ingestion.stop(timeout=5.0)
+        shutil.rmtree(self.directory)
+
+    def _write(self, name, data):
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def test_ingest(self):
+        self.ingestion.ingest(self.path, lambda stored, size: self.progress.append((stored, size))) \
+            .addCallback(self.results.append)
+        self.reactor.run_until(lambda: self.results)
+
+        blob_hash, size = self.results[0]
+        self.assertEqual((blob_hash, size), (sha256(self.data).hexdigest(), 10000))
+        self.assertEqual(self.blob_store.open(blob_hash).read(), self.data)
+        self.assertEqual(self.progress, [(4096, 10000), (8192, 10000), (10000, 10000)])
+
+    def test_ingest_in_order(self):
+        other = self._write('other.pdf', 'other')
+        self.ingestion.ingest(self.path).addCallback(self.results.append)
+        self.ingestion.ingest(other).addCallback(self.results.append)
+        self.reactor.run_until(lambda: len(self.results) == 2)
+
+        self.assertEqual([size for _, size in self.results], [10000, 5])
+
+    def test_ingest_missing_file(self):
+        self.ingestion.ingest(os.path.join(self.directory, 'missing.pdf')).addErrback(self.results.append)
+        self.reactor.run_until(lambda: self.results)
+
+        self.assertTrue(self.results[0].check(IOError))
+        # Nothing is left behind in the blob store
+        self.assertEqual([name for _, _, names in os.walk(self.blob_store.directory) for name in names], [])
+
+
+class PendingDocumentsTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(os.getcwd(), 'test_ingestion')
+        os.makedirs(self.directory)
+        self.blob_store = BlobStore(os.path.join(self.directory, 'blobs'))
+        self.api = MarketAPI(MarketDatabase(PersistentBackend(self.directory, u'market.db')), self.blob_store)
+        self.reactor = ReactorQueue()
+        self.api.ingestion = DocumentIngestion(self.blob_store, self.reactor)
+        self.api.ingestion.start()
+        self.progress = []
+        self.api.document_listeners.append(lambda document, stored, size: self.progress.append((document.name,
+                                                                                                  stored, size)))
+
+        self.data = 'passport data' * 1000
+        path = os.path.join(self.directory, 'passport.pdf')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        self.payload = {'role': 1, 'first_name': u'Bob', 'last_name': u'Saget', 'email': 'example@example.com',
+                        'iban': 'NL53 INGBB 04027 30393', 'phonenumber': '+3170253719234',
+                        'current_postalcode': '2162CD', 'current_housenumber': '22', 'current_address': 'straat',
+                        'documents_list': {'Passport': path}}
+        self.user, _, _ = self.api.create_user()
+
+    def tearDown(self):
+        self.api.ingestion.stop(timeout=5.0)
+        self.api.db.backend.close()
+        shutil.rmtree(self.directory)
+
+    def test_profile_saved_before_documents(self):
+        profile = self.api.create_profile(self.user, self.payload)
+
+        # The profile refers to the document right away, while its data is still being stored
+        document = self.api.db.get(Document.type, profile.document_list[0])
+        self.assertTrue(document.pending)
+        self.assertIn(document.id, self.api.pending_documents)
+
+        documents = []
+        self.api._load_documents(profile.document_list).addCallback(documents.append)
+        self.reactor.run_until(lambda: documents)
+
+        self.assertEqual(len(documents[0]), 1)
+        stored = self.api.db.get(Document.type, document.id)
+        self.assertFalse(stored.pending)
+        self.assertEqual((stored.blob_hash, stored.size), (sha256(self.data).hexdigest(), len(self.data)))
+        self.assertEqual(self.api.pending_documents, {})
+        self.assertEqual(self.progress, [('Passport', len(self.data), len(self.data))])
+
+    def test_failed_document_removed(self):
+        self.payload['documents_list'] = {'Passport': os.path.join(self.directory, 'missing.pdf')}
+        profile = self.api.create_profile(self.user, self.payload)
+        document_id = profile.document_list[0]
+
+        documents = []
+        self.api._load_documents([document_id]).addCallback(documents.append)
+        self.reactor.run_until(lambda: documents)
+
+        self.assertEqual(documents, [[]])
+        self.assertIsNone(self.api.db.get(Document.type, document_id))
+        self.assertEqual(self.api.db.get(BorrowersProfile.type, profile.id).document_list, [])
+        self.assertEqual(self.progress, [('Passport', None, 0)])
+
+    def test_resume_documents(self):
+        profile = self.api.create_profile(self.user, self.payload)
+        document_id = profile.document_list[0]
+        # The application stops before the document is stored
+        self.api.ingestion.stop(timeout=5.0)
+        self.api.pending_documents.clear()
+        self.reactor.calls = []
+        orphan = Document.pending_document('Orphan', os.path.join(self.directory, 'passport.pdf'))
+        self.api.db.post(Document.type, orphan)
+
+        self.api.ingestion.start()
+        deferreds = self.api.resume_documents()
+        self.assertEqual(len(deferreds), 1)
+        self.reactor.run_until(lambda: not self.api.pending_documents)
+
+        # The document of the profile is stored from its file, the one without a profile is removed
+        stored = self.api.db.get(Document.type, document_id)
+        self.assertFalse(stored.pending)
+        self.assertIsNone(stored.source)
+        self.assertEqual(stored.blob_hash, sha256(self.data).hexdigest())
+        self.assertIsNone(self.api.db.get(Document.type, orphan.id))
+        self.assertEqual(self.api.db.get(BorrowersProfile.type, profile.id).document_list, [document_id])
+
+    def test_resume_documents_without_file(self):
+        profile = self.api.create_profile(self.user, self.payload)
+        document_id = profile.document_list[0]
+        self.api.ingestion.stop(timeout=5.0)
+        self.api.pending_documents.clear()
+        self.reactor.calls = []
+        # A document left pending by a version that didn't keep its file
+        document = self.api.db.get(Document.type, document_id)
+        document._source = None
+        self.api.db.put(Document.type, document_id, document)
+
+        self.api.ingestion.start()
+        self.assertEqual(self.api.resume_documents(), [])
+        self.assertIsNone(self.api.db.get(Document.type, document_id))
+        self.assertEqual(self.api.db.get(BorrowersProfile.type, profile.id).document_list, [])
+
+    def test_upgrade_inline_documents(self):
+        # A document as pickled by a version that stored its data inline
+        document = Document('application/pdf', None, 0, 'Passport')
+        del document._blob_hash, document._size, document._source
+        document._data = self.data.encode('base64')
+        self.api.db.post(Document.type, document)
+
+        stored = self.api.db.get(Document.type, document.id)
+        self.assertFalse(stored.pending)
+        self.assertIsNone(stored.blob_hash)
+        self.assertEqual(self.api.resume_documents(), [])
+        self.assertIsNotNone(self.api.db.get(Document.type, document.id))
+
+        self.assertEqual(self.api.upgrade_documents(), 1)
+        self.assertEqual(self.api.upgrade_documents(), 0)
+        upgraded = self.api.db.get(Document.type, document.id)
+        self.assertIsNone(upgraded.inline_data)
+        self.assertEqual((upgraded.blob_hash, upgraded.size), (sha256(self.data).hexdigest(), len(self.data)))
+        self.assertEqual(upgraded.open(self.blob_store).read(), self.data)
+
+    def test_replaced_profile_releases_documents(self):
+        profile = self.api.create_profile(self.user, self.payload)
+        documents = []
+        self.api._load_documents(profile.document_list).addCallback(documents.append)
+        self.reactor.run_until(lambda: documents)
+        blob_hash = documents[0][0].blob_hash
+
+        path = os.path.join(self.directory, 'contract.pdf')
+        with open(path, 'wb') as f:
+            f.write('contract data')
+        self.payload['documents_list'] = {'Contract': path}
+        new_profile = self.api.create_profile(self.user, self.payload)
+        self.reactor.run_until(lambda: not self.api.pending_documents)
+
+        # The documents of the replaced profile are deleted, along with their data
+        self.assertIsNone(self.api.db.get(Document.type, profile.document_list[0]))
+        self.assertEqual(self.api.db.get(BorrowersProfile.type, profile.id).document_list, [])
+        self.assertFalse(self.blob_store.contains(blob_hash))
+        self.assertFalse(self.api.db.get(Document.type, new_profile.document_list[0]).pending)
+
+
+if __name__ == '__main__':
+    unittest.main()
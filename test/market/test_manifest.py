@@ -0,0 +1,52 @@
+import hashlib
+import os
+import shutil
+import unittest
+
+from tftp_manifest import Manifest, ManifestEntry, file_hash
+
+
+class ManifestTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.folder = os.path.join(os.getcwd(), 'test_manifest')
+        os.makedirs(self.folder)
+        for name, data in (('a.pdf', 'first'), ('b.pdf', 'second'), ('c.txt', 'ignored')):
+            with open(os.path.join(self.folder, name), 'wb') as f:
+                f.write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_file_hash(self):
+        self.assertEqual(file_hash(os.path.join(self.folder, 'a.pdf')), hashlib.sha256('first').hexdigest())
+
+    def test_from_folder(self):
+        manifest = Manifest.from_folder(self.folder)
+
+        self.assertEqual(manifest.entries, [ManifestEntry('a.pdf', hashlib.sha256('first').hexdigest(), 5),
+                                            ManifestEntry('b.pdf', hashlib.sha256('second').hexdigest(), 6)])
+        self.assertEqual(manifest.paths['b.pdf'], os.path.join(self.folder, 'b.pdf'))
+
+    def test_add_known_hash(self):
+        manifest = Manifest()
+        manifest.add('../folder/document.pdf', '/nonexistent', 'ab' * 32, 10)
+
+        self.assertEqual(manifest.entries, [ManifestEntry('document.pdf', 'ab' * 32, 10)])
+
+    def test_encode_decode(self):
+        manifest = Manifest.from_folder(self.folder)
+        decoded = Manifest.decode(manifest.encode())
+
+        self.assertEqual(decoded.entries, manifest.entries)
+        self.assertEqual(decoded.paths, {})
+
+    def test_missing(self):
+        manifest = Manifest.from_folder(self.folder)
+        present = {'a.pdf': hashlib.sha256('first').hexdigest(), 'b.pdf': hashlib.sha256('partial').hexdigest()}
+
+        self.assertEqual([entry.name for entry in manifest.missing(present)], ['b.pdf'])
+        self.assertEqual(manifest.missing(dict((entry.name, entry.sha256) for entry in manifest.entries)), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 from __future__ import absolute_import
 
 import os
+import shutil
 import unittest
 import uuid
 
@@ -8,6 +9,7 @@ import sys
 
 from market.api.api import MarketAPI
 from market.database.backends import MemoryBackend
+from market.database.blobstore import BlobStore
 from market.database.database import MarketDatabase
 from market.models import DatabaseModel
 from market.models.document import Document
@@ -142,18 +144,18 @@ class ModelTestSuite(unittest.TestCase):
         file_name = 'test.py'
         mime = 'text/x-python'
         file_path = os.path.join(os.path.dirname(sys.modules['market'].__file__), '__init__.py')
-        document = Document.encode_document(file_name, file_path)
+        blob_store = BlobStore(os.path.join(os.getcwd(), 'test_blobs'))
+        document = Document.store_document(file_name, file_path, blob_store)
 
         self.assertTrue(isinstance(document, Document))
         self.assertEqual(document.name, file_name)
         self.assertEqual(document.mime, mime)
+        self.assertEqual(document.size, os.path.getsize(file_path))
+        self.assertFalse(hasattr(document, '_data'))
 
-        this_folder = os.getcwd()
-        document.decode_document(os.path.join(this_folder, file_name))
-        new_file_path = os.path.join(this_folder, file_name)
-
-        self.assertEqual(open(file_path).read(), open(new_file_path).read())
+        with document.open(blob_store) as document_file:
+            self.assertEqual(open(file_path, 'rb').read(), document_file.read())
 
         # Cleanup
-        os.remove(new_file_path)
+        shutil.rmtree(blob_store.directory)
 
@@ -1,5 +1,7 @@
 import time
 import unittest
+
+import mock
 from twisted.python.threadable import registerAsIOThread
 from uuid import UUID
 
@@ -9,6 +11,7 @@ from dispersy.endpoint import ManualEnpoint
 from dispersy.member import DummyMember
 from market.api.api import STATUS, MarketAPI
 from market.community.community import MortgageMarketCommunity
+from market.community.payload import BlockBatchPayload
 from market.database.backends import PersistentBackend
 from market.database.database import MarketDatabase
 from market.models import DatabaseModel
@@ -16,6 +19,12 @@ from market.models.loans import Mortgage
 from market.database.backends import DatabaseBlock
 
 
+class FakeMessage(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.candidate = LoopbackCandidate()
+
+
 class CustomAssertions(object):
     """
     This function checks whether two blocks: block1 and block2, are the same block.
@@ -273,6 +282,70 @@ class BlockchainDatabaseTest(unittest.TestCase, CustomAssertions):
         # Check whether the genesis block and the first block are added correctly
         self.assertEqual(result.previous_hash, genesis_block.hash_block)
 
+    @mock.patch('dispersy.dispersy.Dispersy.store_update_forward')
+    def test_block_range_sync(self, patch):
+        """
+        This test checks that a benefactor whose signature response timed out completes its block with the block of the
+        beneficiary.
+        """
+        meta = self.community.get_meta_message(u"signed_confirm")
+        message_no_ben = meta.impl(authentication=([self.member, self.member_bank],),
+                                   distribution=(self.community.claim_global_time(),),
+                                   payload=self.payload2,
+                                   destination=(LoopbackCandidate(),))
+        message_ben = meta.impl(authentication=([self.member, self.member_bank],),
+                                distribution=(self.community.claim_global_time(),),
+                                payload=self.payload,
+                                destination=(LoopbackCandidate(),))
+
+        # The bank only has its own half, the borrower has the complete block
+        self.community_bank.persist_signature(message_no_ben)
+        self.community.persist_signature(message_ben)
+        self.assertEqual(len(self.bank_db.get_incomplete_blocks(self.bank.id, 10)), 1)
+
+        self.community_bank.send_block_range_request(self.bank.id, 2, 2, LoopbackCandidate())
+        request = patch.call_args[0][0][0]
+        patch.reset_mock()
+
+        self.community.on_block_range_request([FakeMessage(request.payload)])
+        response = patch.call_args[0][0][0]
+        self.assertIsInstance(response.payload, BlockBatchPayload.Implementation)
+        self.assertEqual(len(response.payload.blocks), 1)
+
+        self.community_bank.on_block_range_response([response])
+
+        block_beneficiary = DatabaseBlock.from_signed_confirm_message(message_ben)
+        self.assertEqualBlocks(self.bank_db.get_by_hash(block_beneficiary.hash_block), block_beneficiary)
+        self.assertEqual(self.bank_db.get_incomplete_blocks(self.bank.id, 10), [])
+
+    def test_block_range_response_rejected(self):
+        """
+        This test checks that a block range response only completes a block when it comes from the beneficiary and
+        leaves the half of the benefactor as it is.
+        """
+        meta = self.community.get_meta_message(u"signed_confirm")
+        message_no_ben = meta.impl(authentication=([self.member, self.member_bank],),
+                                   distribution=(self.community.claim_global_time(),),
+                                   payload=self.payload2,
+                                   destination=(LoopbackCandidate(),))
+        self.community_bank.persist_signature(message_no_ben)
+
+        block = DatabaseBlock(self.payload[:2] + (self.mortgage.encode(), self.mortgage.encode()) + self.payload[4:])
+        forged = DatabaseBlock(self.payload[:2] + (self.mortgage.encode(), self.mortgage.encode()) +
+                               self.payload[4:8] + ('forged',) + self.payload[9:])
+        for received in (block, forged):
+            received.previous_hash = ''
+            received.sequence_number = 1
+        response_meta = self.community.get_meta_message(u"block_range_response")
+        for member, row in ((self.member_bank, block.to_row()), (self.member, forged.to_row())):
+            response = response_meta.impl(authentication=(member,),
+                                          distribution=(self.community.claim_global_time(),),
+                                          destination=(LoopbackCandidate(),),
+                                          payload=([row],))
+            self.community_bank.on_block_range_response([response])
+
+        self.assertEqual(len(self.bank_db.get_incomplete_blocks(self.bank.id, 10)), 1)
+
     def tearDown(self):
         self.dispersy._database.close()
         self.dispersy_bank._database.close()
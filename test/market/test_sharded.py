@@ -0,0 +1,135 @@
+from __future__ import absolute_import
+import os
+import shutil
+import unittest
+from uuid import uuid4
+
+from market.database.backends import DatabaseBlock, PersistentBackend
+from market.database.database import MarketDatabase
+from market.database.sharded import ShardedBackend
+from market.api.api import STATUS
+from market.models.house import House
+from market.models.loans import Investment
+from market.models.user import User
+
+SHARD_DIRECTORY = 'test_shards'
+
+
+class ShardedBackendTestSuite(unittest.TestCase):
+    def setUp(self):
+        if os.path.exists(SHARD_DIRECTORY):
+            shutil.rmtree(SHARD_DIRECTORY)
+        self.backend = ShardedBackend(SHARD_DIRECTORY)
+        self.database = MarketDatabase(self.backend)
+
+    def tearDown(self):
+        self.backend.close()
+        shutil.rmtree(SHARD_DIRECTORY)
+
+    def test_routing(self):
+        house = House('2500AA', '34', 'Aa Weg', 1000)
+        user = User('public_key', 0)
+        self.database.post(House.type, house)
+        self.database.post(User.type, user)
+        self.backend.set_option('option', 'value')
+
+        self.assertEqual(sorted(name for name in os.listdir(SHARD_DIRECTORY) if name.endswith('.db')),
+                         ['chain.db', 'type-%s.db' % House.type, 'type-%s.db' % User.type])
+        self.assertEqual(self.database.get(House.type, house.id), house)
+        self.assertEqual(self.database.get_all(User.type), [user])
+        self.assertIsNone(self.database.get(House.type, user.id))
+        self.assertFalse(self.backend.exists(User.type, house.id))
+        self.assertFalse(self.backend.id_available(house.id))
+
+        # The shards are found again when reopened
+        self.backend.close()
+        self.backend = ShardedBackend(SHARD_DIRECTORY)
+        self.database = MarketDatabase(self.backend)
+        self.assertEqual(self.database.get(User.type, user.id), user)
+        self.assertEqual(self.backend.get_option('option'), 'value')
+
+        self.assertTrue(self.database.delete(house))
+        self.assertFalse(self.database.get_all(House.type))
+
+    def test_digests(self):
+        single = PersistentBackend(SHARD_DIRECTORY, u'single.db')
+        try:
+            for i in range(10):
+                for backend in (self.backend, single):
+                    backend.post(House.type if i % 2 else User.type, str(i), 'value %d' % i)
+
+            self.assertEqual(self.backend.get_digest_root(), single.get_digest_root())
+        finally:
+            single.close()
+
+    def test_investments(self):
+        self.assertEqual(self.database.investments_for_investor('investor'), [])
+
+        investment = Investment('investor', 1000, 10, 5.0, uuid4(), STATUS.PENDING)
+        self.database.post(Investment.type, investment)
+
+        # The index is kept next to the investments
+        self.assertTrue(os.path.exists(os.path.join(SHARD_DIRECTORY, 'type-%s.db' % Investment.type)))
+        self.assertEqual(self.database.investments_for_investor('investor', STATUS.PENDING), [investment])
+        self.assertEqual(self.database.investments_for_mortgage(investment.mortgage_id), [investment])
+
+    def test_chain(self):
+        self.backend.check_add_genesis_block()
+        block = DatabaseBlock(('a', 'b', 'agreement', 'agreement', 1, 2, '', '', '', '', 1))
+        self.backend.add_block(block)
+
+        self.assertEqual(self.backend.get_latest_hash(), block.hash_block)
+        self.assertEqual(self.backend.get_by_public_key_and_sequence_number('b', 2).hash_block, block.hash_block)
+        self.assertEqual(self.backend.get_next_sequence_number(), 2)
+
+    def test_transaction(self):
+        house = House('2500AA', '34', 'Aa Weg', 1000)
+        user = User('public_key', 0)
+        self.database.post(House.type, house)
+        self.database.post(User.type, user)
+
+        with self.assertRaises(ValueError):
+            with self.database.transaction():
+                user.campaign_ids.append('campaign')
+                self.database.put(User.type, user.id, user)
+                self.database.delete(house)
+                raise ValueError
+
+        # Both shards are rolled back
+        self.assertEqual(self.database.get(User.type, user.id).campaign_ids, [])
+        self.assertTrue(self.backend.exists(House.type, house.id))
+
+        with self.database.transaction():
+            self.database.put(User.type, user.id, user)
+            self.database.delete(house)
+
+        self.backend.close()
+        self.backend = ShardedBackend(SHARD_DIRECTORY)
+        self.database = MarketDatabase(self.backend)
+        self.assertEqual(self.database.get(User.type, user.id).campaign_ids, ['campaign'])
+        self.assertFalse(self.backend.exists(House.type, house.id))
+
+    def test_transaction_new_shard(self):
+        user = User('public_key', 0)
+        self.database.post(User.type, user)
+
+        with self.assertRaises(ValueError):
+            with self.database.transaction():
+                self.database.post(House.type, House('2500AA', '34', 'Aa Weg', 1000))
+                user.campaign_ids.append('campaign')
+                self.database.put(User.type, user.id, user)
+                raise ValueError
+
+        # The shard created within the transaction is rolled back with the others
+        self.assertFalse(self.database.get_all(House.type))
+        self.assertEqual(self.database.get(User.type, user.id).campaign_ids, [])
+
+        house = House('2500AA', '35', 'Aa Weg', 1000)
+        with self.database.transaction():
+            self.database.post(House.type, house)
+        self.assertEqual(self.database.get_all(House.type), [house])
+        self.assertEqual(self.backend._shards[House.type]._transaction_depth, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
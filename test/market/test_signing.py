@@ -0,0 +1,105 @@
+from __future__ import absolute_import
+import unittest
+
+from market.community.signing import SigningPipeline
+
+
+class FakeAgreement(object):
+    type = 'agreement'
+
+    def __init__(self, id):
+        self.id = id
+
+
+class FakePayload(object):
+    def __init__(self, agreement, sequence_number):
+        self.agreement_benefactor = agreement
+        self.sequence_number_benefactor = sequence_number
+
+
+class FakeMessage(object):
+    def __init__(self, payload):
+        self.payload = payload
+
+
+class FakeAPI(object):
+    def __init__(self):
+        self.user_candidate = {'beneficiary': 'candidate'}
+
+
+class FakeCommunity(object):
+    """
+    Records the signature requests instead of sending them.
+    """
+
+    def __init__(self):
+        self.api = FakeAPI()
+        self.sequence_number = 0
+        self.sent = []
+
+    def create_signed_confirm_request_message(self, candidate, agreement):
+        self.sequence_number += 1
+        return FakeMessage(FakePayload(agreement, self.sequence_number))
+
+    def create_signature_request(self, candidate, message, response_func, timeout):
+        self.sent.append(message)
+
+    def allow_signed_confirm_response(self, request, response, modified):
+        return response is not None and modified
+
+
+class SigningPipelineTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.community = FakeCommunity()
+        self.pipeline = SigningPipeline(self.community, window=2, retries=1)
+
+    def test_unknown_beneficiary(self):
+        self.assertFalse(self.pipeline.push('unknown', FakeAgreement('1')))
+        self.assertEqual(self.community.sent, [])
+
+    def test_window(self):
+        for i in range(5):
+            self.assertTrue(self.pipeline.push('beneficiary', FakeAgreement(str(i))))
+        # A request that is already pending is not queued again
+        self.pipeline.push('beneficiary', FakeAgreement('0'))
+
+        self.assertEqual(len(self.community.sent), 2)
+        self.assertEqual(self.pipeline.in_flight, 2)
+        self.assertEqual(self.pipeline.queued, 3)
+
+        while self.pipeline.in_flight:
+            request = self.community.sent[len(self.community.sent) - self.pipeline.in_flight]
+            self.assertTrue(self.pipeline.on_response(request, request, True))
+            self.assertLessEqual(self.pipeline.in_flight, 2)
+
+        self.assertEqual([message.payload.sequence_number_benefactor for message in self.community.sent],
+                         [1, 2, 3, 4, 5])
+        self.assertEqual(self.pipeline.stats.requested, 5)
+        self.assertEqual(self.pipeline.stats.completed, 5)
+        self.assertGreaterEqual(self.pipeline.stats.max_latency, self.pipeline.stats.average_latency)
+        self.assertIn("5 requested, 5 completed", str(self.pipeline.stats))
+
+    def test_retry(self):
+        agreement = FakeAgreement('1')
+        self.pipeline.push('beneficiary', agreement)
+        request = self.community.sent[0]
+
+        # The first timeout resends the same message, keeping its sequence number
+        self.assertFalse(self.pipeline.on_response(request, None, False))
+        self.assertEqual(self.community.sent, [request, request])
+        self.assertTrue(self.pipeline.is_pending(agreement))
+
+        # The second one gives up
+        self.pipeline.on_response(request, None, False)
+        self.assertFalse(self.pipeline.is_pending(agreement))
+        self.assertEqual(self.pipeline.stats.timeouts, 2)
+        self.assertEqual(self.pipeline.stats.retries, 1)
+        self.assertEqual(self.pipeline.stats.failed, 1)
+
+        # It can be requested again afterwards
+        self.pipeline.push('beneficiary', agreement)
+        self.assertEqual(self.community.sent[-1].payload.sequence_number_benefactor, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,237 @@
+from __future__ import absolute_import
+import os
+import shutil
+import unittest
+
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+
+from market.api.api import MarketAPI, FAN_OUT_LOAN_REQUEST_TASK, SEND_DOCUMENTS_TASK, SIGN_LOAN_REQUEST_TASK
+from market.api.tasks import DONE, FAILED, PENDING, RUNNING, TaskRunner
+from market.database.backends import PersistentBackend
+from market.database.blobstore import BlobStore
+from market.database.database import MarketDatabase
+from market.models.loans import LoanRequest
+from market.models.user import User
+
+
+class TaskRunnerTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(os.getcwd(), 'test_tasks')
+        os.makedirs(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.backend = PersistentBackend(self.directory, u'market.db')
+        self.clock = Clock()
+        self.runner = self._runner()
+        self.calls = []
+        self.failures = 0
+
+    def tearDown(self):
+        self.backend.close()
+
+    def _runner(self):
+        runner = TaskRunner(self.backend, max_attempts=3, retry_delay=10, call_later=self.clock.callLater)
+        runner.register('record', lambda *arguments: self.calls.append(arguments))
+        runner.register('flaky', self._flaky)
+        return runner
+
+    def _flaky(self, name):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("Failure of %s" % name)
+        self.calls.append((name,))
+
+    def test_run(self):
+        self.runner.start()
+        task = self.runner.submit('record', ['a', 1])
+
+        # The task runs in the background, not while submitting it
+        self.assertEqual(self.calls, [])
+        self.clock.advance(0)
+        self.assertEqual(self.calls, [('a', 1)])
+        self.assertEqual((task.status, task.attempts), (DONE, 1))
+        self.assertEqual(self.backend.get_tasks(), [(task.id, 'record', self.backend.get_tasks()[0][2], DONE, 1,
+                                                     None, None)])
+
+    def test_retry(self):
+        self.runner.start()
+        self.failures = 2
+        task = self.runner.submit('flaky', ['b'])
+
+        self.clock.advance(0)
+        self.assertEqual((task.status, task.error), (PENDING, "Failure of b"))
+        # The delay doubles after every attempt
+        self.clock.advance(10)
+        self.assertEqual(task.attempts, 2)
+        self.clock.advance(10)
+        self.assertEqual(self.calls, [])
+        self.clock.advance(10)
+        self.assertEqual(self.calls, [('b',)])
+        self.assertEqual((task.status, task.attempts, task.error), (DONE, 3, None))
+
+    def test_give_up(self):
+        self.runner.start()
+        self.failures = 3
+        task = self.runner.submit('flaky', ['c'])
+        waiting = self.runner.submit('record', ['d'], after=task)
+
+        self.clock.advance(0)
+        self.clock.advance(10)
+        self.clock.advance(20)
+
+        self.assertEqual((task.status, task.attempts), (FAILED, 3))
+        # The task waiting for the failed task fails along with it
+        self.assertEqual(waiting.status, FAILED)
+        self.assertEqual(self.calls, [])
+
+    def test_after(self):
+        self.runner.start()
+        deferred = Deferred()
+        self.runner.register('wait', lambda: deferred)
+        first = self.runner.submit('wait', [])
+        second = self.runner.submit('record', ['e'], after=first)
+
+        self.clock.advance(0)
+        self.assertEqual((first.status, second.status), (RUNNING, PENDING))
+        self.assertEqual(self.calls, [])
+
+        deferred.callback(None)
+        self.clock.advance(0)
+        self.assertEqual(first.status, DONE)
+        self.assertEqual(self.calls, [('e',)])
+
+    def test_resume(self):
+        task = self.runner.submit('record', ['f'])
+        self.assertEqual(self.calls, [])
+
+        # A new runner, after a restart, runs the unfinished task
+        runner = self._runner()
+        runner.start()
+        self.clock.advance(0)
+        self.assertEqual(self.calls, [('f',)])
+        self.assertEqual(runner.get(task.id).status, DONE)
+
+    def test_resume_after_failed(self):
+        self.runner.start()
+        self.failures = 3
+        task = self.runner.submit('flaky', ['g'])
+        self.clock.advance(0)
+        self.clock.advance(10)
+        self.clock.advance(20)
+        self.assertEqual(task.status, FAILED)
+        # Stored before the failure, so it is still pending when the node stops
+        self.runner.stop()
+        waiting = self.runner.submit('record', ['h'], after=task)
+
+        # The new runner doesn't load the failed task, but fails the task waiting for it
+        runner = self._runner()
+        runner.start()
+        self.clock.advance(0)
+        self.assertEqual(self.calls, [])
+        self.assertEqual(runner.get(waiting.id).status, FAILED)
+
+    def test_resume_after_done(self):
+        self.runner.start()
+        task = self.runner.submit('record', ['i'])
+        self.clock.advance(0)
+        self.runner.stop()
+        waiting = self.runner.submit('record', ['j'], after=task)
+
+        runner = self._runner()
+        runner.start()
+        self.clock.advance(0)
+        self.assertEqual(self.calls, [('i',), ('j',)])
+        self.assertEqual(runner.get(waiting.id).status, DONE)
+
+    def test_prune(self):
+        self.runner.start()
+        done = self.runner.submit('record', ['k'])
+        self.clock.advance(0)
+        self.runner.stop()
+        waiting = self.runner.submit('record', ['l'], after=done)
+        other = self.runner.submit('record', ['m'])
+        self.backend.save_task(other.id, other.name, self.backend.get_tasks()[2][2], DONE, 1, None, None)
+
+        # The done task that is waited for is kept until the task waiting for it is done
+        self._runner().start()
+        self.assertEqual([row[0] for row in self.backend.get_tasks()], [done.id, waiting.id])
+        self.clock.advance(0)
+        self._runner().start()
+        self.assertEqual(self.backend.get_tasks(), [])
+
+    def test_listeners(self):
+        statuses = []
+        self.runner.listeners.append(lambda task: statuses.append(task.status))
+        self.runner.start()
+        self.runner.submit('record', [])
+        self.clock.advance(0)
+
+        self.assertEqual(statuses, [PENDING, RUNNING, DONE])
+
+
+class LoanRequestTasksTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.directory = os.path.join(os.getcwd(), 'test_tasks')
+        os.makedirs(self.directory)
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.api = MarketAPI(MarketDatabase(PersistentBackend(self.directory, u'market.db')))
+        self.clock = Clock()
+        self.api.use_task_runner(TaskRunner(self.api.db.backend, call_later=self.clock.callLater))
+        self.api.task_runner.start()
+
+        self.user, _, _ = self.api.create_user()
+        self.user.role_id = 1
+        self.api.create_profile(self.user, {'role': 1, 'first_name': u'Bob', 'last_name': u'Saget',
+                                            'email': 'example@example.com', 'iban': 'NL53 INGBB 04027 30393',
+                                            'phonenumber': '+3170253719234', 'current_postalcode': '2162CD',
+                                            'current_housenumber': '22', 'current_address': 'straat',
+                                            'documents_list': {}})
+        self.bank = User(public_key='bank', time_added=0)
+        self.api.db.post(User.type, self.bank)
+        self.payload = {'mortgage_type': 1, 'banks': [self.bank.id], 'description': u'I want to buy a house',
+                        'amount_wanted': 123456, 'postal_code': '1111AA', 'house_number': '11', 'address': 'straat',
+                        'price': 123456, 'house_link': 'http://www.myhouseee.com/',
+                        'seller_phone_number': '0612345678', 'seller_email': 'seller1@gmail.com'}
+
+    def tearDown(self):
+        self.api.db.backend.close()
+
+    def test_create_loan_request(self):
+        loan_request = self.api.create_loan_request(self.user, self.payload)
+
+        # Only the core models are stored right away
+        self.assertIsInstance(loan_request, LoanRequest)
+        self.assertEqual(self.api.db.backend.get_inbox(self.bank.id), [])
+        self.assertIsNone(self.api.db.get(LoanRequest.type, loan_request.id).signature)
+        self.assertEqual(self.api.outgoing_queue._queue, [])
+        self.assertEqual(sorted(task.name for task in self.api.task_runner.tasks()),
+                         sorted([SEND_DOCUMENTS_TASK, SIGN_LOAN_REQUEST_TASK, FAN_OUT_LOAN_REQUEST_TASK]))
+        self.assertEqual(self.api.document_task.name, SEND_DOCUMENTS_TASK)
+
+        self.clock.advance(0)
+        self.assertTrue(all(task.status == DONE for task in self.api.task_runner.tasks()))
+        self.assertIsNotNone(self.api.db.get(LoanRequest.type, loan_request.id).signature)
+        self.assertEqual([entry[0] for entry in self.api.db.backend.get_inbox(self.bank.id)], [str(loan_request.id)])
+        self.assertEqual(len(self.api.outgoing_queue._queue), 1)
+
+    def test_documents_of_offline_bank_failed(self):
+        self.api.db.blob_store = BlobStore(os.path.join(self.directory, 'blobs'))
+        path = os.path.join(self.directory, 'passport.pdf')
+        with open(path, 'wb') as f:
+            f.write('passport data')
+        self.api.create_profile(self.user, {'role': 1, 'first_name': u'Bob', 'last_name': u'Saget',
+                                            'email': 'example@example.com', 'iban': 'NL53 INGBB 04027 30393',
+                                            'phonenumber': '+3170253719234', 'current_postalcode': '2162CD',
+                                            'current_housenumber': '22', 'current_address': 'straat',
+                                            'documents_list': {'Passport': path}})
+        self.api.create_loan_request(self.user, self.payload)
+
+        # The bank has no candidate, so its documents are not sent and the task is run again later
+        self.clock.advance(0)
+        self.assertEqual(self.api.failed_documents, [(self.bank.id, 'Passport')])
+        self.assertEqual((self.api.document_task.status, self.api.document_task.error),
+                         (PENDING, "1 documents could not be sent"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,20 @@
 from __future__ import absolute_import
 import os
+import shutil
 import logging
 import threading
 import unittest
 import time
+import hashlib
+import json
 import tftpy
 
 import tftp_client
-from tftp_server import Server
-from tftp_client import Client, TransferQueue
-from mock import MagicMock
+from tftp_server import Server, ReceivePipeline, PARTIAL_PREFIX
+from tftp_client import Client, TransferMetrics, TransferQueue, TransferResult
+from tftp_compression import CODECS_KEY, ZLIB
+from tftp_manifest import MANIFEST_NAME, Manifest
+from mock import MagicMock, patch
 
 
 class DocumentTransferTestSuite(unittest.TestCase):
@@ -30,6 +35,11 @@ class DocumentTransferTestSuite(unittest.TestCase):
         self.queue = TransferQueue()
         self.document_path_client = os.path.normpath(os.getcwd()+'/../../resources/documents/')
         self.document_path_host = os.path.normpath('/../../resources/')
+        # Some tests replace the methods of Client, put them back afterwards
+        for name in ('upload', 'upload_folder'):
+            patcher = patch.object(Client, name, Client.__dict__[name])
+            patcher.start()
+            self.addCleanup(patcher.stop)
 
     def throw(self, exception):
         raise exception()
@@ -85,6 +95,60 @@ class DocumentTransferTestSuite(unittest.TestCase):
         mock.assert_called_once_with(os.path.normpath(os.getcwd()+'/resources/received/file1.pdf'),
                                      '/received/file1.pdf')
 
+    def test_client_blksize(self):
+        self.assertEqual(self.client.options, {})
+        self.assertEqual(Client('127.0.0.1', 69, 1428).client.options, {'blksize': 1428})
+
+    def test_client_blksize_loopback(self):
+        local_file = os.path.join(os.getcwd(), 'blksize_local.pdf')
+        remote_file = os.path.join(os.getcwd(), 'blksize_remote.pdf')
+        with open(local_file, 'wb') as f:
+            f.write(os.urandom(20000))
+
+        client = Client('127.0.0.1', tftp_client.DEFAULT_PORT, 8192)
+        client.upload(local_file, 'blksize_remote.pdf')
+
+        self.assertEqual(int(client.client.context.options['blksize']), 8192)
+        # The server moves the file into place after acknowledging the last block
+        deadline = time.time() + 2
+        while not os.path.exists(remote_file) and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(open(local_file, 'rb').read(), open(remote_file, 'rb').read())
+        os.remove(local_file)
+        os.remove(remote_file)
+
+    def test_client_blksize_fallback(self):
+        refusing, accepting = MagicMock(), MagicMock()
+        refusing.upload.side_effect = tftpy.TftpException("Failed to negotiate options")
+        with patch('tftp_client.TftpClient', side_effect=[refusing, accepting]) as tftp_client_class:
+            client = Client('127.0.0.1', 69, 1428)
+            client.upload('file1.pdf', 'file2.pdf')
+
+        self.assertIsNone(client.blksize)
+        tftp_client_class.assert_called_with('127.0.0.1', 69, {})
+        accepting.upload.assert_called_once_with('file2.pdf', 'file1.pdf')
+
+        # Other errors are not retried
+        refusing.upload.side_effect = tftpy.TftpException("Timed out waiting for traffic")
+        with patch('tftp_client.TftpClient', side_effect=[refusing, accepting]):
+            client = Client('127.0.0.1', 69, 1428)
+            with self.assertRaises(tftpy.TftpException):
+                client.upload('file1.pdf', 'file2.pdf')
+
+    def test_queue_blksize(self):
+        queue = TransferQueue(blksize=1428)
+        queue.add('127.0.0.1', 69, 'file.pdf', 'file.pdf', blksize=8192)
+
+        self.assertEqual(queue.jobs, [('127.0.0.1', 69, 'file.pdf', 'file.pdf')])
+        self.assertEqual(queue.create_client('127.0.0.1', 69).blksize, 8192)
+        self.assertEqual(queue.create_client('127.0.0.2', 69).blksize, 1428)
+
+        # A host that refused the options isn't asked again
+        client = queue.create_client('127.0.0.2', 69)
+        client.blksize = None
+        queue.client_done(client)
+        self.assertIsNone(queue.create_client('127.0.0.2', 69).blksize)
+
     def test_enable_logging(self):
         tftpy.log.addHandler = MagicMock()
         logging.FileHandler = MagicMock()
@@ -94,12 +158,69 @@ class DocumentTransferTestSuite(unittest.TestCase):
         self.assertEqual(tftpy.log.level, 20)
         tftpy.setLogLevel(0)
 
+    def test_queue_codecs(self):
+        queue = TransferQueue()
+        self.assertEqual(queue.create_client('127.0.0.1', 69).codecs, [])
+
+        client = queue.create_client('127.0.0.1', 69)
+        client.codecs = [ZLIB]
+        client.metrics.add(1000, 400, 0.5, True)
+        queue.client_done(client)
+        self.assertEqual(queue.create_client('127.0.0.1', 69).codecs, [ZLIB])
+        self.assertEqual(queue.metrics[('127.0.0.1', 69)].ratio, 0.4)
+        self.assertEqual(queue.metrics[('127.0.0.1', 69)].rate, 2000)
+
+        # Compression can be turned off
+        queue.compress = False
+        self.assertEqual(queue.create_client('127.0.0.1', 69).codecs, [])
+
     def test_queue_construction(self):
         self.assertEqual(self.queue.jobs, [])
         self.assertEqual(self.queue.failed, [])
         self.assertEqual(self.queue.sent, [])
         self.assertTrue(isinstance(self.queue, TransferQueue))
 
+    def test_manifest_resume(self):
+        local_folder = os.path.join(os.getcwd(), 'manifest_local')
+        remote_folder = os.path.join(os.getcwd(), 'manifest_remote')
+        os.makedirs(local_folder)
+        for name in ('a.pdf', 'b.pdf', 'c.pdf'):
+            with open(os.path.join(local_folder, name), 'wb') as f:
+                f.write(os.urandom(3000))
+
+        def upload():
+            results = []
+            queue = TransferQueue(call_in_reactor=lambda f, *args: f(*args))
+            queue.add('127.0.0.1', tftp_client.DEFAULT_PORT, Manifest.from_folder(local_folder), 'manifest_remote/')
+            queue.upload_all_concurrent().addCallback(results.extend)
+            self.wait_for(results, 1)
+            # The server closes the files after acknowledging the last block
+            time.sleep(0.2)
+            return sorted(os.path.basename(local) for local, _ in results[0].sent), \
+                sorted(os.path.basename(local) for local, _ in results[0].skipped)
+
+        try:
+            self.assertEqual(upload(), (['a.pdf', 'b.pdf', 'c.pdf'], []))
+            self.assertTrue(os.path.isfile(os.path.join(remote_folder, 'manifest.json')))
+            self.assertEqual(upload(), ([], ['a.pdf', 'b.pdf', 'c.pdf']))
+
+            # A file cut short by a crash, and a changed file, are sent again
+            with open(os.path.join(remote_folder, 'b.pdf'), 'r+b') as f:
+                f.truncate(1000)
+            with open(os.path.join(local_folder, 'c.pdf'), 'wb') as f:
+                f.write(os.urandom(3000))
+            self.assertEqual(upload(), (['b.pdf', 'c.pdf'], ['a.pdf']))
+            for name in ('a.pdf', 'b.pdf', 'c.pdf'):
+                self.assertEqual(open(os.path.join(local_folder, name), 'rb').read(),
+                                 open(os.path.join(remote_folder, name), 'rb').read())
+        finally:
+            shutil.rmtree(local_folder)
+            shutil.rmtree(remote_folder, ignore_errors=True)
+
+    def test_server_have_outside_root(self):
+        self.assertEqual(self.server.dynamic_file('../../have.json').read(), '{}')
+        self.assertIsNone(self.server.dynamic_file('missing.pdf'))
+
     def test_queue_add(self):
         self.assertEqual(self.queue.jobs, [])
         self.queue.add('127.0.0.1', 69, tftp_client.DEFAULT_CLIENT_PATH, tftp_client.DEFAULT_HOST_PATH)
@@ -144,3 +265,263 @@ class DocumentTransferTestSuite(unittest.TestCase):
         self.assertFalse(self.queue.upload_list(self.queue.jobs))
         self.assertEqual(self.queue.failed, [('127.0.0.1', 99, self.document_path_client, self.document_path_host)])
         self.assertEqual(self.queue.sent, [])
+
+    def wait_for(self, results, amount, timeout=5.0):
+        deadline = time.time() + timeout
+        while len(results) < amount and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(results), amount)
+
+    def test_upload_concurrent_limits(self):
+        lock = threading.Lock()
+        active = {'total': 0, 'max_total': 0}
+        active_per_host = {}
+        max_per_host = {}
+
+        def upload(client, local_file, remote_file):
+            host = client.host
+            with lock:
+                active['total'] += 1
+                active['max_total'] = max(active['max_total'], active['total'])
+                active_per_host[host] = active_per_host.get(host, 0) + 1
+                max_per_host[host] = max(max_per_host.get(host, 0), active_per_host[host])
+            time.sleep(0.02)
+            with lock:
+                active['total'] -= 1
+                active_per_host[host] -= 1
+
+        def init(client, host_ip, port, blksize=None, codecs=None):
+            client.host = (host_ip, port)
+            client.host_ip, client.port, client.blksize = host_ip, port, blksize
+            client.codecs, client.metrics = [], TransferMetrics()
+
+        queue = TransferQueue(max_transfers=4, max_transfers_per_host=2, call_in_reactor=lambda f, *args: f(*args))
+        for bank in range(3):
+            for document in range(4):
+                queue.add('127.0.0.%d' % bank, 50000, 'file%d.pdf' % document, 'remote%d.pdf' % document)
+
+        results = []
+        with patch.object(Client, '__init__', init), patch.object(Client, 'upload', upload):
+            for deferred in queue.upload_list_concurrent(queue.jobs):
+                deferred.addCallback(results.append)
+            self.wait_for(results, 12)
+
+        self.assertTrue(all(isinstance(result, TransferResult) and result.success for result in results))
+        self.assertEqual(len(queue.sent), 12)
+        self.assertEqual(queue.failed, [])
+        self.assertLessEqual(active['max_total'], 4)
+        self.assertTrue(all(maximum <= 2 for maximum in max_per_host.values()))
+
+    def test_upload_concurrent_failure(self):
+        def upload(client, local_file, remote_file):
+            if local_file.endswith('bad.pdf'):
+                raise tftpy.TftpException("Timed out")
+
+        queue = TransferQueue(call_in_reactor=lambda f, *args: f(*args))
+        queue.file_search = lambda x: ['/documents/good.pdf', '/documents/bad.pdf']
+        queue.add('127.0.0.1', 50000, os.getcwd(), 'loan/')
+
+        results = []
+        with patch.object(Client, 'upload', upload):
+            queue.upload_list_concurrent(queue.jobs)[0].addCallback(results.append)
+            self.wait_for(results, 1)
+
+        result = results[0]
+        self.assertFalse(result.success)
+        self.assertEqual(result.sent, [('/documents/good.pdf', 'loan/good.pdf')])
+        self.assertEqual([failed[:2] for failed in result.failed], [('/documents/bad.pdf', 'loan/bad.pdf')])
+        # Only the failed file is retried
+        self.assertEqual(queue.failed, [('127.0.0.1', 50000, '/documents/bad.pdf', 'loan/bad.pdf')])
+        self.assertEqual(queue.sent, [])
+
+    def test_upload_concurrent_unexpected_error(self):
+        def upload(client, local_file, remote_file):
+            raise KeyError(local_file)
+
+        queue = TransferQueue(max_transfers=1, call_in_reactor=lambda f, *args: f(*args))
+        queue.add('127.0.0.1', 50000, 'first.pdf', 'first.pdf')
+        queue.add('127.0.0.1', 50000, 'second.pdf', 'second.pdf')
+
+        results = []
+        with patch.object(Client, 'upload', upload):
+            for deferred in queue.upload_list_concurrent(queue.jobs):
+                deferred.addCallback(results.append)
+            self.wait_for(results, 2)
+
+        # The error fails the file, and the transfer slot is freed for the next one
+        self.assertEqual([[failed[:2] for failed in result.failed] for result in results],
+                         [[('first.pdf', 'first.pdf')], [('second.pdf', 'second.pdf')]])
+        self.assertEqual(queue._active, 0)
+
+    def test_upload_all_concurrent_empty(self):
+        results = []
+        self.queue.upload_all_concurrent().addCallback(results.append)
+        self.assertEqual(results, [[]])
+
+
+class ReceivePipelineTestSuite(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.root = os.path.join(os.getcwd(), 'receive_root')
+        os.makedirs(cls.root)
+        cls.server = Server(cls.root, tftp_client.DEFAULT_PORT + 1, folder_quota=10000)
+        cls.server.start()
+        time.sleep(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+        shutil.rmtree(cls.root)
+
+    def setUp(self):
+        self.received = []
+        self.server.subscribe(self.received.append)
+        self.local_file = os.path.join(os.getcwd(), 'receive_local.pdf')
+        self.data = os.urandom(6000)
+        with open(self.local_file, 'wb') as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        self.server.unsubscribe(self.received.append)
+        os.remove(self.local_file)
+
+    def upload(self, remote_file):
+        tftpy.TftpClient('127.0.0.1', tftp_client.DEFAULT_PORT + 1).upload(remote_file, self.local_file)
+
+    def wait_for_event(self, amount=1, timeout=2.0):
+        # The server moves the file into place after acknowledging the last block
+        deadline = time.time() + timeout
+        while len(self.received) < amount and time.time() < deadline:
+            time.sleep(0.01)
+
+    def partial_files(self):
+        return [name for _, _, names in os.walk(self.root) for name in names if name.startswith(PARTIAL_PREFIX)]
+
+    def test_receive(self):
+        self.upload('1/passport.pdf')
+        self.wait_for_event()
+
+        self.assertEqual(len(self.received), 1)
+        received = self.received[0]
+        self.assertEqual((received.folder, received.name, received.size), ('1', 'passport.pdf', 6000))
+        self.assertEqual(received.sha256, hashlib.sha256(self.data).hexdigest())
+        self.assertEqual(received.sender, '127.0.0.1')
+        self.assertEqual(open(received.path, 'rb').read(), self.data)
+        self.assertEqual(self.partial_files(), [])
+        # The hash computed while receiving is used for the have.json
+        self.assertEqual(self.server.folder_hashes(os.path.join(self.root, '1')),
+                         {'passport.pdf': received.sha256})
+
+    def test_folder_quota(self):
+        self.upload('2/first.pdf')
+        with self.assertRaises(tftpy.TftpException):
+            self.upload('2/second.pdf')
+        self.wait_for_event()
+        deadline = time.time() + 2.0
+        while self.server.pipeline.receiving and time.time() < deadline:
+            time.sleep(0.01)
+
+        # The refused upload leaves nothing behind and doesn't count, another folder has its own quota
+        self.assertFalse(os.path.exists(os.path.join(self.root, '2', 'second.pdf')))
+        self.assertEqual(self.partial_files(), [])
+        self.assertEqual(self.server.pipeline.folder_usage['2'], 6000)
+        self.upload('3/second.pdf')
+        self.wait_for_event(2)
+        self.assertEqual([received.name for received in self.received], ['first.pdf', 'second.pdf'])
+
+        # Replacing a file only counts the new version once it is in place
+        with open(self.local_file, 'wb') as f:
+            f.write(os.urandom(3000))
+        self.upload('6/small.pdf')
+        self.upload('6/small.pdf')
+        self.wait_for_event(4)
+        self.assertEqual(self.server.pipeline.folder_usage['6'], 3000)
+
+    def test_receive_compressed(self):
+        data = 'Loan request document, page 1. ' * 300
+        with open(self.local_file, 'wb') as f:
+            f.write(data)
+        manifest = Manifest()
+        manifest.add('compressed.pdf', self.local_file)
+
+        client = Client('127.0.0.1', tftp_client.DEFAULT_PORT + 1)
+        missing = client.upload_manifest(manifest, '7/')
+        self.assertEqual(client.codecs, [ZLIB])
+        for local_file, remote_file in missing:
+            client.upload(local_file, remote_file)
+        self.wait_for_event(2)
+
+        # The file is stored as it was, and the server knows its hash
+        received = self.received[1]
+        self.assertEqual((received.name, received.size), ('compressed.pdf', len(data)))
+        self.assertEqual(open(received.path, 'rb').read(), data)
+        self.assertFalse(os.path.exists(os.path.join(self.root, '7', 'compressed.pdf.zlib')))
+        self.assertEqual(client.metrics.compressed_files, 1)
+        self.assertEqual(client.metrics.raw_bytes, len(data))
+        self.assertLess(client.metrics.ratio, 0.1)
+        self.assertEqual(client.upload_manifest(manifest, '7/'), [])
+
+    def test_manifest_hash_mismatch(self):
+        manifest = Manifest()
+        manifest.add('mismatch.pdf', self.local_file, sha256=hashlib.sha256('other data').hexdigest())
+        client = Client('127.0.0.1', tftp_client.DEFAULT_PORT + 1)
+        client.upload_manifest(manifest, '11/')
+        self.wait_for_event()
+        self.upload('11/mismatch.pdf')
+        deadline = time.time() + 2.0
+        while self.server.pipeline.receiving and time.time() < deadline:
+            time.sleep(0.01)
+
+        # The upload differs from what the manifest promised, so it is dropped and doesn't count
+        self.assertEqual([received.name for received in self.received], [MANIFEST_NAME])
+        self.assertFalse(os.path.exists(os.path.join(self.root, '11', 'mismatch.pdf')))
+        self.assertEqual(self.partial_files(), [])
+        self.assertEqual(self.server.pipeline.folder_usage['11'], len(manifest.encode()))
+
+    def test_receive_incompressible(self):
+        client = Client('127.0.0.1', tftp_client.DEFAULT_PORT + 1, codecs=[ZLIB])
+        client.upload(self.local_file, '8/random.pdf')
+        self.wait_for_event()
+
+        self.assertEqual(self.received[0].name, 'random.pdf')
+        self.assertEqual(client.metrics.compressed_files, 0)
+        self.assertEqual(client.metrics.ratio, 1.0)
+
+    def test_corrupt_compressed_file_refused(self):
+        with open(self.local_file, 'wb') as f:
+            f.write('corrupt data ' * 500)
+        with self.assertRaises(tftpy.TftpException):
+            self.upload('9/corrupt.pdf.zlib')
+        self.assertFalse(os.path.exists(os.path.join(self.root, '9', 'corrupt.pdf')))
+
+    def test_have_codecs(self):
+        have = self.server.dynamic_file('10/have.json')
+        self.assertEqual(json.loads(have.read())[CODECS_KEY], [ZLIB])
+
+    def test_hidden_file_refused(self):
+        with self.assertRaises(tftpy.TftpException):
+            self.upload('4/' + PARTIAL_PREFIX + 'x')
+
+    def test_pipeline_limits(self):
+        pipeline = ReceivePipeline(self.root, max_sessions=1, sender_quota=100, folder_quota=1000)
+        receiving = pipeline.open('context', os.path.join(self.root, 'pipeline.pdf'), 'sender')
+        try:
+            self.assertTrue(pipeline.busy)
+            self.assertEqual(receiving.folder, '')
+            self.assertTrue(pipeline.reserve(receiving, 60))
+            self.assertFalse(pipeline.reserve(receiving, 60))
+        finally:
+            pipeline.finish('context', False)
+
+        self.assertFalse(pipeline.busy)
+        self.assertEqual(pipeline.sender_usage['sender'], 0)
+        self.assertEqual(self.partial_files(), [])
+
+    def test_remove_partial_files(self):
+        os.makedirs(os.path.join(self.root, '5'))
+        with open(os.path.join(self.root, '5', PARTIAL_PREFIX + 'abc'), 'wb') as f:
+            f.write('partial')
+
+        ReceivePipeline(self.root).remove_partial_files()
+        self.assertEqual(self.partial_files(), [])
@@ -0,0 +1,87 @@
+from __future__ import absolute_import
+import json
+import os
+import unittest
+
+from market.database.backends import PersistentBackend, DatabaseBlock
+from market.database.verifier import ChainVerifier
+
+CHECKPOINT_PATH = 'verifier_checkpoint.json'
+
+
+class ChainVerifierTestSuite(unittest.TestCase):
+    def setUp(self):
+        self.backend = PersistentBackend('.', u'verifier.db')
+        self.backend.clear()
+        self.backend.check_add_genesis_block()
+        self.add_blocks(1, 20)
+
+    def tearDown(self):
+        self.backend.close()
+        if os.path.exists(CHECKPOINT_PATH):
+            os.remove(CHECKPOINT_PATH)
+
+    def add_blocks(self, start, end):
+        for i in range(start, end):
+            self.backend.add_block(DatabaseBlock(('benefactor', 'beneficiary', '', '', i, i, '', '', 'signature', '',
+                                                  i)))
+
+    def test_valid_chain(self):
+        report = ChainVerifier(self.backend, processes=2).run()
+        self.assertTrue(report.valid)
+        self.assertEqual(report.blocks_verified, 20)
+
+    def test_tampered_block(self):
+        self.backend.execute(u"UPDATE block_chain SET signature_benefactor = ? WHERE sequence_number = 5",
+                             (buffer('forged'),))
+        self.backend.execute(u"UPDATE block_chain SET previous_hash = ? WHERE sequence_number = 10",
+                             (buffer('unknown'),))
+
+        report = ChainVerifier(self.backend, processes=2).run()
+        self.assertFalse(report.valid)
+        # The link hash covers the link itself, so the block after the forged link is reported as well
+        self.assertEqual([problem for _, problem in report.errors],
+                         ["hash mismatch"] + ["previous hash does not match the preceding block"] * 2)
+
+    def test_checkpoint(self):
+        report = ChainVerifier(self.backend, CHECKPOINT_PATH, processes=2).run()
+        self.assertEqual(report.blocks_verified, 20)
+
+        self.add_blocks(20, 25)
+        report = ChainVerifier(self.backend, CHECKPOINT_PATH, processes=2).run()
+        self.assertTrue(report.valid)
+        self.assertEqual(report.blocks_verified, 5)
+
+    def test_checkpoint_of_full_hashes_ignored(self):
+        # A checkpoint written before the blocks were linked by their link hashes
+        with open(CHECKPOINT_PATH, 'w') as checkpoint_file:
+            json.dump({'position': 20, 'hash': self.backend.get_latest_hash(), 'sequence_number': 19}, checkpoint_file)
+        self.add_blocks(20, 25)
+
+        report = ChainVerifier(self.backend, CHECKPOINT_PATH, processes=2).run()
+        self.assertTrue(report.valid)
+        self.assertEqual(report.blocks_verified, 25)
+
+    def test_checkpoint_before_error(self):
+        self.backend.execute(u"UPDATE block_chain SET signature_benefactor = ? WHERE sequence_number = 5",
+                             (buffer('forged'),))
+
+        self.assertFalse(ChainVerifier(self.backend, CHECKPOINT_PATH, processes=2).run().valid)
+        # The checkpoint stays before the block with the error, so it is reported again
+        report = ChainVerifier(self.backend, CHECKPOINT_PATH, processes=2).run()
+        self.assertEqual(report.errors, [(6, "hash mismatch")])
+        self.assertEqual(report.blocks_verified, 15)
+
+    def test_completed_block(self):
+        # A block completed by its beneficiary after the next block was added keeps its link
+        block = self.backend.get_by_public_key_and_sequence_number('benefactor', 3)
+        block.signature_beneficiary = 'signature'
+        block._hash_block = block.compute_hash()
+        self.backend.update_block_with_beneficiary(block)
+
+        report = ChainVerifier(self.backend, processes=2).run()
+        self.assertTrue(report.valid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,95 @@
 import socket
 import os
 import glob
+import json
 import ntpath
 import tftpy
+from StringIO import StringIO
+from collections import defaultdict, deque
 from tftpy import TftpClient
-from threading import Thread
+from threading import Thread, Lock
+from twisted.internet.defer import Deferred, gatherResults
 import time
 import logging
 
+from tftp_compression import CODECS_KEY, CompressingReader, choose_codec, compressed_name
+from tftp_manifest import HAVE_NAME, MANIFEST_NAME, Manifest
+
 DEFAULT_CLIENT_PATH = os.getcwd()+'/resources/documents/'
 DEFAULT_HOST_PATH = ''
 DEFAULT_PORT = 50000
+# Maximum amount of files uploaded at the same time by a TransferQueue, in total and to a single host.
+MAX_TRANSFERS = 8
+MAX_TRANSFERS_PER_HOST = 2
+# Block size requested from the server (RFC 2348). A block of 1428 bytes, plus the TFTP, UDP and IP headers, fits in a
+# 1500 byte Ethernet frame with room to spare for tunnel headers, so blocks aren't fragmented. None uses 512 byte blocks
+# without negotiating.
+DEFAULT_BLKSIZE = 1428
+
+logger = logging.getLogger(__name__)
+
+
+class ReceiveBuffer(object):
+    """
+        A file-like object collecting a download in memory, which keeps its data when tftpy closes it.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def close(self):
+        self.closed = True
+
+    def getvalue(self):
+        return ''.join(self.chunks)
+
+
+class TransferMetrics(object):
+    """
+        The bytes and time of the files uploaded to a single host.
+    """
+    def __init__(self):
+        self.files = 0
+        self.compressed_files = 0
+        # Size of the files, and the bytes actually sent
+        self.raw_bytes = 0
+        self.sent_bytes = 0
+        self.seconds = 0.0
+
+    def add(self, raw_bytes, sent_bytes, seconds, compressed):
+        self.files += 1
+        self.compressed_files += 1 if compressed else 0
+        self.raw_bytes += raw_bytes
+        self.sent_bytes += sent_bytes
+        self.seconds += seconds
+
+    def merge(self, other):
+        self.files += other.files
+        self.compressed_files += other.compressed_files
+        self.raw_bytes += other.raw_bytes
+        self.sent_bytes += other.sent_bytes
+        self.seconds += other.seconds
+
+    @property
+    def ratio(self):
+        """
+            The bytes sent as a fraction of the size of the files.
+        """
+        return float(self.sent_bytes) / self.raw_bytes if self.raw_bytes else 1.0
+
+    @property
+    def rate(self):
+        """
+            The size of the files uploaded per second.
+        """
+        return self.raw_bytes / self.seconds if self.seconds else 0.0
+
+    def __str__(self):
+        return "%d files (%d compressed), %d of %d bytes sent (ratio %.2f) in %.2f seconds" % \
+               (self.files, self.compressed_files, self.sent_bytes, self.raw_bytes, self.ratio, self.seconds)
 
 
 class Client:
@@ -19,10 +98,25 @@ class Client:
         Makes it possible to download from or upload to a TFTP server.
         Only accepts .pdf files.
     """
-    def __init__(self, host_ip=socket.gethostbyname(socket.gethostname()), port=DEFAULT_PORT):
-        self.client = TftpClient(host_ip, port)
+    def __init__(self, host_ip=socket.gethostbyname(socket.gethostname()), port=DEFAULT_PORT, blksize=None,
+                 codecs=None):
+        """
+            :param blksize: Block size to negotiate with the server, None to use the default of 512 bytes.
+            :param codecs: The codecs the server accepts, to compress the uploads with when worthwhile. Updated by
+            upload_manifest.
+        """
+        self.host_ip = host_ip
+        self.port = port
+        self.blksize = blksize
+        self.codecs = list(codecs or [])
+        self.client = TftpClient(host_ip, port, self.options)
         self.files = []
         self.file_search = glob.glob
+        self.metrics = TransferMetrics()
+
+    @property
+    def options(self):
+        return {'blksize': self.blksize} if self.blksize else {}
 
     def upload(self, local_file_name, remote_file_name=None):
         """
@@ -32,7 +126,65 @@ class Client:
         """
         if not remote_file_name:
             remote_file_name = DEFAULT_HOST_PATH + ntpath.basename(local_file_name)
-        self.client.upload(remote_file_name, local_file_name)
+        if hasattr(local_file_name, 'read'):
+            self._upload(local_file_name, remote_file_name)
+            return
+
+        start = time.time()
+        codec = choose_codec(local_file_name, self.codecs) if self.codecs else None
+        if codec:
+            reader = CompressingReader(local_file_name)
+            self._upload(reader, compressed_name(remote_file_name, codec))
+            raw_bytes, sent_bytes = reader.raw_bytes, reader.compressed_bytes
+        else:
+            self._upload(local_file_name, remote_file_name)
+            raw_bytes = sent_bytes = os.path.getsize(local_file_name) if os.path.isfile(local_file_name) else 0
+        self.metrics.add(raw_bytes, sent_bytes, time.time() - start, codec is not None)
+
+    def _upload(self, local_file, remote_file_name):
+        try:
+            self.client.upload(remote_file_name, local_file)
+        except tftpy.TftpException as e:
+            if not self.blksize or not self.is_negotiation_failure(e):
+                raise
+            # The server refused the options, fall back to the defaults for this and later uploads
+            tftpy.log.warning("Server %s:%d refused blksize %d, falling back to the default",
+                              self.host_ip, self.port, self.blksize)
+            self.blksize = None
+            self.client = TftpClient(self.host_ip, self.port, self.options)
+            if hasattr(local_file, 'seek'):
+                local_file.seek(0)
+            self.client.upload(remote_file_name, local_file)
+
+    @staticmethod
+    def is_negotiation_failure(exception):
+        """
+            Checks if an exception of tftpy is caused by a failed option negotiation, raised either by tftpy itself
+            or by an error packet of the server.
+        """
+        return 'negotiate' in str(exception)
+
+    def upload_manifest(self, manifest, host_path=None):
+        """
+            Uploads the manifest to a folder on the server and asks the server which of its files it already has, and
+            which codecs it accepts.
+            :param manifest: The Manifest of the files.
+            :param host_path: Path of the folder on the server where files will be written to.
+            :return: List of (local file, remote file) tuples of the files the server doesn't have.
+        """
+        host_path = host_path or DEFAULT_HOST_PATH
+        self.upload(StringIO(manifest.encode()), host_path + MANIFEST_NAME)
+
+        have = ReceiveBuffer()
+        try:
+            self.client.download(host_path + HAVE_NAME, have)
+            present = json.loads(have.getvalue())
+        except (tftpy.TftpException, ValueError):
+            # A server without manifests, send everything
+            present = {}
+        self.codecs = list(present.get(CODECS_KEY, []))
+
+        return [(manifest.paths[entry.name], host_path + entry.name) for entry in manifest.missing(present)]
 
     def upload_folder(self, path=DEFAULT_CLIENT_PATH, host_path=None):
         """
@@ -58,26 +210,94 @@ class Client:
         tftpy.log.addHandler(fh)
 
 
+class TransferResult(object):
+    """
+        The outcome of a single job of a TransferQueue.
+        Holds the (local file, remote file) tuples that have been sent and the (local file, remote file, error) tuples
+        that failed.
+    """
+    def __init__(self, job):
+        self.job = job
+        self.sent = []
+        self.failed = []
+        # The (local file, remote file) tuples of a manifest the server already had
+        self.skipped = []
+
+    @property
+    def success(self):
+        return not self.failed
+
+
 class TransferQueue:
     """
         Creates a TransferQueue object used for sending files.
         Remembers the files that that have and have not been sent.
     """
-    def __init__(self):
+    def __init__(self, max_transfers=MAX_TRANSFERS, max_transfers_per_host=MAX_TRANSFERS_PER_HOST,
+                 call_in_reactor=None, blksize=DEFAULT_BLKSIZE, compress=True):
+        """
+            :param max_transfers: Maximum amount of files uploaded at the same time in concurrent mode.
+            :param max_transfers_per_host: Maximum amount of files uploaded to a single host at the same time.
+            :param call_in_reactor: Callable used to fire the Deferreds of the concurrent mode on the reactor thread,
+            defaults to reactor.callFromThread.
+            :param blksize: Block size negotiated with the hosts, unless set for a host in add.
+            :param compress: Whether to compress the files of a manifest, for the hosts that accept it.
+        """
         self.jobs = []
+        self.blksize = blksize
+        # (IP address, port) -> block size, for the hosts with a block size of their own or that refused the options
+        self.host_blksize = {}
+        self.compress = compress
+        # (IP address, port) -> codecs the host accepts, as learned from a manifest upload
+        self.host_codecs = {}
+        # (IP address, port) -> TransferMetrics of the files uploaded to the host
+        self.metrics = defaultdict(TransferMetrics)
         self.failed = []
         self.sent = []
+        self.max_transfers = max_transfers
+        self.max_transfers_per_host = max_transfers_per_host
+        self.call_in_reactor = call_in_reactor
+        self.file_search = glob.glob
 
-    def add(self, ip_address, host_port, local_files, remote_files):
+        self._lock = Lock()
+        self._transfers = deque()
+        self._active = 0
+        self._active_per_host = defaultdict(int)
+
+    def add(self, ip_address, host_port, local_files, remote_files, blksize=None):
         """
             Adds a job to the list of files that need to be sent.
            :param ip_address: IP address of the TFTP server.
            :param host_port: Port of on which the server is being hosted.
-           :param local_files: File path of the document(s) that need to be sent.
+           :param local_files: File path of the document(s) that need to be sent, or a Manifest of them, in which case
+           only the files the server doesn't have yet are sent.
            :param remote_files: Path which the files will be written to on the server.
+           :param blksize: Block size to negotiate with this server, None for the block size of the queue.
         """
+        if blksize is not None:
+            self.host_blksize[(ip_address, host_port)] = blksize
         self.jobs.append((ip_address, host_port, local_files, remote_files))
 
+    def create_client(self, ip_address, host_port):
+        """
+            Creates a Client for a host, using the block size and codecs of the host.
+        """
+        host = (ip_address, host_port)
+        return Client(ip_address, host_port, self.host_blksize.get(host, self.blksize),
+                      self.host_codecs.get(host) if self.compress else None)
+
+    def client_done(self, client):
+        """
+            Remembers the block size a host fell back to, so later uploads don't negotiate again, and the codecs it
+            accepts, and adds the metrics of the client to those of the host.
+        """
+        host = (client.host_ip, client.port)
+        if not client.blksize:
+            self.host_blksize[host] = None
+        if client.codecs:
+            self.host_codecs[host] = client.codecs
+        self.metrics[host].merge(client.metrics)
+
     def upload_all(self):
         """
             Uploads all files that have been previously added.
@@ -101,18 +321,151 @@ class TransferQueue:
         for job in jobs:
             ip_address, host_port, local_files, remote_files = job
             try:
-                client = Client(ip_address, host_port)
-                if os.path.isdir(local_files):
+                client = self.create_client(ip_address, host_port)
+                if isinstance(local_files, Manifest):
+                    for local_file, remote_file in client.upload_manifest(local_files, remote_files):
+                        client.upload(local_file, remote_file)
+                elif os.path.isdir(local_files):
                     client.upload_folder(local_files, remote_files)
                     self.sent.append(job)
                 else:
                     client.upload(local_files, remote_files)
+                self.client_done(client)
                 self.sent.append(job)
             except tftpy.TftpException as e:
                 self.failed.append(job)
-                print e.message
+                logger.warning("Upload to %s:%d failed: %s", ip_address, host_port, e)
         if self.failed:
             return False
         else:
             return True
 
+    def upload_all_concurrent(self):
+        """
+            Uploads all files that have been previously added, concurrently.
+            :return: Deferred firing with the TransferResult of every job once all jobs have finished.
+        """
+        return gatherResults(self.upload_list_concurrent(self.jobs)).addCallback(self.log_metrics)
+
+    def log_metrics(self, results=None):
+        """
+            Logs the metrics of every host.
+        """
+        for (ip_address, host_port), metrics in sorted(self.metrics.items()):
+            logger.info("Uploaded to %s:%d: %s", ip_address, host_port, metrics)
+        return results
+
+    def upload_list_concurrent(self, jobs):
+        """
+            Upload the files of all jobs on separate threads, at most max_transfers at the same time and at most
+            max_transfers_per_host to a single host. Failed files are added to `failed` as jobs of their own, so
+            retry_failed only sends them again.
+            :param jobs: Tuples of files and their destination
+            :return: A Deferred per job, firing with its TransferResult on the reactor thread.
+        """
+        if self.call_in_reactor is None:
+            from twisted.internet import reactor
+            self.call_in_reactor = reactor.callFromThread
+
+        deferreds = []
+        for job in jobs:
+            ip_address, host_port, local_files, remote_files = job
+            result = TransferResult(job)
+            deferred = Deferred()
+            deferreds.append(deferred)
+
+            files = self.list_files(local_files, remote_files)
+            if not files:
+                self.sent.append(job)
+                deferred.callback(result)
+                continue
+
+            state = {'result': result, 'deferred': deferred, 'remaining': len(files)}
+            with self._lock:
+                for local_file, remote_file in files:
+                    self._transfers.append(((ip_address, host_port), local_file, remote_file, state))
+
+        self._start_transfers()
+        return deferreds
+
+    def list_files(self, local_files, remote_files):
+        """
+            Lists the files of a job, like Client.upload_folder does for a folder. The manifest of a job is uploaded
+            first, as a transfer of its own that adds the missing files once the server answered.
+            :return: List of (local file, remote file) tuples.
+        """
+        if isinstance(local_files, Manifest) or not os.path.isdir(local_files):
+            return [(local_files, remote_files)]
+
+        files = []
+        for f in self.file_search(local_files + '/*.pdf'):
+            if not remote_files:
+                files.append((f, DEFAULT_HOST_PATH + ntpath.basename(f)))
+            else:
+                files.append((f, remote_files + ntpath.basename(f)))
+        return files
+
+    def _start_transfers(self):
+        """
+            Starts the waiting transfers that fit within the global and per host limits.
+        """
+        with self._lock:
+            waiting = deque()
+            while self._transfers and self._active < self.max_transfers:
+                transfer = self._transfers.popleft()
+                host = transfer[0]
+                if self._active_per_host[host] >= self.max_transfers_per_host:
+                    waiting.append(transfer)
+                    continue
+
+                self._active += 1
+                self._active_per_host[host] += 1
+                thread = Thread(target=self._transfer, args=transfer, name='transfer-%s:%d' % host)
+                thread.daemon = True
+                thread.start()
+            waiting.extend(self._transfers)
+            self._transfers = waiting
+
+    def _transfer(self, host, local_file, remote_file, state):
+        error = None
+        missing = []
+        try:
+            client = self.create_client(*host)
+            if isinstance(local_file, Manifest):
+                missing = client.upload_manifest(local_file, remote_file)
+            else:
+                client.upload(local_file, remote_file)
+            self.client_done(client)
+        except (tftpy.TftpException, EnvironmentError) as e:
+            error = e
+        except Exception as e:
+            # Any error only fails the file, so the transfer is still counted as done and the Deferred fires
+            logger.exception("Upload of %s to %s:%d failed", local_file, host[0], host[1])
+            error = e
+
+        with self._lock:
+            self._active -= 1
+            self._active_per_host[host] -= 1
+
+            result = state['result']
+            if error is None and isinstance(local_file, Manifest):
+                host_path = remote_file or DEFAULT_HOST_PATH
+                result.skipped.extend((local_file.paths[entry.name], host_path + entry.name)
+                                      for entry in local_file.entries
+                                      if (local_file.paths[entry.name], host_path + entry.name) not in missing)
+                for missing_local_file, missing_remote_file in missing:
+                    self._transfers.append((host, missing_local_file, missing_remote_file, state))
+                state['remaining'] += len(missing)
+            elif error is None:
+                result.sent.append((local_file, remote_file))
+            else:
+                result.failed.append((local_file, remote_file, error))
+                self.failed.append(host + (local_file, remote_file))
+            state['remaining'] -= 1
+            finished = not state['remaining']
+            if finished and result.success:
+                self.sent.append(result.job)
+
+        if finished:
+            self.call_in_reactor(state['deferred'].callback, result)
+        self._start_transfers()
@@ -0,0 +1,125 @@
+"""
+Compression of uploads, negotiated per transfer.
+
+A server lists the codecs it can decompress in the have.json it generates, under the `CODECS_KEY`, which no file can
+be named after as the server refuses hidden files. A client that uploaded a manifest only compresses the files it sends
+to that server when both sides know the codec, the file is large enough and a sample of it compresses well, so
+documents that are compressed already (most scans) are sent as they are. A compressed file is sent under its name with
+the codec as extension, and the server decompresses it while receiving it.
+
+Only zlib is used, as lzma isn't part of the standard library of Python 2.
+"""
+import os
+import zlib
+
+# Key of the codecs a server accepts in its have.json.
+CODECS_KEY = '.codecs'
+ZLIB = 'zlib'
+CODECS = [ZLIB]
+# Files smaller than this are always sent as they are.
+MIN_SIZE = 4 * 1024
+# Amount and size of the samples taken from a file to decide if compressing it is worthwhile.
+SAMPLES = 3
+SAMPLE_SIZE = 16 * 1024
+# Files whose samples compress to more than this fraction of their size are sent as they are.
+MAX_RATIO = 0.9
+LEVEL = 6
+# Size of the chunks in which files are read and compressed.
+CHUNK_SIZE = 64 * 1024
+
+
+def sample_ratio(path, samples=SAMPLES, sample_size=SAMPLE_SIZE):
+    """
+        Compresses samples from the start, middle and end of a file, quickly.
+        :return: The size of the compressed samples, as a fraction of their original size.
+    """
+    size = os.path.getsize(path)
+    raw = compressed = 0
+    with open(path, 'rb') as f:
+        for i in xrange(samples):
+            f.seek(max(0, (size - sample_size) * i // max(1, samples - 1)))
+            sample = f.read(sample_size)
+            raw += len(sample)
+            compressed += len(zlib.compress(sample, 1))
+    return float(compressed) / raw if raw else 1.0
+
+
+def choose_codec(path, codecs, min_size=MIN_SIZE, max_ratio=MAX_RATIO):
+    """
+        Decides how to send a file.
+        :param codecs: The codecs the server accepts.
+        :return: The codec to compress the file with, or None to send it as it is.
+    """
+    if ZLIB not in codecs or os.path.getsize(path) < min_size or sample_ratio(path) > max_ratio:
+        return None
+    return ZLIB
+
+
+def compressed_name(remote_file, codec):
+    return remote_file + '.' + codec
+
+
+def split_codec(path):
+    """
+        :return: Tuple of the path without the codec extension, and the codec, None for a file sent as it is.
+    """
+    for codec in CODECS:
+        if path.endswith('.' + codec):
+            return path[:-len(codec) - 1], codec
+    return path, None
+
+
+class CompressingReader(object):
+    """
+        A file-like object reading a file compressed, chunk by chunk, so the file is compressed while it is sent.
+    """
+    def __init__(self, path, level=LEVEL):
+        self._file = open(path, 'rb')
+        self._compressor = zlib.compressobj(level)
+        self._buffer = ''
+        self._finished = False
+        self.raw_bytes = 0
+        self.compressed_bytes = 0
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def read(self, size):
+        while len(self._buffer) < size and not self._finished:
+            chunk = self._file.read(CHUNK_SIZE)
+            if chunk:
+                self.raw_bytes += len(chunk)
+                self._buffer += self._compressor.compress(chunk)
+            else:
+                self._buffer += self._compressor.flush()
+                self._finished = True
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.compressed_bytes += len(data)
+        return data
+
+    def close(self):
+        self._file.close()
+
+
+class Decompressor(object):
+    """
+        Decompresses a file while it is received, never producing more data than allowed.
+    """
+    def __init__(self, codec):
+        assert codec == ZLIB
+        self._decompressor = zlib.decompressobj()
+
+    def decompress(self, data, limit):
+        """
+            :param limit: The maximum amount of bytes the data may decompress to.
+            :return: The decompressed data, or None if it exceeds the limit.
+            :raises zlib.error: If the data is corrupt.
+        """
+        decompressed = self._decompressor.decompress(data, limit + 1)
+        if len(decompressed) > limit or self._decompressor.unconsumed_tail:
+            return None
+        return decompressed
+
+    def flush(self):
+        return self._decompressor.flush()
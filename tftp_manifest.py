@@ -0,0 +1,86 @@
+"""
+Transfer manifests, listing the files uploaded to a folder with their SHA-256 hash and size.
+
+Before uploading the files of a folder, a client uploads the manifest of the folder and downloads `have.json` from
+it, which the server generates on request: the names and hashes of the files already in the folder. Only the files
+the server doesn't have, or has with another hash, are uploaded. A file left behind incomplete by a crash has another
+hash, so an interrupted transfer resumes with the files that didn't fully arrive.
+"""
+import glob
+import hashlib
+import json
+import ntpath
+import os
+from collections import namedtuple
+
+MANIFEST_NAME = 'manifest.json'
+HAVE_NAME = 'have.json'
+# Size of the chunks in which files are hashed.
+CHUNK_SIZE = 64 * 1024
+
+ManifestEntry = namedtuple('ManifestEntry', ['name', 'sha256', 'size'])
+
+
+def file_hash(path):
+    """
+        Hashes a file chunk by chunk.
+        :return: The hex encoded SHA-256 hash of the file.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        chunk = f.read(CHUNK_SIZE)
+        while chunk:
+            digest.update(chunk)
+            chunk = f.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+class Manifest(object):
+    """
+        The files of a transfer. Only the names, hashes and sizes are sent, the local paths stay with the sender.
+    """
+    def __init__(self, entries=None):
+        self.entries = list(entries or [])
+        # File name -> local path
+        self.paths = {}
+
+    def add(self, name, path, sha256=None, size=None):
+        """
+            Adds a file to the manifest.
+            :param name: The name of the file on the server, without any folders.
+            :param path: The local path of the file.
+            :param sha256: The hash of the file if already known, it is computed otherwise.
+            :param size: The size of the file if already known.
+        """
+        name = ntpath.basename(name)
+        if sha256 is None:
+            sha256 = file_hash(path)
+        if size is None:
+            size = os.path.getsize(path)
+        self.entries.append(ManifestEntry(name, sha256, size))
+        self.paths[name] = path
+
+    @staticmethod
+    def from_folder(path, pattern='*.pdf'):
+        """
+            Creates the manifest of the files in a folder.
+        """
+        manifest = Manifest()
+        for f in sorted(glob.glob(os.path.join(path, pattern))):
+            manifest.add(ntpath.basename(f), f)
+        return manifest
+
+    def missing(self, present):
+        """
+            :param present: Dictionary of the names and hashes of the files the server already has.
+            :return: The entries the server doesn't have, or has with another hash.
+        """
+        return [entry for entry in self.entries if present.get(entry.name) != entry.sha256]
+
+    def encode(self):
+        return json.dumps([entry._asdict() for entry in self.entries])
+
+    @staticmethod
+    def decode(data):
+        return Manifest(ManifestEntry(str(entry['name']), str(entry['sha256']), entry['size'])
+                        for entry in json.loads(data))
@@ -1,21 +1,408 @@
 import tftpy
+import hashlib
+import json
+import ntpath
 import os
+import tempfile
 import threading
 import time
 import logging
+import zlib
+from collections import defaultdict, namedtuple
+from StringIO import StringIO
+
+from tftp_compression import CODECS, CODECS_KEY, Decompressor, split_codec
+from tftp_manifest import HAVE_NAME, MANIFEST_NAME, Manifest, file_hash
 
 DEFAULT_PORT = 50000
 DEFAULT_ROOT = os.getcwd()+'/resources/received/'
+# Maximum amount of uploads received at the same time.
+DEFAULT_MAX_SESSIONS = 16
+# Maximum amount of bytes stored from a single sender, and in a single loan request folder.
+DEFAULT_SENDER_QUOTA = 256 * 1024 * 1024
+DEFAULT_FOLDER_QUOTA = 64 * 1024 * 1024
+# Prefix of the temporary files uploads are written to until they complete.
+PARTIAL_PREFIX = '.partial-'
+
+logger = logging.getLogger(__name__)
+
+# A completely received file. The folder is the loan request folder the file was uploaded to.
+ReceivedFile = namedtuple('ReceivedFile', ['sender', 'folder', 'name', 'path', 'sha256', 'size'])
+
+
+class ReceivingFile(object):
+    """
+        The file an upload is written to. The data goes to a hidden temporary file next to the final path, hashed on
+        the way, which only replaces the final path once the upload completes. Compressed uploads are decompressed
+        on the way, so the hash and size are those of the original file.
+    """
+    def __init__(self, path, sender, folder, codec=None):
+        self.path = path
+        self.sender = sender
+        self.folder = folder
+        self.codec = codec
+        self.size = 0
+        # Bytes accounted to the quotas
+        self.reserved = 0
+        self.digest = hashlib.sha256()
+        self._decompressor = Decompressor(codec) if codec else None
+        # The decoded block tftpy is about to write
+        self._pending = None
+        descriptor, self.temporary_path = tempfile.mkstemp(prefix=PARTIAL_PREFIX, dir=os.path.dirname(path))
+        self._file = os.fdopen(descriptor, 'wb')
+
+    @property
+    def closed(self):
+        return self._file.closed
+
+    def decode(self, data, limit):
+        """
+            Decodes the next block before tftpy acknowledges and writes it.
+            :param limit: The maximum amount of bytes the block may decode to.
+            :return: The size of the decoded block, or None if it exceeds the limit.
+            :raises zlib.error: If the block is corrupt.
+        """
+        self._pending = self._decompressor.decompress(data, limit) if self._decompressor else data
+        if self._pending is None or len(self._pending) > limit:
+            self._pending = None
+            return None
+        return len(self._pending)
+
+    def write(self, data):
+        if self._pending is not None:
+            data, self._pending = self._pending, None
+        self._write(data)
+
+    def _write(self, data):
+        self.digest.update(data)
+        self._file.write(data)
+        self.size += len(data)
+
+    def close(self):
+        """
+            Closes the temporary file, making sure the data is on disk. Called by tftpy when the session ends.
+        """
+        if not self._file.closed:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+
+    def finalize(self):
+        """
+            Writes what the decompressor still holds and closes the temporary file.
+            :return: The hex encoded SHA-256 hash of the received data.
+        """
+        if self._decompressor and not self._file.closed:
+            self._write(self._decompressor.flush())
+        self.close()
+        return self.digest.hexdigest()
+
+    def complete(self):
+        """
+            Moves the received data to the final path.
+            :return: The `ReceivedFile`.
+        """
+        self.finalize()
+        os.rename(self.temporary_path, self.path)
+        return ReceivedFile(self.sender, self.folder, ntpath.basename(self.path), self.path, self.digest.hexdigest(),
+                            self.size)
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.temporary_path):
+            os.remove(self.temporary_path)
+
+
+class ReceivePipeline(object):
+    """
+        Keeps track of the uploads to a server: bounds the amount of uploads received at the same time, enforces the
+        byte quotas per sender and per loan request folder, and notifies the subscribers of every completed file.
+    """
+    def __init__(self, root_folder, max_sessions=DEFAULT_MAX_SESSIONS, sender_quota=DEFAULT_SENDER_QUOTA,
+                 folder_quota=DEFAULT_FOLDER_QUOTA):
+        self.root_folder = os.path.abspath(root_folder)
+        self.max_sessions = max_sessions
+        self.sender_quota = sender_quota
+        self.folder_quota = folder_quota
+        self._lock = threading.RLock()
+        # Session context -> ReceivingFile of the uploads in progress
+        self.receiving = {}
+        # Sender -> bytes stored and being received from the sender since the server started
+        self.sender_usage = defaultdict(int)
+        # Folder -> bytes stored and being received in the folder, counted from disk when the folder is first used
+        self.folder_usage = {}
+        # Path -> sender of the files received since the server started
+        self.owners = {}
+        self.subscribers = []
+
+    @property
+    def busy(self):
+        return len(self.receiving) >= self.max_sessions
+
+    def subscribe(self, callback):
+        """
+            Calls the callback with the `ReceivedFile` of every completed upload, on the thread of the server.
+        """
+        with self._lock:
+            self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self.subscribers:
+                self.subscribers.remove(callback)
+
+    def folder_of(self, path):
+        """
+            :return: The loan request folder of a path below the root folder, '' for files directly in the root.
+        """
+        parts = os.path.relpath(path, self.root_folder).split(os.sep)
+        return parts[0] if len(parts) > 1 else ''
+
+    def _folder_usage(self, folder):
+        if folder not in self.folder_usage:
+            path = os.path.join(self.root_folder, folder)
+            usage = 0
+            if os.path.isdir(path):
+                for name in os.listdir(path):
+                    if not name.startswith('.') and os.path.isfile(os.path.join(path, name)):
+                        usage += os.path.getsize(os.path.join(path, name))
+            self.folder_usage[folder] = usage
+        return self.folder_usage[folder]
+
+    def open(self, context, path, sender, codec=None):
+        """
+            Starts receiving an upload.
+            :param codec: The codec the upload is compressed with, if any.
+            :return: The `ReceivingFile` to write the upload to.
+        """
+        with self._lock:
+            receiving = self.receiving[context] = ReceivingFile(path, sender, self.folder_of(path), codec)
+            return receiving
+
+    def available(self, receiving):
+        """
+            :return: The amount of bytes an upload may still store within the quotas of its sender and folder.
+        """
+        with self._lock:
+            return max(0, min(self.sender_quota - self.sender_usage[receiving.sender],
+                              self.folder_quota - self._folder_usage(receiving.folder)))
+
+    def reserve(self, receiving, size):
+        """
+            Accounts the next block of an upload to the quotas of its sender and folder.
+            :return: True if the block fits within both quotas, False otherwise.
+        """
+        with self._lock:
+            if self.sender_usage[receiving.sender] + size > self.sender_quota or \
+                    self._folder_usage(receiving.folder) + size > self.folder_quota:
+                return False
+            self.sender_usage[receiving.sender] += size
+            self.folder_usage[receiving.folder] += size
+            receiving.reserved += size
+            return True
+
+    def expected_hash(self, path):
+        """
+            :return: The hash the manifest uploaded to the folder of a path lists for the file, or None if the folder
+            has no manifest or the manifest doesn't list the file.
+        """
+        name = ntpath.basename(path)
+        manifest_path = os.path.join(os.path.dirname(path), MANIFEST_NAME)
+        if name == MANIFEST_NAME or not os.path.isfile(manifest_path):
+            return None
+        try:
+            with open(manifest_path, 'rb') as f:
+                entries = Manifest.decode(f.read()).entries
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Ignoring malformed manifest %s", manifest_path)
+            return None
+        for entry in entries:
+            if entry.name == name:
+                return entry.sha256
+        return None
+
+    def _drop(self, receiving):
+        receiving.discard()
+        self.sender_usage[receiving.sender] -= receiving.reserved
+        self.folder_usage[receiving.folder] -= receiving.reserved
+
+    def finish(self, context, success):
+        """
+            Ends an upload, moving the file into place and notifying the subscribers if the upload succeeded, or
+            dropping it and releasing its bytes from the quotas if it didn't. An upload whose hash differs from the
+            one in the manifest of its folder is dropped as well.
+        """
+        with self._lock:
+            receiving = self.receiving.pop(context, None)
+            if receiving is None:
+                return
+
+            if not success:
+                self._drop(receiving)
+                logger.warning("Dropped incomplete upload of %s from %s", receiving.path, receiving.sender)
+                return
+
+            expected = self.expected_hash(receiving.path)
+            sha256 = receiving.finalize()
+            if expected is not None and sha256 != expected:
+                self._drop(receiving)
+                logger.warning("Dropped upload of %s from %s, its hash %s doesn't match the manifest hash %s",
+                               receiving.path, receiving.sender, sha256, expected)
+                return
+
+            if os.path.isfile(receiving.path):
+                # The replaced file no longer counts
+                size = os.path.getsize(receiving.path)
+                self.folder_usage[receiving.folder] -= size
+                if receiving.path in self.owners:
+                    self.sender_usage[self.owners[receiving.path]] -= size
+            received = receiving.complete()
+            self.owners[received.path] = received.sender
+            subscribers = list(self.subscribers)
+
+        for callback in subscribers:
+            try:
+                callback(received)
+            except Exception:
+                logger.exception("Subscriber failed on %s", received.path)
+
+    def remove_partial_files(self):
+        """
+            Removes the temporary files of the uploads that were in progress when a previous server stopped.
+        """
+        for folder, _, names in os.walk(self.root_folder):
+            for name in names:
+                if name.startswith(PARTIAL_PREFIX):
+                    os.remove(os.path.join(folder, name))
+
+
+class ReceiveSessions(dict):
+    """
+        The session table of the tftpy server. Starts every new session in `ReceiveStart`, so uploads go through the
+        pipeline, and tells the pipeline how each session ended.
+    """
+    def __init__(self, pipeline):
+        super(ReceiveSessions, self).__init__()
+        self.pipeline = pipeline
+
+    def __setitem__(self, key, context):
+        context.state = ReceiveStart(context, self.pipeline)
+        super(ReceiveSessions, self).__setitem__(key, context)
+
+    def __delitem__(self, key):
+        context = self[key]
+        super(ReceiveSessions, self).__delitem__(key)
+        # A session that ran to completion has no state left
+        self.pipeline.finish(context, context.state is None)
+
+
+class ReceiveStart(tftpy.TftpStateServerStart):
+    """
+        The start state of a session, handling uploads with `ReceiveWRQ`.
+    """
+    def __init__(self, context, pipeline):
+        tftpy.TftpStateServerStart.__init__(self, context)
+        self.pipeline = pipeline
+
+    def handle(self, pkt, raddress, rport):
+        if isinstance(pkt, tftpy.TftpPacketWRQ):
+            return ReceiveWRQ(self.context, self.pipeline).handle(pkt, raddress, rport)
+        return tftpy.TftpStateServerStart.handle(self, pkt, raddress, rport)
+
+
+class ReceiveWRQ(tftpy.TftpStateServerRecvWRQ):
+    """
+        Starts an upload into a `ReceivingFile` of the pipeline, instead of overwriting the final path right away. An
+        upload named with a codec extension is compressed, and stored without the extension.
+    """
+    def __init__(self, context, pipeline):
+        tftpy.TftpStateServerRecvWRQ.__init__(self, context)
+        self.pipeline = pipeline
+
+    def handle(self, pkt, raddress, rport):
+        sendoack = self.serverInitial(pkt, raddress, rport)
+        if ntpath.basename(self.full_path).startswith('.'):
+            self.sendError(tftpy.TftpErrors.AccessViolation)
+            raise tftpy.TftpException("Refusing to receive hidden file %s" % self.full_path)
+        if self.pipeline.busy:
+            self.sendError(tftpy.TftpErrors.NotDefined)
+            raise tftpy.TftpException("Too many uploads in progress, refusing %s" % self.full_path)
+
+        self.make_subdirs()
+        path, codec = split_codec(self.full_path)
+        self.context.fileobj = self.pipeline.open(self.context, path, raddress, codec)
+
+        if sendoack:
+            self.sendOACK()
+        else:
+            self.sendACK()
+        self.context.next_block = 1
+        return ReceiveDAT(self.context, self.pipeline)
+
+
+class ReceiveDAT(tftpy.TftpStateExpectDAT):
+    """
+        Receives the blocks of an upload, refusing the upload once it exceeds a quota, before acknowledging the block.
+    """
+    def __init__(self, context, pipeline):
+        tftpy.TftpStateExpectDAT.__init__(self, context)
+        self.pipeline = pipeline
+
+    def handleDat(self, pkt):
+        if pkt.blocknumber == self.context.next_block:
+            receiving = self.context.fileobj
+            try:
+                size = receiving.decode(pkt.data, self.pipeline.available(receiving))
+            except zlib.error:
+                self.sendError(tftpy.TftpErrors.IllegalTftpOp)
+                raise tftpy.TftpException("Corrupt compressed upload of %s" % receiving.path)
+            if size is None or not self.pipeline.reserve(receiving, size):
+                self.sendError(tftpy.TftpErrors.DiskFull)
+                raise tftpy.TftpException("Quota exceeded by %s" % receiving.path)
+        state = tftpy.TftpStateExpectDAT.handleDat(self, pkt)
+        return self if isinstance(state, tftpy.TftpStateExpectDAT) else state
 
 
 class Server:
     """
         Create a Server object that uses the tftpy module to host a TFTP server
     """
-    def __init__(self, root_folder=DEFAULT_ROOT, port=DEFAULT_PORT):
-        self.server = tftpy.TftpServer(root_folder)
+    def __init__(self, root_folder=DEFAULT_ROOT, port=DEFAULT_PORT, max_sessions=DEFAULT_MAX_SESSIONS,
+                 sender_quota=DEFAULT_SENDER_QUOTA, folder_quota=DEFAULT_FOLDER_QUOTA):
+        """
+            :param max_sessions: Maximum amount of uploads received at the same time.
+            :param sender_quota: Maximum amount of bytes stored from a single sender.
+            :param folder_quota: Maximum amount of bytes stored in a single loan request folder.
+        """
+        self.server = tftpy.TftpServer(root_folder, self.dynamic_file)
+        self.root_folder = os.path.abspath(root_folder)
         self.port = port
         self.thread = threading.Thread(target=self.server_listen)
+        # Path -> (size, modification time, hash) of the files hashed for a have.json
+        self.hashes = {}
+
+        # Uploads are written to temporary files and moved into place once complete
+        self.pipeline = ReceivePipeline(self.root_folder, max_sessions, sender_quota, folder_quota)
+        self.pipeline.remove_partial_files()
+        self.pipeline.subscribe(self.remember_hash)
+        self.server.sessions = ReceiveSessions(self.pipeline)
+
+    def subscribe(self, callback):
+        """
+            Calls the callback with the `ReceivedFile` of every completed upload. The callback runs on the thread of
+            the server.
+        """
+        self.pipeline.subscribe(callback)
+
+    def unsubscribe(self, callback):
+        self.pipeline.unsubscribe(callback)
+
+    def remember_hash(self, received):
+        """
+            Keeps the hash computed while receiving a file, so a have.json doesn't hash the file again.
+        """
+        stat = os.stat(received.path)
+        self.hashes[received.path] = (stat.st_size, stat.st_mtime, received.sha256)
 
     def stop(self, now=False):
         """
@@ -42,6 +429,45 @@ class Server:
         """
         self.server.listen(listenport=self.port)
 
+    def dynamic_file(self, file_name):
+        """
+            Generates the files that don't exist on disk, being the have.json of a folder, which also lists the codecs
+            the server accepts.
+            :param file_name: The requested file name, relative to the root folder.
+            :return: A file-like object, or None if the file doesn't exist.
+        """
+        if ntpath.basename(file_name) != HAVE_NAME:
+            return None
+
+        if file_name.startswith(self.root_folder):
+            folder = os.path.dirname(file_name)
+        else:
+            folder = os.path.join(self.root_folder, os.path.dirname(file_name.lstrip('/')))
+        folder = os.path.abspath(folder)
+        if not folder.startswith(self.root_folder):
+            return StringIO(json.dumps({}))
+        have = self.folder_hashes(folder) if os.path.isdir(folder) else {}
+        have[CODECS_KEY] = CODECS
+        return StringIO(json.dumps(have))
+
+    def folder_hashes(self, folder):
+        """
+            Hashes the files received in a folder. A file is only hashed again if its size or modification time
+            changed since it was last hashed.
+            :return: Dictionary of the names and hashes of the files.
+        """
+        hashes = {}
+        for name in os.listdir(folder):
+            path = os.path.join(folder, name)
+            if name == MANIFEST_NAME or name.startswith('.') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            cached = self.hashes.get(path)
+            if not cached or cached[:2] != (stat.st_size, stat.st_mtime):
+                cached = self.hashes[path] = (stat.st_size, stat.st_mtime, file_hash(path))
+            hashes[name] = cached[2]
+        return hashes
+
     def is_running(self):
         """
             Checks if the server is currently active.
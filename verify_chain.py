@@ -0,0 +1,33 @@
+import argparse
+import os
+import sys
+
+from market.database.backends import PersistentBackend
+from market.database.verifier import ChainVerifier
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Verify the block chain of a market node.")
+
+    parser.add_argument("--working-directory", help="Directory holding the database", type=str, default=os.getcwd())
+    parser.add_argument("--database", help="Name of the database file", type=str, default=PersistentBackend.DATABASE_PATH)
+    parser.add_argument("--checkpoint", help="Checkpoint file, only blocks added since the last run are verified",
+                        type=str)
+    parser.add_argument("--processes", help="Amount of worker processes, defaults to the amount of CPUs", type=int)
+
+    args = parser.parse_args()
+
+    if not os.path.exists(os.path.join(args.working_directory, args.database)):
+        raise SystemExit("No database found at %s" % os.path.join(args.working_directory, args.database))
+
+    backend = PersistentBackend(args.working_directory, unicode(args.database))
+    try:
+        report = ChainVerifier(backend, args.checkpoint, args.processes).run()
+    finally:
+        backend.close()
+
+    for position, problem in report.errors:
+        print "Block %d: %s" % (position, problem)
+    print "Verified %d blocks after position %d, %d problems found." % (report.blocks_verified,
+                                                                        report.start_position, len(report.errors))
+
+    sys.exit(0 if report.valid else 1)